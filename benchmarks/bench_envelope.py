@@ -0,0 +1,85 @@
+"""
+Compares the two ways ``WSGIProxyApp`` forwards environ keys: a header
+for each key (protocol version 0.1) and a single
+``X-WSGIProxy-Envelope`` (version 0.2, :mod:`wsgiproxy.envelope`).
+For a few sets of keys it reports the bytes of header added to each
+request, and the CPU time to encode (``encode_environ``) and decode
+(``WSGIProxyMiddleware._fixup_environ``) them.
+
+Run with::
+
+    python benchmarks/bench_envelope.py [iterations]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wsgiproxy.app import WSGIProxyApp
+from wsgiproxy.middleware import WSGIProxyMiddleware
+from bench_headers import environ as base_environ
+
+
+def make_case(count):
+    """
+    An environ with `count` keys of each type to forward, and the app
+    that forwards them.
+    """
+    environ = base_environ.copy()
+    keys = {'string_keys': [], 'unicode_keys': [], 'json_keys': []}
+    for i in range(count):
+        environ['myapp.user%s' % i] = 'user-%s@example.com' % i
+        environ['myapp.name%s' % i] = u'J\xf6rg Schr\xf6der %s' % i
+        environ['myapp.session%s' % i] = {
+            'id': '0123456789abcdef%s' % i, 'roles': ['admin', 'staff'],
+            'expires': 1514764800 + i}
+        keys['string_keys'].append('myapp.user%s' % i)
+        keys['unicode_keys'].append('myapp.name%s' % i)
+        keys['json_keys'].append('myapp.session%s' % i)
+    app = WSGIProxyApp('http://localhost:8080', **keys)
+    return app, environ
+
+def header_bytes(environ):
+    size = 0
+    for key, value in environ.items():
+        if key.startswith('HTTP_X_WSGIPROXY'):
+            # Name: value\r\n
+            size += len(key) - 5 + 2 + len(value) + 2
+    return size
+
+def proxied_environ(encoded):
+    """
+    What the backend sees: only the CGI variables and headers.
+    """
+    return dict([(key, value) for key, value in encoded.items()
+                 if '.' not in key or key == 'wsgi.url_scheme'])
+
+def main(iterations=20000):
+    middleware = WSGIProxyMiddleware(None)
+    start_response = lambda *args: None
+    print '%-5s %-9s %8s %12s %12s' % (
+        'keys', 'protocol', 'bytes', 'encode (us)', 'decode (us)')
+    for count in 1, 5, 20:
+        app, environ = make_case(count)
+        for envelope in False, True:
+            encoded = app.encode_environ(environ, envelope=envelope)
+            received = proxied_environ(encoded)
+            encode_time = min(timeit.repeat(
+                lambda: app.encode_environ(environ, envelope=envelope),
+                number=iterations, repeat=5))
+            decode_time = min(timeit.repeat(
+                lambda: middleware._fixup_environ(received.copy(),
+                                                  start_response),
+                number=iterations, repeat=5))
+            print '%-5s %-9s %8s %12.2f %12.2f' % (
+                count * 3, envelope and '0.2' or '0.1',
+                header_bytes(encoded), encode_time / iterations * 1e6,
+                decode_time / iterations * 1e6)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
@@ -0,0 +1,154 @@
+"""
+Measures the per-request CPU cost of translating headers: building
+the upstream request headers from the environ
+(``exactproxy.request_headers``), parsing the response headers
+(``exactproxy.parse_headers``) and encoding the environ in
+``WSGIProxyApp.encode_environ``.  Each is compared with the
+implementation it replaced (kept below as ``old_*``).
+
+Run with::
+
+    python benchmarks/bench_headers.py [iterations]
+"""
+
+import mimetools
+import os
+import sys
+import timeit
+import urllib
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wsgiproxy import exactproxy
+from wsgiproxy.app import WSGIProxyApp
+
+
+def old_request_headers(environ):
+    headers = {}
+    for key, value in environ.items():
+        if key.startswith('HTTP_'):
+            key = key[5:].replace('_', '-').title()
+            if key.lower() not in exactproxy.hop_by_hop_headers:
+                headers[key] = value
+    if environ.get('CONTENT_TYPE'):
+        headers['Content-Type'] = environ['CONTENT_TYPE']
+    return headers
+
+def old_parse_headers(message):
+    headers_out = []
+    for full_header in message.headers:
+        if not full_header:
+            continue
+        if full_header[0].isspace():
+            last_header, last_value = headers_out.pop()
+            value = last_value + ', ' + full_header.strip()
+            headers_out.append((last_header, value))
+            continue
+        header, value = full_header.split(':', 1)
+        value = value.strip()
+        if header.lower() not in exactproxy.filtered_headers:
+            headers_out.append((header, value))
+    return headers_out
+
+def old_encode_environ(self, environ):
+    for name in ['QUERY_STRING', 'SCRIPT_NAME', 'PATH_INFO']:
+        if name not in environ:
+            environ[name] = ''
+    orig_environ = environ
+    environ = environ.copy()
+    environ['wsgiproxy.orig_environ'] = orig_environ
+    for key in environ.keys():
+        if key.startswith('HTTP_X_WSGIPROXY'):
+            del environ[key]
+    for key, dest in self.header_map.items():
+        environ['HTTP_%s' % dest] = environ[key]
+    for prefix, keys, encoder in [
+        ('STR', self.string_keys, self.str_encode),
+        ('UNICODE', self.unicode_keys, self.unicode_encode),
+        ('JSON', self.json_keys, self.json_encode),
+        ('PICKLE', self.pickle_keys, self.pickle_encode)]:
+        for count, key in enumerate(keys):
+            if key not in environ:
+                continue
+            new_key = 'HTTP_X_WSGIPROXY_%s_%s' % (prefix, count)
+            environ[new_key] = '%s %s' % (
+                urllib.quote(key), encoder(environ[key]))
+    environ['HTTP_X_WSGIPROXY_VERSION'] = '0.1'
+    return environ
+
+
+# A typical browser request, as a WSGI server would give it:
+environ = {
+    'REQUEST_METHOD': 'GET',
+    'SCRIPT_NAME': '',
+    'PATH_INFO': '/some/page',
+    'QUERY_STRING': 'a=1&b=2',
+    'SERVER_NAME': 'example.com',
+    'SERVER_PORT': '80',
+    'SERVER_PROTOCOL': 'HTTP/1.1',
+    'REMOTE_ADDR': '10.0.0.1',
+    'CONTENT_TYPE': '',
+    'CONTENT_LENGTH': '',
+    'wsgi.url_scheme': 'http',
+    'wsgi.version': (1, 0),
+    'wsgi.multithread': True,
+    'wsgi.multiprocess': False,
+    'wsgi.run_once': False,
+    'HTTP_HOST': 'example.com',
+    'HTTP_USER_AGENT': 'Mozilla/5.0 (X11; Linux x86_64) Gecko/20100101',
+    'HTTP_ACCEPT': 'text/html,application/xhtml+xml;q=0.9,*/*;q=0.8',
+    'HTTP_ACCEPT_LANGUAGE': 'en-US,en;q=0.5',
+    'HTTP_ACCEPT_ENCODING': 'gzip, deflate',
+    'HTTP_COOKIE': 'session=0123456789abcdef; theme=dark',
+    'HTTP_CONNECTION': 'keep-alive',
+    'HTTP_CACHE_CONTROL': 'max-age=0',
+    'HTTP_REFERER': 'http://example.com/',
+    'HTTP_X_REQUESTED_WITH': 'XMLHttpRequest',
+    'HTTP_DNT': '1',
+    }
+
+response_headers = '\r\n'.join([
+    'Date: Mon, 01 Jan 2018 00:00:00 GMT',
+    'Server: Apache',
+    'Content-Type: text/html; charset=utf-8',
+    'Content-Length: 12345',
+    'Cache-Control: private, max-age=0',
+    'Set-Cookie: session=0123456789abcdef; Path=/; HttpOnly',
+    'Set-Cookie: theme=dark; Path=/',
+    'Vary: Accept-Encoding',
+    'Connection: keep-alive',
+    'Keep-Alive: timeout=5',
+    'X-Frame-Options: SAMEORIGIN',
+    '', ''])
+message = mimetools.Message(StringIO(response_headers))
+
+app = WSGIProxyApp('http://localhost:8080', string_keys=['SERVER_PROTOCOL'])
+
+cases = [
+    ('request_headers',
+     lambda: old_request_headers(environ),
+     lambda: exactproxy.request_headers(environ)),
+    ('parse_headers',
+     lambda: old_parse_headers(message),
+     lambda: exactproxy.parse_headers(message)),
+    ('encode_environ',
+     lambda: old_encode_environ(app, environ),
+     lambda: app.encode_environ(environ)),
+    ]
+
+def main(iterations=100000):
+    print '%-16s %12s %12s %8s' % ('', 'before (us)', 'after (us)', 'speedup')
+    for name, before, after in cases:
+        assert before() == after() or name == 'encode_environ'
+        before_time = min(timeit.repeat(before, number=iterations, repeat=3))
+        after_time = min(timeit.repeat(after, number=iterations, repeat=3))
+        print '%-16s %12.2f %12.2f %7.2fx' % (
+            name, before_time / iterations * 1e6,
+            after_time / iterations * 1e6, before_time / after_time)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
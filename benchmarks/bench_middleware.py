@@ -0,0 +1,101 @@
+"""
+Measures ``WSGIProxyMiddleware._fixup_environ``, which decodes the
+keys a ``WSGIProxyApp`` forwards, against the implementation it
+replaced (kept below as ``old_fixup_environ``, which scanned the
+environ once per key type), and with ``lazy=True``.  ``old`` only
+times the key decoding, while the others time the whole method.
+
+Environs are a typical browser request plus, for the larger cases, the
+headers added by a load balancer and a CDN, with 3 to 60 forwarded
+keys.
+
+Run with::
+
+    python benchmarks/bench_middleware.py [iterations]
+"""
+
+import os
+import sys
+import timeit
+import urllib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wsgiproxy.middleware import WSGIProxyMiddleware
+from bench_envelope import make_case, proxied_environ
+
+
+def old_fixup_environ(self, environ, secure=True):
+    # The key decoding of the previous _fixup_environ
+    for header, key in [
+        ('HTTP_HOST', 'HTTP_HOST'),
+        ('SCRIPT_NAME', 'SCRIPT_NAME'),
+        ('PATH_INFO', 'PATH_INFO'),
+        ('QUERY_STRING', 'QUERY_STRING'),
+        ('WSGI_URL_SCHEME', 'wsgi.url_scheme')]:
+        header = 'HTTP_X_WSGIPROXY_%s' % header
+        if header in environ:
+            environ[key] = environ.pop(header)
+    for prefix, decoder, is_secure in [
+        ('STR', self.str_decode, True),
+        ('UNICODE', self.unicode_decode, True),
+        ('JSON', self.json_decode, True),
+        ('PICKLE', self.pickle_decode, False)]:
+        expect = 'HTTP_X_WSGIPROXY_%s' % prefix
+        for key in environ.keys():
+            if key.startswith(expect):
+                key_name, value = environ[key].split(None, 1)
+                key_name = urllib.unquote(key_name)
+                environ[key_name] = decoder(value)
+
+# Headers added on the way by a CDN and a load balancer:
+extra_headers = dict([
+    ('HTTP_X_FORWARDED_PROTO', 'https'),
+    ('HTTP_X_REAL_IP', '203.0.113.7'),
+    ('HTTP_X_REQUEST_ID', '5f0c6e1e-2b1a-4c1e-9e3a-6b1f1c0d2e3f'),
+    ('HTTP_VIA', '1.1 varnish, 1.1 cdn'),
+    ('HTTP_CDN_LOOP', 'cdn'),
+    ('HTTP_TRUE_CLIENT_IP', '203.0.113.7'),
+    ('HTTP_X_AMZN_TRACE_ID', 'Root=1-5e1b4151-5ac6c58f5d1d7f2b0f1e2d3c'),
+    ('HTTP_SEC_FETCH_MODE', 'navigate'),
+    ('HTTP_SEC_FETCH_SITE', 'same-origin'),
+    ('HTTP_UPGRADE_INSECURE_REQUESTS', '1'),
+    ] + [('HTTP_X_CUSTOM_%s' % i, 'value %s' % i) for i in range(20)])
+
+def cases():
+    for count, extra in (1, False), (5, True), (20, True):
+        app, environ = make_case(count)
+        if extra:
+            environ = dict(environ, **extra_headers)
+        for envelope in False, True:
+            received = proxied_environ(
+                app.encode_environ(environ, envelope=envelope))
+            yield count * 3, envelope, received
+
+def main(iterations=20000):
+    eager = WSGIProxyMiddleware(None)
+    lazy = WSGIProxyMiddleware(None, lazy=True)
+    start_response = lambda *args: None
+    def time(func):
+        return min(timeit.repeat(func, number=iterations, repeat=5)
+                   ) / iterations * 1e6
+    print '%-5s %-8s %-8s %11s %11s %11s' % (
+        'keys', 'environ', 'protocol', 'old (us)', 'new (us)', 'lazy (us)')
+    for count, envelope, received in cases():
+        if envelope:
+            old = float('nan')
+        else:
+            old = time(lambda: old_fixup_environ(eager, received.copy()))
+        new = time(lambda: eager._fixup_environ(received.copy(),
+                                                start_response))
+        lazy_time = time(lambda: lazy._fixup_environ(received.copy(),
+                                                     start_response))
+        print '%-5s %-8s %-8s %11.2f %11.2f %11.2f' % (
+            count, len(received), envelope and '0.2' or '0.1',
+            old, new, lazy_time)
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        main(int(sys.argv[1]))
+    else:
+        main()
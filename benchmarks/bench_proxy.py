@@ -0,0 +1,449 @@
+"""
+Measures the whole proxy path: ``WSGIProxyApp`` (with
+``proxy_exact_request``, ``encode_environ`` and, for signed requests,
+``Signer.sign``) sending requests to a local upstream server, which
+runs a payload application behind ``WSGIProxyMiddleware``
+(``_fixup_environ`` and the signature check).
+
+For each combination of response size, concurrency (threads calling
+the proxy at once), keep-alive on or off, and signed or unsigned
+requests, it reports the requests per second, the 50th and 99th
+percentile latency (until the whole body has been read) and the
+resident memory of the proxy's process.  ``--output`` writes the
+results as JSON, and ``--compare`` compares two such files, marking
+the cases that got slower by more than ``--threshold`` percent (and
+exiting with status 1 if there are any).
+
+The upstream runs in a subprocess by default, so it doesn't compete
+with the proxy for the GIL; ``--upstream thread`` runs it in this
+process instead.  Bodies are generated and read in pieces, so sizes up
+to gigabytes can be used (the number of requests for a case is
+limited to ``--max-bytes`` in all).
+
+Run with::
+
+    python benchmarks/bench_proxy.py [--sizes 1k,64k,1m,1g]
+        [--concurrency 1,8,32] [--requests 1000] [--output new.json]
+    python benchmarks/bench_proxy.py --compare old.json new.json
+"""
+
+import BaseHTTPServer
+import SocketServer
+import itertools
+import json
+import optparse
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib
+from cStringIO import StringIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from wsgiproxy.app import WSGIProxyApp
+from wsgiproxy.middleware import WSGIProxyMiddleware
+from wsgiproxy.pool import ConnectionPool
+
+default_sizes = '1k,64k,1m'
+default_concurrency = '1,8'
+
+# The block the upstream sends bodies in:
+block = 'x' * 65536
+
+def payload_app(environ, start_response):
+    """
+    Responds with ``?size=N`` bytes.
+    """
+    size = int(environ['QUERY_STRING'].split('size=', 1)[1])
+    start_response('200 OK', [('Content-Type', 'application/octet-stream'),
+                              ('Content-Length', str(size))])
+    return blocks(size)
+
+def blocks(size):
+    while size > len(block):
+        yield block
+        size -= len(block)
+    yield block[:size]
+
+def upstream_app(secret_file):
+    """
+    The payload app behind the middleware: unsigned under ``/plain``,
+    signed (with `secret_file`) under ``/signed``.
+    """
+    plain = WSGIProxyMiddleware(payload_app)
+    signed = WSGIProxyMiddleware(payload_app, secret_file=secret_file)
+    def dispatch(environ, start_response):
+        if environ['PATH_INFO'].startswith('/signed'):
+            return signed(environ, start_response)
+        return plain(environ, start_response)
+    return dispatch
+
+
+class UpstreamHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """
+    A minimal HTTP/1.1 (keep-alive) WSGI server for the upstream.
+    """
+
+    protocol_version = 'HTTP/1.1'
+    # Write the status and headers together (small separate writes
+    # meet Nagle's algorithm and delayed ACKs, adding ~40ms per
+    # keep-alive request):
+    wbufsize = -1
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        path, sep, query = self.path.partition('?')
+        host, port = self.server.server_address[:2]
+        environ = {
+            'REQUEST_METHOD': self.command,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_NAME': host,
+            'SERVER_PORT': str(port),
+            'SERVER_PROTOCOL': self.request_version,
+            'REMOTE_ADDR': self.client_address[0],
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.input': self.rfile,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            }
+        for name, value in self.headers.items():
+            key = name.upper().replace('-', '_')
+            if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[key] = value
+            else:
+                environ['HTTP_' + key] = value
+        response = []
+        def start_response(status, headers, exc_info=None):
+            response[:] = [status, headers]
+        app_iter = self.server.app(environ, start_response)
+        try:
+            status, headers = response
+            code, reason = status.split(' ', 1)
+            self.send_response(int(code), reason)
+            if not [name for name, value in headers
+                    if name.lower() == 'content-length']:
+                headers = headers + [('Connection', 'close')]
+                self.close_connection = 1
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            for chunk in app_iter:
+                self.wfile.write(chunk)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+
+class UpstreamServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, app):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), UpstreamHandler)
+        self.app = app
+
+def serve(secret_file):
+    # Run (with --serve) as the upstream subprocess
+    server = UpstreamServer(upstream_app(secret_file))
+    sys.stdout.write('%s\n' % server.server_address[1])
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+class ClosingPool(ConnectionPool):
+    """
+    A pool that never keeps connections (keep-alive off).
+    """
+
+    def put(self, key, conn):
+        conn.close()
+
+def proxy_environ(path, size):
+    return {
+        'REQUEST_METHOD': 'GET',
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path,
+        'QUERY_STRING': 'size=%s' % size,
+        'SERVER_NAME': 'localhost',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'HTTP_HOST': 'localhost',
+        'HTTP_USER_AGENT': 'bench_proxy',
+        'HTTP_ACCEPT': '*/*',
+        'REMOTE_ADDR': '127.0.0.1',
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': StringIO(''),
+        'bench.user': 'user@example.com',
+        }
+
+def run_case(port, secret_file, size, concurrency, keep_alive, signed,
+             requests):
+    if keep_alive:
+        pool = ConnectionPool(max_idle=concurrency)
+    else:
+        pool = ClosingPool()
+    app = WSGIProxyApp('http://127.0.0.1:%s' % port, connection_pool=pool,
+                       string_keys=['bench.user'],
+                       secret_file=signed and secret_file or None)
+    path = signed and '/signed' or '/plain'
+    latencies = []
+    errors = []
+    counter = itertools.count()
+    def start_response(status, headers, exc_info=None):
+        if not status.startswith('200'):
+            errors.append(status)
+    def worker():
+        while counter.next() < requests:
+            environ = proxy_environ(path, size)
+            start = time.time()
+            app_iter = app(environ, start_response)
+            try:
+                received = 0
+                for chunk in app_iter:
+                    received += len(chunk)
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+            latencies.append(time.time() - start)
+            if received != size:
+                errors.append('%s bytes' % received)
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    pool.close()
+    latencies.sort()
+    return {
+        'size': size,
+        'concurrency': concurrency,
+        'keep_alive': keep_alive,
+        'signed': signed,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'seconds': elapsed,
+        'requests_per_second': len(latencies) / elapsed,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'rss_kb': rss_kb(),
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        }
+
+def percentile(values, percent):
+    # values must be sorted
+    if not values:
+        return float('nan')
+    index = int(round(percent / 100.0 * (len(values) - 1)))
+    return values[index]
+
+def rss_kb():
+    """
+    The current resident memory of this process (or the maximum, where
+    /proc isn't available).
+    """
+    try:
+        f = open('/proc/self/statm')
+        try:
+            pages = int(f.read().split()[1])
+        finally:
+            f.close()
+        return pages * resource.getpagesize() // 1024
+    except (IOError, OSError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def parse_size(value):
+    value = value.strip().lower()
+    for suffix, factor in (('k', 1024), ('m', 1024 ** 2), ('g', 1024 ** 3)):
+        if value.endswith(suffix):
+            return int(float(value[:-1]) * factor)
+    return int(value)
+
+def format_size(size):
+    for suffix, factor in (('g', 1024 ** 3), ('m', 1024 ** 2), ('k', 1024)):
+        if size >= factor and not size % factor:
+            return '%s%s' % (size // factor, suffix)
+    return str(size)
+
+def start_upstream(mode, secret_file):
+    """
+    Returns ``(port, stop)``.
+    """
+    if mode == 'thread':
+        server = UpstreamServer(upstream_app(secret_file))
+        thread = threading.Thread(target=server.serve_forever)
+        thread.setDaemon(True)
+        thread.start()
+        def stop():
+            server.shutdown()
+            server.server_close()
+        return server.server_address[1], stop
+    proc = subprocess.Popen(
+        [sys.executable, os.path.abspath(__file__), '--serve',
+         '--secret-file', secret_file], stdout=subprocess.PIPE)
+    port = int(proc.stdout.readline())
+    def stop():
+        proc.terminate()
+        proc.wait()
+    return port, stop
+
+def git_revision():
+    try:
+        proc = subprocess.Popen(
+            ['git', 'rev-parse', 'HEAD'], stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+        revision = proc.communicate()[0].strip()
+    except OSError:
+        return None
+    return revision or None
+
+def case_name(result):
+    return '%s c=%s %s %s' % (
+        format_size(result['size']), result['concurrency'],
+        result['keep_alive'] and 'keep-alive' or 'close',
+        result['signed'] and 'signed' or 'plain')
+
+def run(options):
+    sizes = [parse_size(size) for size in options.sizes.split(',')]
+    concurrencies = [int(c) for c in options.concurrency.split(',')]
+    max_bytes = parse_size(options.max_bytes)
+    tmp_dir = tempfile.mkdtemp(prefix='bench-proxy-')
+    secret_file = os.path.join(tmp_dir, 'secret')
+    f = open(secret_file, 'wb')
+    f.write(os.urandom(32))
+    f.close()
+    port, stop = start_upstream(options.upstream, secret_file)
+    results = []
+    print '%-32s %9s %9s %9s %9s %7s' % (
+        'case', 'req/s', 'p50 (ms)', 'p99 (ms)', 'RSS (kB)', 'errors')
+    try:
+        for size, concurrency, keep_alive, signed in itertools.product(
+                sizes, concurrencies, (True, False), (False, True)):
+            requests = min(options.requests,
+                           max(concurrency, max_bytes // max(size, 1)))
+            result = run_case(port, secret_file, size, concurrency,
+                              keep_alive, signed, requests)
+            results.append(result)
+            print '%-32s %9.1f %9.2f %9.2f %9s %7s' % (
+                case_name(result), result['requests_per_second'],
+                result['p50_ms'], result['p99_ms'], result['rss_kb'],
+                result['errors'])
+    finally:
+        stop()
+        shutil.rmtree(tmp_dir)
+    if options.output:
+        data = {
+            'meta': {
+                'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+                'python': sys.version.split()[0],
+                'platform': platform.platform(),
+                'revision': git_revision(),
+                'upstream': options.upstream,
+                },
+            'results': results,
+            }
+        f = open(options.output, 'w')
+        try:
+            json.dump(data, f, indent=2, sort_keys=True)
+        finally:
+            f.close()
+
+def load_results(filename):
+    f = open(filename)
+    try:
+        data = json.load(f)
+    finally:
+        f.close()
+    return dict([(case_name(result), result) for result in data['results']])
+
+def compare(old_file, new_file, threshold):
+    """
+    Prints the change in each case found in both files, and returns
+    the number of cases that got slower by more than `threshold`
+    percent (in requests per second or p99 latency).
+    """
+    old = load_results(old_file)
+    new = load_results(new_file)
+    print '%-32s %9s %9s %8s %9s %9s %8s' % (
+        'case', 'old req/s', 'new req/s', 'change', 'old p99', 'new p99',
+        'change')
+    regressions = 0
+    for name in sorted(set(old) & set(new),
+                       key=lambda name: sort_key(new[name])):
+        a, b = old[name], new[name]
+        rate = change(a['requests_per_second'], b['requests_per_second'])
+        p99 = change(a['p99_ms'], b['p99_ms'])
+        slower = rate < -threshold or p99 > threshold
+        if slower:
+            regressions += 1
+        print '%-32s %9.1f %9.1f %+7.1f%% %9.2f %9.2f %+7.1f%%%s' % (
+            name, a['requests_per_second'], b['requests_per_second'], rate,
+            a['p99_ms'], b['p99_ms'], p99, slower and ' *' or '')
+    for name in sorted(set(old) ^ set(new)):
+        print '%-32s only in %s' % (name, name in old and old_file or new_file)
+    return regressions
+
+def sort_key(result):
+    return (result['size'], result['concurrency'], not result['keep_alive'],
+            result['signed'])
+
+def change(old, new):
+    if not old:
+        return 0.0
+    return (new - old) / old * 100
+
+def main(args=None):
+    parser = optparse.OptionParser(
+        usage='%prog [options]\n       %prog --compare OLD.json NEW.json')
+    parser.add_option('--sizes', default=default_sizes,
+                      help='Response sizes, like 1k,1m,1g (default %default)')
+    parser.add_option('--concurrency', default=default_concurrency,
+                      help='Numbers of concurrent requests (default %default)')
+    parser.add_option('--requests', type='int', default=1000,
+                      help='Requests per case (default %default)')
+    parser.add_option('--max-bytes', default='256m',
+                      help='Fewer requests for large sizes, to send at most '
+                      'this much per case (default %default)')
+    parser.add_option('--upstream', choices=['process', 'thread'],
+                      default='process',
+                      help='Run the upstream in a subprocess or a thread')
+    parser.add_option('--output', help='Write the results to this JSON file')
+    parser.add_option('--compare', action='store_true',
+                      help='Compare two result files')
+    parser.add_option('--threshold', type='float', default=10,
+                      help='Percent change that counts as slower (with '
+                      '--compare; default %default)')
+    parser.add_option('--serve', action='store_true',
+                      help=optparse.SUPPRESS_HELP)
+    parser.add_option('--secret-file', help=optparse.SUPPRESS_HELP)
+    options, args = parser.parse_args(args)
+    if options.serve:
+        serve(options.secret_file)
+    elif options.compare:
+        if len(args) != 2:
+            parser.error('--compare needs two result files')
+        if compare(args[0], args[1], options.threshold):
+            sys.exit(1)
+    else:
+        run(options)
+
+if __name__ == '__main__':
+    main()
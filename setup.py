@@ -42,6 +42,9 @@ values.
       ],
       extras_require={
           'testing': ['MiniMock', 'WebOb'],
+          'asyncio': ['trollius'],
+          'brotli': ['Brotli'],
+          'http2': ['h2<4'],
       },
       entry_points="""
       [paste.app_factory]
@@ -50,6 +53,9 @@ values.
 
       [paste.filter_app_factory]
       main = wsgiproxy.wsgiapp:make_middleware
+      cache = wsgiproxy.wsgiapp:make_cache
+      single_flight = wsgiproxy.wsgiapp:make_single_flight
+      compress = wsgiproxy.wsgiapp:make_compress
       """,
       )
       
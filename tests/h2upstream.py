@@ -0,0 +1,229 @@
+"""
+A small HTTP/2 server run in threads (using h2), used as the upstream
+for the HTTP/2 transport tests.  Each request is handled in a thread
+of its own, so requests on a connection can overlap.
+"""
+import select
+import socket
+import ssl
+import threading
+
+import h2.config
+import h2.connection
+import h2.events
+import h2.exceptions
+import h2.settings
+
+
+class H2Request(object):
+    def __init__(self, stream_id, headers):
+        self.stream_id = stream_id
+        self.headers = dict(headers)
+        self.method = self.headers[':method']
+        self.path = self.headers[':path']
+        self.body = []
+
+
+def default_handler(request, body):
+    return 200, [('content-type', 'text/plain')], 'path=%s' % request.path
+
+
+class H2ServerConnection(object):
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        self.lock = threading.Lock()
+        config = h2.config.H2Configuration(client_side=False,
+                                           header_encoding=None)
+        self.h2 = h2.connection.H2Connection(config=config)
+        self.h2.local_settings = h2.settings.Settings(
+            client=False, initial_values={
+                h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS:
+                    server.max_streams,
+                })
+        self.requests = {}
+        # Maps stream ids to the response data not sent yet:
+        self.pending = {}
+
+    def run(self):
+        self.lock.acquire()
+        try:
+            self.h2.initiate_connection()
+            self.flush()
+        finally:
+            self.lock.release()
+        sock = self.sock
+        try:
+            while 1:
+                select.select([sock], [], [])
+                self.lock.acquire()
+                try:
+                    data = sock.recv(65536)
+                    if not data:
+                        return
+                    if isinstance(sock, ssl.SSLSocket):
+                        while sock.pending():
+                            data += sock.recv(65536)
+                    for event in self.h2.receive_data(data):
+                        self.handle(event)
+                    self.flush()
+                finally:
+                    self.lock.release()
+        except (socket.error, h2.exceptions.H2Error):
+            pass
+        finally:
+            sock.close()
+
+    def flush(self):
+        data = self.h2.data_to_send()
+        if data:
+            self.sock.sendall(data)
+
+    def handle(self, event):
+        server = self.server
+        if isinstance(event, h2.events.RequestReceived):
+            request = H2Request(event.stream_id, event.headers)
+            self.requests[event.stream_id] = request
+            server.requests.append(request)
+            server.started(1)
+        elif isinstance(event, h2.events.DataReceived):
+            self.requests[event.stream_id].body.append(event.data)
+            self.h2.acknowledge_received_data(
+                event.flow_controlled_length, event.stream_id)
+        elif isinstance(event, h2.events.StreamEnded):
+            request = self.requests.pop(event.stream_id)
+            thread = threading.Thread(target=self.respond, args=(request,))
+            thread.setDaemon(True)
+            thread.start()
+        elif isinstance(event, h2.events.StreamReset):
+            server.resets.append(event.stream_id)
+            if event.stream_id in self.pending:
+                del self.pending[event.stream_id]
+                server.started(-1)
+        elif isinstance(event, h2.events.WindowUpdated):
+            self.send_pending()
+
+    def respond(self, request):
+        body = ''.join(request.body)
+        self.server.bodies.append(body)
+        status, headers, content = self.server.handler(request, body)
+        headers = [(':status', str(status))] + [
+            (name.lower(), value) for name, value in headers]
+        if content is not None and request.method != 'HEAD':
+            headers.append(('content-length', str(len(content))))
+        else:
+            content = ''
+        self.lock.acquire()
+        try:
+            self.h2.send_headers(request.stream_id, headers)
+            self.pending[request.stream_id] = content
+            self.send_pending()
+            self.flush()
+        except (socket.error, h2.exceptions.H2Error):
+            pass
+        finally:
+            self.lock.release()
+
+    def send_pending(self):
+        for stream_id, data in self.pending.items():
+            try:
+                while 1:
+                    size = min(len(data), self.h2.max_outbound_frame_size,
+                               self.h2.local_flow_control_window(stream_id))
+                    if size <= 0:
+                        break
+                    self.h2.send_data(stream_id, data[:size])
+                    data = data[size:]
+            except h2.exceptions.StreamClosedError:
+                # Reset by a frame that hasn't been handled yet
+                continue
+            if data:
+                self.pending[stream_id] = data
+            else:
+                self.h2.end_stream(stream_id)
+                del self.pending[stream_id]
+                self.server.started(-1)
+
+    def unsent(self):
+        self.lock.acquire()
+        try:
+            return sum(len(data) for data in self.pending.values())
+        finally:
+            self.lock.release()
+
+
+class H2UpstreamServer(object):
+
+    """
+    Listens on `address` (or a Unix socket path, with
+    ``family=socket.AF_UNIX``), speaking HTTP/2 with prior knowledge,
+    or over TLS with ALPN if `ssl_context` is given.  `handler` is
+    called with the request and its body and returns ``(status,
+    headers, content)``.
+    """
+
+    def __init__(self, handler=default_handler, address=('127.0.0.1', 0),
+                 ssl_context=None, max_streams=100, family=socket.AF_INET):
+        self.handler = handler
+        self.ssl_context = ssl_context
+        self.max_streams = max_streams
+        self.requests = []
+        self.bodies = []
+        self.resets = []
+        self.connections = []
+        self.lock = threading.Lock()
+        self.active = 0
+        self.max_active = 0
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        if family != socket.AF_UNIX:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(address)
+        self.sock.listen(50)
+        self.thread = threading.Thread(target=self.serve)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    @property
+    def port(self):
+        return self.sock.getsockname()[1]
+
+    def started(self, count):
+        self.lock.acquire()
+        try:
+            self.active += count
+            self.max_active = max(self.max_active, self.active)
+        finally:
+            self.lock.release()
+
+    def serve(self):
+        while 1:
+            try:
+                sock, address = self.sock.accept()
+            except socket.error:
+                return
+            if self.ssl_context is not None:
+                try:
+                    sock = self.ssl_context.wrap_socket(sock,
+                                                        server_side=True)
+                except (socket.error, ssl.SSLError):
+                    continue
+            conn = H2ServerConnection(self, sock)
+            self.connections.append(conn)
+            thread = threading.Thread(target=conn.run)
+            thread.setDaemon(True)
+            thread.start()
+
+    def unsent(self):
+        return sum(conn.unsent() for conn in self.connections)
+
+    def stop(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        for conn in self.connections:
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
@@ -0,0 +1,88 @@
+"""
+A small server for the spawn tests: ``spawned_app.py PORT [--ready]``
+(or ``spawned_app.py --fd FD``, to use an inherited socket, or
+``spawned_app.py --unix PATH`` to listen on a Unix domain socket;
+``--fd FD --unix`` inherits a Unix domain socket).
+
+Responds with its PID; ``?sleep=N`` makes it wait N seconds first.
+With ``--ready`` it prints READY once it is listening.
+"""
+
+import os
+import socket
+import sys
+import time
+import urlparse
+from SocketServer import ThreadingMixIn
+from wsgiref.simple_server import make_server, WSGIServer, WSGIRequestHandler
+
+
+class ThreadingWSGIServer(ThreadingMixIn, WSGIServer):
+    daemon_threads = True
+
+
+class QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+class UnixServer(ThreadingWSGIServer):
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        ThreadingWSGIServer.server_bind(self)
+
+    def setup_environ(self):
+        self.server_name = 'localhost'
+        self.server_port = 80
+        ThreadingWSGIServer.setup_environ(self)
+
+
+class UnixHandler(QuietHandler):
+    def setup(self):
+        # There is no client address on a Unix domain socket
+        self.client_address = ('127.0.0.1', 0)
+        QuietHandler.setup(self)
+
+
+def app(environ, start_response):
+    query = urlparse.parse_qs(environ.get('QUERY_STRING', ''))
+    if 'sleep' in query:
+        time.sleep(float(query['sleep'][0]))
+    body = 'pid=%s' % os.getpid()
+    start_response('200 OK', [('Content-Type', 'text/plain'),
+                              ('Content-Length', str(len(body)))])
+    return [body]
+
+def main(args):
+    if args[0] == '--fd' and '--unix' in args:
+        sock = socket.fromfd(int(args[1]), socket.AF_UNIX, socket.SOCK_STREAM)
+        server = UnixServer(sock.getsockname(), UnixHandler,
+                            bind_and_activate=False)
+        server.socket = sock
+        server.setup_environ()
+        server.set_app(app)
+    elif args[0] == '--fd':
+        sock = socket.fromfd(int(args[1]), socket.AF_INET, socket.SOCK_STREAM)
+        server = ThreadingWSGIServer(sock.getsockname(), QuietHandler,
+                                     bind_and_activate=False)
+        server.socket = sock
+        server.server_name = 'localhost'
+        server.server_port = sock.getsockname()[1]
+        server.setup_environ()
+        server.set_app(app)
+    elif args[0] == '--unix':
+        server = UnixServer(args[1], UnixHandler)
+        server.set_app(app)
+    else:
+        server = make_server('127.0.0.1', int(args[0]), app,
+                             server_class=ThreadingWSGIServer,
+                             handler_class=QuietHandler)
+    if '--ready' in args:
+        print 'Listening on port %s' % args[0]
+        print 'READY'
+        sys.stdout.flush()
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,170 @@
+import socket
+import threading
+import time
+import unittest
+from cStringIO import StringIO
+
+try:
+    import trollius
+except ImportError:
+    raise unittest.SkipTest("trollius is not installed")
+
+from webob import Request
+from wsgiproxy.aioproxy import AsyncEngine, AsyncConnectionPool, proxy_request
+from wsgiproxy.app import WSGIProxyApp
+from tests.upstream import UpstreamServer
+
+
+class AsyncEngineTests(unittest.TestCase):
+    def setUp(self):
+        self.server = UpstreamServer()
+        self.engine = AsyncEngine(timeout=5)
+
+    def tearDown(self):
+        self.engine.close()
+        self.server.stop()
+
+    def make_request(self, path):
+        req = Request.blank(path)
+        req.environ['SERVER_NAME'] = '127.0.0.1'
+        req.environ['SERVER_PORT'] = str(self.server.port)
+        return req
+
+    def test_get(self):
+        for i in range(3):
+            res = self.make_request('/page%s' % i).get_response(self.engine)
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.body, 'path=/page%s' % i)
+            self.assertEqual(res.headers['Content-Type'], 'text/plain')
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_chunked_response(self):
+        self.server.handler = lambda handler, body: (
+            200, [('X-Foo', 'bar')], ['abc', 'defg'])
+        res = self.make_request('/').get_response(self.engine)
+        self.assertEqual(res.body, 'abcdefg')
+        self.assertEqual(res.headers['X-Foo'], 'bar')
+        self.assertTrue('Transfer-Encoding' not in res.headers)
+
+    def test_post(self):
+        req = self.make_request('/')
+        req.method = 'POST'
+        req.body = 'x' * 100000
+        req.get_response(self.engine).body
+        self.assertEqual(self.server.bodies[0], 'x' * 100000)
+
+    def test_hop_by_hop_headers(self):
+        req = self.make_request('/')
+        req.headers['Connection'] = 'close'
+        req.headers['X-Other'] = 'yes'
+        req.get_response(self.engine).body
+        headers = self.server.requests[0][2]
+        self.assertEqual(headers.getheader('connection'), None)
+        self.assertEqual(headers.getheader('x-other'), 'yes')
+
+    def test_timeout(self):
+        import time
+        def slow_handler(handler, body):
+            time.sleep(0.5)
+            return 200, [], 'late'
+        self.server.handler = slow_handler
+        req = self.make_request('/')
+        req.environ['wsgiproxy.timeout'] = 0.1
+        res = req.get_response(self.engine)
+        self.assertEqual(res.status_code, 504)
+
+    def test_connection_refused(self):
+        req = self.make_request('/')
+        self.server.stop()
+        res = req.get_response(self.engine)
+        self.assertEqual(res.status_code, 502)
+
+    def test_proxy_request_coroutine(self):
+        from trollius import From, Return
+        loop = self.engine.loop
+        pool = AsyncConnectionPool(loop=loop)
+        environ = self.make_request('/coro').environ
+        @trollius.coroutine
+        def fetch():
+            res = yield From(proxy_request(environ, pool=pool, loop=loop))
+            body = yield From(res.read_all())
+            res.close()
+            raise Return((res.status, body))
+        self.assertEqual(self.engine.run(fetch()), ('200 OK', 'path=/coro'))
+
+    def test_wsgiproxyapp_engine(self):
+        app = WSGIProxyApp('http://127.0.0.1:%s/base' % self.server.port,
+                           engine=self.engine)
+        req = Request.blank('/page', environ={'REMOTE_ADDR': '127.0.0.1'})
+        res = req.get_response(app)
+        self.assertEqual(res.body, 'path=/base/page')
+
+    def test_body_read_off_loop(self):
+        threads = []
+        class SlowInput(object):
+            def __init__(self, data):
+                self.input = StringIO(data)
+            def read(self, size=-1):
+                threads.append(threading.current_thread())
+                time.sleep(0.05)
+                return self.input.read(size)
+        req = self.make_request('/')
+        req.method = 'PUT'
+        req.environ['wsgi.input'] = SlowInput('y' * 200000)
+        req.environ['CONTENT_LENGTH'] = '200000'
+        uploader = threading.Thread(
+            target=lambda: req.get_response(self.engine).body)
+        uploader.start()
+        while not threads:
+            time.sleep(0.01)
+        # The loop is free for other requests meanwhile
+        start = time.time()
+        res = self.make_request('/other').get_response(self.engine)
+        self.assertEqual(res.body, 'path=/other')
+        self.assertTrue(time.time() - start < 0.1)
+        uploader.join()
+        self.assertEqual(self.server.bodies[-1], 'y' * 200000)
+        self.assertTrue(self.engine.thread not in threads)
+
+    def test_stream_reader_body(self):
+        from trollius import From, Return
+        loop = self.engine.loop
+        environ = self.make_request('/').environ
+        environ['REQUEST_METHOD'] = 'POST'
+        environ.pop('CONTENT_LENGTH', None)
+        @trollius.coroutine
+        def fetch():
+            body = trollius.StreamReader(loop=loop)
+            body.feed_data('abc' * 1000)
+            body.feed_eof()
+            environ['wsgi.input'] = body
+            res = yield From(proxy_request(environ, loop=loop))
+            yield From(res.read_all())
+            res.close()
+            raise Return(res.status)
+        self.assertEqual(self.engine.run(fetch()), '200 OK')
+        self.assertEqual(self.server.bodies[0], 'abc' * 1000)
+        self.assertEqual(
+            self.server.requests[0][2].getheader('transfer-encoding'),
+            'chunked')
+
+    def test_bad_response_head(self):
+        for head in ['garbage\r\n\r\n',
+                     'HTTP/1.1 200 OK\r\nno colon here\r\n\r\n',
+                     'HTTP/1.1 200 OK\r\nContent-Length: lots\r\n\r\n']:
+            listener = socket.socket()
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(1)
+            def respond():
+                conn, address = listener.accept()
+                conn.recv(65536)
+                conn.sendall(head)
+                conn.close()
+            t = threading.Thread(target=respond)
+            t.start()
+            req = self.make_request('/')
+            req.environ['SERVER_PORT'] = str(listener.getsockname()[1])
+            res = req.get_response(self.engine)
+            t.join()
+            listener.close()
+            self.assertEqual(res.status_code, 502, head)
@@ -0,0 +1,128 @@
+import unittest
+
+from webob import Request
+from wsgiproxy.app import WSGIProxyApp
+from wsgiproxy.balancer import (
+    Backend, RoundRobinBalancer, LeastOutstandingBalancer, WeightedBalancer,
+    ConsistentHashBalancer, make_balancer)
+from wsgiproxy.wsgiapp import make_app
+from tests.upstream import UpstreamServer
+
+
+def backends(*weights):
+    return [Backend('http://host%s.example.com/' % i, weight)
+            for i, weight in enumerate(weights)]
+
+
+class BalancerTests(unittest.TestCase):
+    def test_backend(self):
+        backend = Backend('https://example.com/some/path?a=b')
+        self.assertEqual(backend.netloc, 'example.com:443')
+        self.assertEqual(backend.path, 'some/path')
+        self.assertEqual(backend.query, 'a=b')
+
+    def test_round_robin(self):
+        b = backends(1, 1, 1)
+        balancer = RoundRobinBalancer(b)
+        chosen = [balancer.choose({}, b) for i in range(6)]
+        self.assertEqual(chosen, b + b)
+
+    def test_least_outstanding(self):
+        b = backends(1, 1, 1)
+        balancer = LeastOutstandingBalancer(b)
+        first = balancer.acquire({})
+        second = balancer.acquire({})
+        third = balancer.acquire({})
+        self.assertEqual(sorted([first, second, third]), sorted(b))
+        balancer.release(second)
+        self.assertTrue(balancer.acquire({}) is second)
+        self.assertEqual(second.in_flight, 1)
+
+    def test_weighted(self):
+        b = backends(3, 1)
+        balancer = WeightedBalancer(b)
+        chosen = [balancer.choose({}, b) for i in range(8)]
+        self.assertEqual(chosen.count(b[0]), 6)
+        self.assertEqual(chosen.count(b[1]), 2)
+        # Smooth: the light backend isn't starved for 3 requests in a row
+        self.assertTrue(b[1] in chosen[:4])
+
+    def test_consistent_hash(self):
+        b = backends(1, 1, 1)
+        balancer = ConsistentHashBalancer(b)
+        paths = ['/page/%s' % i for i in range(50)]
+        first = [balancer.choose({'PATH_INFO': path}, b) for path in paths]
+        again = [balancer.choose({'PATH_INFO': path}, b) for path in paths]
+        self.assertEqual(first, again)
+        self.assertEqual(len(set(first)), 3)
+        # Removing a backend only moves the keys that were on it:
+        fewer = [balancer.choose({'PATH_INFO': path}, b[:2])
+                 for path in paths]
+        for before, after in zip(first, fewer):
+            if before is not b[2]:
+                self.assertTrue(before is after)
+
+    def test_consistent_hash_cookie(self):
+        b = backends(1, 1)
+        balancer = ConsistentHashBalancer(b, hash_key='cookie:session')
+        env = {'HTTP_COOKIE': 'other=1; session=abc', 'PATH_INFO': '/a'}
+        chosen = balancer.choose(env, b)
+        for path in ['/b', '/c', '/d']:
+            env['PATH_INFO'] = path
+            self.assertTrue(balancer.choose(env, b) is chosen)
+
+    def test_unknown_strategy(self):
+        self.assertRaises(ValueError, make_balancer, backends(1), 'random')
+
+    def test_hash_key(self):
+        balancer = make_balancer(backends(1, 1), 'consistent_hash',
+                                 hash_key='client')
+        self.assertEqual(balancer.hash_key, 'client')
+        # The other strategies don't hash
+        for balance in ['round_robin', 'least_outstanding', 'weighted']:
+            self.assertRaises(ValueError, make_balancer, backends(1, 1),
+                              balance, hash_key='client')
+
+
+class WSGIProxyAppBalancingTests(unittest.TestCase):
+    def setUp(self):
+        self.servers = [UpstreamServer(), UpstreamServer()]
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+
+    def hrefs(self):
+        return ['http://127.0.0.1:%s/app%s?x=%s' % (server.port, i, i)
+                for i, server in enumerate(self.servers)]
+
+    def get(self, app, path='/page'):
+        req = Request.blank(path, environ={'REMOTE_ADDR': '127.0.0.1'})
+        return req.get_response(app)
+
+    def test_round_robin(self):
+        app = WSGIProxyApp(self.hrefs())
+        bodies = [self.get(app).body for i in range(4)]
+        self.assertEqual(bodies, ['path=/app0/page?x=0',
+                                  'path=/app1/page?x=1'] * 2)
+        for i, server in enumerate(self.servers):
+            headers = server.requests[0][2]
+            self.assertEqual(headers['X-Traversal-Path'], 'app%s' % i)
+            self.assertEqual(headers['X-Traversal-Query-String'], 'x=%s' % i)
+        self.assertEqual([b.in_flight for b in app.backends], [0, 0])
+
+    def test_in_flight(self):
+        app = WSGIProxyApp(self.hrefs(), balance='least_outstanding')
+        req = Request.blank('/', environ={'REMOTE_ADDR': '127.0.0.1'})
+        app_iter = app(req.environ, lambda *args: None)
+        self.assertEqual(sorted(b.in_flight for b in app.backends), [0, 1])
+        app_iter.close()
+        self.assertEqual([b.in_flight for b in app.backends], [0, 0])
+
+    def test_make_app(self):
+        app = make_app({}, href=' '.join(self.hrefs()), balance='weighted',
+                       weights='2 1')
+        self.assertEqual([b.weight for b in app.backends], [2, 1])
+        bodies = [self.get(app).body for i in range(3)]
+        self.assertEqual(sorted(bodies), ['path=/app0/page?x=0'] * 2
+                         + ['path=/app1/page?x=1'])
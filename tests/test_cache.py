@@ -0,0 +1,347 @@
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from webob import Request
+from wsgiproxy.app import WSGIProxyApp
+from wsgiproxy.cache import (CachingMiddleware, MemoryStore, DiskStore,
+                             CacheEntry, parse_cache_control, OrderedDict,
+                             _LinkedDict)
+from tests.upstream import UpstreamServer
+
+
+class CountingApp(object):
+    """
+    Returns `body` with `headers`, counting the requests it gets.
+    """
+
+    def __init__(self, headers=None, body='hello', delay=0):
+        if headers is None:
+            headers = [('Cache-Control', 'max-age=60')]
+        self.headers = headers
+        self.body = body
+        self.delay = delay
+        self.requests = []
+
+    def __call__(self, environ, start_response):
+        self.requests.append(environ.copy())
+        if self.delay:
+            time.sleep(self.delay)
+        etag = dict(self.headers).get('ETag')
+        if etag and environ.get('HTTP_IF_NONE_MATCH') == etag:
+            start_response('304 Not Modified', self.headers)
+            return []
+        start_response('200 OK', self.headers + [
+            ('Content-Type', 'text/plain'),
+            ('Content-Length', str(len(self.body)))])
+        return [self.body]
+
+
+class CacheTests(unittest.TestCase):
+
+    def get(self, app, path='/', **headers):
+        req = Request.blank(path)
+        for name, value in headers.items():
+            req.environ['HTTP_%s' % name.upper()] = value
+        res = req.get_response(app)
+        # Read the body (and close the app_iter) as a server would
+        res.body
+        return res
+
+    def test_hit(self):
+        upstream = CountingApp()
+        app = CachingMiddleware(upstream)
+        res = self.get(app)
+        self.assertEqual(res.body, 'hello')
+        self.assertEqual(res.headers['X-Cache'], 'MISS')
+        res = self.get(app)
+        self.assertEqual(res.body, 'hello')
+        self.assertEqual(res.headers['X-Cache'], 'HIT')
+        self.assertTrue('Age' in res.headers)
+        self.assertEqual(len(upstream.requests), 1)
+        self.assertEqual(app.stats['hits'], 1)
+        self.assertEqual(app.stats['misses'], 1)
+        self.assertEqual(app.stats['bytes_from_cache'], 5)
+        self.assertEqual(app.stats['bytes_from_backend'], 5)
+        # Different paths and queries are different responses:
+        self.get(app, '/other')
+        self.get(app, '/?a=1')
+        self.assertEqual(len(upstream.requests), 3)
+
+    def test_not_storable(self):
+        for headers in ([('Cache-Control', 'no-store')],
+                        [('Cache-Control', 'private, max-age=60')],
+                        [('Cache-Control', 'max-age=60'),
+                         ('Set-Cookie', 'a=b')],
+                        [('Cache-Control', 'max-age=60'), ('Vary', '*')],
+                        []):
+            upstream = CountingApp(headers)
+            app = CachingMiddleware(upstream)
+            self.get(app)
+            self.get(app)
+            self.assertEqual(len(upstream.requests), 2, headers)
+
+    def test_bypass(self):
+        upstream = CountingApp()
+        app = CachingMiddleware(upstream)
+        self.get(app)
+        req = Request.blank('/', method='POST')
+        req.get_response(app).body
+        self.get(app, authorization='Basic Zm9vOmJhcg==')
+        self.assertEqual(len(upstream.requests), 3)
+        self.assertEqual(app.stats['bypassed'], 2)
+        # no-cache goes to the backend (but still stores the response)
+        self.get(app, cache_control='no-cache')
+        self.assertEqual(len(upstream.requests), 4)
+
+    def test_request_cache_control(self):
+        upstream = CountingApp([('Cache-Control', 'max-age=60'),
+                                ('ETag', '"v1"')])
+        app = CachingMiddleware(upstream)
+        self.get(app)
+        # A browser reload revalidates
+        res = self.get(app, cache_control='max-age=0')
+        self.assertEqual(res.headers['X-Cache'], 'REVALIDATED')
+        self.assertEqual(res.body, 'hello')
+        self.assertEqual(len(upstream.requests), 2)
+        self.assertEqual(self.get(app, cache_control='max-age=30')
+                         .headers['X-Cache'], 'HIT')
+        entry = CacheEntry('200 OK', [('Cache-Control', 'max-age=60')], '',
+                           [], now=100)
+        cc = parse_cache_control
+        self.assertTrue(entry.is_fresh_for({}, 130))
+        self.assertFalse(entry.is_fresh_for(cc('max-age=20'), 130))
+        self.assertTrue(entry.is_fresh_for(cc('min-fresh=20'), 130))
+        self.assertFalse(entry.is_fresh_for(cc('min-fresh=40'), 130))
+        self.assertFalse(entry.is_fresh_for({}, 170))
+        self.assertTrue(entry.is_fresh_for(cc('max-stale=20'), 170))
+        self.assertFalse(entry.is_fresh_for(cc('max-stale=5'), 170))
+        self.assertTrue(entry.is_fresh_for(cc('max-stale'), 1000))
+        entry = CacheEntry('200 OK', [
+            ('Cache-Control', 'max-age=60, must-revalidate')], '', [],
+            now=100)
+        self.assertFalse(entry.is_fresh_for(cc('max-stale'), 170))
+
+    def test_expires(self):
+        from email.utils import formatdate
+        now = time.time()
+        upstream = CountingApp([('Date', formatdate(now, usegmt=True)),
+                                ('Expires', formatdate(now + 60, usegmt=True))])
+        app = CachingMiddleware(upstream)
+        self.get(app)
+        self.assertEqual(self.get(app).headers['X-Cache'], 'HIT')
+        upstream = CountingApp([('Date', formatdate(now, usegmt=True)),
+                                ('Expires', formatdate(now - 60, usegmt=True))])
+        app = CachingMiddleware(upstream)
+        self.get(app)
+        self.get(app)
+        self.assertEqual(len(upstream.requests), 2)
+
+    def test_vary(self):
+        upstream = CountingApp([('Cache-Control', 'max-age=60'),
+                                ('Vary', 'Accept-Encoding')])
+        app = CachingMiddleware(upstream)
+        self.get(app, accept_encoding='gzip')
+        self.get(app, accept_encoding='identity')
+        self.assertEqual(len(upstream.requests), 2)
+        self.assertEqual(
+            self.get(app, accept_encoding='gzip').headers['X-Cache'], 'HIT')
+        self.assertEqual(
+            self.get(app, accept_encoding='identity').headers['X-Cache'], 'HIT')
+        self.assertEqual(len(upstream.requests), 2)
+
+    def test_conditional_request(self):
+        upstream = CountingApp([('Cache-Control', 'max-age=60'),
+                                ('ETag', '"v1"'),
+                                ('Last-Modified',
+                                 'Sat, 01 Jan 2011 00:00:00 GMT')])
+        app = CachingMiddleware(upstream)
+        self.get(app)
+        res = self.get(app, if_none_match='"v1"')
+        self.assertEqual(res.status_int, 304)
+        self.assertEqual(res.body, '')
+        self.assertEqual(res.headers['ETag'], '"v1"')
+        res = self.get(app, if_none_match='"v2"')
+        self.assertEqual(res.status_int, 200)
+        res = self.get(app, if_modified_since='Sun, 02 Jan 2011 00:00:00 GMT')
+        self.assertEqual(res.status_int, 304)
+        res = self.get(app, if_modified_since='Fri, 31 Dec 2010 00:00:00 GMT')
+        self.assertEqual(res.status_int, 200)
+        self.assertEqual(len(upstream.requests), 1)
+        self.assertEqual(app.stats['not_modified'], 2)
+
+    def test_revalidate(self):
+        upstream = CountingApp([('Cache-Control', 'max-age=0'),
+                                ('ETag', '"v1"')])
+        app = CachingMiddleware(upstream)
+        self.get(app)
+        res = self.get(app)
+        self.assertEqual(res.body, 'hello')
+        self.assertEqual(res.headers['X-Cache'], 'REVALIDATED')
+        self.assertEqual(upstream.requests[1]['HTTP_IF_NONE_MATCH'], '"v1"')
+        self.assertEqual(app.stats['revalidated'], 1)
+        # The client's own validators aren't passed on
+        self.get(app, if_none_match='"other"')
+        self.assertEqual(upstream.requests[2]['HTTP_IF_NONE_MATCH'], '"v1"')
+
+    def test_stale_while_revalidate(self):
+        upstream = CountingApp([('Cache-Control',
+                                 'max-age=1, stale-while-revalidate=60')])
+        app = CachingMiddleware(upstream)
+        self.get(app)
+        entry = app.store.get(app.cache_key(Request.blank('/').environ))
+        entry.stored_at -= 2
+        upstream.body = 'new'
+        res = self.get(app)
+        self.assertEqual(res.body, 'hello')
+        self.assertEqual(res.headers['X-Cache'], 'STALE')
+        for i in range(100):
+            if not app.revalidating and len(upstream.requests) == 2:
+                break
+            time.sleep(0.01)
+        self.assertEqual(len(upstream.requests), 2)
+        res = self.get(app)
+        self.assertEqual(res.body, 'new')
+        self.assertEqual(res.headers['X-Cache'], 'HIT')
+
+    def test_collapse(self):
+        upstream = CountingApp(delay=0.2)
+        app = CachingMiddleware(upstream)
+        results = []
+        def request():
+            results.append(self.get(app).body)
+        threads = [threading.Thread(target=request) for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, ['hello'] * 5)
+        self.assertEqual(len(upstream.requests), 1)
+        self.assertEqual(app.stats['collapsed'], 4)
+
+    def test_max_object_size(self):
+        upstream = CountingApp(body='x' * 100)
+        app = CachingMiddleware(upstream, max_object_size=50)
+        self.assertEqual(self.get(app).body, 'x' * 100)
+        self.get(app)
+        self.assertEqual(len(upstream.requests), 2)
+
+    def test_write(self):
+        def writing_app(environ, start_response):
+            write = start_response('200 OK', [
+                ('Cache-Control', 'max-age=60')])
+            write('hello ')
+            return ['world']
+        app = CachingMiddleware(writing_app)
+        self.assertEqual(self.get(app).body, 'hello world')
+        res = self.get(app)
+        self.assertEqual(res.headers['X-Cache'], 'HIT')
+        self.assertEqual(res.body, 'hello world')
+
+    def test_collapse_too_large(self):
+        # Requests collapsed onto a response too large to store go
+        # upstream themselves as soon as its headers arrive
+        upstream = CountingApp(body='x' * 100, delay=0.2)
+        app = CachingMiddleware(upstream, max_object_size=50)
+        leader = Request.blank('/').call_application(app)
+        other = []
+        def request():
+            other.append(self.get(app).body)
+        t = threading.Thread(target=request)
+        t.start()
+        t.join(5)
+        self.assertEqual(other, ['x' * 100])
+        self.assertEqual(len(upstream.requests), 2)
+        status, headers, app_iter = leader
+        self.assertEqual(''.join(app_iter), 'x' * 100)
+        app_iter.close()
+
+    def test_no_start_response(self):
+        app = CachingMiddleware(lambda environ, start_response: [])
+        self.assertRaises(AssertionError, self.get, app)
+        self.assertEqual(app.fetching, {})
+
+    def test_proxy(self):
+        server = UpstreamServer(
+            lambda handler, body: (200, [('Cache-Control', 'max-age=60')],
+                                   'path=%s' % handler.path))
+        try:
+            app = CachingMiddleware(
+                WSGIProxyApp('http://127.0.0.1:%s' % server.port))
+            for i in range(3):
+                req = Request.blank('/foo')
+                req.environ['REMOTE_ADDR'] = '127.0.0.1'
+                res = req.get_response(app)
+                self.assertEqual(res.body, 'path=/foo')
+            self.assertEqual(len(server.requests), 1)
+        finally:
+            server.stop()
+
+
+class StoreTests(unittest.TestCase):
+
+    def make_entry(self, body):
+        return CacheEntry('200 OK', [('Cache-Control', 'max-age=60')],
+                          body, [])
+
+    def test_parse_cache_control(self):
+        self.assertEqual(parse_cache_control('max-age=60, No-Cache, x="y"'),
+                         {'max-age': '60', 'no-cache': True, 'x': 'y'})
+
+    def test_memory_lru(self):
+        size = self.make_entry('x' * 100).size
+        # (with the stand-in for OrderedDict used on Python 2.6 too)
+        for dict_class in (OrderedDict, _LinkedDict):
+            store = MemoryStore(max_bytes=size * 2)
+            store.entries = dict_class()
+            store.set('a', self.make_entry('x' * 100))
+            store.set('b', self.make_entry('x' * 100))
+            store.get('a')
+            store.set('c', self.make_entry('x' * 100))
+            self.assertTrue(store.get('a') is not None)
+            self.assertTrue(store.get('b') is None)
+            self.assertTrue(store.get('c') is not None)
+            self.assertEqual(store.size, size * 2)
+            self.assertEqual(store.evictions, 1)
+            store.delete('a')
+            self.assertEqual(store.size, size)
+            self.assertEqual(len(store.entries), 1)
+
+    def test_linked_dict(self):
+        d = _LinkedDict()
+        for key in 'abcd':
+            d[key] = key.upper()
+        d['b'] = 'B2'
+        self.assertEqual(d.pop('c'), 'C')
+        self.assertEqual(d.pop('c', None), None)
+        self.assertRaises(KeyError, d.pop, 'c')
+        self.assertEqual(d.popitem(last=False), ('a', 'A'))
+        self.assertEqual(d.popitem(), ('d', 'D'))
+        self.assertTrue('b' in d)
+        self.assertEqual(d.popitem(last=False), ('b', 'B2'))
+        self.assertEqual(len(d), 0)
+        self.assertRaises(KeyError, d.popitem)
+
+    def test_disk(self):
+        directory = tempfile.mkdtemp()
+        try:
+            store = DiskStore(directory)
+            store.set('a', self.make_entry('hello'))
+            self.assertEqual(store.get('a').body, 'hello')
+            self.assertTrue(store.get('b') is None)
+            # A new store finds the existing entries
+            store = DiskStore(directory)
+            self.assertEqual(store.get('a').body, 'hello')
+            self.assertTrue(store.size > 0)
+            store.delete('a')
+            self.assertTrue(store.get('a') is None)
+            self.assertEqual(store.size, 0)
+            app = CachingMiddleware(CountingApp(), directory=directory)
+            self.assertTrue(isinstance(app.store, DiskStore))
+            Request.blank('/').get_response(app).body
+            res = Request.blank('/').get_response(app)
+            self.assertEqual(res.headers['X-Cache'], 'HIT')
+        finally:
+            shutil.rmtree(directory)
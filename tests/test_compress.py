@@ -0,0 +1,167 @@
+import gzip
+import unittest
+import zlib
+from cStringIO import StringIO
+
+from webob import Request
+from wsgiproxy import compress
+from wsgiproxy.compress import CompressingMiddleware, parse_accept_encoding
+
+text = 'Some text that compresses rather well. ' * 100
+
+
+def make_app(body=text, headers=None, status='200 OK', chunks=False,
+             content_type='text/html; charset=utf8'):
+    environs = []
+    def app(environ, start_response):
+        environs.append(environ.copy())
+        response_headers = [('Content-Type', content_type)]
+        if not chunks:
+            response_headers.append(('Content-Length', str(len(body))))
+        start_response(status, response_headers + list(headers or []))
+        if chunks:
+            return [body[i:i + 100] for i in range(0, len(body), 100)]
+        return [body]
+    app.environs = environs
+    return app
+
+
+def get(app, accept='gzip, deflate', **headers):
+    req = Request.blank('/')
+    if accept is not None:
+        req.headers['Accept-Encoding'] = accept
+    req.headers.update(headers)
+    res = req.get_response(app)
+    res.body
+    return res
+
+
+def gunzip(data):
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+
+class CompressTests(unittest.TestCase):
+    def test_gzip(self):
+        app = CompressingMiddleware(make_app(headers=[('ETag', '"abc"')]))
+        res = get(app)
+        self.assertEqual(res.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(res.headers['Vary'], 'Accept-Encoding')
+        self.assertEqual(res.headers['ETag'], '"abc-gzip"')
+        self.assertTrue('Content-Length' not in res.headers or
+                        int(res.headers['Content-Length']) == len(res.body))
+        self.assertTrue(len(res.body) < len(text) / 10)
+        self.assertEqual(gunzip(res.body), text)
+        self.assertEqual(app.stats['compressed'], 1)
+        self.assertEqual(app.stats['bytes_in'], len(text))
+
+    def test_chunks(self):
+        app = CompressingMiddleware(make_app(chunks=True), window_bits=9)
+        self.assertEqual(gunzip(get(app).body), text)
+
+    def test_skipped(self):
+        # Not accepted, too small, wrong type, or already encoded
+        app = CompressingMiddleware(make_app())
+        for accept in [None, 'identity', 'gzip;q=0', 'br']:
+            res = get(app, accept)
+            self.assertEqual(res.body, text)
+            self.assertEqual(res.headers['Vary'], 'Accept-Encoding')
+        small = CompressingMiddleware(make_app(chunks=True), min_size=10000)
+        self.assertEqual(get(small).body, text)
+        for content_type, headers in [
+            ('image/png', []),
+            ('text/event-stream', []),
+            ('text/css', [('Content-Encoding', 'deflate')]),
+            ('text/css', [('Cache-Control', 'public, no-transform')])]:
+            inner = make_app(headers=headers, content_type=content_type)
+            res = get(CompressingMiddleware(inner))
+            self.assertEqual(res.body, text)
+            self.assertTrue('Vary' not in res.headers)
+        res = get(CompressingMiddleware(make_app(status='204 No Content',
+                                                 body='')))
+        self.assertEqual(res.status_int, 204)
+
+    def test_conditional(self):
+        inner = make_app(headers=[('ETag', '"abc"')])
+        app = CompressingMiddleware(inner)
+        get(app, **{'If-None-Match': '"abc-gzip"'})
+        self.assertEqual(inner.environs[0]['HTTP_IF_NONE_MATCH'], '"abc"')
+        not_modified = CompressingMiddleware(make_app(
+            status='304 Not Modified', body='', headers=[('ETag', '"abc"')]))
+        res = get(not_modified, **{'If-None-Match': '"abc-gzip"'})
+        self.assertEqual(res.headers['ETag'], '"abc-gzip"')
+
+    def test_upstream_gzip(self):
+        data = zlib.compressobj(6, zlib.DEFLATED, 16 + 15)
+        gzipped = data.compress(text) + data.flush()
+        inner = make_app(body=gzipped, headers=[('Content-Encoding', 'gzip'),
+                                                ('ETag', '"abc"')])
+        app = CompressingMiddleware(inner, upstream_gzip=True)
+        res = get(app, 'gzip')
+        self.assertEqual(inner.environs[0]['HTTP_ACCEPT_ENCODING'], 'gzip')
+        self.assertEqual(res.body, gzipped)
+        self.assertEqual(res.headers['Vary'], 'Accept-Encoding')
+        res = get(app, None)
+        self.assertEqual(inner.environs[1]['HTTP_ACCEPT_ENCODING'], 'gzip')
+        self.assertEqual(res.body, text)
+        self.assertTrue('Content-Encoding' not in res.headers)
+        self.assertEqual(res.headers['ETag'], 'W/"abc"')
+        self.assertEqual(app.stats['decompressed'], 1)
+
+    def test_accept_encoding(self):
+        self.assertEqual(parse_accept_encoding('gzip;q=0.5, br, *;q=0'),
+                         {'gzip': 0.5, 'br': 1.0, '*': 0.0})
+        app = CompressingMiddleware(None)
+        app.encodings = ['br', 'gzip']
+        self.assertEqual(app.choose_encoding(
+            parse_accept_encoding('gzip, br;q=0.5')), 'gzip')
+        self.assertEqual(app.choose_encoding(
+            parse_accept_encoding('gzip, br')), 'br')
+        self.assertEqual(app.choose_encoding(
+            parse_accept_encoding('*')), 'br')
+        self.assertEqual(app.choose_encoding(
+            parse_accept_encoding('x-gzip')), 'gzip')
+
+    if compress._brotli is not None:
+        def test_brotli(self):
+            res = get(CompressingMiddleware(make_app()), 'br, gzip')
+            self.assertEqual(res.headers['Content-Encoding'], 'br')
+            self.assertEqual(compress._brotli.decompress(res.body), text)
+
+
+class ProxiedTests(unittest.TestCase):
+    def test_through_proxy(self):
+        from wsgiproxy.app import WSGIProxyApp
+        from wsgiproxy.pool import ConnectionPool
+        from tests.upstream import UpstreamServer
+        def handler(handler, body):
+            headers = [('Content-Type', 'text/plain')]
+            if handler.headers.getheader('accept-encoding') == 'gzip':
+                data = zlib.compressobj(6, zlib.DEFLATED, 16 + 15)
+                return 200, headers + [('Content-Encoding', 'gzip')], (
+                    data.compress(text) + data.flush())
+            return 200, headers, text
+        server = UpstreamServer(handler)
+        pool = ConnectionPool()
+        try:
+            proxy = WSGIProxyApp('http://127.0.0.1:%s' % server.port,
+                                 connection_pool=pool)
+            for upstream_gzip in False, True:
+                app = CompressingMiddleware(proxy, upstream_gzip=upstream_gzip)
+                for accept in 'gzip', None:
+                    req = Request.blank('/')
+                    req.environ['REMOTE_ADDR'] = '127.0.0.1'
+                    if accept:
+                        req.headers['Accept-Encoding'] = accept
+                    res = req.get_response(app)
+                    if accept:
+                        self.assertEqual(res.headers['Content-Encoding'],
+                                         'gzip')
+                        self.assertEqual(gunzip(res.body), text)
+                    else:
+                        self.assertEqual(res.body, text)
+        finally:
+            pool.close()
+            server.stop()
+        sent = [headers.getheader('accept-encoding')
+                for method, path, headers in server.requests]
+        self.assertEqual(sent, ['gzip', 'identity', 'gzip', 'gzip'])
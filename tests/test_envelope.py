@@ -0,0 +1,167 @@
+import unittest
+import zlib
+
+from webob import Request
+from wsgiproxy.app import WSGIProxyApp
+from wsgiproxy.envelope import pack, unpack, unpack_fields, EnvelopeError
+from wsgiproxy.middleware import WSGIProxyMiddleware
+
+
+class RecordingApp(object):
+    def __init__(self):
+        self.environs = []
+
+    def __call__(self, environ, start_response):
+        self.environs.append(environ.copy())
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['ok']
+
+
+class Wire(object):
+    """
+    Records what the proxy sends, before the middleware sees it.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.environs = []
+
+    def __call__(self, environ, start_response):
+        self.environs.append(environ.copy())
+        return self.app(environ, start_response)
+
+
+def proxied(app):
+    req = Request.blank('/')
+    req.environ['REMOTE_ADDR'] = '127.0.0.1'
+    req.environ['myapp.user'] = 'bob'
+    req.environ['myapp.name'] = u'J\xf6rg'
+    req.environ['myapp.roles'] = ['admin', 'staff']
+    res = req.get_response(app)
+    res.body
+    return res
+
+
+class EnvelopeTests(unittest.TestCase):
+    items = [('S', 'a.str', 'some\nvalue'),
+             ('U', 'a.unicode', u'\u2603'),
+             ('J', 'a.json', {'x': [1, 2]}),
+             ('P', 'a.pickle', set([1]))]
+
+    def test_round_trip(self):
+        header = pack(self.items)
+        self.assertTrue('\n' not in header)
+        self.assertEqual(
+            unpack(header, allow_pickle=True),
+            [('a.str', 'some\nvalue'), ('a.unicode', u'\u2603'),
+             ('a.json', {'x': [1, 2]}), ('a.pickle', set([1]))])
+        self.assertEqual([type for type, key, value in unpack_fields(header)],
+                         ['S', 'U', 'J', 'P'])
+        self.assertRaises(EnvelopeError, unpack, header)
+
+    def test_compression(self):
+        items = [('S', 'key%s' % i, 'x' * 100) for i in range(10)]
+        compressed = pack(items)
+        self.assertTrue(len(compressed) < len(pack(items, None)))
+        self.assertEqual(unpack(compressed), unpack(pack(items, None)))
+
+    def test_bad_envelopes(self):
+        header = pack(self.items[:1])
+        unknown_type = '\x00Z\x00\x01k\x00\x00\x00\x00'.encode('base64')
+        bad_zlib = '\x01 not zlib'.encode('base64')
+        for bad in ['', '!!!', header[:-4], unknown_type, bad_zlib]:
+            self.assertRaises(EnvelopeError, unpack_fields, bad)
+
+    def test_oversized(self):
+        # A small header that would decompress to 10 MB
+        bomb = ('\x01' + zlib.compress('\0' * (10 * 1024 * 1024), 9)
+                ).encode('base64')
+        self.assertTrue(len(bomb) < 20000)
+        self.assertRaises(EnvelopeError, unpack_fields, bomb)
+        header = pack([('S', 'key', 'x' * 1000)])
+        self.assertRaises(EnvelopeError, unpack, header, max_size=500)
+        self.assertEqual(unpack(header, max_size=2000),
+                         [('key', 'x' * 1000)])
+
+    def test_negotiation(self):
+        backend = RecordingApp()
+        app = WSGIProxyApp('http://example.com', string_keys=['myapp.user'],
+                           unicode_keys=['myapp.name'],
+                           json_keys=['myapp.roles'],
+                           engine=Wire(WSGIProxyMiddleware(backend)))
+        res = proxied(app)
+        # The version header is only for the proxy:
+        self.assertTrue('X-WSGIProxy-Versions' not in res.headers)
+        self.assertTrue('HTTP_X_WSGIPROXY_STR_0' in app.engine.environs[0])
+        self.assertEqual(app.backends[0].protocol_versions, ('0.1', '0.2'))
+        proxied(app)
+        sent = app.engine.environs[1]
+        self.assertTrue('HTTP_X_WSGIPROXY_STR_0' not in sent)
+        self.assertTrue('HTTP_X_WSGIPROXY_ENVELOPE' in sent)
+        for environ in backend.environs:
+            self.assertTrue('HTTP_X_WSGIPROXY_ENVELOPE' not in environ)
+            self.assertEqual(environ['myapp.user'], 'bob')
+            self.assertEqual(environ['myapp.name'], u'J\xf6rg')
+            self.assertEqual(environ['myapp.roles'], ['admin', 'staff'])
+
+    def test_downgrade(self):
+        backend = RecordingApp()
+        middleware = WSGIProxyMiddleware(backend)
+        app = WSGIProxyApp('http://example.com', string_keys=['myapp.user'],
+                           engine=Wire(middleware))
+        proxied(app)
+        self.assertEqual(app.backends[0].protocol_versions, ('0.1', '0.2'))
+        # The backend is rolled back to a middleware that only
+        # understands 0.1 (and doesn't say so)
+        def old_middleware(environ, start_response):
+            if 'HTTP_X_WSGIPROXY_ENVELOPE' in environ:
+                start_response('500 Internal Server Error', [])
+                return ['Unknown protocol version']
+            def unversioned_start_response(status, headers, exc_info=None):
+                headers = [(name, value) for name, value in headers
+                           if name.lower() != 'x-wsgiproxy-versions']
+                return start_response(status, headers, exc_info)
+            return middleware(environ, unversioned_start_response)
+        app.engine = Wire(old_middleware)
+        self.assertEqual(proxied(app).status_int, 500)
+        self.assertEqual(app.backends[0].protocol_versions, None)
+        self.assertEqual(proxied(app).status_int, 200)
+        self.assertTrue('HTTP_X_WSGIPROXY_STR_0' in app.engine.environs[-1])
+        self.assertEqual(backend.environs[-1]['myapp.user'], 'bob')
+
+    def test_bad_value(self):
+        # Not UTF-8, so it can't be decoded (lazy mode or not)
+        header = ('\x00U\x00\x06a.name\x00\x00\x00\x01\xff'
+                  ).encode('base64').strip()
+        for lazy in (False, True):
+            backend = RecordingApp()
+            req = Request.blank('/', environ={
+                'HTTP_X_WSGIPROXY_VERSION': '0.2',
+                'HTTP_X_WSGIPROXY_ENVELOPE': header})
+            res = req.get_response(WSGIProxyMiddleware(backend, lazy=lazy))
+            self.assertEqual(res.status_int, 400, lazy)
+            self.assertEqual(backend.environs, [])
+
+    def test_disabled(self):
+        backend = RecordingApp()
+        app = WSGIProxyApp('http://example.com', string_keys=['myapp.user'],
+                           envelope=False,
+                           engine=Wire(WSGIProxyMiddleware(backend)))
+        proxied(app)
+        proxied(app)
+        self.assertTrue('HTTP_X_WSGIPROXY_STR_0' in app.engine.environs[1])
+        # Not negotiating, but the version header still isn't passed on
+        self.assertTrue('X-WSGIProxy-Versions' not in proxied(app).headers)
+        # And only requests from a proxy get it
+        res = Request.blank('/').get_response(WSGIProxyMiddleware(backend))
+        self.assertTrue('X-WSGIProxy-Versions' not in res.headers)
+
+    def test_untrusted_pickle(self):
+        backend = RecordingApp()
+        app = WSGIProxyApp('http://example.com', pickle_keys=['myapp.roles'],
+                           envelope=True, engine=WSGIProxyMiddleware(backend))
+        self.assertEqual(proxied(app).status_int, 400)
+        app.engine = WSGIProxyMiddleware(backend, trust_ips=['127.0.0.1'])
+        proxied(app)
+        self.assertEqual(backend.environs[0]['myapp.roles'],
+                         ['admin', 'staff'])
@@ -1,10 +1,13 @@
 import httplib
+import mimetools
 import socket
+from cStringIO import StringIO
 import unittest
 
 from minimock import mock, restore, Mock, TraceTracker, assert_same_trace
 from webob import Request
-from wsgiproxy.exactproxy import proxy_exact_request
+from wsgiproxy.exactproxy import (proxy_exact_request, header_name,
+                                  request_headers, parse_headers)
 
 
 def h(**kw):
@@ -24,8 +27,8 @@ Called httplib.HTTPConnection.request(
     '%(body)s',
     {'Host': '%(host)s', 'Content-Length': %(content_length)s})
 Called httplib.HTTPConnection.getresponse()
-Called httpresponse.getheader('content-length')
-Called httpresponse.read()
+Called httpresponse.read(65536)
+Called httpresponse.read(65536)
 Called httplib.HTTPConnection.close()
     """.strip() % dict(
         server_name=request.server_name,
@@ -49,11 +52,14 @@ class ExactProxyTests(unittest.TestCase):
         mock('httplib.HTTPSConnection', mock_obj=self.conn)
         self.conn.mock_returns = self.conn
 
+    def tearDown(self):
+        restore()
+
     def set_response(self, status, headers, body):
         mock_response = Mock('httpresponse', tracker=self.trace_tracker)
         mock_response.status = int(status.split()[0])
         mock_response.reason = status.split(None, 1)[1]
-        mock_response.read.mock_returns = body
+        mock_response.read.mock_returns_func = StringIO(body).read
         mock_response.getheader.mock_returns_func = headers.get
         mock_response.msg.headers = [
             '%s: %s' % (name, value) for name, value in headers.items()]
@@ -119,6 +125,36 @@ class ExactProxyTests(unittest.TestCase):
         self.assertEqual(res.headers['X-Foobar'], 'blaz')
         assert_same_trace(self.trace_tracker, expected_trace_for_request(req))
 
+    def test_chunked_response(self):
+        req = Request.blank('http://example.com/testform')
+        req.environ['wsgiproxy.chunk_size'] = 4
+        self.set_response(
+            status='200 OK',
+            headers=h(content_type='text/plain'),
+            body='0123456789',
+            )
+
+        res = proxy_exact_request(req.environ, lambda *args: None)
+
+        self.assertEqual(list(res), ['0123', '4567', '89'])
+        res.close()
+        self.assertTrue('HTTPConnection.close()' in self.trace_tracker.dump())
+
+    def test_file_wrapper(self):
+        req = Request.blank('http://example.com/testform')
+        req.environ['wsgi.file_wrapper'] = lambda f, size: ('wrapped', f, size)
+        self.set_response(
+            status='200 OK',
+            headers=h(content_type='text/plain'),
+            body='some stuff',
+            )
+
+        res = proxy_exact_request(req.environ, lambda *args: None)
+
+        self.assertEqual(res[0], 'wrapped')
+        self.assertEqual(res[1].read(), 'some stuff')
+        self.assertEqual(res[2], 65536)
+
     def test_post(self):
         req = Request.blank('http://example.com/testform')
         req.method = 'POST'
@@ -141,3 +177,34 @@ class ExactProxyTests(unittest.TestCase):
         self.assertEqual(res.headers['Content-Type'], 'text/html')
         assert_same_trace(self.trace_tracker, expected_trace_for_request(req))
 
+
+
+class HeaderTests(unittest.TestCase):
+    def test_header_name(self):
+        self.assertEqual(header_name('HTTP_USER_AGENT'), 'User-Agent')
+        self.assertEqual(header_name('HTTP_USER_AGENT'), 'User-Agent')
+        self.assertEqual(header_name('HTTP_CONNECTION'), None)
+        self.assertEqual(header_name('SERVER_NAME'), None)
+
+    def test_request_headers(self):
+        environ = {'HTTP_HOST': 'example.com', 'HTTP_X_FOO_BAR': 'baz',
+                   'HTTP_KEEP_ALIVE': '300', 'CONTENT_TYPE': 'text/plain',
+                   'SERVER_NAME': 'example.com'}
+        self.assertEqual(request_headers(environ),
+                         {'Host': 'example.com', 'X-Foo-Bar': 'baz',
+                          'Content-Type': 'text/plain'})
+
+    def test_parse_headers(self):
+        message = mimetools.Message(StringIO(
+            'Content-Type: text/plain\r\n'
+            'X-Long: one\r\n'
+            '  two\r\n'
+            'Transfer-Encoding: chunked\r\n'
+            'Connection: close\r\n'
+            'Set-Cookie: a=1\r\n'
+            'Set-Cookie: b=2\r\n\r\n'))
+        self.assertEqual(parse_headers(message),
+                         [('Content-Type', 'text/plain'),
+                          ('X-Long', 'one, two'),
+                          ('Set-Cookie', 'a=1'),
+                          ('Set-Cookie', 'b=2')])
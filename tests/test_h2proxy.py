@@ -0,0 +1,322 @@
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+from cStringIO import StringIO
+
+try:
+    import h2
+except ImportError:
+    raise unittest.SkipTest("h2 is not installed")
+
+from webob import Request
+from wsgiproxy.app import WSGIProxyApp
+from wsgiproxy.exactproxy import proxy_exact_request
+from wsgiproxy.h2proxy import H2Pool, h2_request_headers
+from wsgiproxy.instrument import Instruments
+from tests.h2upstream import H2UpstreamServer
+from tests.upstream import UpstreamServer
+
+
+def make_request(port, path='/', pool=None, **environ):
+    req = Request.blank(path)
+    req.environ['SERVER_NAME'] = '127.0.0.1'
+    req.environ['SERVER_PORT'] = str(port)
+    req.environ['wsgiproxy.h2_pool'] = pool
+    req.environ.update(environ)
+    return req
+
+
+def sleeping_handler(seconds, size=10):
+    def handler(request, body):
+        time.sleep(seconds)
+        return 200, [('content-type', 'text/plain')], 'x' * size
+    return handler
+
+
+def run_concurrently(count, func):
+    results = [None] * count
+    def run(i):
+        results[i] = func(i)
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10)
+    return results
+
+
+class H2ProxyTests(unittest.TestCase):
+    def setUp(self):
+        self.pool = H2Pool()
+        self.servers = []
+
+    def tearDown(self):
+        self.pool.close()
+        for server in self.servers:
+            server.stop()
+
+    def serve(self, handler=None, **kw):
+        if handler is not None:
+            kw['handler'] = handler
+        server = H2UpstreamServer(**kw)
+        self.servers.append(server)
+        return server
+
+    def get(self, req):
+        res = req.get_response(proxy_exact_request)
+        res.body
+        return res
+
+    def test_get(self):
+        server = self.serve(lambda request, body: (
+            200, [('content-type', 'text/plain'), ('set-cookie', 'a=1'),
+                  ('set-cookie', 'b=2'), ('connection', 'close')],
+            'path=%s' % request.path))
+        req = make_request(server.port, '/some%20path?a=b', self.pool)
+        req.headers['Host'] = 'example.com'
+        req.headers['X-Test'] = 'yes'
+        res = self.get(req)
+        self.assertEqual(res.status, '200 OK')
+        self.assertEqual(res.body, 'path=/some%20path?a=b')
+        self.assertEqual(res.headers.getall('Set-Cookie'), ['a=1', 'b=2'])
+        self.assertTrue('Connection' not in res.headers)
+        headers = server.requests[0].headers
+        self.assertEqual(headers[':authority'], 'example.com')
+        self.assertEqual(headers[':scheme'], 'http')
+        self.assertEqual(headers['x-test'], 'yes')
+        self.assertTrue('host' not in headers)
+        # A second request shares the connection
+        res = self.get(make_request(server.port, '/again', self.pool))
+        self.assertEqual(res.body, 'path=/again')
+        self.assertEqual(len(server.connections), 1)
+
+    def test_headers(self):
+        req = make_request(8080, '/p', HTTP_TRANSFER_ENCODING='chunked',
+                           CONTENT_TYPE='text/plain')
+        del req.environ['HTTP_HOST']
+        headers = h2_request_headers(req.environ, ('http', '127.0.0.1',
+                                                   '8080'), 5)
+        self.assertEqual(headers[:4], [
+            (':method', 'GET'), (':scheme', 'http'),
+            (':authority', '127.0.0.1:8080'), (':path', '/p')])
+        self.assertEqual(sorted(headers[4:]), [
+            ('content-length', '5'), ('content-type', 'text/plain')])
+
+    def test_upload(self):
+        server = self.serve(lambda request, body: (
+            200, [], '%s %s' % (request.method, len(body))))
+        body = ''.join(chr(i % 256) for i in range(300 * 1024))
+        req = make_request(server.port, '/', self.pool)
+        req.method = 'POST'
+        req.body = body
+        self.assertEqual(self.get(req).body, 'POST %s' % len(body))
+        self.assertEqual(server.bodies[0], body)
+        # Without a Content-Length
+        req = make_request(server.port, '/', self.pool)
+        req.method = 'PUT'
+        req.environ['wsgi.input'] = StringIO('abc' * 50000)
+        req.environ['wsgi.input_terminated'] = True
+        req.environ.pop('CONTENT_LENGTH', None)
+        self.assertEqual(self.get(req).body, 'PUT 150000')
+        self.assertTrue('content-length' not in server.requests[1].headers)
+
+    def test_multiplexed(self):
+        server = self.serve(sleeping_handler(0.2))
+        pool = H2Pool(max_connections=1)
+        try:
+            start = time.time()
+            statuses = run_concurrently(20, lambda i: self.get(
+                make_request(server.port, '/%s' % i, pool)).status_int)
+            elapsed = time.time() - start
+        finally:
+            pool.close()
+        self.assertEqual(statuses, [200] * 20)
+        self.assertEqual(len(server.connections), 1)
+        self.assertTrue(server.max_active > 10, server.max_active)
+        self.assertTrue(elapsed < 2, elapsed)
+
+    def test_max_streams(self):
+        # The server allows 2 streams per connection:
+        server = self.serve(sleeping_handler(0.1), max_streams=2)
+        pool = H2Pool(max_connections=2)
+        try:
+            statuses = run_concurrently(8, lambda i: self.get(
+                make_request(server.port, '/', pool)).status_int)
+        finally:
+            pool.close()
+        self.assertEqual(statuses, [200] * 8)
+        self.assertEqual(len(server.connections), 2)
+        self.assertTrue(server.max_active <= 4, server.max_active)
+
+    def test_flow_control(self):
+        size = 2 * 1024 * 1024
+        server = self.serve(sleeping_handler(0, size))
+        pool = H2Pool(stream_window=64 * 1024)
+        try:
+            req = make_request(server.port, '/', pool)
+            status, headers, app_iter = req.call_application(
+                proxy_exact_request)
+            first = app_iter.next()
+            time.sleep(0.2)
+            # The server is held back until more is read:
+            self.assertTrue(server.unsent() > size - 4 * 64 * 1024,
+                            server.unsent())
+            received = len(first) + sum(len(chunk) for chunk in app_iter)
+            app_iter.close()
+            self.assertEqual(received, size)
+            self.assertEqual(server.unsent(), 0)
+        finally:
+            pool.close()
+
+    def test_close_early(self):
+        server = self.serve(sleeping_handler(0, 1024 * 1024))
+        req = make_request(server.port, '/', self.pool)
+        status, headers, app_iter = req.call_application(proxy_exact_request)
+        app_iter.next()
+        app_iter.close()
+        for i in range(20):
+            if server.resets:
+                break
+            time.sleep(0.01)
+        self.assertEqual(server.resets, [1])
+        res = self.get(make_request(server.port, '/', self.pool))
+        self.assertEqual(len(res.body), 1024 * 1024)
+        self.assertEqual(len(server.connections), 1)
+
+    def test_errors(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        req = make_request(port, '/', self.pool)
+        res = self.get(req)
+        self.assertEqual(res.status_int, 502)
+        self.assertTrue(
+            isinstance(req.environ['wsgiproxy.upstream_error'], socket.error))
+        server = self.serve(sleeping_handler(1))
+        start = time.time()
+        res = self.get(make_request(
+            server.port, '/', self.pool,
+            **{'wsgiproxy.first_byte_timeout': 0.2}))
+        self.assertEqual(res.status_int, 504)
+        self.assertTrue(time.time() - start < 0.8)
+
+    def test_lost_connection(self):
+        server = self.serve()
+        self.get(make_request(server.port, '/', self.pool))
+        server.connections[0].sock.shutdown(socket.SHUT_RDWR)
+        time.sleep(0.05)
+        # The dead connection is dropped, and a new one opened:
+        res = self.get(make_request(server.port, '/', self.pool))
+        self.assertEqual(res.body, 'path=/')
+        self.assertEqual(len(server.connections), 2)
+
+    def test_instruments(self):
+        events = []
+        instruments = Instruments()
+        instruments.subscribe(events.append)
+        server = self.serve()
+        for i in range(2):
+            self.get(make_request(server.port, '/', self.pool, **{
+                'wsgiproxy.instruments': instruments}))
+        first, second = events
+        self.assertEqual(first.source, 'http2')
+        self.assertEqual(first.status, 200)
+        self.assertEqual(first.bytes_in, len('path=/'))
+        self.assertFalse(first.reused)
+        self.assertTrue('connect' in first.phases)
+        self.assertTrue(second.reused)
+
+    def test_unix_socket(self):
+        path = tempfile.mktemp(suffix='.sock')
+        server = self.serve(address=path, family=socket.AF_UNIX)
+        try:
+            res = self.get(make_request(0, '/unix', self.pool, **{
+                'wsgiproxy.unix_socket': path}))
+        finally:
+            os.unlink(path)
+        self.assertEqual(res.body, 'path=/unix')
+
+    def test_app(self):
+        server = self.serve()
+        app = WSGIProxyApp('http://127.0.0.1:%s/base' % server.port,
+                           http2=self.pool)
+        req = Request.blank('/path')
+        req.environ['REMOTE_ADDR'] = '10.0.0.1'
+        res = req.get_response(app)
+        self.assertEqual(res.body, 'path=/base/path')
+        headers = server.requests[0].headers
+        self.assertEqual(headers['x-forwarded-for'], '10.0.0.1')
+        self.assertEqual(headers[':authority'], '127.0.0.1:%s' % server.port)
+
+
+class TLSTests(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.dir = tempfile.mkdtemp()
+        cls.cert = os.path.join(cls.dir, 'cert.pem')
+        cls.key = os.path.join(cls.dir, 'key.pem')
+        try:
+            subprocess.check_call(
+                ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                 '-days', '1', '-subj', '/CN=localhost',
+                 '-keyout', cls.key, '-out', cls.cert],
+                stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError):
+            shutil.rmtree(cls.dir)
+            raise unittest.SkipTest("Can't make a certificate with openssl")
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.dir)
+
+    def server_context(self, protocols):
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.load_cert_chain(self.cert, self.key)
+        context.set_alpn_protocols(protocols)
+        return context
+
+    def make_pool(self):
+        context = ssl.create_default_context(cafile=self.cert)
+        context.check_hostname = False
+        return H2Pool(ssl_context=context)
+
+    def test_alpn(self):
+        server = H2UpstreamServer(ssl_context=self.server_context(['h2']))
+        pool = self.make_pool()
+        try:
+            req = make_request(server.port, '/tls', pool)
+            req.scheme = 'https'
+            res = req.get_response(proxy_exact_request)
+        finally:
+            pool.close()
+            server.stop()
+        self.assertEqual(res.body, 'path=/tls')
+        self.assertEqual(server.requests[0].headers[':scheme'], 'https')
+
+    def test_http1_fallback(self):
+        server = UpstreamServer()
+        server.socket = self.server_context(['http/1.1']).wrap_socket(
+            server.socket, server_side=True)
+        pool = self.make_pool()
+        verifying_context = ssl._create_default_https_context
+        ssl._create_default_https_context = ssl._create_unverified_context
+        try:
+            for i in range(2):
+                req = make_request(server.port, '/old', pool)
+                req.scheme = 'https'
+                res = req.get_response(proxy_exact_request)
+                self.assertEqual(res.body, 'path=/old')
+        finally:
+            ssl._create_default_https_context = verifying_context
+            pool.close()
+            server.stop()
+        self.assertEqual(pool.http1_keys,
+                         set([('https', '127.0.0.1', str(server.port))]))
+        self.assertEqual(len(server.requests), 2)
@@ -0,0 +1,124 @@
+import threading
+import unittest
+
+from webob import Request
+from wsgiproxy.app import WSGIProxyApp
+from wsgiproxy.balancer import Backend
+from wsgiproxy.health import BackendHealth, HealthChecker
+from tests.upstream import UpstreamServer
+
+
+class BackendHealthTests(unittest.TestCase):
+    def test_circuit(self):
+        health = BackendHealth(failure_threshold=2, recovery_time=10)
+        health.record_failure(now=100)
+        self.assertTrue(health.available(now=100))
+        health.record_failure(now=100)
+        self.assertFalse(health.up)
+        self.assertFalse(health.available(now=105))
+        self.assertEqual(health.retry_after(now=105), 5)
+        # Half-open: a single trial request is allowed
+        self.assertTrue(health.available(now=110))
+        health.attempt(now=110)
+        self.assertFalse(health.available(now=111))
+        # A failed trial keeps it down for another recovery_time
+        health.record_failure(now=112)
+        self.assertFalse(health.available(now=120))
+        self.assertTrue(health.available(now=122))
+        health.attempt(now=122)
+        health.record_success()
+        self.assertTrue(health.up)
+        self.assertEqual(health.failures, 0)
+
+    def test_single_trial(self):
+        health = BackendHealth(failure_threshold=1, recovery_time=10)
+        health.record_failure(now=100)
+        results = []
+        def attempt():
+            results.append(health.attempt(now=110))
+        threads = [threading.Thread(target=attempt) for i in range(20)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        # Only one request gets to try the backend
+        self.assertEqual(results.count(True), 1)
+        self.assertEqual(health.trial_started, 110)
+        self.assertFalse(health.attempt(now=115))
+
+    def test_success_resets_failures(self):
+        health = BackendHealth(failure_threshold=2)
+        health.record_failure()
+        health.record_success()
+        health.record_failure()
+        self.assertTrue(health.up)
+
+
+class HealthCheckingAppTests(unittest.TestCase):
+    def setUp(self):
+        self.server = UpstreamServer()
+        dead = UpstreamServer()
+        dead.stop()
+        self.dead_port = dead.port
+
+    def tearDown(self):
+        self.server.stop()
+
+    def get(self, app):
+        req = Request.blank('/', environ={'REMOTE_ADDR': '127.0.0.1'})
+        return req.get_response(app)
+
+    def test_dead_backend_taken_out(self):
+        app = WSGIProxyApp(['http://127.0.0.1:%s' % self.server.port,
+                            'http://127.0.0.1:%s' % self.dead_port],
+                           failure_threshold=1)
+        statuses = [self.get(app).status_code for i in range(6)]
+        self.assertEqual(statuses, [200, 502, 200, 200, 200, 200])
+        self.assertFalse(app.backends[1].health.up)
+
+    def test_all_down(self):
+        app = WSGIProxyApp('http://127.0.0.1:%s' % self.dead_port,
+                           failure_threshold=2, recovery_time=30)
+        statuses = [self.get(app).status_code for i in range(3)]
+        self.assertEqual(statuses, [502, 502, 503])
+        res = self.get(app)
+        self.assertTrue(int(res.headers['Retry-After']) > 0)
+
+    def test_failure_status(self):
+        self.server.handler = lambda handler, body: (503, [], 'busy')
+        app = WSGIProxyApp('http://127.0.0.1:%s' % self.server.port,
+                           failure_threshold=1)
+        self.assertEqual(self.get(app).body, 'busy')
+        self.assertFalse(app.backends[0].health.up)
+
+    def test_client_abort(self):
+        # A client that gives up part-way through its upload doesn't
+        # count against the backend
+        class AbortedInput(object):
+            sent = 0
+            def read(self, size=-1):
+                if self.sent:
+                    raise IOError("Client went away")
+                self.sent += 1
+                return 'x' * min(size, 1000)
+        app = WSGIProxyApp('http://127.0.0.1:%s' % self.server.port,
+                           failure_threshold=1)
+        for i in range(3):
+            req = Request.blank('/', method='POST', environ={
+                'REMOTE_ADDR': '127.0.0.1', 'wsgi.input': AbortedInput(),
+                'CONTENT_LENGTH': str(1024 * 1024)})
+            self.assertRaises(IOError, req.get_response, app)
+        self.assertTrue(app.backends[0].health.up)
+        self.assertEqual(app.backends[0].health.failures, 0)
+        self.assertEqual(self.get(app).status_code, 200)
+
+    def test_health_checker(self):
+        backends = [Backend('http://127.0.0.1:%s' % self.server.port),
+                    Backend('http://127.0.0.1:%s' % self.dead_port)]
+        for backend in backends:
+            backend.health.failure_threshold = 1
+        checker = HealthChecker(backends, 'health', timeout=1)
+        checker.check_all()
+        self.assertTrue(backends[0].health.up)
+        self.assertFalse(backends[1].health.up)
+        self.assertEqual(self.server.requests[0][1], '/health')
@@ -0,0 +1,141 @@
+import socket
+import unittest
+
+from webob import Request
+from wsgiproxy.app import WSGIProxyApp
+from wsgiproxy.exactproxy import proxy_exact_request
+from wsgiproxy.instrument import (Instruments, RequestEvent,
+                                  PrometheusExporter, StatsDExporter)
+from wsgiproxy.pool import ConnectionPool
+from tests.upstream import UpstreamServer
+
+
+class InstrumentTests(unittest.TestCase):
+    def setUp(self):
+        self.server = UpstreamServer()
+        self.pool = ConnectionPool()
+        self.instruments = Instruments()
+        self.events = []
+        self.instruments.subscribe(self.events.append)
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+
+    def send(self, path='/', port=None, body=None):
+        req = Request.blank(path)
+        if body is not None:
+            req.method = 'POST'
+            req.body = body
+        req.environ['SERVER_NAME'] = '127.0.0.1'
+        req.environ['SERVER_PORT'] = str(port or self.server.port)
+        req.environ['wsgiproxy.connection_pool'] = self.pool
+        req.environ['wsgiproxy.instruments'] = self.instruments
+        res = req.get_response(proxy_exact_request)
+        res.body
+        return res
+
+    def test_exact(self):
+        self.send('/first', body='x' * 10)
+        self.send('/second')
+        first, second = self.events
+        self.assertEqual(first.source, 'exact')
+        self.assertEqual(first.method, 'POST')
+        self.assertEqual(first.status, 200)
+        self.assertEqual(first.backend, '127.0.0.1:%s' % self.server.port)
+        self.assertEqual(first.bytes_out, 10)
+        self.assertEqual(first.bytes_in, len('path=/first'))
+        self.assertEqual(first.reused, False)
+        self.assertEqual(sorted(first.phases), sorted(
+            ['prepare', 'dns', 'connect', 'send', 'first_byte', 'body']))
+        self.assertTrue(first.duration >= sum(first.phases.values()) - 1e-6)
+        self.assertEqual(second.reused, True)
+        self.assertTrue('connect' not in second.phases)
+
+    def test_error(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        self.assertEqual(self.send(port=port).status_int, 502)
+        event, = self.events
+        self.assertEqual(event.status, 502)
+        self.assertTrue(isinstance(event.error, socket.error))
+
+    def test_unsubscribed(self):
+        self.instruments.unsubscribe(self.events.append)
+        req = Request.blank('/')
+        req.environ['SERVER_NAME'] = '127.0.0.1'
+        req.environ['SERVER_PORT'] = str(self.server.port)
+        req.environ['wsgiproxy.instruments'] = self.instruments
+        req.get_response(proxy_exact_request).body
+        self.assertTrue('wsgiproxy.event' not in req.environ)
+        self.assertEqual(self.events, [])
+
+    def test_app(self):
+        href = 'http://127.0.0.1:%s/base' % self.server.port
+        app = WSGIProxyApp(href, connection_pool=self.pool,
+                           instruments=self.instruments)
+        req = Request.blank('/page')
+        req.environ['REMOTE_ADDR'] = '127.0.0.1'
+        res = req.get_response(app)
+        self.assertEqual(res.body, 'path=/base/page')
+        event, = self.events
+        self.assertEqual(event.source, 'app')
+        self.assertEqual(event.backend, href)
+        self.assertEqual(event.status, 200)
+        self.assertTrue('prepare' in event.phases)
+        self.assertTrue('body' in event.phases)
+
+
+def make_event(status=200, reused=True):
+    event = RequestEvent(Instruments(), 'app', 'GET', now=100)
+    event.backend = 'http://"b"/'
+    event.status = status
+    event.reused = reused
+    event.bytes_in = 5
+    event.phases = {'connect': 0.002, 'first_byte': 0.01}
+    event.end = 100.02
+    return event
+
+
+class ExporterTests(unittest.TestCase):
+    def test_prometheus(self):
+        exporter = PrometheusExporter(buckets=[0.01, 0.1])
+        exporter.record(make_event())
+        exporter.record(make_event(status=None, reused=None))
+        text = exporter.render()
+        labels = 'backend="http://\\"b\\"/",source="app"'
+        for line in [
+            'wsgiproxy_requests_total{%s,status="200"} 1' % labels,
+            'wsgiproxy_requests_total{%s,status="error"} 1' % labels,
+            'wsgiproxy_request_duration_seconds_bucket{backend="http://'
+            '\\"b\\"/",le="0.1",source="app"} 2',
+            'wsgiproxy_request_duration_seconds_count{%s} 2' % labels,
+            'wsgiproxy_body_bytes_total{backend="http://\\"b\\"/",'
+            'direction="in"} 10',
+            'wsgiproxy_connections_total{backend="http://\\"b\\"/",'
+            'kind="reused"} 1']:
+            self.assertTrue(line in text, (line, text))
+        res = Request.blank('/metrics').get_response(exporter)
+        self.assertEqual(res.body, exporter.render())
+
+    def test_statsd(self):
+        receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        receiver.bind(('127.0.0.1', 0))
+        receiver.settimeout(5)
+        exporter = StatsDExporter(port=receiver.getsockname()[1],
+                                  per_backend=True)
+        try:
+            exporter.record(make_event())
+            lines = receiver.recv(65536).splitlines()
+        finally:
+            exporter.close()
+            receiver.close()
+        self.assertEqual(lines[:4], [
+            'wsgiproxy.app.requests:1|c',
+            'wsgiproxy.app.status.200:1|c',
+            'wsgiproxy.app.duration:20.000|ms',
+            'wsgiproxy.app.phase.connect:2.000|ms'])
+        self.assertTrue('wsgiproxy.app.connections.reused:1|c' in lines)
+        self.assertTrue('wsgiproxy.backend.http_b.requests:1|c' in lines)
@@ -1,7 +1,8 @@
 import unittest
 
+from wsgiproxy.app import WSGIProxyApp
 from wsgiproxy.sampleapp import application
-from wsgiproxy.middleware import WSGIProxyMiddleware
+from wsgiproxy.middleware import WSGIProxyMiddleware, LazyValue, get_value
 
 def start_response(status, headers, exc_info=None):
     # print('*** start_response: status=%r; headers=%r' % (status, headers))
@@ -170,3 +171,63 @@ class WSGIProxyMiddlewareTests(unittest.TestCase):
         self.assertEqual(result[5], "<tr><td>SCRIPT_NAME</td><td>'foo.py'</td></tr>\n")
         self.assertEqual(result[6], '</table></body></html>')
 
+
+def forwarded_environ(envelope=False, **keys):
+    environ = {'REMOTE_ADDR': '127.0.0.1', 'PATH_INFO': '/',
+               'wsgi.url_scheme': 'http', 'HTTP_HOST': 'example.com',
+               'myapp.user': 'bob', 'myapp.name': u'J\xf6rg',
+               'myapp.roles': ['admin'], 'myapp.tags': set(['a'])}
+    proxy = WSGIProxyApp('http://localhost', **keys)
+    encoded = proxy.encode_environ(environ, envelope=envelope)
+    # Only the headers get to the backend:
+    return dict([(key, value) for key, value in encoded.items()
+                 if '.' not in key])
+
+def call(app, environ):
+    environs = []
+    def inner(environ, start_response):
+        environs.append(environ)
+        start_response('200 OK', [])
+        return []
+    statuses = []
+    WSGIProxyMiddleware(inner, **app)(
+        environ, lambda status, headers, exc_info=None: statuses.append(status))
+    return statuses[0], environs and environs[0]
+
+
+class ForwardedKeyTests(unittest.TestCase):
+    keys = dict(string_keys=['myapp.user'], unicode_keys=['myapp.name'],
+                json_keys=['myapp.roles'], pickle_keys=['myapp.tags'])
+
+    def test_decoded(self):
+        for envelope in False, True:
+            environ = forwarded_environ(envelope, **self.keys)
+            status, environ = call({'trust_ips': ['127.0.0.1']}, environ)
+            self.assertEqual(status, '200 OK')
+            self.assertEqual(environ['myapp.user'], 'bob')
+            self.assertEqual(environ['myapp.name'], u'J\xf6rg')
+            self.assertEqual(environ['myapp.roles'], ['admin'])
+            self.assertEqual(environ['myapp.tags'], set(['a']))
+            self.assertEqual(environ['HTTP_HOST'], 'example.com')
+            self.assertEqual(
+                [key for key in environ if key.startswith('HTTP_X_WSGIPROXY')],
+                [])
+
+    def test_untrusted_pickle(self):
+        for envelope in False, True:
+            status, environ = call({}, forwarded_environ(envelope, **self.keys))
+            self.assertEqual(status[:3], '400')
+
+    def test_lazy(self):
+        for envelope in False, True:
+            environ = forwarded_environ(envelope, **self.keys)
+            status, environ = call({'trust_ips': ['127.0.0.1'], 'lazy': True},
+                                   environ)
+            self.assertEqual(environ['myapp.user'], 'bob')
+            self.assertTrue(isinstance(environ['myapp.roles'], LazyValue))
+            self.assertTrue(isinstance(environ['myapp.tags'], LazyValue))
+            self.assertEqual(get_value(environ, 'myapp.roles'), ['admin'])
+            self.assertEqual(environ['myapp.roles'], ['admin'])
+            self.assertEqual(get_value(environ, 'myapp.tags'), set(['a']))
+            self.assertEqual(get_value(environ, 'myapp.user'), 'bob')
+            self.assertEqual(get_value(environ, 'missing', 1), 1)
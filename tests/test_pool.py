@@ -0,0 +1,147 @@
+import os
+import shutil
+import socket
+import tempfile
+import unittest
+
+from webob import Request
+from wsgiproxy.exactproxy import proxy_exact_request
+from wsgiproxy.app import WSGIProxyApp
+from wsgiproxy.pool import ConnectionPool
+from tests.upstream import UpstreamServer, UnixUpstreamServer
+
+
+class ConnectionPoolTests(unittest.TestCase):
+    def setUp(self):
+        self.server = UpstreamServer()
+        self.pool = ConnectionPool()
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+
+    def send(self, path, method='GET'):
+        req = Request.blank(path)
+        req.method = method
+        req.environ['SERVER_NAME'] = '127.0.0.1'
+        req.environ['SERVER_PORT'] = str(self.server.port)
+        req.environ['wsgiproxy.connection_pool'] = self.pool
+        res = req.get_response(proxy_exact_request)
+        # Reading the body closes the app_iter, releasing the connection:
+        res.body
+        return res
+
+    def key(self):
+        return ('http', '127.0.0.1', str(self.server.port))
+
+    def test_reuses_connection(self):
+        for i in range(3):
+            res = self.send('/page%s' % i)
+            self.assertEqual(res.body, 'path=/page%s' % i)
+        self.assertEqual(len(self.server.connections), 1)
+        self.assertEqual(len(self.pool.idle[self.key()]), 1)
+
+    def test_chunked_response(self):
+        self.server.handler = lambda handler, body: (
+            200, [], ['a' * 10, 'b' * 20])
+        for i in range(2):
+            res = self.send('/')
+            self.assertEqual(res.body, 'a' * 10 + 'b' * 20)
+            self.assertTrue('Transfer-Encoding' not in res.headers)
+        self.assertEqual(len(self.server.connections), 1)
+
+    def test_unread_response_not_pooled(self):
+        req = Request.blank('/')
+        req.environ['SERVER_NAME'] = '127.0.0.1'
+        req.environ['SERVER_PORT'] = str(self.server.port)
+        req.environ['wsgiproxy.connection_pool'] = self.pool
+        app_iter = proxy_exact_request(req.environ, lambda *args: None)
+        app_iter.close()
+        self.assertEqual(self.pool.idle.get(self.key()), None)
+
+    def test_no_pool(self):
+        req = Request.blank('/')
+        req.environ['SERVER_NAME'] = '127.0.0.1'
+        req.environ['SERVER_PORT'] = str(self.server.port)
+        for i in range(2):
+            req.get_response(proxy_exact_request).body
+        self.assertEqual(len(self.server.connections), 2)
+
+    def test_retry_stale_connection(self):
+        self.send('/')
+        # The server drops the idle connection behind our back:
+        self.server.connections[0].shutdown(socket.SHUT_RDWR)
+        res = self.send('/again')
+        self.assertEqual(res.body, 'path=/again')
+        self.assertEqual(len(self.server.connections), 2)
+
+    def test_idle_timeout(self):
+        self.pool.idle_timeout = -1
+        self.send('/')
+        self.send('/')
+        self.assertEqual(len(self.server.connections), 2)
+
+    def test_max_idle(self):
+        self.pool.max_idle = 2
+        conns = [self.pool.get(self.key())[0] for i in range(3)]
+        for conn in conns:
+            conn.connect()
+            self.pool.put(self.key(), conn)
+        self.assertEqual(len(self.pool.idle[self.key()]), 2)
+        self.assertTrue(conns[0].sock is None)
+
+    def test_expire_idle_below_top(self):
+        self.pool.idle_timeout = 60
+        conns = [self.pool.get(self.key())[0] for i in range(3)]
+        for conn in conns:
+            conn.connect()
+            self.pool.put(self.key(), conn)
+        idle = self.pool.idle[self.key()]
+        idle[:2] = [(conn, released - 120) for conn, released in idle[:2]]
+        conn, reused = self.pool.get(self.key())
+        self.assertTrue(reused)
+        self.assertTrue(conn is conns[2])
+        self.assertEqual(idle, [])
+        self.assertTrue(conns[0].sock is None)
+        self.assertTrue(conns[1].sock is None)
+
+
+class UnixSocketTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'upstream.sock')
+        self.server = UnixUpstreamServer(self.path)
+        self.pool = ConnectionPool()
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+        shutil.rmtree(self.dir)
+
+    def test_environ_key(self):
+        for i in range(2):
+            req = Request.blank('/page%s' % i)
+            req.environ['wsgiproxy.unix_socket'] = self.path
+            req.environ['wsgiproxy.connection_pool'] = self.pool
+            res = req.get_response(proxy_exact_request)
+            self.assertEqual(res.body, 'path=/page%s' % i)
+        self.assertEqual(len(self.server.connections), 1)
+        self.assertEqual(
+            len(self.pool.idle[('http+unix', self.path, None)]), 1)
+
+    def test_href(self):
+        app = WSGIProxyApp('http+unix://%s/base'
+                           % self.path.replace('/', '%2F'),
+                           connection_pool=self.pool)
+        req = Request.blank('/page')
+        req.environ['REMOTE_ADDR'] = '127.0.0.1'
+        res = req.get_response(app)
+        self.assertEqual(res.body, 'path=/base/page')
+        self.assertEqual(self.server.requests[0][2]['Host'], 'localhost:80')
+
+    def test_missing_socket(self):
+        req = Request.blank('/')
+        req.environ['wsgiproxy.unix_socket'] = self.path + '.missing'
+        res = req.get_response(proxy_exact_request)
+        self.assertEqual(res.status_int, 502)
+        self.assertTrue(self.path + '.missing' in res.body)
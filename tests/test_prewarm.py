@@ -0,0 +1,48 @@
+import time
+import unittest
+
+from wsgiproxy.prewarm import WarmPolicy, RequestRate, parse_time_of_day
+
+
+class WarmPolicyTests(unittest.TestCase):
+    def test_parse_time_of_day(self):
+        self.assertEqual(parse_time_of_day('09:30'), 570)
+        self.assertEqual(parse_time_of_day(9), 540)
+        self.assertEqual(parse_time_of_day('9.5'), 570)
+
+    def test_min_warm(self):
+        self.assertFalse(WarmPolicy().active())
+        self.assertEqual(WarmPolicy().warm_count(), 0)
+        self.assertEqual(WarmPolicy(min_warm=2).warm_count(), 2)
+
+    def test_schedule(self):
+        policy = WarmPolicy(schedule=[('09:00', '17:00', 3),
+                                      ('22:00', '02:00', 1)])
+        def at(hour, minute=0):
+            return time.mktime((2011, 6, 1, hour, minute, 0, 0, 0, -1))
+        self.assertEqual(policy.warm_count(at(8, 59)), 0)
+        self.assertEqual(policy.warm_count(at(9)), 3)
+        self.assertEqual(policy.warm_count(at(16, 59)), 3)
+        self.assertEqual(policy.warm_count(at(17)), 0)
+        self.assertEqual(policy.warm_count(at(23)), 1)
+        self.assertEqual(policy.warm_count(at(1)), 1)
+        self.assertEqual(policy.warm_count(at(2)), 0)
+
+    def test_rate(self):
+        policy = WarmPolicy(rate=0.5, rate_window=10)
+        now = 1000000
+        for i in range(4):
+            policy.record_request(now + i)
+        self.assertEqual(policy.warm_count(now + 5), 0)
+        policy.record_request(now + 5)
+        self.assertEqual(policy.warm_count(now + 5), 1)
+        # The requests age out of the window
+        self.assertEqual(policy.warm_count(now + 12), 0)
+
+    def test_request_rate(self):
+        rate = RequestRate(window=2)
+        for i in range(10):
+            rate.record(100 + i * 0.1)
+        self.assertEqual(rate.rate(100.9), 5.0)
+        self.assertEqual(rate.rate(102.5), 0.0)
+        self.assertEqual(len(rate.buckets), 0)
@@ -0,0 +1,189 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from webob import Request
+from wsgiproxy.app import WSGIProxyApp
+from wsgiproxy.middleware import WSGIProxyMiddleware
+from wsgiproxy.secretloader import SecretFile, Keyring
+from wsgiproxy.signature import (
+    Signer, ReplayCache, BadSignature, sign_request, check_request)
+
+
+def signed_environ(signer, now=None):
+    environ = Request.blank('/some/path?a=1').environ
+    environ['HTTP_X_WSGIPROXY_STR_0'] = 'key value'
+    signer.sign(environ, now)
+    return environ
+
+
+class SignerTests(unittest.TestCase):
+    def test_round_trip(self):
+        signer = Signer(secret='sekrit')
+        environ = signed_environ(signer)
+        signer.check(environ)
+        self.assertTrue('HTTP_X_WSGIPROXY_SIGNATURE' not in environ)
+        environ = Request.blank('/').environ
+        sign_request(environ, 'sekrit')
+        check_request(environ, 'sekrit')
+
+    def test_tampered(self):
+        signer = Signer(secret='sekrit')
+        for change in [('PATH_INFO', '/other'), ('QUERY_STRING', 'a=2'),
+                       ('REQUEST_METHOD', 'POST'),
+                       ('HTTP_X_WSGIPROXY_STR_0', 'key other'),
+                       ('HTTP_X_WSGIPROXY_PICKLE_0', 'key x')]:
+            environ = signed_environ(signer)
+            environ[change[0]] = change[1]
+            self.assertRaises(BadSignature, signer.check, environ)
+        environ = signed_environ(Signer(secret='other'))
+        self.assertRaises(BadSignature, signer.check, environ)
+        self.assertRaises(BadSignature, signer.check, {})
+        self.assertRaises(BadSignature, signer.check,
+                          {'HTTP_X_WSGIPROXY_SIGNATURE': 'junk'})
+
+    def test_window(self):
+        signer = Signer(secret='sekrit', window=60)
+        environ = signed_environ(signer, time.time() - 120)
+        self.assertRaises(BadSignature, signer.check, environ)
+
+    def test_replay(self):
+        signer = Signer(secret='sekrit')
+        environ = signed_environ(signer)
+        signer.check(environ.copy())
+        self.assertRaises(BadSignature, signer.check, environ)
+        self.assertEqual(len(signer.replay_cache), 1)
+
+    def test_replay_from_future(self):
+        # A signature from the future is still remembered when it
+        # would last be accepted
+        signer = Signer(secret='sekrit', window=60)
+        now = int(time.time())
+        environ = signed_environ(signer, now + 50)
+        signer.check(environ.copy(), now)
+        self.assertRaises(BadSignature, signer.check, environ.copy(),
+                          now + 100)
+        self.assertRaises(BadSignature, signer.check, environ.copy(),
+                          now + 110)
+
+
+class ReplayCacheTests(unittest.TestCase):
+    def test_expiry(self):
+        cache = ReplayCache(window=10, max_size=3)
+        self.assertTrue(cache.add('a', 100))
+        self.assertFalse(cache.add('a', 105))
+        # Forgotten after the window:
+        self.assertTrue(cache.add('a', 111))
+        for nonce in 'bcd':
+            cache.add(nonce, 112)
+        self.assertEqual(len(cache), 3)
+        self.assertEqual(sorted(cache.seen), ['b', 'c', 'd'])
+
+
+class SecretFileTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'secret')
+        self.write('one')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, secret, mtime=None):
+        f = open(self.path, 'wb')
+        f.write(secret)
+        f.close()
+        if mtime is not None:
+            os.utime(self.path, (mtime, mtime))
+
+    def test_reload(self):
+        secret = SecretFile(self.path, reload_interval=10)
+        now = time.time()
+        self.assertEqual(secret.get(now), 'one')
+        self.write('two', now + 5)
+        # Not looked at until the interval has passed:
+        self.assertEqual(secret.get(now + 1), 'one')
+        self.assertEqual(secret.get(now + 20), 'two')
+        self.write('three', now + 30)
+        secret = SecretFile(self.path, reload_interval=None)
+        self.write('four', now + 40)
+        self.assertEqual(secret.get(now + 1000), 'three')
+        secret.reload()
+        self.assertEqual(secret.get(), 'four')
+
+    def test_proxy(self):
+        environs = []
+        def backend(environ, start_response):
+            environs.append(environ)
+            start_response('200 OK', [])
+            return ['ok']
+        middleware = WSGIProxyMiddleware(backend, secret_file=self.path)
+        app = WSGIProxyApp('http://example.com/base', secret_file=self.path,
+                           pickle_keys=['myapp.tags'], engine=middleware)
+        req = Request.blank('/page?a=1')
+        req.environ['REMOTE_ADDR'] = '10.0.0.1'
+        req.environ['myapp.tags'] = set(['a'])
+        res = req.get_response(app)
+        self.assertEqual(res.status_int, 200)
+        self.assertEqual(environs[0]['myapp.tags'], set(['a']))
+        # Unsigned requests are refused:
+        res = Request.blank('/').get_response(middleware)
+        self.assertEqual(res.status_int, 403)
+
+
+class KeyringTests(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def keyring_dir(self, name, **keys):
+        path = os.path.join(self.dir, name)
+        if not os.path.exists(path):
+            os.mkdir(path)
+        for key_id, secret in keys.items():
+            f = open(os.path.join(path, key_id), 'wb')
+            f.write(secret)
+            f.close()
+        return path
+
+    def test_load(self):
+        path = self.keyring_dir('keys', **{'9': 'nine', '10': 'ten'})
+        self.assertEqual(Keyring(path).get(),
+                         ('10', {'9': 'nine', '10': 'ten'}))
+        self.keyring_dir('keys', current='9\n')
+        self.assertEqual(Keyring(path).get()[0], '9')
+        self.keyring_dir('keys', current='8')
+        self.assertRaises(ValueError, Keyring, path)
+        self.assertRaises(ValueError, Keyring, self.keyring_dir('empty'))
+        secret_file = os.path.join(self.dir, 'secret')
+        open(secret_file, 'wb').write('old')
+        self.assertEqual(Keyring(secret_file).get(), ('0', {'0': 'old'}))
+
+    def test_rotation(self):
+        proxy_keys = self.keyring_dir('proxy', **{'1': 'one'})
+        backend_keys = self.keyring_dir('backend', **{'1': 'one'})
+        proxy = Signer(proxy_keys, reload_interval=None)
+        backend = Signer(backend_keys, reload_interval=None)
+        backend.check(signed_environ(proxy))
+        # The backends learn the new key first...
+        self.keyring_dir('backend', **{'2': 'two'})
+        backend.keyring.reload()
+        backend.check(signed_environ(proxy))
+        # ...then the proxies start using it
+        self.keyring_dir('proxy', **{'2': 'two'})
+        proxy.keyring.reload()
+        environ = signed_environ(proxy)
+        self.assertTrue(environ['HTTP_X_WSGIPROXY_SIGNATURE'].startswith('2 '))
+        backend.check(environ)
+        # A broken keyring doesn't lose the keys:
+        os.rename(proxy_keys, proxy_keys + '.old')
+        proxy.keyring.reload_interval = 0
+        backend.check(signed_environ(proxy))
+        # A backend without the key refuses it:
+        old_backend = Signer(secret='one')
+        self.assertRaises(BadSignature, old_backend.check,
+                          signed_environ(proxy))
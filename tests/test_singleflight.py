@@ -0,0 +1,172 @@
+import threading
+import time
+import unittest
+
+from webob import Request
+from wsgiproxy.singleflight import SingleFlight
+
+
+class GatedApp(object):
+    """
+    Doesn't respond until `gate` is set; counts the requests it gets.
+    """
+
+    def __init__(self, body='hello', headers=None):
+        self.gate = threading.Event()
+        self.body = body
+        self.headers = headers
+        self.calls = 0
+
+    def __call__(self, environ, start_response):
+        self.calls += 1
+        self.gate.wait(5)
+        headers = self.headers
+        if headers is None:
+            headers = [('Content-Length', str(len(self.body)))]
+        start_response('200 OK', [('Content-Type', 'text/plain')] + headers)
+        # Stream it in small pieces
+        return [self.body[i:i + 3] for i in range(0, len(self.body), 3)]
+
+
+class FailingApp(GatedApp):
+    """
+    Sends the first chunk of the body, then fails.
+    """
+
+    def __call__(self, environ, start_response):
+        self.calls += 1
+        self.gate.wait(5)
+        start_response('200 OK', [('Content-Length', str(len(self.body)))])
+        return self.app_iter()
+
+    def app_iter(self):
+        yield self.body[:3]
+        raise IOError('upstream went away')
+
+
+class SingleFlightTests(unittest.TestCase):
+
+    def run_requests(self, app, upstream, count=5, make_request=None):
+        if make_request is None:
+            make_request = lambda i: Request.blank('/page?a=1')
+        results = [None] * count
+        def request(i):
+            try:
+                results[i] = make_request(i).get_response(app).body
+            except Exception, e:
+                results[i] = e
+        threads = [threading.Thread(target=request, args=(i,))
+                   for i in range(count)]
+        for t in threads:
+            t.start()
+        # Let them all arrive before the backend responds
+        for i in range(100):
+            if sum([flight.users for flight in app.flights.values()]) >= count:
+                break
+            time.sleep(0.01)
+        upstream.gate.set()
+        for t in threads:
+            t.join()
+        return results
+
+    def test_merged(self):
+        upstream = GatedApp(body='some longer response body')
+        app = SingleFlight(upstream)
+        results = self.run_requests(app, upstream)
+        self.assertEqual(results, ['some longer response body'] * 5)
+        self.assertEqual(upstream.calls, 1)
+        self.assertEqual(app.stats['merged'], 4)
+        self.assertEqual(app.flights, {})
+        # Later requests get a new flight
+        upstream.gate.clear()
+        self.run_requests(app, upstream, count=1)
+        self.assertEqual(upstream.calls, 2)
+
+    def test_not_identical(self):
+        upstream = GatedApp()
+        app = SingleFlight(upstream)
+        def make_request(i):
+            req = Request.blank('/page?a=%s' % (i % 2))
+            return req
+        self.run_requests(app, upstream, count=4, make_request=make_request)
+        self.assertEqual(upstream.calls, 2)
+        upstream = GatedApp()
+        app = SingleFlight(upstream)
+        def make_request(i):
+            req = Request.blank('/page')
+            req.environ['HTTP_COOKIE'] = 'session=%s' % i
+            return req
+        self.run_requests(app, upstream, count=3, make_request=make_request)
+        self.assertEqual(upstream.calls, 3)
+        self.assertEqual(
+            app.request_key(Request.blank('/', method='POST').environ), None)
+
+    def test_max_size(self):
+        upstream = GatedApp(body='x' * 100)
+        app = SingleFlight(upstream, max_size=50)
+        results = self.run_requests(app, upstream, count=3)
+        self.assertEqual(results, ['x' * 100] * 3)
+        self.assertEqual(upstream.calls, 3)
+        self.assertEqual(app.stats['not_merged'], 2)
+
+    def test_unknown_length(self):
+        upstream = GatedApp(body='x' * 100, headers=[])
+        app = SingleFlight(upstream, max_size=50)
+        results = self.run_requests(app, upstream, count=3)
+        self.assertEqual(results, ['x' * 100] * 3)
+        self.assertEqual(upstream.calls, 1)
+
+    def test_error(self):
+        def broken_app(environ, start_response):
+            raise ValueError('broken')
+        app = SingleFlight(broken_app)
+        self.assertRaises(ValueError, Request.blank('/').get_response, app)
+        self.assertEqual(app.flights, {})
+
+    def test_error_mid_body(self):
+        upstream = FailingApp(body='x' * 30)
+        app = SingleFlight(upstream)
+        results = self.run_requests(app, upstream, count=3)
+        self.assertEqual(upstream.calls, 1)
+        for result in results:
+            self.assertTrue(isinstance(result, IOError), result)
+        self.assertEqual(app.flights, {})
+
+    def test_write(self):
+        def writing_app(environ, start_response):
+            write = start_response('200 OK', [('Content-Type', 'text/plain')])
+            write('written, ')
+            return ['returned']
+        app = SingleFlight(writing_app)
+        res = Request.blank('/').get_response(app)
+        self.assertEqual(res.body, 'written, returned')
+
+    def test_chunks_dropped(self):
+        # A flight read by one request alone doesn't keep what it has
+        # passed on
+        upstream = GatedApp(body='x' * 30)
+        upstream.gate.set()
+        app = SingleFlight(upstream)
+        status, headers, app_iter = Request.blank('/').call_application(app)
+        flight = app_iter.flight
+        for chunk in app_iter:
+            self.assertTrue(len(flight.chunks) <= 1, flight.chunks)
+        self.assertEqual(flight.base, 10)
+        app_iter.close()
+        self.assertEqual(app.flights, {})
+        # Nor does one too large to share
+        app = SingleFlight(upstream, max_size=10)
+        status, headers, app_iter = Request.blank('/').call_application(app)
+        flight = app_iter.flight
+        self.assertFalse(flight.shared)
+        for chunk in app_iter:
+            self.assertTrue(len(flight.chunks) <= 1, flight.chunks)
+        app_iter.close()
+
+    def test_no_start_response(self):
+        def lazy_app(environ, start_response):
+            return ['never started']
+        app = SingleFlight(lazy_app)
+        self.assertRaises(AssertionError, Request.blank('/').get_response,
+                          app)
+        self.assertEqual(app.flights, {})
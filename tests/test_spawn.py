@@ -1,8 +1,334 @@
+import os
+import signal
+import socket
+import sys
+import threading
+import time
 import unittest
 
-from wsgiproxy.spawn import SpawningApplication
+from webob import Request
+from wsgiproxy.instrument import Instruments
+from wsgiproxy.readiness import StartupError
+from wsgiproxy.spawn import SpawningApplication, install_reload_handler
+
+spawned_app = os.path.join(os.path.dirname(__file__), 'spawned_app.py')
+start_script = '%s %s __PORT__' % (sys.executable, spawned_app)
+
+
+def get(app, path='/'):
+    req = Request.blank(path)
+    req.environ['REMOTE_ADDR'] = '127.0.0.1'
+    res = req.get_response(app)
+    # Read the body, so the request is finished
+    res.body
+    return res
 
 
 class SpawningApplicationTests(unittest.TestCase):
     def test_create(self):
         app = SpawningApplication(start_script='/usr/bin/true')
+
+    def test_bad_processes(self):
+        self.assertRaises(ValueError, SpawningApplication, start_script='x',
+                          min_processes=3, max_processes=2)
+        self.assertRaises(ValueError, SpawningApplication, start_script='x',
+                          spawned_port=8080, max_processes=2)
+
+    def test_spawn(self):
+        app = SpawningApplication(start_script)
+        try:
+            res = get(app)
+            self.assertEqual(res.status_int, 200)
+            pid = app.proc.pid
+            self.assertEqual(res.body, 'pid=%s' % pid)
+            self.assertEqual(get(app).body, 'pid=%s' % pid)
+            self.assertEqual(app.children[0].in_flight, 0)
+            # A subprocess that dies is replaced
+            proc = app.proc
+            app.proc.kill()
+            proc.wait()
+            res = get(app)
+            self.assertEqual(res.status_int, 200)
+            self.assertNotEqual(res.body, 'pid=%s' % pid)
+        finally:
+            app.close()
+        self.assertEqual(app.proc, None)
+
+    def test_instruments(self):
+        instruments = Instruments()
+        events = []
+        instruments.subscribe(events.append)
+        app = SpawningApplication(start_script, instruments=instruments)
+        try:
+            get(app)
+            get(app)
+        finally:
+            app.close()
+        first, second = events
+        self.assertEqual(first.source, 'spawn')
+        self.assertEqual(first.status, 200)
+        self.assertTrue(first.backend.startswith('127.0.0.1:'))
+        # Starting the subprocess is part of the first request:
+        self.assertTrue(first.phases['acquire'] > second.phases['acquire'])
+        self.assertEqual(first.reused, False)
+
+    def test_crash_on_start(self):
+        app = SpawningApplication(
+            '%s -c "import sys; sys.exit(3)"' % sys.executable)
+        instruments = Instruments()
+        events = []
+        instruments.subscribe(events.append)
+        app.instruments = instruments
+        res = get(app)
+        self.assertEqual(res.status_int, 502)
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0].status, 502)
+        self.assertTrue(isinstance(events[0].error, StartupError))
+        self.assertEqual(app.children, [])
+        self.assertEqual(app.allocated_ports, set())
+        self.assertEqual(app.stats['failed'], 1)
+
+    def test_start_timeout(self):
+        app = SpawningApplication(
+            '%s -c "import time; time.sleep(10)"' % sys.executable,
+            start_timeout=0.2)
+        start = time.time()
+        res = get(app)
+        self.assertEqual(res.status_int, 503)
+        self.assertTrue(int(res.headers['Retry-After']) >= 1)
+        self.assertTrue(time.time() - start < 2)
+        self.assertEqual(app.children, [])
+
+    def test_ready_checks(self):
+        for kw in [dict(ready='http', ready_path='/health'),
+                   dict(ready='stdout')]:
+            script = start_script
+            if kw['ready'] == 'stdout':
+                script += ' --ready'
+            app = SpawningApplication(script, **kw)
+            try:
+                self.assertEqual(get(app).status_int, 200)
+                self.assertEqual(app.stats['spawned'], 1)
+                self.assertTrue(0 < app.stats['last_startup_time'] < 5)
+            finally:
+                app.close()
+        self.assertRaises(ValueError, SpawningApplication, 'x', ready='bad')
+
+    def test_bind_socket(self):
+        app = SpawningApplication('%s %s --fd __FD__'
+                                  % (sys.executable, spawned_app),
+                                  bind_socket=True)
+        try:
+            res = get(app)
+            self.assertEqual(res.body, 'pid=%s' % app.proc.pid)
+            child = app.children[0]
+            port = child.port
+            # A replacement gets the same socket (and port)
+            child.proc.kill()
+            child.proc.wait()
+            res = get(app)
+            self.assertEqual(res.body, 'pid=%s' % app.proc.pid)
+            self.assertEqual(app.children[0].port, port)
+            self.assertEqual(app.free_sockets, [])
+        finally:
+            app.close()
+
+    def test_unix_socket(self):
+        app = SpawningApplication('%s %s --unix __SOCKET__'
+                                  % (sys.executable, spawned_app),
+                                  unix_socket=True)
+        try:
+            res = get(app)
+            self.assertEqual(res.body, 'pid=%s' % app.proc.pid)
+            path = app.children[0].socket_path
+            self.assertTrue(path.startswith(app.unix_socket))
+            self.assertEqual(app.allocated_ports, set())
+        finally:
+            app.close()
+        self.assertFalse(os.path.exists(app.unix_socket))
+        app = SpawningApplication('%s %s --fd __FD__ --unix'
+                                  % (sys.executable, spawned_app),
+                                  unix_socket=True, bind_socket=True)
+        try:
+            res = get(app)
+            self.assertEqual(res.body, 'pid=%s' % app.proc.pid)
+        finally:
+            app.close()
+        self.assertFalse(os.path.exists(app.unix_socket))
+
+    def test_min_warm(self):
+        app = SpawningApplication(start_script, idle_shutdown=0.1,
+                                  min_warm=1, warm_interval=0.05)
+        try:
+            # Started without any request
+            for i in range(100):
+                if app.children:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(len(app.children), 1)
+            get(app)
+            time.sleep(0.3)
+            # Not shut down for idleness
+            self.assertEqual(len(app.children), 1)
+        finally:
+            app.close()
+
+    def test_cold_wait(self):
+        app = SpawningApplication(start_script, cold_wait=0)
+        try:
+            res = get(app)
+            self.assertEqual(res.status_int, 503)
+            self.assertEqual(res.headers['Retry-After'], '1')
+            for i in range(100):
+                if app.children:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(get(app).status_int, 200)
+        finally:
+            app.close()
+        app = SpawningApplication(start_script, cold_wait=5)
+        try:
+            self.assertEqual(get(app).status_int, 200)
+        finally:
+            app.close()
+        app = SpawningApplication(
+            '%s -c "import sys; sys.exit(3)"' % sys.executable, cold_wait=5)
+        self.assertEqual(get(app).status_int, 503)
+
+    def test_reload(self):
+        app = SpawningApplication(start_script)
+        try:
+            old_body = get(app).body
+            old_proc = app.proc
+            results = []
+            slow = threading.Thread(
+                target=lambda: results.append(get(app, '/?sleep=0.5')))
+            slow.start()
+            while not app.children[0].in_flight:
+                time.sleep(0.01)
+            reloader = threading.Thread(target=app.reload)
+            reloader.start()
+            for i in range(100):
+                if app.proc is not old_proc:
+                    break
+                time.sleep(0.05)
+            # New requests go to the new subprocess while the old one
+            # finishes its request
+            new_body = get(app).body
+            self.assertNotEqual(new_body, old_body)
+            self.assertEqual(old_proc.poll(), None)
+            slow.join()
+            reloader.join()
+            self.assertEqual(results[0].status_int, 200)
+            self.assertEqual(results[0].body, old_body)
+            old_proc.wait()
+            self.assertEqual(get(app).body, new_body)
+        finally:
+            app.close()
+
+    def test_reload_fixed_port(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        app = SpawningApplication(start_script, spawned_port=port)
+        try:
+            old_body = get(app).body
+            # The new subprocess couldn't listen on the same port
+            self.assertRaises(ValueError, app.reload)
+            self.assertEqual(get(app).body, old_body)
+            proc = app.proc
+        finally:
+            app.close()
+        # Wait until the port is free again
+        proc.wait()
+        app = SpawningApplication('%s %s --fd __FD__'
+                                  % (sys.executable, spawned_app),
+                                  spawned_port=port, bind_socket=True)
+        try:
+            old_body = get(app).body
+            old_proc = app.proc
+            sock = app.children[0].socket
+            app.reload()
+            old_proc.wait()
+            # The new subprocess took over the socket
+            self.assertEqual(app.children[0].socket, sock)
+            self.assertEqual(app.children[0].port, port)
+            for i in range(3):
+                res = get(app)
+                self.assertEqual(res.status_int, 200)
+                self.assertEqual(res.body, 'pid=%s' % app.proc.pid)
+            self.assertNotEqual(res.body, old_body)
+            self.assertEqual(app.free_sockets, [])
+        finally:
+            app.close()
+        self.assertEqual(app.free_sockets, [])
+
+    def test_reload_handler(self):
+        old_handler = signal.getsignal(signal.SIGUSR1)
+        app = SpawningApplication(start_script)
+        try:
+            install_reload_handler(signal.SIGUSR1, drain_timeout=1)
+            old_pid = app.proc.pid if get(app) else None
+            os.kill(os.getpid(), signal.SIGUSR1)
+            for i in range(100):
+                if app.proc is not None and app.proc.pid != old_pid:
+                    break
+                time.sleep(0.05)
+            self.assertNotEqual(get(app).body, 'pid=%s' % old_pid)
+        finally:
+            signal.signal(signal.SIGUSR1, old_handler)
+            app.close()
+
+    def test_stdout_without_ready_line(self):
+        app = SpawningApplication(
+            '%s -c "print 1"' % sys.executable, ready='stdout')
+        self.assertEqual(get(app).status_int, 502)
+
+    def test_pool(self):
+        app = SpawningApplication(start_script, min_processes=2,
+                                  max_processes=3, grow_in_flight=1,
+                                  shrink_after=0.2)
+        try:
+            get(app)
+            self.assertEqual(len(app.children), 2)
+            ports = set([child.port for child in app.children])
+            self.assertEqual(len(ports), 2)
+            # Requests are spread over the children
+            pids = set([get(app).body for i in range(4)])
+            self.assertEqual(len(pids), 2)
+            # Keep both busy, so a third is started
+            threads = [threading.Thread(target=get, args=(app, '/?sleep=0.5'))
+                       for i in range(3)]
+            for t in threads:
+                t.start()
+            for i in range(100):
+                if len(app.children) == 3:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(len(app.children), 3)
+            for t in threads:
+                t.join()
+            # And it is shut down again once idle
+            for i in range(100):
+                if len(app.children) == 2:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(len(app.children), 2)
+        finally:
+            app.close()
+
+    def test_idle_shutdown(self):
+        app = SpawningApplication(start_script, idle_shutdown=0.2)
+        try:
+            get(app)
+            proc = app.proc
+            for i in range(100):
+                if not app.children:
+                    break
+                time.sleep(0.05)
+            self.assertEqual(app.children, [])
+            proc.wait()
+            self.assertEqual(get(app).status_int, 200)
+        finally:
+            app.close()
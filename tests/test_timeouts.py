@@ -0,0 +1,112 @@
+import socket
+import time
+import unittest
+
+from webob import Request
+from wsgiproxy.app import WSGIProxyApp
+from wsgiproxy.exactproxy import proxy_exact_request, get_timeout
+from wsgiproxy.middleware import WSGIProxyMiddleware
+from tests.upstream import UpstreamServer
+
+
+def slow_handler(handler, body):
+    time.sleep(0.3)
+    return 200, [], 'slow'
+
+def slow_body_handler(handler, body):
+    handler.send_response(200)
+    handler.send_header('Content-Length', '10')
+    handler.end_headers()
+    handler.wfile.write('12345')
+    handler.wfile.flush()
+    time.sleep(0.3)
+    handler.wfile.write('67890')
+    return None
+
+
+class TimeoutTests(unittest.TestCase):
+    def setUp(self):
+        self.server = UpstreamServer()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def make_request(self, **timeouts):
+        req = Request.blank('/')
+        req.environ['SERVER_NAME'] = '127.0.0.1'
+        req.environ['SERVER_PORT'] = str(self.server.port)
+        for name, value in timeouts.items():
+            req.environ['wsgiproxy.%s' % name] = value
+        return req
+
+    def test_get_timeout(self):
+        now = time.time()
+        environ = {'wsgiproxy.read_timeout': 5,
+                   'wsgiproxy.deadline': now + 2}
+        self.assertTrue(1 < get_timeout(environ, 'read_timeout') <= 2)
+        self.assertEqual(get_timeout({}, 'read_timeout', 3), 3)
+        environ['wsgiproxy.deadline'] = now - 1
+        self.assertRaises(socket.timeout, get_timeout, environ, 'x')
+
+    def test_first_byte_timeout(self):
+        self.server.handler = slow_handler
+        req = self.make_request(first_byte_timeout=0.05)
+        res = req.get_response(proxy_exact_request)
+        self.assertEqual(res.status_code, 504)
+        self.assertTrue(isinstance(req.environ['wsgiproxy.upstream_error'],
+                                   socket.timeout))
+
+    def test_deadline(self):
+        self.server.handler = slow_handler
+        req = self.make_request(deadline=time.time() + 0.05)
+        res = req.get_response(proxy_exact_request)
+        self.assertEqual(res.status_code, 504)
+
+    def test_within_timeouts(self):
+        req = self.make_request(connect_timeout=5, first_byte_timeout=5,
+                                read_timeout=5)
+        res = req.get_response(proxy_exact_request)
+        self.assertEqual(res.body, 'path=/')
+
+    def test_read_timeout(self):
+        self.server.handler = slow_body_handler
+        req = self.make_request(read_timeout=0.05, chunk_size=5)
+        app_iter = proxy_exact_request(req.environ, lambda *args: None)
+        self.assertEqual(app_iter.next(), '12345')
+        self.assertRaises(socket.timeout, app_iter.next)
+        app_iter.close()
+
+
+class DeadlinePropagationTests(unittest.TestCase):
+    def setUp(self):
+        self.server = UpstreamServer()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_app_sends_deadline(self):
+        app = WSGIProxyApp('http://127.0.0.1:%s' % self.server.port,
+                           total_timeout=10)
+        req = Request.blank('/', environ={'REMOTE_ADDR': '127.0.0.1'})
+        req.get_response(app)
+        remaining = float(self.server.requests[0][2]['X-WSGIProxy-Deadline'])
+        self.assertTrue(9 < remaining <= 10)
+
+    def test_app_timeout(self):
+        self.server.handler = slow_handler
+        app = WSGIProxyApp('http://127.0.0.1:%s' % self.server.port,
+                           first_byte_timeout=0.05)
+        req = Request.blank('/', environ={'REMOTE_ADDR': '127.0.0.1'})
+        self.assertEqual(req.get_response(app).status_code, 504)
+
+    def test_middleware_reads_deadline(self):
+        environs = []
+        def app(environ, start_response):
+            environs.append(environ)
+            start_response('200 OK', [])
+            return []
+        environ = {'HTTP_X_WSGIPROXY_DEADLINE': '2.5'}
+        WSGIProxyMiddleware(app)(environ, lambda *args: None)
+        deadline = environs[0]['wsgiproxy.deadline']
+        self.assertTrue(time.time() + 2 < deadline <= time.time() + 2.5)
+        self.assertTrue('HTTP_X_WSGIPROXY_DEADLINE' not in environs[0])
@@ -0,0 +1,120 @@
+import unittest
+
+from webob import Request
+from wsgiproxy.app import WSGIProxyApp
+from wsgiproxy.instrument import RequestEvent, Instruments
+from wsgiproxy.middleware import WSGIProxyMiddleware
+from wsgiproxy.pool import ConnectionPool
+from wsgiproxy.tracing import TraceContext, parse_traceparent, server_timing
+from tests.upstream import UpstreamServer
+
+traceparent = '00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01'
+
+
+class RecordingApp(object):
+    def __init__(self):
+        self.environs = []
+
+    def __call__(self, environ, start_response):
+        self.environs.append(environ.copy())
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return ['ok']
+
+
+def get(app, headers=()):
+    req = Request.blank('/')
+    req.environ['REMOTE_ADDR'] = '127.0.0.1'
+    req.headers.update(headers)
+    res = req.get_response(app)
+    res.body
+    return req, res
+
+
+class TraceContextTests(unittest.TestCase):
+    def test_parse(self):
+        trace = parse_traceparent(traceparent, 'a=b')
+        self.assertEqual(trace.trace_id, '4bf92f3577b34da6a3ce929d0e0e4736')
+        self.assertEqual(trace.span_id, '00f067aa0ba902b7')
+        self.assertTrue(trace.sampled)
+        self.assertEqual(trace.tracestate, 'a=b')
+        self.assertEqual(trace.traceparent, traceparent)
+        # Later versions can add fields:
+        self.assertEqual(
+            parse_traceparent('01' + traceparent[2:] + '-more').span_id,
+            '00f067aa0ba902b7')
+        for bad in [None, '', 'garbage', traceparent + '-more',
+                    'ff' + traceparent[2:],
+                    traceparent.replace('4bf92f3577b34da6a3ce929d0e0e4736',
+                                        '0' * 32),
+                    traceparent.replace('00f067aa0ba902b7', '0' * 16),
+                    traceparent[:-1]]:
+            self.assertEqual(parse_traceparent(bad), None, bad)
+
+    def test_child(self):
+        trace = TraceContext.new()
+        child = trace.child()
+        self.assertEqual(child.trace_id, trace.trace_id)
+        self.assertNotEqual(child.span_id, trace.span_id)
+        self.assertEqual(len(child.traceparent), 55)
+
+    def test_server_timing(self):
+        event = RequestEvent(Instruments(), 'app', now=100)
+        event.phases = {'prepare': 0.001, 'dns': 0.002, 'connect': 0.003}
+        self.assertEqual(
+            server_timing(event, now=100.026),
+            'queue;dur=1.000, connect;dur=5.000, upstream;dur=20.000')
+
+
+class PropagationTests(unittest.TestCase):
+    def test_forwarded(self):
+        backend = RecordingApp()
+        app = WSGIProxyApp('http://example.com', trace=True,
+                           engine=WSGIProxyMiddleware(backend))
+        req, res = get(app, {'traceparent': traceparent,
+                             'tracestate': 'vendor=1'})
+        proxy_trace = req.environ['wsgiproxy.trace']
+        self.assertEqual(proxy_trace.trace_id,
+                         '4bf92f3577b34da6a3ce929d0e0e4736')
+        self.assertNotEqual(proxy_trace.span_id, '00f067aa0ba902b7')
+        received = backend.environs[0]['wsgiproxy.trace']
+        self.assertEqual(received.trace_id, proxy_trace.trace_id)
+        self.assertEqual(received.span_id, proxy_trace.span_id)
+        self.assertEqual(received.tracestate, 'vendor=1')
+
+    def test_started(self):
+        backend = RecordingApp()
+        app = WSGIProxyApp('http://example.com', trace=True,
+                           engine=WSGIProxyMiddleware(backend))
+        req, res = get(app, {'traceparent': 'bogus', 'tracestate': 'x=1'})
+        environ = backend.environs[0]
+        self.assertEqual(environ['HTTP_TRACEPARENT'],
+                         req.environ['wsgiproxy.trace'].traceparent)
+        self.assertTrue('HTTP_TRACESTATE' not in environ)
+        self.assertEqual(environ['wsgiproxy.trace'].tracestate, None)
+
+    def test_disabled(self):
+        backend = RecordingApp()
+        app = WSGIProxyApp('http://example.com',
+                           engine=WSGIProxyMiddleware(backend))
+        req, res = get(app, {'traceparent': traceparent})
+        self.assertTrue('wsgiproxy.trace' not in req.environ)
+        self.assertEqual(backend.environs[0]['HTTP_TRACEPARENT'], traceparent)
+        self.assertTrue('Server-Timing' not in res.headers)
+
+    def test_server_timing(self):
+        server = UpstreamServer(lambda handler, body: (
+            200, [('Server-Timing', 'db;dur=5')], 'ok'))
+        pool = ConnectionPool()
+        try:
+            app = WSGIProxyApp('http://127.0.0.1:%s' % server.port,
+                               connection_pool=pool, server_timing=True)
+            req, res = get(app)
+        finally:
+            pool.close()
+            server.stop()
+        timings = res.headers.getall('Server-Timing')
+        self.assertEqual(timings[0], 'db;dur=5')
+        names = [metric.split(';')[0] for metric in timings[1].split(', ')]
+        self.assertEqual(names, ['queue', 'connect', 'upstream'])
+        self.assertTrue(float(timings[1].split('connect;dur=')[1]
+                              .split(',')[0]) > 0)
@@ -0,0 +1,81 @@
+import unittest
+from cStringIO import StringIO
+
+from webob import Request
+from wsgiproxy import exactproxy
+from wsgiproxy.exactproxy import proxy_exact_request, LimitedInput
+from wsgiproxy.pool import ConnectionPool
+from tests.upstream import UpstreamServer
+
+
+def echo_handler(handler, body):
+    info = '%s %s' % (len(body), handler.headers.getheader('transfer-encoding'))
+    return 200, [], info
+
+
+class TrackingInput(object):
+    """wsgi.input that records the largest read"""
+
+    def __init__(self, data):
+        self.data = StringIO(data)
+        self.largest_read = 0
+
+    def read(self, size=-1):
+        self.largest_read = max(self.largest_read, size)
+        return self.data.read(size)
+
+
+class UploadTests(unittest.TestCase):
+    def setUp(self):
+        self.server = UpstreamServer(echo_handler)
+        self.pool = ConnectionPool()
+
+    def tearDown(self):
+        self.pool.close()
+        self.server.stop()
+
+    def make_request(self, body, content_length=None):
+        req = Request.blank('/upload', method='POST')
+        req.environ['SERVER_NAME'] = '127.0.0.1'
+        req.environ['SERVER_PORT'] = str(self.server.port)
+        req.environ['wsgiproxy.connection_pool'] = self.pool
+        req.environ['wsgi.input'] = TrackingInput(body)
+        if content_length is None:
+            req.environ.pop('CONTENT_LENGTH', None)
+        else:
+            req.environ['CONTENT_LENGTH'] = str(content_length)
+        return req
+
+    def test_large_upload_is_streamed(self):
+        body = 'x' * (exactproxy.upload_chunk_size * 5 + 3)
+        req = self.make_request(body, len(body))
+        res = req.get_response(proxy_exact_request)
+        self.assertEqual(res.body, '%s None' % len(body))
+        self.assertEqual(self.server.bodies[0], body)
+        self.assertTrue(
+            req.environ['wsgi.input'].largest_read
+            <= exactproxy.upload_chunk_size)
+
+    def test_chunked_upload(self):
+        body = 'y' * (exactproxy.upload_chunk_size * 2 + 10)
+        req = self.make_request(body)
+        req.environ['HTTP_TRANSFER_ENCODING'] = 'chunked'
+        res = req.get_response(proxy_exact_request)
+        self.assertEqual(res.body, '%s chunked' % len(body))
+        self.assertEqual(self.server.bodies[0], body)
+
+    def test_input_terminated(self):
+        req = self.make_request('some data')
+        req.environ['wsgi.input_terminated'] = True
+        res = req.get_response(proxy_exact_request)
+        self.assertEqual(res.body, '9 chunked')
+
+    def test_no_length(self):
+        req = self.make_request('ignored')
+        res = req.get_response(proxy_exact_request)
+        self.assertEqual(res.body, '0 None')
+
+    def test_limited_input_disconnect(self):
+        body = LimitedInput(StringIO('short'), 10)
+        self.assertEqual(body.read(), 'short')
+        self.assertRaises(IOError, body.read)
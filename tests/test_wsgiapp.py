@@ -1,9 +1,37 @@
+import os
+import shutil
+import tempfile
 import unittest
 
-from wsgiproxy.wsgiapp import make_app
+from wsgiproxy.wsgiapp import make_app, make_middleware
 
 
 class MiscTests(unittest.TestCase):
     def test_make_app(self):
         global_conf = {}
         app = make_app(global_conf, href='http://example.com/testform')
+
+    def test_envelope(self):
+        href = 'http://example.com/testform'
+        app = make_app({}, href=href)
+        self.assertEqual(app.envelope, 'auto')
+        app = make_app({}, href=href, envelope='true')
+        self.assertTrue(app.envelope is True)
+        app = make_app({}, href=href, envelope='false')
+        self.assertTrue(app.envelope is False)
+
+    def test_make_middleware(self):
+        dir = tempfile.mkdtemp()
+        try:
+            secret_file = os.path.join(dir, 'secret')
+            f = open(secret_file, 'wb')
+            f.write('secret')
+            f.close()
+            middleware = make_middleware(
+                None, {'secret_file': secret_file}, lazy='true',
+                signature_window='60', secret_reload_interval='30')
+            self.assertTrue(middleware.lazy)
+            self.assertEqual(middleware.signer.window, 60)
+            self.assertEqual(middleware.signer.keyring.reload_interval, 30)
+        finally:
+            shutil.rmtree(dir)
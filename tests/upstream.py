@@ -0,0 +1,117 @@
+"""
+A small keep-alive HTTP server run in a thread, used as the upstream
+for tests that need real sockets.
+"""
+import BaseHTTPServer
+import SocketServer
+import os
+import socket
+import threading
+
+
+class UpstreamHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connections.append(self.connection)
+
+    def respond(self):
+        server = self.server
+        server.requests.append((self.command, self.path, self.headers))
+        length = self.headers.getheader('content-length')
+        if length:
+            body = self.rfile.read(int(length))
+        elif self.headers.getheader('transfer-encoding') == 'chunked':
+            body = self.read_chunked()
+        else:
+            body = ''
+        server.bodies.append(body)
+        status, headers, content = server.handler(self, body)
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        if isinstance(content, list):
+            # Send each item as a separate chunk
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            for chunk in content + ['']:
+                self.wfile.write('%x\r\n%s\r\n' % (len(chunk), chunk))
+            return
+        if content is not None:
+            self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        if content and self.command != 'HEAD':
+            self.wfile.write(content)
+
+    def read_chunked(self):
+        chunks = []
+        while 1:
+            size = int(self.rfile.readline().strip(), 16)
+            chunks.append(self.rfile.read(size))
+            self.rfile.readline()
+            if not size:
+                return ''.join(chunks)
+
+    do_GET = do_HEAD = do_POST = do_PUT = do_DELETE = respond
+
+
+def default_handler(handler, body):
+    return 200, [('Content-Type', 'text/plain')], 'path=%s' % handler.path
+
+
+class UpstreamServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, handler=default_handler, address=('127.0.0.1', 0)):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, address, UpstreamHandler)
+        self.handler = handler
+        self.requests = []
+        self.bodies = []
+        self.connections = []
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       kwargs=dict(poll_interval=0.05))
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def handle_error(self, request, client_address):
+        # Tests drop connections on purpose
+        pass
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        # Don't leave handler threads waiting on kept-alive connections
+        for conn in self.connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+
+class UnixUpstreamServer(UpstreamServer):
+    """
+    The same server, listening on a Unix domain socket at `path`.
+    """
+    address_family = socket.AF_UNIX
+
+    def __init__(self, path, handler=default_handler):
+        UpstreamServer.__init__(self, handler, path)
+
+    def server_bind(self):
+        SocketServer.TCPServer.server_bind(self)
+        self.server_name = 'localhost'
+        self.server_port = 80
+
+    def stop(self):
+        UpstreamServer.stop(self)
+        os.unlink(self.server_address)
@@ -2,3 +2,6 @@
 # Licensed under the MIT license: http://www.opensource.org/licenses/mit-license.php
 #
 protocol_version = '0.1'
+# All the versions wsgiproxy.middleware understands (0.2 adds
+# wsgiproxy.envelope):
+protocol_versions = ('0.1', '0.2')
@@ -0,0 +1,570 @@
+"""
+An asyncio proxy engine, an alternative to the blocking
+:mod:`wsgiproxy.exactproxy`.
+
+:func:`proxy_request` is a coroutine that takes the same environment
+as :func:`wsgiproxy.exactproxy.proxy_exact_request` (the request is
+sent to ``SERVER_NAME:SERVER_PORT``, with the headers from the
+``HTTP_*`` keys, leaving out hop-by-hop headers) and returns an
+:class:`AsyncResponse` whose body is read chunk by chunk.  Any number
+of requests can be in flight on one event loop, sharing the
+keep-alive connections of an :class:`AsyncConnectionPool`.  It can be
+called directly from an asyncio server.
+
+:class:`AsyncEngine` runs an event loop in a background thread and
+exposes it as a WSGI application, which is what
+``WSGIProxyApp(engine='asyncio')`` uses.  WSGI workers still wait for
+their response, but all upstream I/O is multiplexed on the one loop
+thread.
+
+This requires `trollius <https://pypi.python.org/pypi/trollius>`_,
+the asyncio port for Python 2.
+"""
+
+import socket
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import trollius as asyncio
+from trollius import From, Return
+from paste import httpexceptions
+from wsgiproxy.exactproxy import (
+    request_headers, request_path, request_body, filtered_headers,
+    chunk_size, get_timeout, upstream_name)
+from wsgiproxy.pool import connection_key, idempotent_methods
+
+__all__ = ['proxy_request', 'AsyncResponse', 'AsyncConnectionPool',
+           'AsyncEngine']
+
+class UpstreamClosed(IOError):
+    """
+    The upstream server closed the connection before sending a
+    response.
+    """
+
+
+class CountingStreamReader(asyncio.StreamReader):
+    """
+    A StreamReader that counts the bytes it is fed, so the pool can
+    tell whether anything arrived on a connection while it was idle.
+    """
+
+    bytes_received = 0
+
+    def feed_data(self, data):
+        self.bytes_received += len(data)
+        asyncio.StreamReader.feed_data(self, data)
+
+
+class AsyncConnectionPool(object):
+
+    """
+    Idle keep-alive connections (``(reader, writer)`` stream pairs),
+    keyed by ``(scheme, host, port)``, like
+    :class:`wsgiproxy.pool.ConnectionPool`.  The pool is only used
+    from its event loop's thread, so it needs no locking.
+    """
+
+    def __init__(self, max_idle=10, idle_timeout=60, loop=None):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.loop = loop
+        # Maps keys to a list of (reader, writer, time_released,
+        # bytes_received):
+        self.idle = {}
+
+    @asyncio.coroutine
+    def get(self, key, timeout=None):
+        """
+        Returns ``(reader, writer, reused)`` for the key, opening a
+        new connection if there is no usable idle one.
+        """
+        conns = self.idle.get(key)
+        now = time.time()
+        while conns:
+            reader, writer, released, received = conns.pop()
+            if (now - released > self.idle_timeout or reader.at_eof()
+                or reader.exception() is not None
+                or reader.bytes_received != received):
+                # Expired, or the server closed it or sent something
+                writer.close()
+                continue
+            raise Return((reader, writer, True))
+        reader, writer = yield From(self.connect(key, timeout))
+        raise Return((reader, writer, False))
+
+    @asyncio.coroutine
+    def connect(self, key, timeout=None):
+        # Like asyncio.open_connection(), but with a CountingStreamReader
+        scheme, host, port = key
+        loop = self.loop
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        reader = CountingStreamReader(loop=loop)
+        protocol = asyncio.StreamReaderProtocol(reader, loop=loop)
+        if scheme == 'http+unix':
+            connecting = loop.create_unix_connection(lambda: protocol, host)
+        elif scheme in ('http', 'https'):
+            connecting = loop.create_connection(
+                lambda: protocol, host, int(port),
+                ssl=scheme == 'https' or None)
+        else:
+            raise ValueError(
+                "Unknown scheme: %r" % scheme)
+        transport, protocol = yield From(asyncio.wait_for(
+            connecting, timeout, loop=loop))
+        writer = asyncio.StreamWriter(transport, protocol, reader, loop)
+        raise Return((reader, writer))
+
+    def put(self, key, reader, writer):
+        conns = self.idle.setdefault(key, [])
+        if len(conns) >= self.max_idle:
+            conns.pop(0)[1].close()
+        conns.append((reader, writer, time.time(), reader.bytes_received))
+
+    def close(self):
+        idle = self.idle
+        self.idle = {}
+        for conns in idle.values():
+            for reader, writer, released, received in conns:
+                writer.close()
+
+
+class AsyncResponse(object):
+
+    """
+    A response from :func:`proxy_request`.  ``status`` is the status
+    line (e.g., ``'200 OK'``) and ``headers`` a list of WSGI-style
+    headers.  Read the body with ``yield From(response.read())``,
+    which returns ``''`` at the end, and call :meth:`close` when done
+    (this returns the connection to the pool if possible).
+    """
+
+    def __init__(self, status_code, reason, headers, reader, writer,
+                 method, version='HTTP/1.1', pool=None, key=None,
+                 timeout=None, deadline=None, chunk_size=chunk_size,
+                 loop=None):
+        self.status_code = status_code
+        self.status = '%s %s' % (status_code, reason)
+        self.reader = reader
+        self.writer = writer
+        self.pool = pool
+        self.key = key
+        self.timeout = timeout
+        self.deadline = deadline
+        self.chunk_size = chunk_size
+        self.loop = loop
+        self.headers = []
+        header_dict = {}
+        for name, value in headers:
+            header_dict[name.lower()] = value
+            if name.lower() not in filtered_headers:
+                self.headers.append((name, value))
+        connection = header_dict.get('connection', '').lower()
+        if version == 'HTTP/1.0':
+            self.keep_alive = 'keep-alive' in connection
+        else:
+            self.keep_alive = 'close' not in connection
+        self.chunked = (
+            'chunked' in header_dict.get('transfer-encoding', '').lower())
+        self.remaining = None
+        if (method == 'HEAD' or status_code in (204, 304)
+            or 100 <= status_code < 200):
+            self.remaining = 0
+            self.chunked = False
+        elif self.chunked:
+            self.chunk_left = 0
+        elif 'content-length' in header_dict:
+            try:
+                self.remaining = int(header_dict['content-length'])
+            except ValueError:
+                self.remaining = -1
+            if self.remaining < 0:
+                raise UpstreamClosed("Bad Content-Length: %r"
+                                     % header_dict['content-length'])
+        else:
+            # Body is ended by closing the connection
+            self.keep_alive = False
+        self.done = self.remaining == 0
+
+    @asyncio.coroutine
+    def read(self):
+        """
+        Returns the next piece of the body, or ``''`` at the end.
+        """
+        if self.done or self.reader is None:
+            raise Return('')
+        if self.chunked:
+            data = yield From(self._read_chunked())
+        else:
+            size = self.chunk_size
+            if self.remaining is not None:
+                size = min(size, self.remaining)
+            data = yield From(self._wait(self.reader.read(size)))
+            if self.remaining is not None:
+                if not data:
+                    raise UpstreamClosed(
+                        "Connection closed with %s bytes of the response "
+                        "left" % self.remaining)
+                self.remaining -= len(data)
+                if not self.remaining:
+                    self.done = True
+            elif not data:
+                self.done = True
+        raise Return(data)
+
+    @asyncio.coroutine
+    def _read_chunked(self):
+        reader = self.reader
+        if not self.chunk_left:
+            line = yield From(self._wait(reader.readline()))
+            try:
+                self.chunk_left = int(line.split(';', 1)[0].strip(), 16)
+            except ValueError:
+                raise UpstreamClosed("Bad chunk header: %r" % line)
+            if not self.chunk_left:
+                # The last chunk; skip any trailers
+                while 1:
+                    line = yield From(self._wait(reader.readline()))
+                    if line in ('\r\n', '\n', ''):
+                        break
+                self.done = True
+                raise Return('')
+        data = yield From(self._wait(
+            reader.read(min(self.chunk_left, self.chunk_size))))
+        if not data:
+            raise UpstreamClosed("Connection closed in a chunk")
+        self.chunk_left -= len(data)
+        if not self.chunk_left:
+            # The CRLF ending the chunk
+            yield From(self._wait(reader.readline()))
+        raise Return(data)
+
+    def _wait(self, coro):
+        timeout = self.timeout
+        if self.deadline is not None:
+            remaining = max(0, self.deadline - time.time())
+            if timeout is None or remaining < timeout:
+                timeout = remaining
+        return asyncio.wait_for(coro, timeout, loop=self.loop)
+
+    @asyncio.coroutine
+    def read_all(self):
+        """
+        Reads and returns the entire rest of the body.
+        """
+        chunks = []
+        while 1:
+            data = yield From(self.read())
+            if not data:
+                break
+            chunks.append(data)
+        raise Return(''.join(chunks))
+
+    def close(self):
+        if self.writer is None:
+            return
+        if self.done and self.keep_alive and self.pool is not None:
+            self.pool.put(self.key, self.reader, self.writer)
+        else:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+@asyncio.coroutine
+def proxy_request(environ, pool=None, timeout=None, loop=None):
+    """
+    Sends the request in `environ` upstream and returns an
+    :class:`AsyncResponse` once the response headers have been read.
+
+    `pool` is an :class:`AsyncConnectionPool` (by default
+    ``environ['wsgiproxy.async_pool']``, or no pooling).  The same
+    timeout keys as ``proxy_exact_request`` are used
+    (``wsgiproxy.connect_timeout``, ``wsgiproxy.first_byte_timeout``,
+    ``wsgiproxy.read_timeout`` and ``wsgiproxy.deadline``); `timeout`
+    (default ``environ['wsgiproxy.timeout']``) is used for any of
+    these that aren't given.  When time runs out
+    ``asyncio.TimeoutError`` is raised.
+
+    The request body is read from ``wsgi.input``, which may be a
+    normal file-like object or an ``asyncio.StreamReader``.  Reading a
+    file-like object blocks, so that is done in the loop's default
+    executor.
+    """
+    if loop is None:
+        loop = asyncio.get_event_loop()
+    if pool is None:
+        pool = environ.get('wsgiproxy.async_pool')
+    if timeout is None:
+        timeout = environ.get('wsgiproxy.timeout')
+    key = connection_key(environ)
+    method = environ['REQUEST_METHOD']
+    headers = request_headers(environ)
+    chunked = False
+    if isinstance(environ.get('wsgi.input'), asyncio.StreamReader):
+        body = environ['wsgi.input']
+        if environ.get('CONTENT_LENGTH'):
+            headers['Content-Length'] = environ['CONTENT_LENGTH']
+        else:
+            headers['Transfer-Encoding'] = 'chunked'
+            chunked = True
+    else:
+        # (this reads a short body right away)
+        body = yield From(loop.run_in_executor(
+            None, request_body, environ, headers))
+    head = ['%s %s HTTP/1.1\r\n' % (method, request_path(environ))]
+    if 'Host' not in headers:
+        head.append('Host: %s:%s\r\n' % (environ['SERVER_NAME'],
+                                         environ['SERVER_PORT']))
+    for name, value in headers.items():
+        head.append('%s: %s\r\n' % (name, value))
+    head.append('\r\n')
+    head = ''.join(head)
+    def phase_timeout(name):
+        try:
+            return get_timeout(environ, name, timeout)
+        except socket.timeout:
+            raise asyncio.TimeoutError()
+    if pool is None:
+        reader, writer = yield From(AsyncConnectionPool(loop=loop).connect(
+            key, phase_timeout('connect_timeout')))
+        reused = False
+    else:
+        reader, writer, reused = yield From(pool.get(
+            key, phase_timeout('connect_timeout')))
+    while 1:
+        try:
+            yield From(_send_body(writer, head, body, chunked,
+                                  phase_timeout('read_timeout'), loop))
+            version, status_code, reason, res_headers = yield From(
+                asyncio.wait_for(_read_head(reader),
+                                 phase_timeout('first_byte_timeout'),
+                                 loop=loop))
+        except (IOError, OSError, EOFError), exc:
+            writer.close()
+            if (reused and method in idempotent_methods
+                and not getattr(body, 'bytes_read', 0)
+                and not isinstance(body, asyncio.StreamReader)):
+                # The server closed the pooled connection while it was
+                # idle; try once more on a fresh connection:
+                reader, writer = yield From(pool.connect(
+                    key, phase_timeout('connect_timeout')))
+                reused = False
+                continue
+            raise
+        except:
+            writer.close()
+            raise
+        break
+    try:
+        response = AsyncResponse(
+            status_code, reason, res_headers, reader, writer, method,
+            version=version,
+            pool=pool, key=key, timeout=phase_timeout('read_timeout'),
+            deadline=environ.get('wsgiproxy.deadline'),
+            chunk_size=environ.get('wsgiproxy.chunk_size', chunk_size),
+            loop=loop)
+    except:
+        writer.close()
+        raise
+    raise Return(response)
+
+@asyncio.coroutine
+def _send_body(writer, head, body, chunked, timeout, loop):
+    """
+    Sends the request head and body; `chunked` is true if a
+    StreamReader `body` is to be sent with chunked transfer-encoding.
+    """
+    if isinstance(body, str):
+        writer.write(head + body)
+    elif isinstance(body, asyncio.StreamReader):
+        writer.write(head)
+        while 1:
+            data = yield From(asyncio.wait_for(
+                body.read(chunk_size), timeout, loop=loop))
+            if chunked:
+                writer.write('%x\r\n%s\r\n' % (len(data), data))
+            elif data:
+                writer.write(data)
+            if not data:
+                break
+            yield From(writer.drain())
+    else:
+        # A LimitedInput or ChunkedInput reading wsgi.input (already
+        # chunk-framed), off the loop
+        writer.write(head)
+        while 1:
+            data = yield From(loop.run_in_executor(
+                None, body.read, chunk_size))
+            if not data:
+                break
+            writer.write(data)
+            yield From(asyncio.wait_for(writer.drain(), timeout, loop=loop))
+    yield From(asyncio.wait_for(writer.drain(), timeout, loop=loop))
+
+@asyncio.coroutine
+def _read_head(reader):
+    # Anything that can't be parsed is reported as UpstreamClosed, so
+    # it gets a 502 like any other bad response
+    while 1:
+        line = yield From(_readline(reader))
+        if not line:
+            raise UpstreamClosed("Connection closed before the response")
+        parts = line.split(None, 2)
+        try:
+            if not parts[0].startswith('HTTP/'):
+                raise ValueError
+            status_code = int(parts[1])
+        except (IndexError, ValueError):
+            raise UpstreamClosed("Bad status line: %r" % line)
+        if len(parts) > 2:
+            reason = parts[2].strip()
+        else:
+            reason = ''
+        headers = []
+        while 1:
+            line = yield From(_readline(reader))
+            if line in ('\r\n', '\n', ''):
+                break
+            if line[0] in ' \t' and headers:
+                # Continuation line
+                name, value = headers.pop()
+                headers.append((name, value + ', ' + line.strip()))
+                continue
+            if ':' not in line:
+                raise UpstreamClosed("Bad header line: %r" % line)
+            name, value = line.split(':', 1)
+            headers.append((name.strip(), value.strip()))
+        if status_code != 100:
+            raise Return((parts[0], status_code, reason, headers))
+
+@asyncio.coroutine
+def _readline(reader):
+    try:
+        line = yield From(reader.readline())
+    except ValueError:
+        # Longer than the reader's limit
+        raise UpstreamClosed("Line too long in the response head")
+    raise Return(line)
+
+
+class AsyncEngine(object):
+
+    """
+    A WSGI application (with the same contract as
+    :func:`wsgiproxy.exactproxy.proxy_exact_request`) that does its
+    upstream I/O on an event loop running in a background thread.
+
+    `timeout` is used when ``environ['wsgiproxy.timeout']`` isn't
+    given; a timeout results in a ``504 Gateway Timeout`` and a
+    failure to connect in a ``502 Bad Gateway``.
+
+    Request bodies are read from ``wsgi.input`` (which blocks) in a
+    pool of up to `body_threads` threads, so a slow upload doesn't
+    hold up the loop.
+    """
+
+    def __init__(self, timeout=None, max_idle=10, idle_timeout=60,
+                 body_threads=20):
+        self.timeout = timeout
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(body_threads)
+        self.loop.set_default_executor(self.executor)
+        self.pool = AsyncConnectionPool(
+            max_idle=max_idle, idle_timeout=idle_timeout, loop=self.loop)
+        self.thread = threading.Thread(target=self._run_loop)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def run(self, coro):
+        """
+        Runs the coroutine on the engine's loop, waiting for and
+        returning its result.  Must not be called from the loop
+        thread.
+        """
+        done = threading.Event()
+        result = []
+        def set_result(future):
+            try:
+                result.append((True, future.result()))
+            except Exception:
+                result.append((False, sys.exc_info()))
+            done.set()
+        def start():
+            asyncio.ensure_future(coro, loop=self.loop).add_done_callback(
+                set_result)
+        self.loop.call_soon_threadsafe(start)
+        done.wait()
+        ok, value = result[0]
+        if not ok:
+            raise value[0], value[1], value[2]
+        return value
+
+    def __call__(self, environ, start_response):
+        timeout = environ.get('wsgiproxy.timeout', self.timeout)
+        try:
+            res = self.run(proxy_request(
+                environ, pool=self.pool, timeout=timeout, loop=self.loop))
+        except asyncio.TimeoutError, e:
+            environ['wsgiproxy.upstream_error'] = e
+            exc = httpexceptions.HTTPGatewayTimeout(
+                "Timed out waiting for %s" % upstream_name(environ))
+            return exc(environ, start_response)
+        except (IOError, OSError, EOFError), e:
+            environ['wsgiproxy.upstream_error'] = e
+            exc = httpexceptions.HTTPBadGateway(
+                "Could not get a response from %s (%s)"
+                % (upstream_name(environ), e))
+            return exc(environ, start_response)
+        start_response(res.status, res.headers)
+        return AsyncResponseBody(self, res)
+
+    def close(self):
+        self.loop.call_soon_threadsafe(self.pool.close)
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.executor.shutdown(wait=False)
+
+
+class AsyncResponseBody(object):
+    """
+    WSGI app_iter reading an :class:`AsyncResponse` through its
+    engine.
+    """
+
+    def __init__(self, engine, response):
+        self.engine = engine
+        self.response = response
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        data = self.engine.run(self.response.read())
+        if not data:
+            raise StopIteration
+        return data
+
+    def close(self):
+        self.engine.loop.call_soon_threadsafe(self.response.close)
+
+_default_engine = None
+_default_engine_lock = threading.Lock()
+
+def default_engine():
+    """
+    Returns an :class:`AsyncEngine` shared by the whole process.
+    """
+    global _default_engine
+    if _default_engine is None:
+        _default_engine_lock.acquire()
+        try:
+            if _default_engine is None:
+                _default_engine = AsyncEngine()
+        finally:
+            _default_engine_lock.release()
+    return _default_engine
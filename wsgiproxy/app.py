@@ -3,13 +3,23 @@ try:
 except ImportError:
     import simplejson
 import cPickle as pickle
+import httplib
 import urllib
-import urlparse
 import re
-from wsgiproxy.signature import sign_request
+import socket
+import sys
+import time
+from paste import httpexceptions
+from wsgiproxy.signature import Signer
 from wsgiproxy import protocol_version
-from wsgiproxy.secretloader import get_secret
-from wsgiproxy.exactproxy import proxy_exact_request
+from wsgiproxy.envelope import pack, envelope_version
+from wsgiproxy.secretloader import default_reload_interval
+from wsgiproxy.exactproxy import proxy_exact_request, timeout_names
+from wsgiproxy.pool import default_pool
+from wsgiproxy.instrument import default_instruments, begin, finishing
+from wsgiproxy.tracing import TraceContext, parse_traceparent, server_timing
+from wsgiproxy.balancer import Backend, make_balancer, ReleasingAppIter
+from wsgiproxy.health import BackendHealth, HealthChecker, failure_statuses
 
 __all__ = ['WSGIProxyApp']
 
@@ -38,17 +48,149 @@ class WSGIProxyApp(object):
 
     ``X-Traversal-Query-String``: Any portion of the query string that
     was not in the original request
+
+    Connections to `href` are kept alive and reused through
+    `connection_pool` (a :class:`wsgiproxy.pool.ConnectionPool`); by
+    default a pool shared by the whole process is used.
+
+    `engine` selects how the request is sent: ``'exact'`` (the
+    default) uses the blocking
+    :func:`wsgiproxy.exactproxy.proxy_exact_request`, and
+    ``'asyncio'`` uses the shared
+    :class:`wsgiproxy.aioproxy.AsyncEngine` (which needs trollius).
+    Any WSGI application with the same contract as
+    ``proxy_exact_request`` can also be given.
+
+    With `http2` the default engine sends requests over HTTP/2,
+    multiplexed over a few connections to each backend: `http2` is
+    an :class:`wsgiproxy.h2proxy.H2Pool`, or true for the shared one
+    (this needs the h2 package; see :mod:`wsgiproxy.h2proxy`).
+
+    `href` can also be a list of hrefs, in which case requests are
+    spread over all of them according to `balance` (one of
+    ``round_robin``, ``least_outstanding``, ``weighted`` or
+    ``consistent_hash``; see :mod:`wsgiproxy.balancer`).  `weights`
+    is a list of integer weights in the same order as the hrefs, and
+    `hash_key` selects what ``consistent_hash`` hashes on (``path``,
+    ``client``, ``cookie:name`` or ``header:name``).  The chosen
+    :class:`wsgiproxy.balancer.Backend` is put in
+    ``environ['wsgiproxy.backend']``.
+
+    Backends that fail `failure_threshold` times in a row (connection
+    errors, timeouts, or 502/503/504 responses) are taken out of
+    rotation for `recovery_time` seconds, after which a single trial
+    request is sent to them (see :mod:`wsgiproxy.health`).  If no
+    backend is available the request fails immediately with ``503
+    Service Unavailable``.  If `health_check` is given (a path, like
+    ``'/health'``) each backend is also probed at that path every
+    `health_interval` seconds from a background thread.
+
+    A backend listening on a Unix domain socket is given as
+    ``http+unix://`` followed by the quoted socket path, like
+    ``http+unix://%2Ftmp%2Fapp.sock/path``; the path is put in
+    ``environ['wsgiproxy.unix_socket']``.
+
+    `connect_timeout`, `first_byte_timeout` and `read_timeout` (in
+    seconds) limit how long to wait on the backend (see
+    :func:`wsgiproxy.exactproxy.proxy_exact_request`); values already
+    in the environ (``environ['wsgiproxy.connect_timeout']``, etc.)
+    take precedence.  `total_timeout` sets a deadline for the whole
+    request.  A request that times out gets a ``504 Gateway
+    Timeout``.  The time left before the deadline is sent to the
+    backend in ``X-WSGIProxy-Deadline``, which
+    :class:`wsgiproxy.middleware.WSGIProxyMiddleware` turns back into
+    ``environ['wsgiproxy.deadline']``.
+
+    The values of `string_keys`, `unicode_keys`, `json_keys` and
+    `pickle_keys` are sent in one ``X-WSGIProxy-Envelope`` header
+    (protocol version 0.2, see :mod:`wsgiproxy.envelope`) instead of a
+    header each when `envelope` is true.  With ``envelope='auto'``
+    (the default) that is done once the backend has said (in an
+    ``X-WSGIProxy-Versions`` response header) that it understands
+    version 0.2.  Envelopes of at least `envelope_compress_size`
+    bytes are compressed.
+
+    With `secret_file` each request is signed with the secret in that
+    file, or the current one of a directory of versioned secrets (see
+    :mod:`wsgiproxy.signature` and :mod:`wsgiproxy.secretloader`), for a
+    :class:`wsgiproxy.middleware.WSGIProxyMiddleware` with the same
+    secret to check.  The file is checked for changes every
+    `secret_reload_interval` seconds.
+
+    Each request is reported to the subscribers of `instruments` (by
+    default :data:`wsgiproxy.instrument.default_instruments`), with the
+    time spent in the proxy and on the backend (see
+    :mod:`wsgiproxy.instrument`).
+
+    With `trace` the proxy takes part in W3C trace context: it
+    continues the trace in the request's ``traceparent`` header (or
+    starts one) with a span of its own, which is sent to the backend
+    and put in ``environ['wsgiproxy.trace']``.  With `server_timing` a
+    ``Server-Timing`` header with the time spent queueing in the
+    proxy, connecting, and waiting on the backend is added to the
+    response (see :mod:`wsgiproxy.tracing`).
     """
 
     def __init__(self, href, secret_file=None,
                  string_keys=None, unicode_keys=None,
-                 json_keys=None, pickle_keys=None):
+                 json_keys=None, pickle_keys=None,
+                 connection_pool=None, engine=None, http2=False,
+                 balance='round_robin', weights=None, hash_key=None,
+                 failure_threshold=5, recovery_time=10,
+                 health_check=None, health_interval=10,
+                 connect_timeout=None, first_byte_timeout=None,
+                 read_timeout=None, total_timeout=None,
+                 envelope='auto', envelope_compress_size=256,
+                 secret_reload_interval=default_reload_interval,
+                 instruments=None, trace=False, server_timing=False):
+        self.balance = balance
+        self.weights = weights
+        self.hash_key = hash_key
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.connect_timeout = connect_timeout
+        self.first_byte_timeout = first_byte_timeout
+        self.read_timeout = read_timeout
+        self.total_timeout = total_timeout
+        self.envelope = envelope
+        self.envelope_compress_size = envelope_compress_size
         self.href = href
+        if health_check:
+            self.health_checker = HealthChecker(
+                self.backends, health_check, interval=health_interval)
+            self.health_checker.start()
+        else:
+            self.health_checker = None
         self.secret_file = secret_file
+        if secret_file is not None:
+            self.signer = Signer(secret_file,
+                                 reload_interval=secret_reload_interval)
+        else:
+            self.signer = None
         self.string_keys = string_keys or ()
         self.unicode_keys = unicode_keys or ()
         self.json_keys = json_keys or ()
         self.pickle_keys = pickle_keys or ()
+        if connection_pool is None:
+            connection_pool = default_pool
+        self.connection_pool = connection_pool
+        if http2 is True:
+            from wsgiproxy.h2proxy import default_pool as http2
+        self.h2_pool = http2 or None
+        if instruments is None:
+            instruments = default_instruments
+        self.instruments = instruments
+        self.trace = trace
+        self.server_timing = server_timing
+        if engine is None or engine == 'exact':
+            engine = proxy_exact_request
+        elif engine == 'asyncio':
+            from wsgiproxy.aioproxy import default_engine
+            engine = default_engine()
+        elif isinstance(engine, basestring):
+            raise ValueError(
+                "Unknown engine: %r" % engine)
+        self.engine = engine
 
     header_map = {
         'HTTP_HOST': 'X_FORWARDED_SERVER',
@@ -56,49 +198,251 @@ class WSGIProxyApp(object):
         'wsgi.url_scheme': 'X_FORWARDED_SCHEME',
         'REMOTE_ADDR': 'X_FORWARDED_FOR',
         }
+    header_items = [(key, 'HTTP_%s' % dest)
+                    for key, dest in header_map.items()]
+
+    def encoded_keys(self):
+        """
+        Returns ``(key, header_key, quoted_key, encoder)`` for each of
+        the keys to encode, computed once for each set of keys.
+        """
+        keys = (self.string_keys, self.unicode_keys, self.json_keys,
+                self.pickle_keys)
+        if self._encoded_keys is None or self._encoded_keys[0] != keys:
+            encoded = []
+            for prefix, prefix_keys, encoder in [
+                ('STR', self.string_keys, self.str_encode),
+                ('UNICODE', self.unicode_keys, self.unicode_encode),
+                ('JSON', self.json_keys, self.json_encode),
+                ('PICKLE', self.pickle_keys, self.pickle_encode)]:
+                for count, key in enumerate(prefix_keys):
+                    encoded.append(
+                        (key, 'HTTP_X_WSGIPROXY_%s_%s' % (prefix, count),
+                         urllib.quote(key), encoder))
+            self._encoded_keys = (keys, encoded)
+        return self._encoded_keys[1]
+
+    _encoded_keys = None
 
     def href__get(self):
         return self._href
 
     def href__set(self, href):
         self._href = href
-        self.href_scheme, self.href_netloc, self.href_path, self.href_query, self.href_fragment = urlparse.urlsplit(href, 'http')
-        assert self.href_scheme in ('http', 'https')
-        if ':' not in self.href_netloc:
-            if self.href_scheme == 'http':
-                self.href_netloc += ':80'
-            else:
-                self.href_netloc += ':443'
-        # The trailing / is implicit:
-        self.href_path = self.href_path.lstrip('/')
+        if isinstance(href, basestring):
+            hrefs = [href]
+        else:
+            hrefs = list(href)
+        weights = self.weights or [1] * len(hrefs)
+        assert len(weights) == len(hrefs), (
+            "You must give one weight for each href (not %r for %r)"
+            % (weights, hrefs))
+        self.backends = [Backend(h, int(weight))
+                         for h, weight in zip(hrefs, weights)]
+        for backend in self.backends:
+            backend.health = BackendHealth(
+                self.failure_threshold, self.recovery_time)
+        # The first (or only) backend is also kept in the href_*
+        # attributes:
+        backend = self.backends[0]
+        self.href_scheme = backend.scheme
+        self.href_netloc = backend.netloc
+        self.href_path = backend.path
+        self.href_query = backend.query
+        self.href_fragment = backend.fragment
+        self.href_unix_socket = backend.unix_socket
+        if len(self.backends) > 1:
+            self.balancer = make_balancer(
+                self.backends, self.balance, self.hash_key)
+        else:
+            self.balancer = None
 
     href = property(href__get, href__set)
 
     def __call__(self, environ, start_response):
-        environ = self.encode_environ(environ)
-        self.setup_forwarded_environ(environ)
-        return self.forward_request(environ, start_response)
+        event, started_event = begin(environ, 'app', self.instruments,
+                                     self.server_timing)
+        now = time.time()
+        candidates = [backend for backend in self.backends
+                      if backend.health.available(now)]
+        while 1:
+            if not candidates:
+                retry_after = min(backend.health.retry_after(now)
+                                  for backend in self.backends)
+                exc = httpexceptions.HTTPServiceUnavailable(
+                    "No backend is available to handle the request",
+                    headers=[('Retry-After', str(int(retry_after) + 1))])
+                if started_event:
+                    event.status = exc.code
+                    event.finish()
+                return exc(environ, start_response)
+            if self.balancer is None:
+                backend = candidates[0]
+                release = None
+            else:
+                balancer = self.balancer
+                backend = balancer.acquire(environ, candidates)
+                release = lambda: balancer.release(backend)
+            if backend.health.attempt(now):
+                break
+            # A down backend whose trial request another request took
+            if release is not None:
+                release()
+            candidates.remove(backend)
+        if event is not None:
+            event.backend = backend.href
+            if started_event:
+                release = finishing(event, release)
+        try:
+            environ = self.encode_environ(
+                environ, envelope=self.use_envelope(backend))
+            if self.trace:
+                self.setup_trace(environ)
+        except:
+            if release is not None:
+                release()
+            raise
+        try:
+            if self.balancer is None:
+                self.setup_forwarded_environ(environ)
+            else:
+                self.setup_forwarded_environ(environ, backend)
+            app_iter = self.forward_request(
+                environ, self.health_start_response(backend, start_response,
+                                                    event))
+        except:
+            exc = sys.exc_info()[1]
+            if isinstance(exc, (socket.error, httplib.HTTPException)):
+                # Only the backend's failures count against it, not
+                # (say) a client that gave up in the middle of an upload
+                backend.health.record_failure()
+            if event is not None:
+                event.error = exc
+            if release is not None:
+                release()
+            raise
+        if release is None:
+            return app_iter
+        return ReleasingAppIter(app_iter, release)
+
+    def use_envelope(self, backend):
+        """
+        True if the keys should be sent to `backend` in an envelope.
+        """
+        if self.envelope == 'auto':
+            versions = backend.protocol_versions
+            return versions is not None and envelope_version in versions
+        return bool(self.envelope)
+
+    def health_start_response(self, backend, start_response, event=None):
+        """
+        Wraps `start_response` to record the response status in the
+        backend's health (and `event`, if given), and with
+        ``envelope='auto'`` the protocol versions it understands.  The
+        ``X-WSGIProxy-Versions`` header is always removed, as it is
+        only meant for the proxy.  With `server_timing` the
+        ``Server-Timing`` header is added.
+        """
+        negotiate = self.envelope == 'auto'
+        add_timing = self.server_timing and event is not None
+        def health_start_response(status, headers, exc_info=None):
+            if add_timing:
+                headers = headers + [('Server-Timing', server_timing(event))]
+            versions = None
+            for i, (name, value) in enumerate(headers):
+                if name.lower() == 'x-wsgiproxy-versions':
+                    versions = tuple(value.split())
+                    headers = headers[:i] + headers[i + 1:]
+                    break
+            if negotiate:
+                # (a backend that stops sending it has been downgraded)
+                backend.protocol_versions = versions
+            try:
+                status_code = int(status.split(None, 1)[0])
+            except ValueError:
+                status_code = None
+            if event is not None:
+                event.status = status_code
+            if status_code in failure_statuses:
+                backend.health.record_failure()
+            else:
+                backend.health.record_success()
+            return start_response(status, headers, exc_info)
+        return health_start_response
 
     def forward_request(self, environ, start_response):
-        return proxy_exact_request(environ, start_response)
+        environ['wsgiproxy.connection_pool'] = self.connection_pool
+        if self.h2_pool is not None:
+            environ['wsgiproxy.h2_pool'] = self.h2_pool
+        environ['wsgiproxy.instruments'] = self.instruments
+        self.setup_timeouts(environ)
+        if self.signer is not None:
+            self.signer.sign(environ)
+        event = environ.get('wsgiproxy.event')
+        if event is not None:
+            event.mark('prepare')
+        return self.engine(environ, start_response)
+
+    def setup_trace(self, environ):
+        """
+        Starts the proxy's span, as a child of the request's
+        ``traceparent`` (if it has a valid one), and sends it on.
+        """
+        parent = parse_traceparent(environ.get('HTTP_TRACEPARENT'),
+                                   environ.get('HTTP_TRACESTATE'))
+        if parent is None:
+            trace = TraceContext.new()
+            # The state belongs to the trace that was dropped:
+            environ.pop('HTTP_TRACESTATE', None)
+        else:
+            trace = parent.child()
+        environ['HTTP_TRACEPARENT'] = trace.traceparent
+        environ['wsgiproxy.trace'] = trace
+        environ['wsgiproxy.orig_environ']['wsgiproxy.trace'] = trace
 
-    def setup_forwarded_environ(self, environ):
+    def setup_timeouts(self, environ):
+        for name in timeout_names:
+            value = getattr(self, name)
+            if value is not None:
+                environ.setdefault('wsgiproxy.%s' % name, value)
+        now = time.time()
+        deadline = environ.get('wsgiproxy.deadline')
+        if self.total_timeout is not None:
+            if deadline is None or now + self.total_timeout < deadline:
+                deadline = environ['wsgiproxy.deadline'] = (
+                    now + self.total_timeout)
+        if deadline is not None:
+            environ['HTTP_X_WSGIPROXY_DEADLINE'] = '%.3f' % max(
+                0, deadline - now)
+
+    def setup_forwarded_environ(self, environ, backend=None):
         # Now we fix the request up so that refers to the target
         # server that we are proxying to
-        environ['wsgi.url_scheme'] = self.href_scheme
-        environ['HTTP_HOST'] = self.href_netloc
-        environ['SERVER_NAME'], environ['SERVER_PORT'] = self.href_netloc.split(':', 1)
-        environ['SCRIPT_NAME'] = self.href_path
-        if self.href_path:
-            environ['HTTP_X_TRAVERSAL_PATH'] = self.href_path
-        if self.href_query:
+        if backend is None:
+            scheme, netloc = self.href_scheme, self.href_netloc
+            path, query = self.href_path, self.href_query
+            unix_socket = self.href_unix_socket
+        else:
+            scheme, netloc = backend.scheme, backend.netloc
+            path, query = backend.path, backend.query
+            unix_socket = backend.unix_socket
+            environ['wsgiproxy.backend'] = backend
+        if unix_socket:
+            environ['wsgiproxy.unix_socket'] = unix_socket
+        environ['wsgi.url_scheme'] = scheme
+        environ['HTTP_HOST'] = netloc
+        environ['SERVER_NAME'], environ['SERVER_PORT'] = netloc.split(':', 1)
+        environ['SCRIPT_NAME'] = path
+        if path:
+            environ['HTTP_X_TRAVERSAL_PATH'] = path
+        if query:
             if environ['QUERY_STRING']:
-                environ['QUERY_STRING'] += '&' + self.href_query
+                environ['QUERY_STRING'] += '&' + query
             else:
-                environ['QUERY_STRING'] = self.href_query
-            environ['HTTP_X_TRAVERSAL_QUERY_STRING'] = self.href_query
+                environ['QUERY_STRING'] = query
+            environ['HTTP_X_TRAVERSAL_QUERY_STRING'] = query
 
-    def encode_environ(self, environ):
+    def encode_environ(self, environ, envelope=False):
         # I don't want to totally overwrite things in the current
         # environment, so we copy:
         for name in ['QUERY_STRING', 'SCRIPT_NAME', 'PATH_INFO']:
@@ -106,30 +450,42 @@ class WSGIProxyApp(object):
                 environ[name] = ''
         orig_environ = environ
         environ = environ.copy()
+        # X-WSGIProxy headers from the client would conflict with ours:
+        conflicting = [key for key in environ
+                       if key[:16] == 'HTTP_X_WSGIPROXY']
+        for key in conflicting:
+            del environ[key]
         environ['wsgiproxy.orig_environ'] = orig_environ
-        if self.secret_file is not None:
-            secret = get_secret(self.secret_file)
-            sign_request(environ)
-        for key in environ.keys():
-            if key.startswith('HTTP_X_WSGIPROXY'):
-                # Conflicting header...
-                del environ[key]
-        for key, dest in self.header_map.items():
-            environ['HTTP_%s' % dest] = environ[key]
-        for prefix, keys, encoder in [
-            ('STR', self.string_keys, self.str_encode),
-            ('UNICODE', self.unicode_keys, self.unicode_encode),
-            ('JSON', self.json_keys, self.json_encode),
-            ('PICKLE', self.pickle_keys, self.pickle_encode)]:
-            for count, key in enumerate(keys):
-                if key not in environ:
-                    continue
-                new_key = 'HTTP_X_WSGIPROXY_%s_%s' % (prefix, count)
-                environ[new_key] = '%s %s' % (
-                    urllib.quote(key), encoder(environ[key]))
+        for key, dest in self.header_items:
+            environ[dest] = environ[key]
+        if envelope:
+            items = [(type, key, environ[key])
+                     for key, type in self.envelope_keys()
+                     if key in environ]
+            if items:
+                environ['HTTP_X_WSGIPROXY_ENVELOPE'] = pack(
+                    items, self.envelope_compress_size)
+            environ['HTTP_X_WSGIPROXY_VERSION'] = envelope_version
+            return environ
+        for key, dest, quoted_key, encoder in self.encoded_keys():
+            if key in environ:
+                environ[dest] = '%s %s' % (quoted_key, encoder(environ[key]))
         environ['HTTP_X_WSGIPROXY_VERSION'] = protocol_version
         return environ
 
+    def envelope_keys(self):
+        """
+        Returns ``(key, type)`` for each of the keys to put in an
+        envelope.
+        """
+        keys = []
+        for type, type_keys in [('S', self.string_keys),
+                                ('U', self.unicode_keys),
+                                ('J', self.json_keys),
+                                ('P', self.pickle_keys)]:
+            keys.extend([(key, type) for key in type_keys])
+        return keys
+
     safe_str_re = re.compile(r'^[^\x00-\x1f]*$')
 
     def str_encode(self, value):
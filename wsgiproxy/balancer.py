@@ -0,0 +1,279 @@
+"""
+Spreading requests over several backends.
+
+:class:`wsgiproxy.app.WSGIProxyApp` accepts a list of hrefs; each one
+becomes a :class:`Backend`, and a balancer chooses the backend for
+each request.  The available strategies (by name, as used by the
+``balance`` argument) are:
+
+``round_robin``:
+    Each backend in turn.
+
+``least_outstanding``:
+    The backend with the fewest requests in flight.
+
+``weighted``:
+    Smooth weighted round robin; a backend with weight 3 gets three
+    times as many requests as one with weight 1.
+
+``consistent_hash``:
+    Requests with the same key go to the same backend (and only the
+    keys of a backend that goes away are moved elsewhere).  The key
+    is set with ``hash_key``: ``path`` (the default), ``client`` (the
+    REMOTE_ADDR), ``cookie:name`` or ``header:name``.
+"""
+
+import bisect
+import Cookie
+import itertools
+import threading
+import urllib
+import urlparse
+try:
+    from hashlib import md5
+except ImportError:
+    from md5 import md5
+from wsgiproxy.health import BackendHealth
+
+__all__ = ['Backend', 'RoundRobinBalancer', 'LeastOutstandingBalancer',
+           'WeightedBalancer', 'ConsistentHashBalancer', 'make_balancer']
+
+class Backend(object):
+
+    """
+    A server that requests are forwarded to, identified by `href`.
+
+    ``in_flight`` is the number of requests currently being sent to
+    (or read from) this backend, and ``health`` its
+    :class:`wsgiproxy.health.BackendHealth`.
+
+    An href like ``http+unix://%2Ftmp%2Fapp.sock/path`` names a backend
+    listening on a Unix domain socket (the quoted path, in
+    ``unix_socket``); it is otherwise treated as
+    ``http://localhost:80/path``.
+    """
+
+    def __init__(self, href, weight=1):
+        self.href = href
+        self.weight = weight
+        self.in_flight = 0
+        self.health = BackendHealth()
+        # The protocol versions the backend said it understands (see
+        # WSGIProxyApp's envelope argument):
+        self.protocol_versions = None
+        self.scheme, self.netloc, self.path, self.query, self.fragment = urlparse.urlsplit(href, 'http')
+        assert self.scheme in ('http', 'https', 'http+unix')
+        self.unix_socket = None
+        if self.scheme == 'http+unix':
+            self.unix_socket = urllib.unquote(self.netloc)
+            self.scheme = 'http'
+            self.netloc = 'localhost:80'
+        if ':' not in self.netloc:
+            if self.scheme == 'http':
+                self.netloc += ':80'
+            else:
+                self.netloc += ':443'
+        # The trailing / is implicit:
+        self.path = self.path.lstrip('/')
+        self.host, self.port = self.netloc.split(':', 1)
+
+    def __repr__(self):
+        return '<%s %s in_flight=%s>' % (
+            self.__class__.__name__, self.href, self.in_flight)
+
+
+class Balancer(object):
+
+    """
+    Base class for balancers.  Subclasses implement :meth:`choose`.
+    """
+
+    def __init__(self, backends):
+        self.backends = backends
+        self.lock = threading.Lock()
+
+    def choose(self, environ, candidates):
+        """
+        Returns one of `candidates` (a non-empty list of backends) for
+        the request.
+        """
+        raise NotImplementedError
+
+    def acquire(self, environ, candidates=None):
+        """
+        Chooses a backend and counts the request as in flight on it.
+        Returns None if there are no candidates.  Call
+        :meth:`release` when the request is finished.
+        """
+        if candidates is None:
+            candidates = self.backends
+        if not candidates:
+            return None
+        backend = self.choose(environ, candidates)
+        self.lock.acquire()
+        try:
+            backend.in_flight += 1
+        finally:
+            self.lock.release()
+        return backend
+
+    def release(self, backend):
+        self.lock.acquire()
+        try:
+            backend.in_flight -= 1
+        finally:
+            self.lock.release()
+
+
+class RoundRobinBalancer(Balancer):
+
+    def __init__(self, backends):
+        Balancer.__init__(self, backends)
+        self.counter = itertools.count()
+
+    def choose(self, environ, candidates):
+        return candidates[self.counter.next() % len(candidates)]
+
+
+class LeastOutstandingBalancer(RoundRobinBalancer):
+
+    def choose(self, environ, candidates):
+        # Start at a rotating offset so ties are spread around:
+        start = self.counter.next() % len(candidates)
+        best = None
+        for backend in candidates[start:] + candidates[:start]:
+            if best is None or backend.in_flight < best.in_flight:
+                best = backend
+        return best
+
+
+class WeightedBalancer(Balancer):
+
+    def __init__(self, backends):
+        Balancer.__init__(self, backends)
+        self.current = {}
+
+    def choose(self, environ, candidates):
+        # Smooth weighted round robin (as in nginx)
+        self.lock.acquire()
+        try:
+            total = 0
+            best = None
+            for backend in candidates:
+                weight = self.current.get(backend, 0) + backend.weight
+                self.current[backend] = weight
+                total += backend.weight
+                if best is None or weight > self.current[best]:
+                    best = backend
+            self.current[best] -= total
+            return best
+        finally:
+            self.lock.release()
+
+
+class ConsistentHashBalancer(Balancer):
+
+    # Points on the ring for each unit of weight:
+    replicas = 100
+
+    def __init__(self, backends, hash_key='path'):
+        Balancer.__init__(self, backends)
+        self.hash_key = hash_key
+        self.ring = []
+        for backend in backends:
+            for i in range(self.replicas * backend.weight):
+                self.ring.append(
+                    (self.hash('%s-%s' % (backend.href, i)), backend))
+        self.ring.sort()
+        self.points = [point for point, backend in self.ring]
+
+    def hash(self, value):
+        return int(md5(value).hexdigest()[:8], 16)
+
+    def request_key(self, environ):
+        """
+        Returns the value from the request that is hashed.
+        """
+        hash_key = self.hash_key
+        if hash_key == 'path':
+            return environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
+        elif hash_key == 'client':
+            return environ.get('REMOTE_ADDR', '')
+        elif hash_key.startswith('header:'):
+            header = hash_key[7:].upper().replace('-', '_')
+            return environ.get('HTTP_%s' % header, '')
+        elif hash_key.startswith('cookie:'):
+            cookies = Cookie.SimpleCookie()
+            try:
+                cookies.load(environ.get('HTTP_COOKIE', ''))
+            except Cookie.CookieError:
+                return ''
+            morsel = cookies.get(hash_key[7:])
+            if morsel is None:
+                return ''
+            return morsel.value
+        raise ValueError(
+            "Unknown hash_key: %r" % hash_key)
+
+    def choose(self, environ, candidates):
+        point = self.hash(self.request_key(environ))
+        index = bisect.bisect(self.points, point)
+        ring = self.ring
+        # Walk around the ring to the first available backend
+        for i in xrange(len(ring)):
+            backend = ring[(index + i) % len(ring)][1]
+            if backend in candidates:
+                return backend
+        return candidates[0]
+
+
+balancers = {
+    'round_robin': RoundRobinBalancer,
+    'least_outstanding': LeastOutstandingBalancer,
+    'weighted': WeightedBalancer,
+    'consistent_hash': ConsistentHashBalancer,
+    }
+
+def make_balancer(backends, balance='round_robin', hash_key=None):
+    """
+    Creates a balancer of the strategy named by `balance` (or
+    `balance` itself, if it is a class or factory).  `hash_key` is
+    only accepted by ``consistent_hash`` (and is passed on to a class
+    or factory).
+    """
+    if isinstance(balance, basestring):
+        if balance not in balancers:
+            raise ValueError(
+                "Unknown balance strategy %r (use one of: %s)"
+                % (balance, ', '.join(sorted(balancers))))
+        if hash_key is not None and balance != 'consistent_hash':
+            raise ValueError(
+                "hash_key (%r) only applies to balance='consistent_hash', "
+                "not %r" % (hash_key, balance))
+        balance = balancers[balance]
+    if hash_key is not None:
+        return balance(backends, hash_key=hash_key)
+    return balance(backends)
+
+
+class ReleasingAppIter(object):
+    """
+    Wraps an app_iter, calling `release` once it has been closed.
+    """
+
+    def __init__(self, app_iter, release):
+        self.app_iter = app_iter
+        self.release = release
+
+    def __iter__(self):
+        return iter(self.app_iter)
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            release = self.release
+            self.release = None
+            if release is not None:
+                release()
@@ -0,0 +1,789 @@
+"""
+An HTTP cache to put in front of :class:`wsgiproxy.app.WSGIProxyApp`
+(or any WSGI application).
+
+:class:`CachingMiddleware` keeps cacheable GET responses, following
+``Cache-Control`` (``max-age``, ``s-maxage``, ``no-cache``,
+``no-store``, ``private``, ``must-revalidate`` and
+``stale-while-revalidate``), ``Expires``, ``Vary``, ``ETag`` and
+``Last-Modified``, and the request's ``Cache-Control`` (``no-cache``,
+``no-store``, ``max-age``, ``min-fresh`` and ``max-stale``).  It answers conditional requests from clients with
+``304 Not Modified`` itself, revalidates stale responses with the
+backend using their validators, and collapses concurrent requests for
+the same missing response into a single request to the backend.
+
+Responses are kept in a :class:`MemoryStore` (an LRU bounded by the
+total size of the responses) or a :class:`DiskStore`.
+"""
+
+import cPickle as pickle
+import os
+import threading
+import time
+from email.utils import formatdate, parsedate_tz, mktime_tz
+try:
+    from collections import OrderedDict
+except ImportError:
+    OrderedDict = None
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import sha as sha1
+
+__all__ = ['CachingMiddleware', 'MemoryStore', 'DiskStore']
+
+# Statuses that may be stored:
+cacheable_statuses = (200, 203, 300, 301, 404, 410)
+
+
+class _LinkedDict(object):
+    """
+    The part of OrderedDict that :class:`MemoryStore` uses, for
+    Python 2.6: a dict whose items are kept in a doubly linked list in
+    the order they were set.
+    """
+
+    def __init__(self):
+        # Maps keys to [prev, next, key, value]; `root` is the sentinel
+        self.links = {}
+        self.root = root = []
+        root[:] = [root, root, None, None]
+
+    def __len__(self):
+        return len(self.links)
+
+    def __contains__(self, key):
+        return key in self.links
+
+    def __setitem__(self, key, value):
+        link = self.links.get(key)
+        if link is not None:
+            link[3] = value
+            return
+        root = self.root
+        last = root[0]
+        link = [last, root, key, value]
+        last[1] = root[0] = self.links[key] = link
+
+    def pop(self, key, *default):
+        link = self.links.pop(key, None)
+        if link is None:
+            if default:
+                return default[0]
+            raise KeyError(key)
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+        return link[3]
+
+    def popitem(self, last=True):
+        if not self.links:
+            raise KeyError('dictionary is empty')
+        if last:
+            key = self.root[0][2]
+        else:
+            key = self.root[1][2]
+        return key, self.pop(key)
+
+if OrderedDict is None:
+    OrderedDict = _LinkedDict
+
+def parse_cache_control(value):
+    """
+    Parses a Cache-Control header into a dictionary of (lower case)
+    directives; directives without a value map to True.
+    """
+    directives = {}
+    if not value:
+        return directives
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '=' in part:
+            name, arg = part.split('=', 1)
+            directives[name.strip().lower()] = arg.strip().strip('"')
+        else:
+            directives[part.lower()] = True
+    return directives
+
+def parse_date(value):
+    if not value:
+        return None
+    parsed = parsedate_tz(value)
+    if parsed is None:
+        return None
+    try:
+        return mktime_tz(parsed)
+    except (OverflowError, ValueError):
+        return None
+
+def _seconds(value):
+    try:
+        return max(0, int(value))
+    except (TypeError, ValueError):
+        return None
+
+
+class CacheEntry(object):
+
+    """
+    A stored response.
+    """
+
+    def __init__(self, status, headers, body, vary, now=None):
+        self.status = status
+        self.body = body
+        self.vary = vary
+        self.update(headers, now)
+
+    def update(self, headers, now=None):
+        """
+        Sets (or, after a 304, refreshes) the headers and freshness.
+        """
+        if now is None:
+            now = time.time()
+        self.headers = headers
+        self.stored_at = now
+        header_dict = dict((name.lower(), value) for name, value in headers)
+        self.etag = header_dict.get('etag')
+        self.last_modified = header_dict.get('last-modified')
+        cc = parse_cache_control(header_dict.get('cache-control'))
+        self.no_cache = 'no-cache' in cc
+        self.must_revalidate = ('must-revalidate' in cc
+                                or 'proxy-revalidate' in cc)
+        self.stale_while_revalidate = _seconds(
+            cc.get('stale-while-revalidate')) or 0
+        self.initial_age = _seconds(header_dict.get('age')) or 0
+        lifetime = _seconds(cc.get('s-maxage'))
+        if lifetime is None:
+            lifetime = _seconds(cc.get('max-age'))
+        if lifetime is None and 'expires' in header_dict:
+            expires = parse_date(header_dict['expires'])
+            date = parse_date(header_dict.get('date')) or now
+            lifetime = max(0, (expires or 0) - date)
+        self.lifetime = lifetime or 0
+        self.size = len(self.body) + sum(
+            len(name) + len(value) for name, value in headers) + 200
+
+    def age(self, now):
+        return self.initial_age + max(0, now - self.stored_at)
+
+    def is_fresh(self, now):
+        return not self.no_cache and self.age(now) < self.lifetime
+
+    def is_fresh_for(self, request_cc, now):
+        """
+        Is the entry fresh enough for a request with the Cache-Control
+        directives `request_cc`?  Its ``max-age`` limits the age of the
+        response (``max-age=0``, sent when reloading, always
+        revalidates), ``min-fresh`` asks for that much freshness left,
+        and ``max-stale`` accepts a response that has been stale up to
+        that long (or any stale response, without a value) unless it
+        must be revalidated.
+        """
+        if self.no_cache:
+            return False
+        age = self.age(now)
+        max_age = _seconds(request_cc.get('max-age'))
+        if max_age is not None and age >= max_age:
+            return False
+        lifetime = self.lifetime - (_seconds(request_cc.get('min-fresh')) or 0)
+        if 'max-stale' in request_cc and not self.must_revalidate:
+            if request_cc['max-stale'] is True:
+                return True
+            lifetime += _seconds(request_cc['max-stale']) or 0
+        return age < lifetime
+
+    def may_serve_stale(self, now):
+        """
+        True if the entry is stale but within its
+        stale-while-revalidate window.
+        """
+        return (not self.no_cache and not self.must_revalidate
+                and self.age(now) < self.lifetime + self.stale_while_revalidate)
+
+    def matches(self, environ):
+        for key, value in self.vary:
+            if environ.get(key) != value:
+                return False
+        return True
+
+    def not_modified_for(self, environ):
+        """
+        Does the request's If-None-Match/If-Modified-Since match this
+        entry?
+        """
+        if_none_match = environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            if not self.etag:
+                return False
+            tags = [tag.strip() for tag in if_none_match.split(',')]
+            return '*' in tags or self.etag in tags or (
+                'W/' + self.etag) in tags or (
+                self.etag.startswith('W/') and self.etag[2:] in tags)
+        if_modified_since = parse_date(environ.get('HTTP_IF_MODIFIED_SINCE'))
+        last_modified = parse_date(self.last_modified)
+        if if_modified_since and last_modified:
+            return last_modified <= if_modified_since
+        return False
+
+
+class VaryIndex(object):
+    """
+    Kept in the store under the plain key of a response that has a
+    Vary header; lists the request headers the response varies on.
+    """
+    size = 100
+
+    def __init__(self, keys):
+        self.keys = keys
+
+
+class MemoryStore(object):
+
+    """
+    An in-memory LRU store, holding at most `max_bytes` (as counted by
+    the entries' ``size``).
+    """
+
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.evictions = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        self.lock.acquire()
+        try:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                # Move to the most-recently-used end
+                self.entries[key] = entry
+            return entry
+        finally:
+            self.lock.release()
+
+    def set(self, key, entry):
+        self.lock.acquire()
+        try:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+            if entry.size > self.max_bytes:
+                return
+            self.entries[key] = entry
+            self.size += entry.size
+            while self.size > self.max_bytes:
+                old_key, old = self.entries.popitem(last=False)
+                self.size -= old.size
+                self.evictions += 1
+        finally:
+            self.lock.release()
+
+    def delete(self, key):
+        self.lock.acquire()
+        try:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old.size
+        finally:
+            self.lock.release()
+
+
+class DiskStore(object):
+
+    """
+    Keeps entries as pickle files in `directory`, evicting the least
+    recently used files once they total more than `max_bytes`.
+    """
+
+    def __init__(self, directory, max_bytes=1024 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.evictions = 0
+        self.lock = threading.Lock()
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        self.size = sum(os.path.getsize(filename)
+                        for filename in self._filenames())
+
+    def _filenames(self):
+        return [os.path.join(self.directory, name)
+                for name in os.listdir(self.directory)
+                if name.endswith('.cache')]
+
+    def filename(self, key):
+        return os.path.join(self.directory, sha1(key).hexdigest() + '.cache')
+
+    def get(self, key):
+        filename = self.filename(key)
+        try:
+            f = open(filename, 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                stored_key, entry = pickle.load(f)
+            except Exception:
+                return None
+        finally:
+            f.close()
+        if stored_key != key:
+            return None
+        try:
+            # The mtime is used as the last access time
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return entry
+
+    def set(self, key, entry):
+        filename = self.filename(key)
+        data = pickle.dumps((key, entry), pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            return
+        tmp = '%s.%s.%s.tmp' % (filename, os.getpid(), threading.currentThread().ident)
+        f = open(tmp, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        self.lock.acquire()
+        try:
+            if os.path.exists(filename):
+                self.size -= os.path.getsize(filename)
+            os.rename(tmp, filename)
+            self.size += len(data)
+            if self.size > self.max_bytes:
+                self._evict()
+        finally:
+            self.lock.release()
+
+    def _evict(self):
+        files = []
+        for filename in self._filenames():
+            try:
+                stat = os.stat(filename)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, filename))
+        files.sort()
+        self.size = sum(size for mtime, size, filename in files)
+        for mtime, size, filename in files:
+            if self.size <= self.max_bytes:
+                break
+            try:
+                os.unlink(filename)
+            except OSError:
+                continue
+            self.size -= size
+            self.evictions += 1
+
+    def delete(self, key):
+        filename = self.filename(key)
+        self.lock.acquire()
+        try:
+            try:
+                size = os.path.getsize(filename)
+                os.unlink(filename)
+            except OSError:
+                return
+            self.size -= size
+        finally:
+            self.lock.release()
+
+
+class CachingMiddleware(object):
+
+    """
+    Caches the responses of `app` (as a shared cache would).
+
+    ``store``:
+        Where responses are kept; by default a :class:`MemoryStore`
+        of `max_bytes`.  If `directory` is given a :class:`DiskStore`
+        is used instead.
+
+    ``max_object_size``:
+        Responses larger than this are not stored.
+
+    ``stale_while_revalidate``:
+        A default for the ``stale-while-revalidate`` Cache-Control
+        extension: for this many seconds after a response becomes
+        stale it is still served while it is refreshed in a background
+        thread.
+
+    ``collapse_timeout``:
+        Requests for a response that another request is already
+        fetching wait up to this long for it before going to the
+        backend themselves.
+
+    Counters are kept in ``stats`` (``hits``, ``misses``, ``stale``,
+    ``revalidated``, ``not_modified``, ``collapsed``, ``stores``,
+    ``bypassed``, ``bytes_from_cache``, ``bytes_from_backend``).  Each
+    response gets an ``X-Cache`` header of ``HIT``, ``MISS``, ``STALE``
+    or ``REVALIDATED``.
+    """
+
+    stat_names = ('hits', 'misses', 'stale', 'revalidated', 'not_modified',
+                  'collapsed', 'stores', 'bypassed', 'bytes_from_cache',
+                  'bytes_from_backend')
+
+    def __init__(self, app, store=None, max_bytes=64 * 1024 * 1024,
+                 directory=None, max_object_size=1024 * 1024,
+                 stale_while_revalidate=0, collapse_timeout=30):
+        self.app = app
+        if store is None:
+            if directory is not None:
+                store = DiskStore(directory, max_bytes)
+            else:
+                store = MemoryStore(max_bytes)
+        self.store = store
+        self.max_object_size = max_object_size
+        self.stale_while_revalidate = stale_while_revalidate
+        self.collapse_timeout = collapse_timeout
+        self.lock = threading.Lock()
+        self.fetching = {}
+        self.revalidating = set()
+        self.stats = dict((name, 0) for name in self.stat_names)
+
+    def count(self, name, amount=1):
+        self.lock.acquire()
+        try:
+            self.stats[name] += amount
+        finally:
+            self.lock.release()
+
+    def cache_key(self, environ):
+        host = environ.get('HTTP_HOST') or '%s:%s' % (
+            environ.get('SERVER_NAME'), environ.get('SERVER_PORT'))
+        key = '%s://%s%s%s' % (environ.get('wsgi.url_scheme', 'http'), host,
+                               environ.get('SCRIPT_NAME', ''),
+                               environ.get('PATH_INFO', ''))
+        if environ.get('QUERY_STRING'):
+            key += '?' + environ['QUERY_STRING']
+        return key
+
+    def lookup(self, key, environ):
+        entry = self.store.get(key)
+        if isinstance(entry, VaryIndex):
+            entry = self.store.get(self.variant_key(key, entry.keys, environ))
+        if entry is not None and not entry.matches(environ):
+            return None
+        return entry
+
+    def variant_key(self, key, vary_keys, environ):
+        return '%s\n%s' % (key, '\n'.join(
+            '%s=%s' % (name, environ.get(name, '')) for name in vary_keys))
+
+    def __call__(self, environ, start_response):
+        method = environ['REQUEST_METHOD']
+        request_cc = parse_cache_control(environ.get('HTTP_CACHE_CONTROL'))
+        if (method not in ('GET', 'HEAD') or 'no-store' in request_cc
+            or 'HTTP_AUTHORIZATION' in environ):
+            self.count('bypassed')
+            return self.app(environ, start_response)
+        key = self.cache_key(environ)
+        no_cache = ('no-cache' in request_cc
+                    or 'no-cache' in environ.get('HTTP_PRAGMA', ''))
+        entry = self.lookup(key, environ)
+        now = time.time()
+        if entry is not None and not no_cache:
+            if entry.is_fresh_for(request_cc, now):
+                self.count('hits')
+                return self.serve(entry, environ, start_response, 'HIT')
+            if ('max-age' not in request_cc and 'min-fresh' not in request_cc
+                and self.may_serve_stale(entry, now)):
+                self.count('stale')
+                self.revalidate_in_background(key, entry, environ)
+                return self.serve(entry, environ, start_response, 'STALE')
+        if method == 'HEAD':
+            # We only store GET responses
+            self.count('bypassed')
+            return self.app(environ, start_response)
+        return self.fetch(key, entry, environ, start_response)
+
+    def may_serve_stale(self, entry, now):
+        if entry.stale_while_revalidate or not self.stale_while_revalidate:
+            return entry.may_serve_stale(now)
+        return (not entry.no_cache and not entry.must_revalidate
+                and entry.age(now) < entry.lifetime
+                + self.stale_while_revalidate)
+
+    def serve(self, entry, environ, start_response, cache_status):
+        if entry.not_modified_for(environ):
+            self.count('not_modified')
+            headers = [(name, value) for name, value in entry.headers
+                       if name.lower() in (
+                           'etag', 'last-modified', 'cache-control',
+                           'expires', 'vary', 'date', 'content-location')]
+            start_response('304 Not Modified',
+                           headers + [('X-Cache', cache_status)])
+            return []
+        age = int(entry.age(time.time()))
+        headers = [(name, value) for name, value in entry.headers
+                   if name.lower() != 'age']
+        headers.append(('Age', str(age)))
+        headers.append(('X-Cache', cache_status))
+        start_response(entry.status, headers)
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return []
+        self.count('bytes_from_cache', len(entry.body))
+        return [entry.body]
+
+    def fetch(self, key, entry, environ, start_response):
+        """
+        Gets the response from the app, collapsing concurrent requests
+        for the same key into one.
+        """
+        self.lock.acquire()
+        try:
+            event = self.fetching.get(key)
+            if event is None:
+                event = self.fetching[key] = threading.Event()
+                leader = True
+            else:
+                leader = False
+        finally:
+            self.lock.release()
+        if not leader:
+            event.wait(self.collapse_timeout)
+            shared = self.lookup(key, environ)
+            if shared is not None and shared.is_fresh(time.time()):
+                self.count('collapsed')
+                return self.serve(shared, environ, start_response, 'HIT')
+            # The response couldn't be stored; get our own
+            return self.fetch_upstream(key, entry, environ, start_response)
+        def done():
+            self.lock.acquire()
+            try:
+                if self.fetching.get(key) is event:
+                    del self.fetching[key]
+            finally:
+                self.lock.release()
+            event.set()
+        try:
+            return self.fetch_upstream(
+                key, entry, environ, start_response, done)
+        except:
+            done()
+            raise
+
+    def fetch_upstream(self, key, entry, environ, start_response,
+                       done=None):
+        upstream_environ = environ.copy()
+        # We want a full response (that we can store) unless we are
+        # revalidating our own entry:
+        for name in ('HTTP_IF_NONE_MATCH', 'HTTP_IF_MODIFIED_SINCE',
+                     'HTTP_IF_MATCH', 'HTTP_IF_UNMODIFIED_SINCE',
+                     'HTTP_IF_RANGE', 'HTTP_RANGE'):
+            upstream_environ.pop(name, None)
+        if entry is not None:
+            if entry.etag:
+                upstream_environ['HTTP_IF_NONE_MATCH'] = entry.etag
+            if entry.last_modified:
+                upstream_environ['HTTP_IF_MODIFIED_SINCE'] = entry.last_modified
+        captured = []
+        written = []
+        def capture_start_response(status, headers, exc_info=None):
+            captured[:] = [status, headers]
+            return written.append
+        app_iter = self.app(upstream_environ, capture_start_response)
+        # Anything passed to write() comes before the app_iter:
+        first_chunks = written
+        if not captured:
+            # The app is lazy about calling start_response
+            for chunk in app_iter:
+                first_chunks.append(chunk)
+                if captured:
+                    break
+        if not captured:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+            raise AssertionError(
+                "The application did not call start_response")
+        status, headers = captured
+        now = time.time()
+        if status.startswith('304') and entry is not None:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+            entry.update(self.merge_headers(entry.headers, headers), now)
+            self.store.set(self.entry_key(key, entry), entry)
+            self.count('revalidated')
+            if done is not None:
+                done()
+            return self.serve(entry, environ, start_response, 'REVALIDATED')
+        self.count('misses')
+        vary = self.vary_for(headers, environ)
+        if (vary is not None and self.is_storable(status, headers)
+            and not self.too_large(headers)):
+            def store(body):
+                new_entry = CacheEntry(status, headers, body, vary, now)
+                if vary:
+                    self.store.set(key, VaryIndex([name for name, value in vary]))
+                self.store.set(self.entry_key(key, new_entry), new_entry)
+                self.count('stores')
+            start_response(status, headers + [('X-Cache', 'MISS')])
+            return StoringAppIter(self, app_iter, first_chunks,
+                                  self.max_object_size, store, done)
+        if done is not None:
+            done()
+        start_response(status, headers + [('X-Cache', 'MISS')])
+        return StoringAppIter(self, app_iter, first_chunks, 0, None, None)
+
+    def entry_key(self, key, entry):
+        if entry.vary:
+            return '%s\n%s' % (key, '\n'.join(
+                '%s=%s' % (name, value or '') for name, value in entry.vary))
+        return key
+
+    def merge_headers(self, old_headers, new_headers):
+        new_names = set(name.lower() for name, value in new_headers)
+        return ([(name, value) for name, value in old_headers
+                 if name.lower() not in new_names]
+                + [(name, value) for name, value in new_headers
+                   if name.lower() != 'content-length'])
+
+    def vary_for(self, headers, environ):
+        """
+        Returns the (environ key, value) pairs the response varies on,
+        or None if it can't be stored because of Vary: *.
+        """
+        vary = []
+        for name, value in headers:
+            if name.lower() != 'vary':
+                continue
+            for header in value.split(','):
+                header = header.strip()
+                if header == '*':
+                    return None
+                if header:
+                    env_key = 'HTTP_%s' % header.upper().replace('-', '_')
+                    vary.append((env_key, environ.get(env_key)))
+        return vary
+
+    def too_large(self, headers):
+        """
+        True if the Content-Length is more than ``max_object_size``.
+        """
+        for name, value in headers:
+            if name.lower() == 'content-length':
+                try:
+                    return int(value) > self.max_object_size
+                except ValueError:
+                    return False
+        return False
+
+    def is_storable(self, status, headers):
+        try:
+            status_code = int(status.split(None, 1)[0])
+        except ValueError:
+            return False
+        if status_code not in cacheable_statuses:
+            return False
+        header_dict = dict((name.lower(), value) for name, value in headers)
+        if 'set-cookie' in header_dict:
+            return False
+        cc = parse_cache_control(header_dict.get('cache-control'))
+        if 'no-store' in cc or 'private' in cc:
+            return False
+        if ('max-age' in cc or 's-maxage' in cc or 'expires' in header_dict
+            or 'etag' in header_dict or 'last-modified' in header_dict):
+            return True
+        return False
+
+    def revalidate_in_background(self, key, entry, environ):
+        self.lock.acquire()
+        try:
+            if key in self.revalidating:
+                return
+            self.revalidating.add(key)
+        finally:
+            self.lock.release()
+        environ = environ.copy()
+        t = threading.Thread(target=self._revalidate,
+                             args=(key, entry, environ))
+        t.setDaemon(True)
+        t.start()
+
+    def _revalidate(self, key, entry, environ):
+        try:
+            app_iter = self.fetch_upstream(
+                key, entry, environ, lambda *args: None)
+            try:
+                for chunk in app_iter:
+                    pass
+            finally:
+                if hasattr(app_iter, 'close'):
+                    app_iter.close()
+        finally:
+            self.lock.acquire()
+            try:
+                self.revalidating.discard(key)
+            finally:
+                self.lock.release()
+
+
+class StoringAppIter(object):
+    """
+    Passes a response on while keeping a copy of its body (up to
+    `max_size` bytes); once the response has been completely read,
+    `store` is called with the body.  `done` is called when the
+    response has been read or closed, whichever comes first, or as
+    soon as it turns out to be too large to store.
+    """
+
+    def __init__(self, cache, app_iter, first_chunks, max_size, store, done):
+        self.cache = cache
+        self.app_iter = app_iter
+        self.first_chunks = first_chunks
+        self.max_size = max_size
+        self.store = store
+        self.done = done
+        self.chunks = []
+        self.size = 0
+        self.complete = False
+        self.finished = False
+
+    def __iter__(self):
+        for chunks in (self.first_chunks, self.app_iter):
+            for chunk in chunks:
+                self.size += len(chunk)
+                if self.store is not None:
+                    if self.size <= self.max_size:
+                        self.chunks.append(chunk)
+                    else:
+                        # It won't be stored, so collapsed requests
+                        # needn't wait for the rest
+                        self.chunks = []
+                        self.release()
+                yield chunk
+        self.complete = True
+        # Don't make collapsed requests wait for the client to close
+        self.finish()
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            self.finish()
+
+    def finish(self):
+        if self.finished:
+            return
+        self.finished = True
+        self.cache.count('bytes_from_backend', self.size)
+        try:
+            if (self.store is not None and self.complete
+                and self.size <= self.max_size):
+                self.store(''.join(self.chunks))
+        finally:
+            self.release()
+
+    def release(self):
+        done = self.done
+        self.done = None
+        if done is not None:
+            done()
@@ -0,0 +1,405 @@
+"""
+Compressing responses on the way through the proxy.
+
+:class:`CompressingMiddleware` (also the ``compress`` filter for Paste
+Deploy) goes in front of :class:`wsgiproxy.app.WSGIProxyApp` (or any
+WSGI application) and compresses responses for clients that accept
+it, so backends don't have to.  The body is compressed as it streams
+through, with a bounded window, so large responses are never held in
+memory.
+
+The encoding is chosen from the request's ``Accept-Encoding``:
+``br`` (if the `brotli <https://pypi.org/project/Brotli/>`_ module is
+installed) or ``gzip``, whichever the client prefers.  Responses are
+left alone if they are already encoded, smaller than ``min_size``,
+not of a compressible type, partial (``206``), marked
+``Cache-Control: no-transform``, or have no body.  Compressed
+responses lose their Content-Length, get ``Vary: Accept-Encoding``,
+and have the encoding added to their ETag (``"abc"`` becomes
+``"abc-gzip"``); the suffix is taken off the ``If-None-Match`` and
+``If-Match`` headers of requests, so conditional requests still work
+with the backend.
+
+With ``upstream_gzip`` the backend is asked for gzip (``Accept-Encoding:
+gzip``) as well, so the hop to the backend is compressed too.  Gzipped
+responses are passed on as they are to clients that accept gzip, and
+decompressed (in bounded pieces) for those that don't.
+"""
+
+import re
+import threading
+import zlib
+try:
+    import brotli as _brotli
+except ImportError:
+    _brotli = None
+
+__all__ = ['CompressingMiddleware']
+
+# Content types that are compressed (prefixes of the lower-case type):
+compressible_types = (
+    'text/',
+    'application/json',
+    'application/javascript',
+    'application/x-javascript',
+    'application/xml',
+    'application/xhtml+xml',
+    'application/rss+xml',
+    'application/atom+xml',
+    'image/svg+xml',
+    )
+
+# ...except these, which are streamed (and would be held back by the
+# compressor):
+streaming_types = ('text/event-stream',)
+
+# Statuses that never have a body or must not be changed:
+skipped_statuses = (204, 206, 304)
+
+# Gzipped bodies are decompressed in pieces of at most this size:
+decompress_size = 64 * 1024
+
+_etag_suffix_re = re.compile(r'-(gzip|br)"')
+
+class CompressingMiddleware(object):
+
+    """
+    Middleware that compresses the responses of `app`.
+
+    ``min_size``:
+        Bodies smaller than this (in bytes) aren't compressed.  For
+        responses without a Content-Length, up to this much is read
+        before deciding.
+
+    ``level``:
+        The gzip compression level (1-9).
+
+    ``window_bits``:
+        The base-two logarithm of the compression window (9-15 for
+        gzip, at least 10 for brotli); smaller windows use less memory
+        for each response.
+
+    ``brotli``:
+        Use brotli when the client prefers it and the module is
+        installed.  ``brotli_quality`` is its quality (0-11).
+
+    ``types``:
+        The content types to compress (prefixes, like ``text/``).
+
+    ``upstream_gzip``:
+        Ask the backend for gzipped responses (see above).
+
+    Counters are kept in ``stats``: ``compressed`` and ``decompressed``
+    responses, and the ``bytes_in`` and ``bytes_out`` of the bodies
+    that were compressed.
+    """
+
+    def __init__(self, app, min_size=1024, level=6, window_bits=15,
+                 brotli=True, brotli_quality=4, types=compressible_types,
+                 upstream_gzip=False):
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+        self.window_bits = window_bits
+        self.brotli_quality = brotli_quality
+        self.encodings = ['gzip']
+        if brotli and _brotli is not None:
+            self.encodings.insert(0, 'br')
+        self.types = tuple(types)
+        self.upstream_gzip = upstream_gzip
+        self.lock = threading.Lock()
+        self.stats = {'compressed': 0, 'decompressed': 0,
+                      'bytes_in': 0, 'bytes_out': 0}
+
+    def count(self, name, amount=1):
+        self.lock.acquire()
+        try:
+            self.stats[name] += amount
+        finally:
+            self.lock.release()
+
+    def choose_encoding(self, codings):
+        """
+        Returns the encoding to use for a client that accepts
+        `codings` (from :func:`parse_accept_encoding`), or None.
+        """
+        best = None
+        best_q = 0
+        for encoding in self.encodings:
+            q = accepted(codings, encoding)
+            if q > best_q:
+                best, best_q = encoding, q
+        return best
+
+    def __call__(self, environ, start_response):
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return self.app(environ, start_response)
+        codings = parse_accept_encoding(environ.get('HTTP_ACCEPT_ENCODING'))
+        encoding = self.choose_encoding(codings)
+        client_gzip = accepted(codings, 'gzip') > 0
+        etag_encoding = strip_etag_suffixes(environ)
+        if self.upstream_gzip:
+            environ['HTTP_ACCEPT_ENCODING'] = 'gzip'
+        captured = []
+        written = []
+        def capture_start_response(status, headers, exc_info=None):
+            captured[:] = [status, headers, exc_info]
+            return written.append
+        app_iter = self.app(environ, capture_start_response)
+        try:
+            first_chunks = written
+            if not captured:
+                # The app is lazy about calling start_response
+                for chunk in app_iter:
+                    first_chunks.append(chunk)
+                    if captured:
+                        break
+            status, headers, exc_info = captured
+            body, headers = self.encode_response(
+                status, headers, chain(first_chunks, app_iter), encoding,
+                client_gzip, etag_encoding)
+        except:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+            raise
+        start_response(status, headers, exc_info)
+        if body is None:
+            return ClosingAppIter(chain(first_chunks, app_iter), app_iter)
+        return ClosingAppIter(body, app_iter)
+
+    def encode_response(self, status, headers, body, encoding, client_gzip,
+                        etag_encoding):
+        """
+        Returns ``(body, headers)``, where `body` is the new body (an
+        iterator) or None if the response is passed on as it is.
+        """
+        try:
+            status_code = int(status.split(None, 1)[0])
+        except ValueError:
+            return None, headers
+        if status_code == 304:
+            if etag_encoding:
+                headers = with_etag_encoding(headers, etag_encoding)
+            return None, headers
+        content_encoding = header_value(headers, 'content-encoding')
+        if content_encoding:
+            content_encoding = content_encoding.strip().lower()
+        vary = self.upstream_gzip
+        decode = False
+        if content_encoding and content_encoding != 'identity':
+            if (not self.upstream_gzip or client_gzip
+                or content_encoding not in ('gzip', 'x-gzip')):
+                if vary:
+                    headers = add_vary(headers)
+                return None, headers
+            # The client can't take the gzip we asked for:
+            decode = True
+            headers = [(name, value) for name, value in headers
+                       if name.lower() not in ('content-encoding',
+                                               'content-length')]
+            headers = weaken_etag(headers)
+            body = gunzip(body)
+            self.count('decompressed')
+        if self.is_compressible(status_code, headers):
+            vary = True
+        else:
+            encoding = None
+        if vary:
+            headers = add_vary(headers)
+        if encoding is None:
+            if decode:
+                return body, headers
+            return None, headers
+        length = header_value(headers, 'content-length')
+        if length is not None:
+            try:
+                if int(length) < self.min_size:
+                    return None, headers
+            except ValueError:
+                return None, headers
+        else:
+            # Read enough to know if it is worth it
+            first = []
+            size = 0
+            for chunk in body:
+                first.append(chunk)
+                size += len(chunk)
+                if size >= self.min_size:
+                    break
+            else:
+                return first, headers
+            body = chain(first, body)
+        headers = [(name, value) for name, value in headers
+                   if name.lower() != 'content-length']
+        headers.append(('Content-Encoding', encoding))
+        headers = with_etag_encoding(headers, encoding)
+        self.count('compressed')
+        return self.compress(body, encoding), headers
+
+    def is_compressible(self, status_code, headers):
+        if status_code < 200 or status_code in skipped_statuses:
+            return False
+        content_type = header_value(headers, 'content-type')
+        if not content_type:
+            return False
+        content_type = content_type.lower()
+        if (not content_type.startswith(self.types)
+            or content_type.startswith(streaming_types)):
+            return False
+        if 'no-transform' in (header_value(headers, 'cache-control')
+                              or '').lower():
+            return False
+        if header_value(headers, 'content-range') is not None:
+            return False
+        return True
+
+    def compressor(self, encoding):
+        """
+        Returns ``(compress, flush)`` functions for `encoding`.
+        """
+        if encoding == 'br':
+            compressor = _brotli.Compressor(
+                quality=self.brotli_quality, lgwin=max(10, self.window_bits))
+            compress = getattr(compressor, 'process', None)
+            if compress is None:
+                compress = compressor.compress
+            return compress, compressor.finish
+        # 16 + window bits gives a gzip header and trailer:
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                      16 + self.window_bits)
+        return compressor.compress, compressor.flush
+
+    def compress(self, body, encoding):
+        compress, flush = self.compressor(encoding)
+        bytes_in = bytes_out = 0
+        try:
+            for chunk in body:
+                bytes_in += len(chunk)
+                data = compress(chunk)
+                if data:
+                    bytes_out += len(data)
+                    yield data
+            data = flush()
+            bytes_out += len(data)
+            if data:
+                yield data
+        finally:
+            self.count('bytes_in', bytes_in)
+            self.count('bytes_out', bytes_out)
+
+
+class ClosingAppIter(object):
+    """
+    Iterates over `body`, closing `app_iter` when closed.
+    """
+
+    def __init__(self, body, app_iter):
+        self.body = body
+        self.app_iter = app_iter
+
+    def __iter__(self):
+        return iter(self.body)
+
+    def close(self):
+        if hasattr(self.app_iter, 'close'):
+            self.app_iter.close()
+
+def chain(first, rest):
+    for chunk in first:
+        yield chunk
+    for chunk in rest:
+        yield chunk
+
+def gunzip(body):
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in body:
+        while chunk:
+            data = decompressor.decompress(chunk, decompress_size)
+            chunk = decompressor.unconsumed_tail
+            if data:
+                yield data
+    data = decompressor.flush()
+    if data:
+        yield data
+
+def parse_accept_encoding(value):
+    """
+    Returns ``{coding: q}`` for an ``Accept-Encoding`` header.
+    """
+    codings = {}
+    if not value:
+        return codings
+    for item in value.split(','):
+        parts = item.split(';')
+        coding = parts[0].strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in parts[1:]:
+            name, sep, q_value = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(q_value)
+                except ValueError:
+                    q = 0.0
+        codings[coding] = q
+    return codings
+
+def accepted(codings, coding):
+    """
+    The q value the client gives `coding` (0 if it isn't accepted).
+    """
+    if coding in codings:
+        return codings[coding]
+    if coding == 'gzip' and 'x-gzip' in codings:
+        return codings['x-gzip']
+    return codings.get('*', 0)
+
+def strip_etag_suffixes(environ):
+    """
+    Takes the encodings added by :func:`with_etag_encoding` off the
+    request's conditional headers, returning the encoding found (or
+    None).
+    """
+    found = None
+    for key in ('HTTP_IF_NONE_MATCH', 'HTTP_IF_MATCH'):
+        value = environ.get(key)
+        if value and '-' in value:
+            match = _etag_suffix_re.search(value)
+            if match is not None:
+                found = match.group(1)
+                environ[key] = _etag_suffix_re.sub('"', value)
+    return found
+
+def header_value(headers, name):
+    for header, value in headers:
+        if header.lower() == name:
+            return value
+    return None
+
+def add_vary(headers):
+    for i, (name, value) in enumerate(headers):
+        if name.lower() == 'vary':
+            names = [v.strip().lower() for v in value.split(',')]
+            if '*' in names or 'accept-encoding' in names:
+                return headers
+            headers = list(headers)
+            headers[i] = (name, value + ', Accept-Encoding')
+            return headers
+    return headers + [('Vary', 'Accept-Encoding')]
+
+def with_etag_encoding(headers, encoding):
+    result = []
+    for name, value in headers:
+        if name.lower() == 'etag' and value.endswith('"'):
+            value = '%s-%s"' % (value[:-1], encoding)
+        result.append((name, value))
+    return result
+
+def weaken_etag(headers):
+    result = []
+    for name, value in headers:
+        if name.lower() == 'etag' and not value.startswith('W/'):
+            value = 'W/' + value
+        result.append((name, value))
+    return result
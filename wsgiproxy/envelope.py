@@ -0,0 +1,171 @@
+"""
+A compact encoding for the environ keys forwarded by WSGIProxy.
+
+In version 0.1 of the protocol :class:`wsgiproxy.app.WSGIProxyApp`
+sends each key it forwards in its own ``X-WSGIProxy-STR-N`` (or
+``UNICODE``, ``JSON``, ``PICKLE``) header.  Version 0.2 packs all of
+them into a single ``X-WSGIProxy-Envelope`` header instead.  The
+envelope is one flags byte followed by the fields; each field is:
+
+* a type byte: ``S`` (a str), ``U`` (unicode, as UTF-8), ``J`` (JSON)
+  or ``P`` (a pickle);
+
+* the length of the key (2 bytes, big-endian) and the key;
+
+* the length of the value (4 bytes, big-endian) and the value.
+
+If the flags have :data:`FLAG_ZLIB` set the fields are compressed with
+zlib (done when they are at least `compress_size` bytes, and only if
+that makes them smaller).  The whole envelope is base64-encoded to fit
+in a header.
+
+A proxy only sends an envelope to a backend that accepts version 0.2;
+see :class:`wsgiproxy.middleware.WSGIProxyMiddleware`.
+"""
+
+import binascii
+import cPickle as pickle
+import struct
+import zlib
+try:
+    import json as simplejson
+except ImportError:
+    import simplejson
+
+__all__ = ['pack', 'unpack', 'unpack_fields', 'EnvelopeError',
+           'envelope_version']
+
+# The protocol version that uses envelopes:
+envelope_version = '0.2'
+
+FLAG_ZLIB = 1
+
+# Fields smaller than this are not worth compressing:
+compress_size = 256
+# Headers are small, so the fastest zlib level does nearly as well:
+compress_level = 1
+# The most a compressed envelope may decompress to (it comes from the
+# client, so it could otherwise expand to fill memory):
+max_size = 1024 * 1024
+
+field_head = struct.Struct('>cH')
+value_head = struct.Struct('>I')
+
+class EnvelopeError(ValueError):
+    """
+    Raised when an envelope can't be decoded.
+    """
+
+
+def encode_str(value):
+    assert isinstance(value, str)
+    return value
+
+def encode_unicode(value):
+    assert isinstance(value, basestring)
+    return unicode(value).encode('utf8')
+
+def encode_json(value):
+    return simplejson.dumps(value)
+
+def encode_pickle(value):
+    return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+encoders = {
+    'S': encode_str,
+    'U': encode_unicode,
+    'J': encode_json,
+    'P': encode_pickle,
+    }
+
+decoders = {
+    'S': str,
+    'U': lambda value: value.decode('utf8'),
+    'J': simplejson.loads,
+    'P': pickle.loads,
+    }
+
+def pack(items, compress_size=compress_size):
+    """
+    Encodes `items`, a list of ``(type, key, value)`` (with str
+    keys), as a header value.
+    """
+    parts = []
+    for type, key, value in items:
+        value = encoders[type](value)
+        parts.append(field_head.pack(type, len(key)) + key
+                     + value_head.pack(len(value)) + value)
+    data = ''.join(parts)
+    flags = 0
+    if compress_size is not None and len(data) >= compress_size:
+        compressed = zlib.compress(data, compress_level)
+        if len(compressed) < len(data):
+            data = compressed
+            flags |= FLAG_ZLIB
+    return binascii.b2a_base64(chr(flags) + data).rstrip('\n')
+
+def unpack_fields(header, max_size=max_size):
+    """
+    Decodes the header value `header` into a list of ``(type, key,
+    encoded_value)``, without decoding the values.  A compressed
+    envelope that decompresses to more than `max_size` bytes is
+    refused.
+    """
+    try:
+        data = binascii.a2b_base64(header)
+    except binascii.Error, e:
+        raise EnvelopeError("Bad base64 in envelope: %s" % e)
+    if not data:
+        raise EnvelopeError("Empty envelope")
+    flags = ord(data[0])
+    data = data[1:]
+    if flags & FLAG_ZLIB:
+        decompressor = zlib.decompressobj()
+        try:
+            data = decompressor.decompress(data, max_size)
+        except zlib.error, e:
+            raise EnvelopeError("Bad compressed envelope: %s" % e)
+        if decompressor.unconsumed_tail:
+            raise EnvelopeError(
+                "Envelope decompresses to more than %s bytes" % max_size)
+    fields = []
+    pos = 0
+    end = len(data)
+    try:
+        while pos < end:
+            type, key_length = field_head.unpack_from(data, pos)
+            pos += field_head.size
+            key = data[pos:pos + key_length]
+            pos += key_length
+            value_length, = value_head.unpack_from(data, pos)
+            pos += value_head.size
+            value = data[pos:pos + value_length]
+            pos += value_length
+            if len(key) != key_length or len(value) != value_length:
+                raise EnvelopeError("Truncated envelope")
+            if type not in decoders:
+                raise EnvelopeError("Unknown field type %r in envelope"
+                                    % type)
+            fields.append((type, key, value))
+    except struct.error:
+        raise EnvelopeError("Truncated envelope")
+    return fields
+
+def unpack(header, allow_pickle=False, max_size=max_size):
+    """
+    Decodes the header value `header` into a list of ``(key,
+    value)``.  Pickles are refused (with :exc:`EnvelopeError`) unless
+    `allow_pickle` is true, as are envelopes that decompress to more
+    than `max_size` bytes.
+    """
+    items = []
+    for type, key, value in unpack_fields(header, max_size):
+        if type == 'P' and not allow_pickle:
+            raise EnvelopeError(
+                "Pickled values are only accepted from a trusted proxy")
+        try:
+            items.append((key, decoders[type](value)))
+        except Exception, e:
+            raise EnvelopeError("Bad value for %r in envelope: %s"
+                                % (key, e))
+    return items
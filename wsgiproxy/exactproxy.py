@@ -1,15 +1,42 @@
 import httplib
 from urllib import quote as url_quote
 import socket
+import time
 from paste import httpexceptions
+from wsgiproxy.pool import (make_connection, connection_key,
+                            idempotent_methods, timed_connect)
+from wsgiproxy.instrument import begin
 
 __all__ = ['proxy_exact_request', 'filter_paste_httpserver_proxy']
 
+# Hop-by-hop headers, which only apply to a single connection and
+# are not passed on in either direction (lower case):
+hop_by_hop_headers = (
+    'connection',
+    'keep-alive',
+    'proxy-connection',
+    'te',
+    'trailer',
+    'upgrade',
+)
+
 # Remove these headers from response (specify lower case header
 # names):
 filtered_headers = (
     'transfer-encoding',
-)
+) + hop_by_hop_headers
+_filtered_header_set = frozenset(filtered_headers)
+
+# The size of the pieces a response body is read and passed on in
+# (can be overridden with environ['wsgiproxy.chunk_size']):
+chunk_size = 64 * 1024
+
+# Timeouts that can be given in the environ (as wsgiproxy.<name>):
+timeout_names = ('connect_timeout', 'first_byte_timeout', 'read_timeout')
+
+# Request bodies larger than this are sent to the server in pieces
+# instead of being read into memory first:
+upload_chunk_size = 64 * 1024
 
 def filter_paste_httpserver_proxy(app):
     """
@@ -51,67 +78,436 @@ def proxy_exact_request(environ, start_response):
     sends the Host header in HTTP_HOST -- they do not have to match.
 
     Does not add X-Forwarded-For or other standard headers
+
+    If ``environ['wsgiproxy.unix_socket']`` is set the request is sent
+    over that Unix domain socket instead (SERVER_NAME and SERVER_PORT
+    are then only used for the Host header).
+
+    If ``environ['wsgiproxy.connection_pool']`` is set to a
+    :class:`wsgiproxy.pool.ConnectionPool` then keep-alive connections
+    are taken from and returned to that pool.
+
+    Request bodies larger than ``upload_chunk_size`` are streamed to
+    the server in chunks, and bodies without a Content-Length are sent
+    with chunked transfer-encoding (when the WSGI server indicates the
+    body is chunked or sets ``wsgi.input_terminated``).  The response
+    body is streamed as well (see :class:`ResponseBody`); the
+    connection is released when the server closes the app_iter.
+
+    If the server can't be reached (or doesn't give a response) the
+    result is a ``502 Bad Gateway``, and the error is put in
+    ``environ['wsgiproxy.upstream_error']``.
+
+    Timeouts (in seconds) are taken from these keys:
+
+    ``wsgiproxy.connect_timeout``:
+        For connecting to the server.
+
+    ``wsgiproxy.first_byte_timeout``:
+        For the response to start once the request is sent.
+
+    ``wsgiproxy.read_timeout``:
+        For each read of the response body (and each send of the
+        request body).
+
+    ``wsgiproxy.deadline``:
+        A ``time.time()`` value by which the whole request must be
+        done; the other timeouts are shortened to fit.
+
+    Running out of time before the response starts results in a
+    ``504 Gateway Timeout``; after that the response is cut off.
+
+    If ``environ['wsgiproxy.h2_pool']`` is set to a
+    :class:`wsgiproxy.h2proxy.H2Pool` the request is sent over HTTP/2
+    instead, sharing connections with other requests (see
+    :mod:`wsgiproxy.h2proxy`).
+
+    The request is timed when ``environ['wsgiproxy.instruments']`` (or
+    :data:`wsgiproxy.instrument.default_instruments`) has subscribers,
+    or added to ``environ['wsgiproxy.event']`` (see
+    :mod:`wsgiproxy.instrument`).
+    """
+    conn_key = connection_key(environ)
+    h2_pool = environ.get('wsgiproxy.h2_pool')
+    if h2_pool is not None and conn_key not in h2_pool.http1_keys:
+        from wsgiproxy.h2proxy import proxy_h2_request
+        return proxy_h2_request(environ, start_response)
+    event, started_event = begin(environ, 'exact')
+    pool = environ.get('wsgiproxy.connection_pool')
+    if pool is None:
+        conn = make_connection(*conn_key)
+        reused = False
+    else:
+        conn, reused = pool.get(conn_key)
+    headers = request_headers(environ)
+    path = request_path(environ)
+    body = request_body(environ, headers)
+    method = environ['REQUEST_METHOD']
+    use_timeouts = 'wsgiproxy.deadline' in environ
+    for name in timeout_names:
+        if environ.get('wsgiproxy.%s' % name) is not None:
+            use_timeouts = True
+    if event is not None:
+        if event.backend is None:
+            event.backend = upstream_name(environ)
+        event.mark('prepare')
+    sock = None
+    while 1:
+        try:
+            if conn.sock is None and (use_timeouts or event is not None):
+                if use_timeouts:
+                    conn.timeout = get_timeout(environ, 'connect_timeout')
+                if event is None:
+                    conn.connect()
+                else:
+                    timed_connect(conn, event)
+            if use_timeouts:
+                sock = conn.sock
+                sock.settimeout(get_timeout(environ, 'read_timeout'))
+            conn.request(method, path, body, headers)
+            if event is not None:
+                event.mark('send')
+            if use_timeouts:
+                sock.settimeout(get_timeout(environ, 'first_byte_timeout'))
+            res = conn.getresponse()
+        except (socket.error, httplib.HTTPException), exc:
+            conn.close()
+            if (reused and method in idempotent_methods
+                and not isinstance(exc, socket.timeout)
+                and not getattr(body, 'bytes_read', 0)):
+                # The server closed the pooled connection while it was
+                # idle; try once more on a fresh connection:
+                conn, reused = pool.connect(conn_key), False
+                continue
+            if event is not None:
+                event.reused = reused
+                event.bytes_out = body_size(body)
+            return upstream_error_response(exc, environ, start_response,
+                                           event, started_event)
+        except IOError, exc:
+            # Reading the request body failed
+            conn.close()
+            if started_event:
+                event.error = exc
+                event.finish()
+            raise
+        break
+    if event is not None:
+        event.mark('first_byte')
+        event.status = res.status
+        event.reused = reused
+        event.bytes_out = body_size(body)
+    headers_out = parse_headers(res.msg)
+    status = '%s %s' % (res.status, res.reason)
+    start_response(status, headers_out)
+    body = ResponseBody(res, conn, pool, conn_key,
+                        environ.get('wsgiproxy.chunk_size', chunk_size))
+    if event is not None:
+        body.set_event(event, started_event)
+    if use_timeouts:
+        body.set_timeouts(sock, environ)
+    if 'wsgi.file_wrapper' in environ:
+        return environ['wsgi.file_wrapper'](body, body.chunk_size)
+    return body
+
+def upstream_error_response(exc, environ, start_response, event,
+                            started_event):
+    """
+    Responds to a failure to get a response from the server: ``504
+    Gateway Timeout`` for a timeout, otherwise ``502 Bad Gateway``.
+    The error is put in ``environ['wsgiproxy.upstream_error']``.
     """
-    scheme = environ['wsgi.url_scheme']
-    if scheme == 'http':
-        ConnClass = httplib.HTTPConnection
-    elif scheme == 'https':
-        ConnClass = httplib.HTTPSConnection
+    environ['wsgiproxy.upstream_error'] = exc
+    if event is not None:
+        event.error = exc
+    if isinstance(exc, socket.timeout):
+        exc = httpexceptions.HTTPGatewayTimeout(
+            "Timed out waiting for %s (%s)"
+            % (upstream_name(environ), exc))
+        return error_response(exc, environ, start_response,
+                              event, started_event)
+    if isinstance(exc, socket.error) and exc.args and exc.args[0] == -2:
+        # Name or service not known
+        message = ("Name or service not known (bad domain name: %s)"
+                   % environ['SERVER_NAME'])
     else:
-        raise ValueError(
-            "Unknown scheme: %r" % scheme)
-    conn = ConnClass('%(SERVER_NAME)s:%(SERVER_PORT)s' % environ)
+        message = ("Could not get a response from %s (%s)"
+                   % (upstream_name(environ), exc))
+    exc = httpexceptions.HTTPBadGateway(message)
+    return error_response(exc, environ, start_response,
+                          event, started_event)
+
+def error_response(exc, environ, start_response, event, started_event):
+    if event is not None:
+        event.status = exc.code
+        if started_event:
+            event.finish()
+    return exc(environ, start_response)
+
+def body_size(body):
+    """
+    The bytes of the request body `body` (from :func:`request_body`)
+    sent so far.
+    """
+    if isinstance(body, str):
+        return len(body)
+    return body.bytes_read
+
+def upstream_name(environ):
+    """
+    Describes the server the request goes to, for error messages.
+    """
+    if environ.get('wsgiproxy.unix_socket'):
+        return environ['wsgiproxy.unix_socket']
+    return '%s:%s' % (environ['SERVER_NAME'], environ['SERVER_PORT'])
+
+def get_timeout(environ, name, default=None):
+    """
+    Returns the timeout `name` (e.g., ``'connect_timeout'``) from
+    ``environ['wsgiproxy.<name>']`` (or `default`), shortened to the
+    time left before ``environ['wsgiproxy.deadline']``.  Returns None
+    for no timeout, and raises ``socket.timeout`` if the deadline has
+    passed already.
+    """
+    timeout = environ.get('wsgiproxy.%s' % name, default)
+    deadline = environ.get('wsgiproxy.deadline')
+    if deadline is not None:
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            raise socket.timeout("The deadline for the request has passed")
+        if timeout is None or remaining < timeout:
+            timeout = remaining
+    return timeout
+
+# Maps environ keys to header names (or None for keys that aren't
+# sent), filled in by header_name():
+_header_names = {}
+
+# The most names _header_names will remember (unusual headers past
+# this are translated every time):
+max_header_names = 1000
+
+def header_name(key):
+    """
+    Returns the HTTP header name for an ``HTTP_*`` environ key
+    (``HTTP_USER_AGENT`` becomes ``User-Agent``), or None if `key`
+    isn't a header to pass on.
+    """
+    try:
+        return _header_names[key]
+    except KeyError:
+        pass
+    if key.startswith('HTTP_'):
+        name = key[5:].replace('_', '-').title()
+        if name.lower() in hop_by_hop_headers:
+            name = None
+    else:
+        name = None
+    if len(_header_names) < max_header_names:
+        _header_names[key] = name
+    return name
+
+def request_headers(environ):
+    """
+    Returns a dictionary of the headers to send for the request,
+    taken from the ``HTTP_*`` keys and CONTENT_TYPE (hop-by-hop
+    headers are left out).
+    """
     headers = {}
-    for key, value in environ.items():
-        if key.startswith('HTTP_'):
-            key = key[5:].replace('_', '-').title()
-            headers[key] = value
+    names = _header_names
+    for key, value in environ.iteritems():
+        if key in names:
+            name = names[key]
+        elif key.startswith('HTTP_'):
+            name = header_name(key)
+        else:
+            continue
+        if name is not None:
+            headers[name] = value
+    if environ.get('CONTENT_TYPE'):
+        headers['Content-Type'] = environ['CONTENT_TYPE']
+    return headers
+
+def request_path(environ):
+    """
+    Returns the (quoted) path and query string to request.
+    """
     path = (url_quote(environ.get('SCRIPT_NAME', ''))
             + url_quote(environ.get('PATH_INFO', '')))
     if environ.get('QUERY_STRING'):
         path += '?' + environ['QUERY_STRING']
+    if not path.startswith("/"):
+        path = "/" + path
+    return path
+
+def request_body(environ, headers):
+    """
+    Returns the request body to send, either as a string or (for
+    large or unknown-length bodies) as a file-like object to be sent
+    piece by piece.  Sets the Content-Length or Transfer-Encoding
+    header in `headers` to match.
+    """
     try:
         content_length = int(environ.get('CONTENT_LENGTH', '0'))
     except ValueError:
         content_length = 0
-    if content_length:
+    if content_length > upload_chunk_size:
+        body = LimitedInput(environ['wsgi.input'], content_length)
+    elif content_length:
         body = environ['wsgi.input'].read(content_length)
+    elif ('chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower()
+          or environ.get('wsgi.input_terminated')):
+        # No length, but the server lets us read wsgi.input to the end
+        body = ChunkedInput(environ['wsgi.input'])
     else:
         body = ''
-    headers['Content-Length'] = content_length
-    if environ.get('CONTENT_TYPE'):
-        headers['Content-Type'] = environ['CONTENT_TYPE']
-    if not path.startswith("/"):
-        path = "/" + path
-    try:
-        conn.request(environ['REQUEST_METHOD'],
-                     path, body, headers)
-    except socket.error, exc:
-        if exc.args[0] == -2:
-            # Name or service not known
-            exc = httpexceptions.HTTPBadGateway(
-                "Name or service not known (bad domain name: %s)"
-                % environ['SERVER_NAME'])
-            return exc(environ, start_response)
-        raise
-    res = conn.getresponse()
-    headers_out = parse_headers(res.msg)
-    status = '%s %s' % (res.status, res.reason)
-    start_response(status, headers_out)
-    length = res.getheader('content-length')
-    # @@: This shouldn't really read in all the content at once
-    if length is not None:
-        body = res.read(int(length))
+    if isinstance(body, ChunkedInput):
+        headers['Transfer-Encoding'] = 'chunked'
     else:
-        body = res.read()
-    conn.close()
-    return [body]
+        headers.pop('Transfer-Encoding', None)
+        headers['Content-Length'] = content_length
+    return body
+
+class LimitedInput(object):
+    """
+    File-like object that reads exactly `length` bytes of the request
+    body from `input` (``wsgi.input``), in whatever sized pieces it
+    is asked for.  ``httplib`` sends file-like bodies block by block,
+    so the upload is never held in memory.
+    """
+
+    def __init__(self, input, length):
+        self.input = input
+        self.remaining = length
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        if self.remaining <= 0:
+            return ''
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.input.read(size)
+        if not data:
+            raise IOError(
+                "Client disconnected with %s bytes of the request body "
+                "left to send" % self.remaining)
+        self.remaining -= len(data)
+        self.bytes_read += len(data)
+        return data
+
+class ChunkedInput(object):
+    """
+    File-like object that reads `input` until it is exhausted and
+    returns it framed with chunked transfer-encoding.
+    """
+
+    def __init__(self, input, chunk_size=None):
+        self.input = input
+        self.chunk_size = chunk_size or upload_chunk_size
+        self.bytes_read = 0
+        self.done = False
+
+    def read(self, size=-1):
+        # Each call returns one complete chunk (of at most chunk_size
+        # bytes of data), regardless of size
+        if self.done:
+            return ''
+        data = self.input.read(self.chunk_size)
+        if not data:
+            self.done = True
+            return '0\r\n\r\n'
+        self.bytes_read += len(data)
+        return '%x\r\n%s\r\n' % (len(data), data)
+
+class ResponseBody(object):
+    """
+    The WSGI app_iter for a proxied response.
+
+    This reads the ``httplib`` response `res` in pieces of at most
+    `chunk_size` bytes as the server iterates over it, so responses
+    are never held in memory (``httplib`` takes care of chunked and
+    unknown-length bodies).  It also has a file-like ``read()`` so
+    it can be passed to ``wsgi.file_wrapper``.
+
+    When the server calls ``close()`` the connection is returned to
+    `pool` if the response was read completely and the connection
+    can be kept alive; otherwise it is closed.
+    """
+
+    def __init__(self, res, conn, pool=None, conn_key=None,
+                 chunk_size=chunk_size):
+        self.res = res
+        self.conn = conn
+        self.pool = pool
+        self.conn_key = conn_key
+        self.chunk_size = chunk_size
+        self.sock = None
+        self.environ = None
+        self.event = None
+        self.finish_event = False
+
+    def set_event(self, event, finish=False):
+        """
+        Count the bytes read in `event` (a
+        :class:`wsgiproxy.instrument.RequestEvent`), and mark its
+        ``body`` phase when closed (finishing it, if `finish`).
+        """
+        self.event = event
+        self.finish_event = finish
+
+    def set_timeouts(self, sock, environ):
+        """
+        Apply the read timeout and deadline from `environ` to each
+        read from `sock`.
+        """
+        self.sock = sock
+        self.environ = environ
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        chunk = self.read(self.chunk_size)
+        if not chunk:
+            raise StopIteration
+        return chunk
+
+    def read(self, size=-1):
+        if self.conn is None:
+            return ''
+        if self.sock is not None and not self.res.isclosed():
+            self.sock.settimeout(get_timeout(self.environ, 'read_timeout'))
+        if size is None or size < 0:
+            data = self.res.read()
+        else:
+            data = self.res.read(size)
+        if self.event is not None:
+            self.event.bytes_in += len(data)
+        return data
+
+    def close(self):
+        conn = self.conn
+        if conn is None:
+            return
+        self.conn = None
+        if (self.pool is not None and self.res.isclosed()
+            and not self.res.will_close):
+            self.pool.put(self.conn_key, conn)
+        else:
+            conn.close()
+        event = self.event
+        if event is not None:
+            event.mark('body')
+            if self.finish_event:
+                event.finish()
 
 def parse_headers(message):
     """
     Turn a Message object into a list of WSGI-style headers.
     """
     headers_out = []
+    append = headers_out.append
+    filtered = _filtered_header_set
     for full_header in message.headers:
         if not full_header:
             # Shouldn't happen, but we'll just ignore
@@ -121,15 +517,13 @@ def parse_headers(message):
             if not headers_out:
                 raise ValueError(
                     "First header starts with a space (%r)" % full_header)
-            last_header, last_value = headers_out.pop()
-            value = last_value + ', ' + full_header.strip()
-            headers_out.append((last_header, value))
+            last_header, last_value = headers_out[-1]
+            headers_out[-1] = (last_header,
+                               last_value + ', ' + full_header.strip())
             continue
-        try:
-            header, value = full_header.split(':', 1)
-        except:
+        header, sep, value = full_header.partition(':')
+        if not sep:
             raise ValueError("Invalid header: %r" % full_header)
-        value = value.strip()
-        if header.lower() not in filtered_headers:
-            headers_out.append((header, value))
+        if header.lower() not in filtered:
+            append((header, value.strip()))
     return headers_out
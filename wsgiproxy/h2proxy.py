@@ -0,0 +1,984 @@
+"""
+An HTTP/2 transport for proxied requests.
+
+``httplib`` sends one request at a time on a connection, so
+:func:`wsgiproxy.exactproxy.proxy_exact_request` needs as many
+connections to a backend as it has requests in flight to it.  Over
+HTTP/2 requests share a connection, each as a stream of its own: an
+:class:`H2Pool` keeps a few connections to each backend and
+multiplexes up to ``max_streams`` requests over each, saving sockets
+and handshakes when many requests fan in to a few backends.
+
+If ``environ['wsgiproxy.h2_pool']`` is set to an :class:`H2Pool`,
+``proxy_exact_request`` sends the request with
+:func:`proxy_h2_request` (``WSGIProxyApp(http2=True)`` does this).
+``https`` backends are offered HTTP/2 with ALPN; one that chooses
+HTTP/1.1 instead is remembered (in the pool's ``http1_keys``) and
+gets its requests from ``proxy_exact_request`` as before.  ``http``
+and ``http+unix`` backends are spoken to in cleartext HTTP/2 (h2c)
+with prior knowledge, so they must support it.
+
+HTTP/2 flow control is tied to the WSGI server reading the response:
+data received on a stream is only acknowledged (letting the backend
+send more) as the app_iter hands it on, so no more than the pool's
+``stream_window`` of a response is buffered while a client is slow
+to read it.  Request bodies are sent as fast as the backend's windows
+allow.
+
+This requires the `h2 <https://pypi.org/project/h2/>`_ package (a
+version before 4 for Python 2).
+"""
+
+import collections
+import httplib
+import os
+import select
+import socket
+import ssl
+import threading
+import time
+
+import h2.config
+import h2.connection
+import h2.errors
+import h2.events
+import h2.exceptions
+import h2.settings
+from wsgiproxy.exactproxy import (
+    proxy_exact_request, request_headers, request_path, LimitedInput,
+    upstream_error_response, upstream_name, get_timeout, timeout_names,
+    chunk_size, upload_chunk_size, _filtered_header_set)
+from wsgiproxy.pool import (connection_key, make_connection,
+                            idempotent_methods, timed_connect)
+from wsgiproxy.instrument import begin
+
+__all__ = ['proxy_h2_request', 'H2Pool', 'H2Connection', 'H2Stream',
+           'H2ResponseBody', 'StreamError', 'StreamRefused',
+           'default_pool']
+
+# How much is read from a connection's socket at a time:
+read_size = 64 * 1024
+
+# The protocols offered to https backends with ALPN, in order of
+# preference:
+alpn_protocols = ['h2', 'http/1.1']
+
+class StreamError(socket.error):
+    """
+    An HTTP/2 stream failed: the server reset it, or its connection
+    was lost.
+    """
+
+class StreamRefused(StreamError):
+    """
+    The server refused a stream without processing it (it was reset
+    with ``REFUSED_STREAM``, or came after the last stream of a
+    ``GOAWAY``), so the request can safely be sent again.
+    """
+
+class HTTP1Only(Exception):
+    """
+    An https backend did not choose HTTP/2 with ALPN.
+    """
+
+
+def proxy_h2_request(environ, start_response):
+    """
+    Sends the request in the environ like
+    :func:`wsgiproxy.exactproxy.proxy_exact_request`, but as a stream
+    on an HTTP/2 connection from ``environ['wsgiproxy.h2_pool']`` (or
+    :data:`default_pool`).  The timeouts, error responses and
+    instrumentation are the same.
+
+    A request refused by the server (or caught by a connection
+    closing) before it was processed is sent once more on another
+    connection, as long as its body hasn't been streamed already.
+    """
+    pool = environ.get('wsgiproxy.h2_pool') or default_pool
+    key = connection_key(environ)
+    if key in pool.http1_keys:
+        return proxy_exact_request(environ, start_response)
+    event, started_event = begin(environ, 'http2')
+    body, length = h2_request_body(environ)
+    headers = h2_request_headers(environ, key, length)
+    method = environ['REQUEST_METHOD']
+    use_timeouts = 'wsgiproxy.deadline' in environ
+    for name in timeout_names:
+        if environ.get('wsgiproxy.%s' % name) is not None:
+            use_timeouts = True
+    if event is not None:
+        if event.backend is None:
+            event.backend = upstream_name(environ)
+        event.mark('prepare')
+    retried = False
+    while 1:
+        conn = stream = None
+        reused = False
+        try:
+            conn, reused = pool.get(
+                key, get_timeout(environ, 'connect_timeout'), event)
+            stream = conn.open_stream(headers, end_stream=body is None)
+            if use_timeouts:
+                stream.environ = environ
+            if body is not None:
+                stream.send_body(body)
+            if event is not None:
+                event.mark('send')
+            response_headers = stream.wait_response()
+        except HTTP1Only:
+            if started_event:
+                del environ['wsgiproxy.event']
+            return proxy_exact_request(environ, start_response)
+        except (socket.error, h2.exceptions.H2Error), exc:
+            if stream is not None:
+                stream.close()
+            elif conn is not None:
+                pool.release(conn)
+            replayable = (body is None or isinstance(body, str)
+                          or not body.bytes_read)
+            if (not retried and replayable
+                and (isinstance(exc, StreamRefused)
+                     or (isinstance(exc, StreamError) and reused
+                         and method in idempotent_methods))):
+                retried = True
+                continue
+            if event is not None:
+                event.reused = reused
+                if stream is not None:
+                    event.bytes_out = stream.bytes_out
+            return upstream_error_response(exc, environ, start_response,
+                                           event, started_event)
+        except IOError, exc:
+            # Reading the request body failed
+            if stream is not None:
+                stream.close()
+            elif conn is not None:
+                pool.release(conn)
+            if started_event:
+                event.error = exc
+                event.finish()
+            raise
+        break
+    status = '200'
+    headers_out = []
+    append = headers_out.append
+    filtered = _filtered_header_set
+    for name, value in response_headers:
+        if name[0] == ':':
+            if name == ':status':
+                status = value
+        elif name not in filtered:
+            append((name, value))
+    if event is not None:
+        event.mark('first_byte')
+        event.status = int(status)
+        event.reused = reused
+        event.bytes_out = stream.bytes_out
+    start_response('%s %s' % (status, httplib.responses.get(int(status),
+                                                            'Unknown')),
+                   headers_out)
+    body = H2ResponseBody(stream,
+                          environ.get('wsgiproxy.chunk_size', chunk_size))
+    if event is not None:
+        body.set_event(event, started_event)
+    if 'wsgi.file_wrapper' in environ:
+        return environ['wsgi.file_wrapper'](body, body.chunk_size)
+    return body
+
+def h2_request_headers(environ, key, length=None):
+    """
+    Returns the HTTP/2 header list for the request: the pseudo-headers
+    (with the Host header as ``:authority``), then the ``HTTP_*``
+    headers in lower case, and a content-length if `length` isn't
+    None.
+    """
+    headers = request_headers(environ)
+    authority = headers.pop('Host', None)
+    if authority is None:
+        authority = '%s:%s' % (environ['SERVER_NAME'], environ['SERVER_PORT'])
+    headers.pop('Transfer-Encoding', None)
+    if key[0] == 'https':
+        scheme = 'https'
+    else:
+        scheme = 'http'
+    result = [(':method', environ['REQUEST_METHOD']),
+              (':scheme', scheme),
+              (':authority', authority),
+              (':path', request_path(environ))]
+    append = result.append
+    for name, value in headers.iteritems():
+        append((name.lower(), value))
+    if length is not None:
+        append(('content-length', str(length)))
+    return result
+
+def h2_request_body(environ):
+    """
+    Returns ``(body, length)`` for the request: `body` is None (no
+    body), a string, or (for large or unknown-length bodies) a
+    file-like object to send piece by piece, and `length` is the
+    Content-Length (or None if there isn't one).
+    """
+    length = environ.get('CONTENT_LENGTH')
+    try:
+        length = int(length)
+    except (TypeError, ValueError):
+        length = None
+    if length is not None and length > upload_chunk_size:
+        return LimitedInput(environ['wsgi.input'], length), length
+    if length:
+        return environ['wsgi.input'].read(length), length
+    if ('chunked' in environ.get('HTTP_TRANSFER_ENCODING', '').lower()
+        or environ.get('wsgi.input_terminated')):
+        # No length, but the server lets us read wsgi.input to the end
+        return TerminatedInput(environ['wsgi.input']), None
+    return None, length
+
+class TerminatedInput(object):
+    """
+    File-like object that reads `input` until it is exhausted (HTTP/2
+    frames the body itself, so it isn't chunked).
+    """
+
+    def __init__(self, input):
+        self.input = input
+        self.bytes_read = 0
+
+    def read(self, size):
+        data = self.input.read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+class H2Pool(object):
+
+    """
+    HTTP/2 connections to backends, keyed by ``(scheme, host, port)``
+    like :class:`wsgiproxy.pool.ConnectionPool`.
+
+    A request gets a stream on the connection to its backend with the
+    fewest requests.  Up to ``max_streams`` requests (or fewer, if the
+    server says so) share a connection; another connection is only
+    opened when they are all full, up to ``max_connections`` for each
+    backend, after which requests wait for a free stream.  Connections
+    left with no requests for ``idle_timeout`` seconds are closed.
+
+    ``stream_window`` is the receive window of each stream (how much
+    of a response is buffered ahead of the WSGI server), and
+    ``connection_window`` that of a whole connection.
+
+    ``ssl_context`` is used for https backends (by default
+    ``ssl.create_default_context()``); it is set to offer ``h2`` with
+    ALPN.
+    """
+
+    def __init__(self, max_connections=2, max_streams=100, idle_timeout=60,
+                 stream_window=256 * 1024,
+                 connection_window=4 * 1024 * 1024, ssl_context=None):
+        self.max_connections = max_connections
+        self.max_streams = max_streams
+        self.idle_timeout = idle_timeout
+        self.stream_window = stream_window
+        self.connection_window = connection_window
+        self._ssl_context = ssl_context
+        self.lock = threading.Lock()
+        self.changed = threading.Condition(self.lock)
+        # Maps keys to a list of H2Connections:
+        self.connections = {}
+        # Maps keys to the number of connections being opened:
+        self.connecting = {}
+        # The keys of https backends that chose HTTP/1.1:
+        self.http1_keys = set()
+
+    @property
+    def ssl_context(self):
+        if self._ssl_context is None:
+            self._ssl_context = ssl.create_default_context()
+        return self._ssl_context
+
+    def get(self, key, connect_timeout=None, event=None):
+        """
+        Returns ``(conn, reused)``: an :class:`H2Connection` to the key
+        with a stream reserved for the request, to be given back with
+        :meth:`release` (:meth:`H2Stream.close` does that).  `reused`
+        is false for a new connection, which is opened within
+        `connect_timeout` (marking the phases of `event`).  Raises
+        ``socket.timeout`` if no stream is free in that time.
+        """
+        deadline = None
+        if connect_timeout is not None:
+            deadline = time.time() + connect_timeout
+        expired = []
+        self.lock.acquire()
+        try:
+            while 1:
+                conns = self.connections.setdefault(key, [])
+                best = None
+                now = time.time()
+                for conn in list(conns):
+                    if not conn.active and (
+                        conn.closing or
+                        now - conn.last_used > self.idle_timeout):
+                        conns.remove(conn)
+                        expired.append(conn)
+                    elif (not conn.closing and conn.active < conn.capacity
+                          and (best is None or conn.active < best.active)):
+                        best = conn
+                if best is not None:
+                    best.active += 1
+                    return best, True
+                if (len(conns) + self.connecting.get(key, 0)
+                    < self.max_connections):
+                    self.connecting[key] = self.connecting.get(key, 0) + 1
+                    break
+                timeout = None
+                if deadline is not None:
+                    timeout = deadline - now
+                    if timeout <= 0:
+                        raise socket.timeout(
+                            "No HTTP/2 stream free in time")
+                self.changed.wait(timeout)
+        finally:
+            self.lock.release()
+            for conn in expired:
+                conn.close()
+        conn = None
+        try:
+            conn = self.connect(key, connect_timeout, event)
+        finally:
+            self.lock.acquire()
+            try:
+                self.connecting[key] -= 1
+                if conn is not None:
+                    conn.active = 1
+                    self.connections.setdefault(key, []).append(conn)
+                self.changed.notifyAll()
+            finally:
+                self.lock.release()
+        return conn, False
+
+    def connect(self, key, timeout=None, event=None):
+        """
+        Opens and starts a new :class:`H2Connection` to the key.
+        Raises :class:`HTTP1Only` (and adds the key to ``http1_keys``)
+        if an https backend doesn't choose HTTP/2.
+        """
+        scheme, host, port = key
+        if scheme == 'https':
+            context = self.ssl_context
+            if not getattr(ssl, 'HAS_ALPN', False):
+                self.http1_keys.add(key)
+                raise HTTP1Only("ALPN is not available")
+            context.set_alpn_protocols(alpn_protocols)
+            conn = httplib.HTTPSConnection('%s:%s' % (host, port),
+                                           context=context)
+        else:
+            conn = make_connection(scheme, host, port)
+        if timeout is not None:
+            conn.timeout = timeout
+        if event is None:
+            conn.connect()
+        else:
+            timed_connect(conn, event)
+        sock = conn.sock
+        if scheme == 'https' and sock.selected_alpn_protocol() != 'h2':
+            sock.close()
+            self.http1_keys.add(key)
+            raise HTTP1Only("%s:%s chose %s" % (
+                host, port, sock.selected_alpn_protocol() or 'HTTP/1.1'))
+        if scheme != 'http+unix':
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.settimeout(None)
+        h2_conn = H2Connection(self, key, sock)
+        h2_conn.start()
+        return h2_conn
+
+    def release(self, conn):
+        """
+        Gives back the stream reserved on `conn` by :meth:`get`.
+        """
+        self.lock.acquire()
+        try:
+            conn.active -= 1
+            conn.last_used = time.time()
+            close = conn.closing and not conn.active
+            if close:
+                conns = self.connections.get(conn.key, ())
+                if conn in conns:
+                    conns.remove(conn)
+            self.changed.notifyAll()
+        finally:
+            self.lock.release()
+        if close:
+            conn.close()
+
+    def discard(self, conn):
+        """
+        Forgets a connection that has failed or been closed.
+        """
+        self.lock.acquire()
+        try:
+            conns = self.connections.get(conn.key, ())
+            if conn in conns:
+                conns.remove(conn)
+            self.changed.notifyAll()
+        finally:
+            self.lock.release()
+
+    def notify(self):
+        """
+        Wakes requests waiting for a stream (when a connection's
+        capacity changes).
+        """
+        self.lock.acquire()
+        try:
+            self.changed.notifyAll()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """
+        Closes all the connections (cutting off requests in flight).
+        """
+        self.lock.acquire()
+        try:
+            connections = self.connections
+            self.connections = {}
+        finally:
+            self.lock.release()
+        for conns in connections.values():
+            for conn in conns:
+                conn.close()
+
+
+class H2Connection(object):
+
+    """
+    An HTTP/2 connection to a backend, shared by the
+    :class:`H2Stream` of each request on it.
+
+    A daemon thread reads from the socket and passes what it receives
+    on to the streams.  The socket and the ``h2`` state are only used
+    with ``lock`` held.  Streams waiting with a timeout tell the
+    thread (through a pipe) when it has to wake them, so no one polls.
+    """
+
+    def __init__(self, pool, key, sock):
+        self.pool = pool
+        self.key = key
+        self.sock = sock
+        self.lock = threading.Lock()
+        config = h2.config.H2Configuration(client_side=True,
+                                           header_encoding=None)
+        self.h2 = h2.connection.H2Connection(config=config)
+        self.h2.local_settings = h2.settings.Settings(
+            client=True, initial_values={
+                h2.settings.SettingCodes.ENABLE_PUSH: 0,
+                h2.settings.SettingCodes.INITIAL_WINDOW_SIZE:
+                    pool.stream_window,
+                })
+        # Maps stream ids to H2Streams:
+        self.streams = {}
+        # The streams reserved by the pool (under the pool's lock):
+        self.active = 0
+        # One stream until the server's settings say how many it takes:
+        self.capacity = 1
+        self.last_used = time.time()
+        # No new streams once closing; error is set when it has failed:
+        self.closing = False
+        self.error = None
+        # When the reading thread will wake up (None for never):
+        self.wakes_at = None
+        self.wake_read, self.wake_write = os.pipe()
+
+    def start(self):
+        self.lock.acquire()
+        try:
+            self.h2.initiate_connection()
+            increment = self.pool.connection_window - 65535
+            if increment > 0:
+                self.h2.increment_flow_control_window(increment)
+            self.flush()
+        finally:
+            self.lock.release()
+        thread = threading.Thread(target=self.run,
+                                  name='h2 %s:%s' % self.key[1:])
+        thread.setDaemon(True)
+        thread.start()
+
+    def open_stream(self, headers, end_stream=False):
+        """
+        Sends a request's `headers` on a new stream, returning its
+        :class:`H2Stream`.
+        """
+        self.lock.acquire()
+        try:
+            if self.closing:
+                raise StreamRefused("The connection is closing")
+            try:
+                stream_id = self.h2.get_next_available_stream_id()
+            except h2.exceptions.NoAvailableStreamIDError:
+                self.closing = True
+                raise StreamRefused("The connection has run out of streams")
+            stream = H2Stream(self, stream_id)
+            try:
+                self.h2.send_headers(stream_id, headers,
+                                     end_stream=end_stream)
+            except h2.exceptions.TooManyStreamsError:
+                raise StreamRefused("The server has no streams free")
+            self.streams[stream_id] = stream
+            stream.sent_end = end_stream
+            self.flush()
+            return stream
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        """
+        Sends whatever the ``h2`` state has to send (with ``lock``
+        held).
+        """
+        data = self.h2.data_to_send()
+        if data:
+            try:
+                self.sock.sendall(data)
+            except socket.error, exc:
+                self.fail_streams(StreamError(
+                    "Lost the connection to %s:%s (%s)"
+                    % (self.key[1], self.key[2], exc)))
+                raise self.error
+
+    def wake(self):
+        # (with lock held)
+        if self.wake_write is not None:
+            os.write(self.wake_write, 'x')
+
+    def run(self):
+        sock = self.sock
+        try:
+            try:
+                while 1:
+                    self.lock.acquire()
+                    try:
+                        if self.error is not None:
+                            break
+                        timeout = self.expire_waits(time.time())
+                        if timeout is None:
+                            self.wakes_at = None
+                        else:
+                            self.wakes_at = time.time() + timeout
+                    finally:
+                        self.lock.release()
+                    readable, writable, errored = select.select(
+                        [sock, self.wake_read], [], [], timeout)
+                    if self.wake_read in readable:
+                        os.read(self.wake_read, 512)
+                    if sock in readable:
+                        self.receive()
+            except Exception, exc:
+                self.lock.acquire()
+                try:
+                    if not isinstance(exc, StreamError):
+                        exc = StreamError(
+                            "Lost the connection to %s:%s (%s)"
+                            % (self.key[1], self.key[2], exc))
+                    self.fail_streams(exc)
+                finally:
+                    self.lock.release()
+        finally:
+            self.pool.discard(self)
+            sock.close()
+            self.lock.acquire()
+            try:
+                os.close(self.wake_read)
+                os.close(self.wake_write)
+                self.wake_write = None
+            finally:
+                self.lock.release()
+
+    def receive(self):
+        notify_pool = False
+        self.lock.acquire()
+        try:
+            sock = self.sock
+            data = sock.recv(read_size)
+            if not data:
+                raise StreamError("%s:%s closed the connection"
+                                  % self.key[1:])
+            if isinstance(sock, ssl.SSLSocket):
+                # Decrypted data doesn't make the socket readable
+                while sock.pending():
+                    data += sock.recv(read_size)
+            for event in self.h2.receive_data(data):
+                notify_pool = self.handle(event) or notify_pool
+            self.flush()
+        finally:
+            self.lock.release()
+        if notify_pool:
+            self.pool.notify()
+
+    def handle(self, event):
+        """
+        Passes `event` on to its stream.  Returns true if waiting
+        requests could use the connection's changed capacity.
+        """
+        stream = self.streams.get(getattr(event, 'stream_id', None))
+        if isinstance(event, h2.events.DataReceived):
+            if stream is None:
+                self.h2.acknowledge_received_data(
+                    event.flow_controlled_length, event.stream_id)
+            else:
+                stream.chunks.append((event.data,
+                                      event.flow_controlled_length))
+                stream.changed.notify()
+        elif isinstance(event, h2.events.ResponseReceived):
+            if stream is not None:
+                stream.headers = event.headers
+                stream.changed.notify()
+        elif isinstance(event, h2.events.StreamEnded):
+            if stream is not None:
+                stream.ended = True
+                stream.changed.notify()
+        elif isinstance(event, h2.events.StreamReset):
+            if stream is not None:
+                if event.error_code == h2.errors.ErrorCodes.REFUSED_STREAM:
+                    stream.fail(StreamRefused("The server refused the stream"))
+                else:
+                    stream.fail(StreamError("The server reset the stream (%s)"
+                                            % event.error_code))
+        elif isinstance(event, h2.events.WindowUpdated):
+            if event.stream_id:
+                if stream is not None:
+                    stream.changed.notify()
+            else:
+                for stream in self.streams.values():
+                    stream.changed.notify()
+        elif isinstance(event, h2.events.RemoteSettingsChanged):
+            codes = h2.settings.SettingCodes
+            if codes.INITIAL_WINDOW_SIZE in event.changed_settings:
+                for stream in self.streams.values():
+                    stream.changed.notify()
+            self.capacity = min(
+                self.pool.max_streams,
+                self.h2.remote_settings.max_concurrent_streams)
+            return True
+        elif isinstance(event, h2.events.ConnectionTerminated):
+            self.closing = True
+            for stream_id, stream in self.streams.items():
+                if stream_id > event.last_stream_id:
+                    stream.fail(StreamRefused(
+                        "The server is closing the connection"))
+            return True
+        return False
+
+    def expire_waits(self, now):
+        """
+        Wakes the streams whose waits have timed out, returning the
+        time until the next one does (or None).
+        """
+        nearest = None
+        for stream in self.streams.values():
+            deadline = stream.deadline
+            if deadline is None:
+                continue
+            if deadline <= now:
+                stream.deadline = None
+                stream.changed.notify()
+            elif nearest is None or deadline < nearest:
+                nearest = deadline
+        if nearest is None:
+            return None
+        return nearest - now
+
+    def fail_streams(self, exc):
+        """
+        Marks the connection as failed with `exc` (with ``lock`` held),
+        failing all its streams and stopping the reading thread.
+        """
+        if self.error is not None:
+            return
+        self.error = exc
+        self.closing = True
+        for stream in self.streams.values():
+            stream.fail(exc)
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.wake()
+
+    def close(self):
+        """
+        Says goodbye to the server and closes the connection.
+        """
+        self.lock.acquire()
+        try:
+            if self.error is not None:
+                return
+            try:
+                self.h2.close_connection()
+                self.flush()
+            except (socket.error, h2.exceptions.H2Error):
+                pass
+            self.fail_streams(StreamError("The connection was closed"))
+        finally:
+            self.lock.release()
+
+
+class H2Stream(object):
+
+    """
+    The stream of one request on an :class:`H2Connection`.
+
+    The reading thread fills in ``headers`` (the response's), queues
+    the body in ``chunks`` and sets ``ended`` or ``error``.  The
+    timeouts in ``environ`` (see
+    :func:`wsgiproxy.exactproxy.proxy_exact_request`) apply to its
+    waits, if it is set.
+    """
+
+    def __init__(self, conn, stream_id):
+        self.conn = conn
+        self.stream_id = stream_id
+        self.changed = threading.Condition(conn.lock)
+        self.headers = None
+        # (data, flow-controlled length) pairs not read yet:
+        self.chunks = collections.deque()
+        self.ended = False
+        self.sent_end = False
+        self.error = None
+        self.closed = False
+        self.environ = None
+        # When the current wait times out:
+        self.deadline = None
+        self.bytes_out = 0
+
+    def fail(self, exc):
+        if self.error is None:
+            self.error = exc
+        self.changed.notify()
+
+    def deadline_for(self, name):
+        if self.environ is None:
+            return None
+        timeout = get_timeout(self.environ, name)
+        if timeout is None:
+            return None
+        return time.time() + timeout
+
+    def wait(self, deadline):
+        """
+        Waits (with the connection's ``lock`` held) to be woken by the
+        reading thread, raising ``socket.timeout`` if `deadline` has
+        passed.
+        """
+        if deadline is None:
+            self.changed.wait()
+            return
+        if time.time() >= deadline:
+            raise socket.timeout("Timed out waiting on the stream")
+        self.deadline = deadline
+        conn = self.conn
+        if conn.wakes_at is None or deadline < conn.wakes_at:
+            conn.wake()
+        try:
+            self.changed.wait()
+        finally:
+            self.deadline = None
+
+    def send_body(self, body):
+        """
+        Sends the request `body` (a string or a file-like object) and
+        ends the stream, as fast as flow control allows.
+        """
+        if isinstance(body, str):
+            self.send_data(body)
+        else:
+            while 1:
+                data = body.read(upload_chunk_size)
+                if not data:
+                    break
+                self.send_data(data)
+        conn = self.conn
+        conn.lock.acquire()
+        try:
+            if self.error is not None:
+                raise self.error
+            conn.h2.end_stream(self.stream_id)
+            self.sent_end = True
+            conn.flush()
+        finally:
+            conn.lock.release()
+
+    def send_data(self, data):
+        conn = self.conn
+        h2_conn = conn.h2
+        while data:
+            deadline = self.deadline_for('read_timeout')
+            conn.lock.acquire()
+            try:
+                while 1:
+                    if self.error is not None:
+                        raise self.error
+                    size = min(len(data),
+                               h2_conn.local_flow_control_window(
+                                   self.stream_id),
+                               h2_conn.max_outbound_frame_size)
+                    if size > 0:
+                        break
+                    self.wait(deadline)
+                h2_conn.send_data(self.stream_id, data[:size])
+                conn.flush()
+            finally:
+                conn.lock.release()
+            self.bytes_out += size
+            data = data[size:]
+
+    def wait_response(self):
+        """
+        Returns the response headers once they have arrived.
+        """
+        deadline = self.deadline_for('first_byte_timeout')
+        self.conn.lock.acquire()
+        try:
+            while self.headers is None:
+                if self.error is not None:
+                    raise self.error
+                self.wait(deadline)
+            return self.headers
+        finally:
+            self.conn.lock.release()
+
+    def read(self, size):
+        """
+        Returns up to `size` bytes of the response body (``''`` at the
+        end), acknowledging them to the server.
+        """
+        deadline = self.deadline_for('read_timeout')
+        conn = self.conn
+        chunks = self.chunks
+        conn.lock.acquire()
+        try:
+            while not chunks:
+                if self.ended:
+                    return ''
+                if self.error is not None:
+                    raise self.error
+                self.wait(deadline)
+            pieces = []
+            length = acknowledged = 0
+            while chunks and length < size:
+                data, flow_controlled_length = chunks.popleft()
+                if length + len(data) > size:
+                    # Leave the rest for next time
+                    chunks.appendleft((data[size - length:], 0))
+                    data = data[:size - length]
+                pieces.append(data)
+                length += len(data)
+                acknowledged += flow_controlled_length
+            if acknowledged and conn.error is None:
+                conn.h2.acknowledge_received_data(acknowledged,
+                                                  self.stream_id)
+                conn.flush()
+        finally:
+            conn.lock.release()
+        if len(pieces) == 1:
+            return pieces[0]
+        return ''.join(pieces)
+
+    def close(self):
+        """
+        Finishes with the stream (resetting it if the response or
+        request hasn't been completely sent), and gives it back to the
+        pool.
+        """
+        conn = self.conn
+        conn.lock.acquire()
+        try:
+            if self.closed:
+                return
+            self.closed = True
+            del conn.streams[self.stream_id]
+            unread = 0
+            for data, flow_controlled_length in self.chunks:
+                unread += flow_controlled_length
+            self.chunks.clear()
+            if conn.error is None:
+                try:
+                    if not (self.ended and self.sent_end):
+                        conn.h2.reset_stream(self.stream_id,
+                                             h2.errors.ErrorCodes.CANCEL)
+                    if unread:
+                        conn.h2.acknowledge_received_data(unread,
+                                                          self.stream_id)
+                    conn.flush()
+                except (socket.error, h2.exceptions.H2Error):
+                    pass
+        finally:
+            conn.lock.release()
+        conn.pool.release(conn)
+
+
+class H2ResponseBody(object):
+
+    """
+    The WSGI app_iter for a response on an :class:`H2Stream`, read in
+    pieces of at most `chunk_size` bytes (with a file-like
+    ``read()`` for ``wsgi.file_wrapper``).  Data is acknowledged to
+    the server as it is read, which lets the server send more;
+    closing the body before the end resets the stream.
+    """
+
+    def __init__(self, stream, chunk_size=chunk_size):
+        self.stream = stream
+        self.chunk_size = chunk_size
+        self.event = None
+        self.finish_event = False
+
+    def set_event(self, event, finish=False):
+        """
+        Count the bytes read in `event`, and mark its ``body`` phase
+        when closed (finishing it, if `finish`).
+        """
+        self.event = event
+        self.finish_event = finish
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        chunk = self.read(self.chunk_size)
+        if not chunk:
+            raise StopIteration
+        return chunk
+
+    def read(self, size=-1):
+        if self.stream is None:
+            return ''
+        if size is None or size < 0:
+            pieces = []
+            while 1:
+                data = self.stream.read(self.chunk_size)
+                if not data:
+                    break
+                pieces.append(data)
+            data = ''.join(pieces)
+        else:
+            data = self.stream.read(size)
+        if self.event is not None:
+            self.event.bytes_in += len(data)
+        return data
+
+    def close(self):
+        stream = self.stream
+        if stream is None:
+            return
+        self.stream = None
+        stream.close()
+        event = self.event
+        if event is not None:
+            event.mark('body')
+            if self.finish_event:
+                event.finish()
+
+default_pool = H2Pool()
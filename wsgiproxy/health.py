@@ -0,0 +1,210 @@
+"""
+Backend health tracking and circuit breaking.
+
+Each :class:`wsgiproxy.balancer.Backend` has a :class:`BackendHealth`
+(in ``backend.health``).  :class:`wsgiproxy.app.WSGIProxyApp` records
+the outcome of every request there (passive checking): after
+``failure_threshold`` consecutive failures (a connection error, a
+timeout, or a 502/503/504 response) the backend is marked down and
+requests are no longer sent to it.  Once ``recovery_time`` seconds
+have passed a single request is let through (the circuit is
+"half-open"); if it succeeds the backend is up again, otherwise it
+stays down for another ``recovery_time``.
+
+A :class:`HealthChecker` can also probe a health URL on each backend
+from a background thread (active checking), bringing backends up or
+down without waiting for real requests.
+"""
+
+import httplib
+import logging
+import socket
+import threading
+import time
+import weakref
+from wsgiproxy.pool import UnixHTTPConnection
+
+__all__ = ['BackendHealth', 'HealthChecker']
+
+# Responses with these statuses are counted as failures:
+failure_statuses = (502, 503, 504)
+
+class BackendHealth(object):
+
+    """
+    The circuit breaker state of a backend.
+
+    ``up`` is false while the backend is marked down.
+    """
+
+    def __init__(self, failure_threshold=5, recovery_time=10):
+        self.failure_threshold = failure_threshold
+        self.recovery_time = recovery_time
+        self.lock = threading.Lock()
+        self.failures = 0
+        self.up = True
+        self.down_since = None
+        self.trial_started = None
+
+    def available(self, now=None):
+        """
+        Is it okay to send a request to this backend?  True when it is
+        up, or when it is down but due for a trial request.  (Only
+        :meth:`attempt` claims the trial, though.)
+        """
+        if now is None:
+            now = time.time()
+        self.lock.acquire()
+        try:
+            return self._available(now)
+        finally:
+            self.lock.release()
+
+    def _available(self, now):
+        if self.up:
+            return True
+        if self.trial_started is not None:
+            # Only one trial at a time (unless it seems to be lost)
+            return now - self.trial_started > self.recovery_time
+        return now - self.down_since >= self.recovery_time
+
+    def attempt(self, now=None):
+        """
+        Called when a request is about to be sent to the backend.
+        Returns false if it can't be: the backend is down, and the
+        trial request has been claimed by another request.  Checking
+        and claiming the trial are done at once, so only one request
+        gets it.
+        """
+        if now is None:
+            now = time.time()
+        self.lock.acquire()
+        try:
+            if not self._available(now):
+                return False
+            if not self.up:
+                self.trial_started = now
+            return True
+        finally:
+            self.lock.release()
+
+    def record_success(self):
+        self.lock.acquire()
+        try:
+            self.failures = 0
+            self.up = True
+            self.down_since = self.trial_started = None
+        finally:
+            self.lock.release()
+
+    def record_failure(self, now=None):
+        self.lock.acquire()
+        try:
+            if now is None:
+                now = time.time()
+            self.failures += 1
+            if not self.up or self.failures >= self.failure_threshold:
+                self.up = False
+                self.down_since = now
+                self.trial_started = None
+        finally:
+            self.lock.release()
+
+    def retry_after(self, now=None):
+        """
+        Seconds until the backend will next be tried.
+        """
+        if self.up:
+            return 0
+        if now is None:
+            now = time.time()
+        return max(0, self.down_since + self.recovery_time - now)
+
+
+class HealthChecker(object):
+
+    """
+    Probes ``health_path`` on each backend every `interval` seconds
+    from a daemon thread.  A response with a status below 500 counts
+    as success; anything else (including no response within
+    `timeout` seconds) counts as a failure.
+    """
+
+    def __init__(self, backends, health_path='/', interval=10, timeout=5,
+                 logger=None):
+        self.backends = backends
+        if not health_path.startswith('/'):
+            health_path = '/' + health_path
+        self.health_path = health_path
+        self.interval = interval
+        self.timeout = timeout
+        if logger is None:
+            logger = logging.getLogger('wsgiproxy.health')
+        self.logger = logger
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is not None:
+            return
+        t = threading.Thread(target=_run_checker, args=(weakref.ref(self),))
+        t.setDaemon(True)
+        self.thread = t
+        t.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def check_all(self):
+        for backend in self.backends:
+            self.check(backend)
+
+    def check(self, backend):
+        """
+        Probes one backend and records the result.
+        """
+        was_up = backend.health.up
+        if self.probe(backend):
+            backend.health.record_success()
+            if not was_up:
+                self.logger.info('Backend %s is up' % backend.href)
+        else:
+            backend.health.record_failure()
+            if was_up and not backend.health.up:
+                self.logger.warning('Backend %s is down' % backend.href)
+
+    def probe(self, backend):
+        if backend.unix_socket:
+            conn = UnixHTTPConnection(backend.unix_socket,
+                                      timeout=self.timeout)
+        elif backend.scheme == 'https':
+            conn = httplib.HTTPSConnection(backend.netloc,
+                                           timeout=self.timeout)
+        else:
+            conn = httplib.HTTPConnection(backend.netloc,
+                                          timeout=self.timeout)
+        try:
+            try:
+                conn.request('GET', self.health_path, headers={
+                    'Host': backend.netloc})
+                res = conn.getresponse()
+                res.read()
+            except (socket.error, httplib.HTTPException), e:
+                self.logger.debug('Health check of %s failed: %s'
+                                  % (backend.href, e))
+                return False
+        finally:
+            conn.close()
+        return res.status < 500
+
+def _run_checker(checker_ref):
+    # Only holds a weak reference between checks, so the checker
+    # (and the app using it) can be garbage collected
+    while 1:
+        checker = checker_ref()
+        if checker is None or checker.stopped.isSet():
+            return
+        checker.check_all()
+        stopped, interval = checker.stopped, checker.interval
+        del checker
+        stopped.wait(interval)
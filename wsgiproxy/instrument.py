@@ -0,0 +1,404 @@
+"""
+Timings and counts for each proxied request.
+
+Subscribe a function to :data:`default_instruments` (or to the
+:class:`Instruments` given to :class:`wsgiproxy.app.WSGIProxyApp` or
+:class:`wsgiproxy.spawn.SpawningApplication`) and it is called with a
+:class:`RequestEvent` as each request finishes::
+
+    from wsgiproxy.instrument import default_instruments, PrometheusExporter
+    exporter = PrometheusExporter()
+    default_instruments.subscribe(exporter.record)
+
+The event says how long the request spent in each phase (see
+:data:`phases`), how many body bytes went each way, the response
+status, which backend it went to, and whether the connection came
+from the pool.  The first of the proxy components to see the request
+starts the event (and puts it in ``environ['wsgiproxy.event']``), the
+others add their phases to it, and it is published once the response
+body is closed.
+
+When nothing is subscribed no event is made and nothing is timed; the
+cost is a check of the subscribers for each request.
+
+Two exporters are included: :class:`PrometheusExporter`, which keeps
+counters and serves them in the Prometheus text format, and
+:class:`StatsDExporter`, which sends each event to a StatsD server.
+"""
+
+import logging
+import re
+import socket
+import threading
+import time
+
+__all__ = ['Instruments', 'RequestEvent', 'default_instruments',
+           'PrometheusExporter', 'StatsDExporter']
+
+# The phases of a request, in order (each is only there if it
+# happened):
+#
+# ``acquire``: waiting for a subprocess (SpawningApplication)
+# ``prepare``: choosing a backend, encoding and signing the request
+# ``dns``: looking up the server's address
+# ``connect``: the TCP (or Unix socket) connection
+# ``tls``: the TLS handshake
+# ``send``: sending the request headers and body
+# ``first_byte``: waiting for the response to start
+# ``body``: reading the response body (until the server closes it)
+phases = ('acquire', 'prepare', 'dns', 'connect', 'tls', 'send',
+          'first_byte', 'body')
+
+logger = logging.getLogger('wsgiproxy.instrument')
+
+class Instruments(object):
+
+    """
+    The subscribers to request events.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Replaced (never changed) so it can be read without the lock:
+        self.subscribers = ()
+
+    def subscribe(self, subscriber):
+        """
+        Calls ``subscriber(event)`` for each finished request.
+        """
+        self.lock.acquire()
+        try:
+            self.subscribers = self.subscribers + (subscriber,)
+        finally:
+            self.lock.release()
+
+    def unsubscribe(self, subscriber):
+        self.lock.acquire()
+        try:
+            subscribers = list(self.subscribers)
+            subscribers.remove(subscriber)
+            self.subscribers = tuple(subscribers)
+        finally:
+            self.lock.release()
+
+    def publish(self, event):
+        for subscriber in self.subscribers:
+            try:
+                subscriber(event)
+            except Exception:
+                logger.exception('Error in subscriber %r' % (subscriber,))
+
+default_instruments = Instruments()
+
+
+class RequestEvent(object):
+
+    """
+    The measurements of one request.
+
+    ``source``
+        What started the event: ``'exact'``
+        (:func:`wsgiproxy.exactproxy.proxy_exact_request`), ``'app'``
+        (``WSGIProxyApp``) or ``'spawn'`` (``SpawningApplication``).
+
+    ``method``, ``status``
+        The request method, and the response status (an integer, or
+        None if there was no response).
+
+    ``backend``
+        The href of the backend, or ``host:port`` (or socket path) of
+        the server.
+
+    ``reused``
+        True if the connection came from the pool, False if it was
+        new (None if no connection was made).
+
+    ``bytes_out``, ``bytes_in``
+        The bytes of request body sent and response body received.
+
+    ``phases``
+        Maps the names in :data:`phases` to the seconds spent in them.
+
+    ``error``
+        The exception that ended the request, if any.
+    """
+
+    def __init__(self, instruments, source, method=None, now=None):
+        self.instruments = instruments
+        self.source = source
+        self.method = method
+        self.status = None
+        self.backend = None
+        self.reused = None
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.phases = {}
+        self.error = None
+        if now is None:
+            now = time.time()
+        self.start = self.last = now
+        self.end = None
+
+    def mark(self, phase, now=None):
+        """
+        Ends `phase` (which started when the last one ended).
+        """
+        if now is None:
+            now = time.time()
+        self.phases[phase] = self.phases.get(phase, 0) + now - self.last
+        self.last = now
+
+    def finish(self, now=None):
+        """
+        Ends the request and publishes the event (only the first time
+        it is called).
+        """
+        if self.end is not None:
+            return
+        if now is None:
+            now = time.time()
+        self.end = now
+        self.instruments.publish(self)
+
+    @property
+    def duration(self):
+        if self.end is None:
+            return None
+        return self.end - self.start
+
+    def __repr__(self):
+        return '<%s %s %s %s %s>' % (
+            self.__class__.__name__, self.source, self.method,
+            self.backend, self.status)
+
+def begin(environ, source, instruments=None, always=False):
+    """
+    Returns ``(event, started)``: the event already in the environ
+    (with `started` false), a new one if `instruments` (by default
+    ``environ['wsgiproxy.instruments']`` or :data:`default_instruments`)
+    has subscribers (or `always`), or None.
+    """
+    event = environ.get('wsgiproxy.event')
+    if event is not None:
+        return event, False
+    if instruments is None:
+        instruments = environ.get('wsgiproxy.instruments',
+                                  default_instruments)
+    if not instruments.subscribers and not always:
+        return None, False
+    event = environ['wsgiproxy.event'] = RequestEvent(
+        instruments, source, environ.get('REQUEST_METHOD'))
+    return event, True
+
+def finishing(event, release=None):
+    """
+    Returns a function that calls `release` (if given) and finishes
+    `event`.
+    """
+    def finish():
+        try:
+            if release is not None:
+                release()
+        finally:
+            event.finish()
+    return finish
+
+
+class PrometheusExporter(object):
+
+    """
+    Counts requests (by source, backend and status), the bytes sent
+    and received and the connections made or reused (by backend), and
+    keeps a histogram of request durations (with `buckets`, in
+    seconds) and the total time in each phase.
+
+    :meth:`record` is the subscriber, and :meth:`render` gives the
+    metrics in the Prometheus text format.  The exporter is also a
+    WSGI application that serves them.
+    """
+
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, prefix='wsgiproxy', buckets=None):
+        self.prefix = prefix
+        if buckets is not None:
+            self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        # (source, backend, status): count
+        self.requests = {}
+        # (source, backend): [count per bucket..., sum, count]
+        self.durations = {}
+        # (backend, phase): [sum, count]
+        self.phase_times = {}
+        # (backend, 'in' or 'out'): bytes
+        self.bytes = {}
+        # (backend, 'reused' or 'new'): count
+        self.connections = {}
+
+    def record(self, event):
+        backend = event.backend or ''
+        if event.status is None:
+            status = 'error'
+        else:
+            status = str(event.status)
+        duration = event.duration
+        self.lock.acquire()
+        try:
+            key = (event.source, backend, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            key = (event.source, backend)
+            counts = self.durations.get(key)
+            if counts is None:
+                counts = self.durations[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if duration <= bound:
+                    counts[i] += 1
+            counts[-2] += duration
+            counts[-1] += 1
+            for phase, seconds in event.phases.iteritems():
+                times = self.phase_times.setdefault((backend, phase), [0, 0])
+                times[0] += seconds
+                times[1] += 1
+            for direction, size in (('in', event.bytes_in),
+                                    ('out', event.bytes_out)):
+                key = (backend, direction)
+                self.bytes[key] = self.bytes.get(key, 0) + size
+            if event.reused is not None:
+                key = (backend, event.reused and 'reused' or 'new')
+                self.connections[key] = self.connections.get(key, 0) + 1
+        finally:
+            self.lock.release()
+
+    def render(self):
+        """
+        Returns the metrics in the Prometheus text exposition format.
+        """
+        prefix = self.prefix
+        lines = []
+        add = lines.append
+        self.lock.acquire()
+        try:
+            add('# TYPE %s_requests_total counter' % prefix)
+            for (source, backend, status), count in sorted(
+                    self.requests.items()):
+                add('%s_requests_total%s %s' % (prefix, labels(
+                    source=source, backend=backend, status=status), count))
+            add('# TYPE %s_request_duration_seconds histogram' % prefix)
+            name = '%s_request_duration_seconds' % prefix
+            for (source, backend), counts in sorted(self.durations.items()):
+                for bound, count in zip(self.buckets, counts):
+                    add('%s_bucket%s %s' % (name, labels(
+                        source=source, backend=backend, le=repr(float(bound))),
+                        count))
+                add('%s_bucket%s %s' % (name, labels(
+                    source=source, backend=backend, le='+Inf'), counts[-1]))
+                add('%s_sum%s %r' % (name, labels(
+                    source=source, backend=backend), counts[-2]))
+                add('%s_count%s %s' % (name, labels(
+                    source=source, backend=backend), counts[-1]))
+            add('# TYPE %s_phase_seconds summary' % prefix)
+            for (backend, phase), (total, count) in sorted(
+                    self.phase_times.items()):
+                add('%s_phase_seconds_sum%s %r' % (prefix, labels(
+                    backend=backend, phase=phase), total))
+                add('%s_phase_seconds_count%s %s' % (prefix, labels(
+                    backend=backend, phase=phase), count))
+            add('# TYPE %s_body_bytes_total counter' % prefix)
+            for (backend, direction), size in sorted(self.bytes.items()):
+                add('%s_body_bytes_total%s %s' % (prefix, labels(
+                    backend=backend, direction=direction), size))
+            add('# TYPE %s_connections_total counter' % prefix)
+            for (backend, kind), count in sorted(self.connections.items()):
+                add('%s_connections_total%s %s' % (prefix, labels(
+                    backend=backend, kind=kind), count))
+        finally:
+            self.lock.release()
+        add('')
+        return '\n'.join(lines)
+
+    def __call__(self, environ, start_response):
+        body = self.render()
+        start_response('200 OK', [
+            ('Content-Type', 'text/plain; version=0.0.4'),
+            ('Content-Length', str(len(body)))])
+        return [body]
+
+def labels(**values):
+    return '{%s}' % ','.join([
+        '%s="%s"' % (name, escape_label(str(value)))
+        for name, value in sorted(values.items())])
+
+def escape_label(value):
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+class StatsDExporter(object):
+
+    """
+    Sends each event (with :meth:`record`) to the StatsD server at
+    `host`:`port` over UDP, as metrics named after `prefix`::
+
+        <prefix>.<source>.requests              count
+        <prefix>.<source>.status.<status>       count
+        <prefix>.<source>.duration              timer (ms)
+        <prefix>.<source>.phase.<phase>         timer (ms)
+        <prefix>.<source>.bytes_in, bytes_out   count
+        <prefix>.<source>.connections.reused    count (or .new)
+
+    With `per_backend` the requests and duration are also sent as
+    ``<prefix>.backend.<backend>.requests`` and ``.duration`` (with
+    the backend name made safe for StatsD).  Sending errors are
+    ignored.
+    """
+
+    def __init__(self, host='127.0.0.1', port=8125, prefix='wsgiproxy',
+                 per_backend=False):
+        self.address = (host, int(port))
+        self.prefix = prefix
+        self.per_backend = per_backend
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+    def record(self, event):
+        self.send(self.lines(event))
+
+    def lines(self, event):
+        """
+        The StatsD lines for `event`.
+        """
+        base = '%s.%s' % (self.prefix, event.source)
+        if event.status is None:
+            status = 'error'
+        else:
+            status = event.status
+        lines = ['%s.requests:1|c' % base,
+                 '%s.status.%s:1|c' % (base, status),
+                 '%s.duration:%.3f|ms' % (base, event.duration * 1000)]
+        for phase in phases:
+            if phase in event.phases:
+                lines.append('%s.phase.%s:%.3f|ms'
+                             % (base, phase, event.phases[phase] * 1000))
+        lines.append('%s.bytes_in:%s|c' % (base, event.bytes_in))
+        lines.append('%s.bytes_out:%s|c' % (base, event.bytes_out))
+        if event.reused is not None:
+            lines.append('%s.connections.%s:1|c'
+                         % (base, event.reused and 'reused' or 'new'))
+        if self.per_backend and event.backend:
+            base = '%s.backend.%s' % (self.prefix, metric_name(event.backend))
+            lines.append('%s.requests:1|c' % base)
+            lines.append('%s.duration:%.3f|ms'
+                         % (base, event.duration * 1000))
+        return lines
+
+    def send(self, lines):
+        try:
+            self.sock.sendto('\n'.join(lines), self.address)
+        except socket.error:
+            pass
+
+    def close(self):
+        self.sock.close()
+
+_unsafe_re = re.compile(r'[^A-Za-z0-9_\-]+')
+
+def metric_name(name):
+    return _unsafe_re.sub('_', name).strip('_')
@@ -1,11 +1,15 @@
 import simplejson
 import cPickle as pickle
 import urllib
-from wsgiproxy import protocol_version
-from wsgiproxy.secretloader import get_secret
+import time
+from wsgiproxy import protocol_versions
+from wsgiproxy import envelope
+from wsgiproxy.secretloader import default_reload_interval
+from wsgiproxy.signature import Signer, BadSignature
+from wsgiproxy.tracing import parse_traceparent
 from paste import httpexceptions
 
-__all__ = ['WSGIProxyMiddleware']
+__all__ = ['WSGIProxyMiddleware', 'LazyValue', 'get_value']
 
 class WSGIProxyMiddleware(object):
 
@@ -18,7 +22,13 @@ class WSGIProxyMiddleware(object):
     ``secret_file``:
     
         A location where a secret is kept, used to sign the request
-        when its coming from ``wsgiproxy.app``
+        when its coming from ``wsgiproxy.app``.  Requests without a
+        valid signature get ``403 Forbidden`` (see
+        :mod:`wsgiproxy.signature`).  This can also be a directory
+        of versioned secrets, any of which is accepted (see
+        :class:`wsgiproxy.secretloader.Keyring`).  The file is checked for changes
+        every ``secret_reload_interval`` seconds, and signatures are
+        accepted for ``signature_window`` seconds.
 
     ``trust_ips``:
 
@@ -62,6 +72,30 @@ class WSGIProxyMiddleware(object):
         Force the port (not including domain).  If you give ``80`` it
         will set ``SERVER_PORT`` and the port portion of
         ``HTTP_HOST``.
+
+    ``lazy``:
+
+        If true, forwarded JSON and pickle values are not decoded
+        until the application asks for them: the environ holds a
+        :class:`LazyValue` until :func:`get_value` is called.  For
+        applications that only look at some of the keys they are
+        sent.
+
+    If the request has an ``X-WSGIProxy-Deadline`` header (the number
+    of seconds the proxy will wait for the response) it is turned into
+    ``environ['wsgiproxy.deadline']``, a ``time.time()`` after which
+    the response won't be used anymore.
+
+    Requests from a proxy get an ``X-WSGIProxy-Versions`` response
+    header listing the protocol versions this middleware understands;
+    :class:`wsgiproxy.app.WSGIProxyApp` uses it to decide whether to
+    send its keys in a single envelope (version 0.2, see
+    :mod:`wsgiproxy.envelope`).
+
+    A valid W3C ``traceparent`` header (with ``tracestate``) is put in
+    ``environ['wsgiproxy.trace']`` as a
+    :class:`wsgiproxy.tracing.TraceContext`, whose ``span_id`` is the
+    span of the proxy (or other client) that sent the request.
     """
 
     def __init__(self, application,
@@ -72,9 +106,26 @@ class WSGIProxyMiddleware(object):
                  scheme=None,
                  host=None,
                  domain=None,
-                 port=None):
+                 port=None,
+                 lazy=False,
+                 signature_window=300,
+                 secret_reload_interval=default_reload_interval):
         self.application = application
+        self.lazy = lazy
+        # The decoder for each X-WSGIProxy-{TYPE}-N header, whether it
+        # needs a trusted proxy, and whether it is decoded lazily:
+        self.key_decoders = {
+            'STR': (self.str_decode, False, False),
+            'UNICODE': (self.unicode_decode, False, False),
+            'JSON': (self.json_decode, False, lazy),
+            'PICKLE': (self.pickle_decode, True, lazy),
+            }
         self.secret_file = secret_file
+        if secret_file is not None:
+            self.signer = Signer(secret_file, window=signature_window,
+                                 reload_interval=secret_reload_interval)
+        else:
+            self.signer = None
         if trust_ips is not None:
             if isinstance(trust_ips, basestring):
                 trust_ips = [trust_ips]
@@ -110,29 +161,49 @@ class WSGIProxyMiddleware(object):
             self.port = None
 
     def __call__(self, environ, start_response):
-        self._fixup_environ(environ, start_response)
+        if 'HTTP_X_WSGIPROXY_VERSION' in environ:
+            start_response = self.versions_start_response(start_response)
         try:
+            self._fixup_environ(environ, start_response)
             self._fixup_configured(environ)
         except httpexceptions.HTTPException, exc:
             return exc(environ, start_response)
         return self.application(environ, start_response)
 
     def _fixup_environ(self, environ, start_response):
+        secure = False
+        if self.signer is not None:
+            # (This has to come first; the signature covers the other
+            # X-WSGIProxy headers)
+            try:
+                self.signer.check(environ)
+            except BadSignature, e:
+                raise httpexceptions.HTTPForbidden(
+                    "Request is not correctly signed: %s" % e)
+            secure = True
         # @@: Obviously better errors here:
         if 'HTTP_X_WSGIPROXY_VERSION' in environ:
             version = environ.pop('HTTP_X_WSGIPROXY_VERSION')
-            assert version == protocol_version
-        secure = False
-        if self.secret_file is not None:
-            secret = get_secret(self.secret_file)
-            # @@: Should catch error:
-            check_request(environ, secret)
-            secure = True
+            assert version in protocol_versions
         if self.trust_ips:
             ip = environ.get('REMOTE_ADDR')
             if ip in self.trust_ips:
                 # @@: Should allow ranges and whatnot:
                 secure = True
+        if 'HTTP_X_WSGIPROXY_DEADLINE' in environ:
+            try:
+                remaining = float(environ.pop('HTTP_X_WSGIPROXY_DEADLINE'))
+            except ValueError:
+                pass
+            else:
+                deadline = time.time() + remaining
+                if deadline < environ.get('wsgiproxy.deadline', deadline + 1):
+                    environ['wsgiproxy.deadline'] = deadline
+        if 'HTTP_TRACEPARENT' in environ:
+            trace = parse_traceparent(environ['HTTP_TRACEPARENT'],
+                                      environ.get('HTTP_TRACESTATE'))
+            if trace is not None:
+                environ['wsgiproxy.trace'] = trace
         if 'HTTP_X_FORWARDED_SERVER' in environ:
             environ['HTTP_HOST'] = environ.pop('HTTP_X_FORWARDED_SERVER')
         if 'HTTP_X_FORWARDED_SCHEME' in environ:
@@ -163,30 +234,83 @@ class WSGIProxyMiddleware(object):
             script_name = add_script_name + script_name
         environ['SCRIPT_NAME'] = script_name
         environ['PATH_INFO'] = path_info
-        for header, key in [
-            ('HTTP_HOST', 'HTTP_HOST'),
-            ('SCRIPT_NAME', 'SCRIPT_NAME'),
-            ('PATH_INFO', 'PATH_INFO'),
-            ('QUERY_STRING', 'QUERY_STRING'),
-            ('WSGI_URL_SCHEME', 'wsgi.url_scheme')]:
-            header = 'HTTP_X_WSGIPROXY_%s' % header
-            if header in environ:
-                environ[key] = environ.pop(header)
-        for prefix, decoder, is_secure in [
-            ('STR', self.str_decode, True),
-            ('UNICODE', self.unicode_decode, True),
-            ('JSON', self.json_decode, True),
-            ('PICKLE', self.pickle_decode, False)]:
-            expect = 'HTTP_X_WSGIPROXY_%s' % prefix
-            for key in environ:
-                if key.startswith(expect):
-                    if not is_secure and not secure:
-                        # Better error again!
-                        assert 0
-                    key_name, value = environ[key].split(None, 1)
-                    key_name = urllib.unquote(key_name)
-                    value = decoder(value)
-                    environ[key_name] = value
+        # The rest of the X-WSGIProxy headers are all handled (and
+        # removed) in one pass:
+        headers = [key for key in environ if key[:17] == 'HTTP_X_WSGIPROXY_']
+        if not headers:
+            return
+        header_keys = self.header_keys
+        key_decoders = self.key_decoders
+        for header in headers:
+            value = environ.pop(header)
+            name = header[17:]
+            if name in header_keys:
+                environ[header_keys[name]] = value
+                continue
+            if name == 'ENVELOPE':
+                self._decode_envelope(environ, value, secure)
+                continue
+            # X-WSGIProxy-{TYPE}-{N}:
+            decoding = key_decoders.get(name.rsplit('_', 1)[0])
+            if decoding is None:
+                continue
+            decoder, trusted_only, lazy = decoding
+            if trusted_only and not secure:
+                raise httpexceptions.HTTPBadRequest(
+                    "Pickled values are only accepted from a trusted proxy")
+            key_name, value = value.split(None, 1)
+            key_name = urllib.unquote(key_name)
+            if lazy:
+                environ[key_name] = LazyValue(decoder, value)
+            else:
+                environ[key_name] = decoder(value)
+
+    # X-WSGIProxy-{NAME} headers that are copied to environ keys:
+    header_keys = {
+        'HOST': 'HTTP_HOST',
+        'SCRIPT_NAME': 'SCRIPT_NAME',
+        'PATH_INFO': 'PATH_INFO',
+        'QUERY_STRING': 'QUERY_STRING',
+        'WSGI_URL_SCHEME': 'wsgi.url_scheme',
+        }
+
+    # Envelope fields that lazy mode doesn't decode right away:
+    lazy_envelope_types = ('J', 'P')
+
+    def _decode_envelope(self, environ, header, secure):
+        try:
+            if not self.lazy:
+                environ.update(envelope.unpack(header, allow_pickle=secure))
+                return
+            for type, key, value in envelope.unpack_fields(header):
+                if type == 'P' and not secure:
+                    raise envelope.EnvelopeError(
+                        "Pickled values are only accepted from a "
+                        "trusted proxy")
+                decoder = envelope.decoders[type]
+                if type in self.lazy_envelope_types:
+                    environ[key] = LazyValue(decoder, value)
+                    continue
+                try:
+                    environ[key] = decoder(value)
+                except Exception, e:
+                    # (as envelope.unpack() reports it)
+                    raise envelope.EnvelopeError(
+                        "Bad value for %r in envelope: %s" % (key, e))
+        except envelope.EnvelopeError, e:
+            raise httpexceptions.HTTPBadRequest(
+                "Bad X-WSGIProxy-Envelope header: %s" % e)
+
+    def versions_start_response(self, start_response):
+        """
+        Wraps `start_response` to add the ``X-WSGIProxy-Versions``
+        header.
+        """
+        versions = ' '.join(protocol_versions)
+        def versions_start_response(status, headers, exc_info=None):
+            headers = headers + [('X-WSGIProxy-Versions', versions)]
+            return start_response(status, headers, exc_info)
+        return versions_start_response
 
     def _fixup_configured(self, environ):
         path_info = environ['PATH_INFO']
@@ -237,4 +361,34 @@ class WSGIProxyMiddleware(object):
 
     def pickle_decode(self, value):
         return pickle.loads(self.str_decode(value))
-    
+
+
+class LazyValue(object):
+
+    """
+    A forwarded value that hasn't been decoded yet (see the ``lazy``
+    argument of :class:`WSGIProxyMiddleware`).
+    """
+
+    __slots__ = ('decoder', 'encoded')
+
+    def __init__(self, decoder, encoded):
+        self.decoder = decoder
+        self.encoded = encoded
+
+    def decode(self):
+        return self.decoder(self.encoded)
+
+    def __repr__(self):
+        return '<%s %r>' % (self.__class__.__name__, self.encoded[:40])
+
+def get_value(environ, key, default=None):
+    """
+    Returns ``environ[key]`` (or `default`), decoding it first if it is
+    a :class:`LazyValue`.  The decoded value is put back in the
+    environ, so it is only decoded once.
+    """
+    value = environ.get(key, default)
+    if isinstance(value, LazyValue):
+        value = environ[key] = value.decode()
+    return value
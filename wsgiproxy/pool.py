@@ -0,0 +1,245 @@
+"""
+Keep-alive connection pooling for upstream HTTP connections.
+
+:func:`wsgiproxy.exactproxy.proxy_exact_request` normally opens a new
+connection for every request.  If a :class:`ConnectionPool` is put in
+``environ['wsgiproxy.connection_pool']`` it will instead reuse idle
+connections to the same ``(scheme, host, port)``, saving the TCP (and
+for https the TLS) handshake on each request.
+
+Requests can also be sent over a Unix domain socket, by putting its
+path in ``environ['wsgiproxy.unix_socket']`` (see
+:func:`connection_key`).
+"""
+
+import httplib
+import select
+import socket
+import ssl
+import threading
+import time
+
+__all__ = ['ConnectionPool', 'default_pool', 'make_connection',
+           'connection_key', 'UnixHTTPConnection', 'timed_connect']
+
+# Methods that can safely be sent a second time when a pooled
+# connection turns out to have been closed by the server:
+idempotent_methods = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS', 'TRACE')
+
+def connection_key(environ):
+    """
+    Returns the ``(scheme, host, port)`` key of the server a request
+    goes to: ``SERVER_NAME:SERVER_PORT``, or ``('http+unix', path,
+    None)`` if ``environ['wsgiproxy.unix_socket']`` is set.
+    """
+    unix_socket = environ.get('wsgiproxy.unix_socket')
+    if unix_socket:
+        return ('http+unix', unix_socket, None)
+    return (environ['wsgi.url_scheme'], environ['SERVER_NAME'],
+            environ['SERVER_PORT'])
+
+def make_connection(scheme, host, port):
+    """
+    Creates a new (unconnected) ``httplib`` connection object for the
+    given scheme.  For ``http+unix`` the host is the socket's path.
+    """
+    if scheme == 'http':
+        ConnClass = httplib.HTTPConnection
+    elif scheme == 'https':
+        ConnClass = httplib.HTTPSConnection
+    elif scheme == 'http+unix':
+        return UnixHTTPConnection(host)
+    else:
+        raise ValueError(
+            "Unknown scheme: %r" % scheme)
+    return ConnClass('%s:%s' % (host, port))
+
+def timed_connect(conn, event):
+    """
+    Connects `conn` (an unconnected connection from
+    :func:`make_connection`) like ``conn.connect()``, marking the
+    ``dns``, ``connect`` and (for https) ``tls`` phases of `event` (a
+    :class:`wsgiproxy.instrument.RequestEvent`).
+    """
+    if isinstance(conn, UnixHTTPConnection):
+        conn.connect()
+        event.mark('connect')
+        return
+    addresses = socket.getaddrinfo(conn.host, conn.port, 0, socket.SOCK_STREAM)
+    event.mark('dns')
+    if not addresses:
+        raise socket.error("getaddrinfo returned no addresses")
+    for family, socktype, proto, canonname, address in addresses:
+        sock = socket.socket(family, socktype, proto)
+        if conn.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            sock.settimeout(conn.timeout)
+        try:
+            if conn.source_address:
+                sock.bind(conn.source_address)
+            sock.connect(address)
+        except socket.error, error:
+            sock.close()
+            continue
+        break
+    else:
+        raise error
+    event.mark('connect')
+    if isinstance(conn, httplib.HTTPSConnection):
+        context = getattr(conn, '_context', None)
+        try:
+            if context is not None:
+                sock = context.wrap_socket(sock, server_hostname=conn.host)
+            else:
+                sock = ssl.wrap_socket(sock, conn.key_file, conn.cert_file)
+        except:
+            sock.close()
+            raise
+        event.mark('tls')
+    conn.sock = sock
+
+
+class UnixHTTPConnection(httplib.HTTPConnection):
+
+    """
+    An HTTP connection over the Unix domain socket at `socket_path`.
+    """
+
+    def __init__(self, socket_path, timeout=socket._GLOBAL_DEFAULT_TIMEOUT):
+        httplib.HTTPConnection.__init__(self, 'localhost', timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+            sock.settimeout(self.timeout)
+        try:
+            sock.connect(self.socket_path)
+        except socket.error:
+            sock.close()
+            raise
+        self.sock = sock
+
+
+class ConnectionPool(object):
+
+    """
+    A thread-safe pool of idle keep-alive connections.
+
+    Connections are keyed by ``(scheme, host, port)``.  At most
+    ``max_idle`` idle connections are kept per key, and idle
+    connections older than ``idle_timeout`` seconds are closed instead
+    of being reused.  Connections are only returned to the pool (with
+    :meth:`put`) once their response has been completely read; a
+    connection whose socket has become readable while idle (i.e., the
+    server closed it or sent unexpected data) is thrown away.
+    """
+
+    def __init__(self, max_idle=10, idle_timeout=60):
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        # Maps keys to a list of (conn, time_released), oldest first:
+        self.idle = {}
+
+    def get(self, key):
+        """
+        Returns ``(conn, reused)`` for the given ``(scheme, host,
+        port)`` key.  ``reused`` is true if the connection came from
+        the pool (and so may have been closed by the server in the
+        meantime).
+        """
+        while 1:
+            now = time.time()
+            self.lock.acquire()
+            try:
+                conns = self.idle.get(key)
+                expired = self.expire(conns, now)
+                if conns:
+                    conn, released = conns.pop()
+                else:
+                    conn = None
+            finally:
+                self.lock.release()
+            for old_conn in expired:
+                old_conn.close()
+            if conn is None:
+                break
+            if not self.is_usable(conn):
+                conn.close()
+                continue
+            return conn, True
+        return self.connect(key), False
+
+    def expire(self, conns, now):
+        """
+        Removes the connections idle longer than ``idle_timeout`` from
+        `conns` (with the lock held), returning them to be closed.
+        Connections are reused newest first, so those further down
+        would otherwise never be looked at.
+        """
+        expired = []
+        while conns and now - conns[0][1] > self.idle_timeout:
+            expired.append(conns.pop(0)[0])
+        return expired
+
+    def connect(self, key):
+        """
+        Creates a new connection for the key (it is not put in the
+        pool until it is released with :meth:`put`).
+        """
+        return make_connection(*key)
+
+    def put(self, key, conn):
+        """
+        Returns a connection to the pool.  The response on the
+        connection must have been completely read.
+        """
+        if getattr(conn, 'sock', None) is None:
+            # Never connected, or closed already
+            return
+        # Don't leave a timeout from this request on the connection
+        conn.sock.settimeout(None)
+        now = time.time()
+        self.lock.acquire()
+        try:
+            conns = self.idle.setdefault(key, [])
+            expired = self.expire(conns, now)
+            if len(conns) >= self.max_idle:
+                expired.append(conns.pop(0)[0])
+            conns.append((conn, now))
+        finally:
+            self.lock.release()
+        for old_conn in expired:
+            old_conn.close()
+
+    def is_usable(self, conn):
+        """
+        Checks that an idle connection has not been closed (or
+        written to) by the server.
+        """
+        sock = getattr(conn, 'sock', None)
+        if sock is None:
+            return False
+        try:
+            readable, writable, errored = select.select([sock], [], [sock], 0)
+        except (select.error, socket.error, ValueError):
+            return False
+        # An idle connection should have nothing to read; if it is
+        # readable the server has closed it (or sent garbage):
+        return not readable and not errored
+
+    def close(self):
+        """
+        Closes all idle connections.
+        """
+        self.lock.acquire()
+        try:
+            idle = self.idle
+            self.idle = {}
+        finally:
+            self.lock.release()
+        for conns in idle.values():
+            for conn, released in conns:
+                conn.close()
+
+default_pool = ConnectionPool()
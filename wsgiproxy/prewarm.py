@@ -0,0 +1,127 @@
+"""
+Deciding how many spawned subprocesses to keep warm.
+
+:class:`wsgiproxy.spawn.SpawningApplication` asks a
+:class:`WarmPolicy` how many subprocesses should be running even
+without requests (so ``idle_shutdown`` doesn't leave the next request
+waiting for a cold start).  The count is the largest of:
+
+* ``min_warm``, always;
+
+* the count of any ``schedule`` window the current (local) time falls
+  in.  Windows are ``(start, end, count)``, with start and end as
+  ``'HH:MM'`` strings or hours; a window can wrap past midnight;
+
+* one, while the average request rate over the last ``rate_window``
+  seconds is at least ``rate`` requests per second.
+"""
+
+import threading
+import time
+
+__all__ = ['WarmPolicy', 'RequestRate']
+
+def parse_time_of_day(value):
+    """
+    Turns ``'HH:MM'`` (or a number of hours) into minutes after
+    midnight.
+    """
+    if isinstance(value, basestring):
+        if ':' in value:
+            hours, minutes = value.split(':', 1)
+            return int(hours) * 60 + int(minutes)
+        value = float(value)
+    return int(value * 60)
+
+
+class RequestRate(object):
+
+    """
+    Counts requests in one-second buckets over the last `window`
+    seconds.
+    """
+
+    def __init__(self, window=600):
+        self.window = window
+        self.lock = threading.Lock()
+        # Maps int(time) to the number of requests in that second:
+        self.buckets = {}
+        self.total = 0
+
+    def record(self, now=None):
+        if now is None:
+            now = time.time()
+        second = int(now)
+        self.lock.acquire()
+        try:
+            self.buckets[second] = self.buckets.get(second, 0) + 1
+            self.total += 1
+            if len(self.buckets) > self.window:
+                self._expire(second)
+        finally:
+            self.lock.release()
+
+    def _expire(self, second):
+        for old in [s for s in self.buckets if s <= second - self.window]:
+            self.total -= self.buckets.pop(old)
+
+    def rate(self, now=None):
+        """
+        Requests per second over the window.
+        """
+        if now is None:
+            now = time.time()
+        self.lock.acquire()
+        try:
+            self._expire(int(now))
+            return float(self.total) / self.window
+        finally:
+            self.lock.release()
+
+
+class WarmPolicy(object):
+
+    def __init__(self, min_warm=0, schedule=None, rate=None,
+                 rate_window=600):
+        self.min_warm = min_warm
+        self.schedule = []
+        for start, end, count in schedule or ():
+            self.schedule.append((parse_time_of_day(start),
+                                  parse_time_of_day(end), count))
+        self.rate = rate
+        if rate:
+            self.request_rate = RequestRate(rate_window)
+        else:
+            self.request_rate = None
+
+    def active(self):
+        """
+        True if the policy ever asks for warm subprocesses.
+        """
+        return bool(self.min_warm or self.schedule or self.rate)
+
+    def record_request(self, now=None):
+        if self.request_rate is not None:
+            self.request_rate.record(now)
+
+    def warm_count(self, now=None):
+        """
+        How many subprocesses to keep running at `now`.
+        """
+        if now is None:
+            now = time.time()
+        count = self.min_warm
+        if self.schedule:
+            local = time.localtime(now)
+            minute = local.tm_hour * 60 + local.tm_min
+            for start, end, window_count in self.schedule:
+                if start <= end:
+                    inside = start <= minute < end
+                else:
+                    inside = minute >= start or minute < end
+                if inside:
+                    count = max(count, window_count)
+        if (self.request_rate is not None
+            and self.request_rate.rate(now) >= self.rate):
+            count = max(count, 1)
+        return count
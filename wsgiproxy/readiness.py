@@ -0,0 +1,233 @@
+"""
+Telling when a spawned subprocess is ready for requests.
+
+:class:`wsgiproxy.spawn.SpawningApplication` waits for each new
+subprocess with one of these checks (chosen with its ``ready``
+argument):
+
+``connect``:
+    Connects to the subprocess's port (or Unix domain socket) until a
+    connection is accepted.
+
+``http``:
+    Requests ``ready_path`` until the response has a status below 500.
+
+``socket``:
+    For a subprocess that inherits a listening socket, which accepts
+    connections already (they are queued until the subprocess gets to
+    them); only checks that the subprocess hasn't exited right away.
+
+``stdout``:
+    Waits for the subprocess to print a line containing
+    ``ready_line``.  The rest of its output is logged.
+
+The probing checks retry with exponential backoff, starting at a
+millisecond, so a subprocess that starts quickly is used quickly.  All
+of them give up with a :exc:`StartupError` when the subprocess exits
+or doesn't become ready before the deadline.
+"""
+
+import httplib
+import socket
+import subprocess
+import threading
+import time
+from wsgiproxy.pool import UnixHTTPConnection
+
+__all__ = ['StartupError', 'StartupTimeout', 'SocketCheck', 'ConnectCheck',
+           'HTTPCheck', 'StdoutCheck', 'make_check']
+
+class StartupError(OSError):
+    """
+    Raised when a subprocess dies or takes too long to start.
+    """
+
+
+class StartupTimeout(StartupError):
+    """
+    Raised when a subprocess isn't ready within its start timeout.
+    """
+
+
+class ReadinessCheck(object):
+
+    """
+    Base class for checks.  :meth:`popen_args` can add arguments for
+    ``subprocess.Popen``, and :meth:`wait` returns once the child is
+    ready.
+    """
+
+    def popen_args(self):
+        return {}
+
+    def started(self, child, logger):
+        """
+        Called right after the subprocess is started.
+        """
+
+    def wait(self, child, deadline):
+        raise NotImplementedError
+
+    def check_alive(self, child):
+        if not child.alive():
+            raise StartupError(
+                "Subprocess %s exited with %s before it was ready"
+                % (child.pid, child.returncode))
+
+    def check_deadline(self, child, deadline):
+        if time.time() >= deadline:
+            raise StartupTimeout(
+                "Subprocess %s wasn't ready in time" % child.pid)
+
+
+class SocketCheck(ReadinessCheck):
+
+    def wait(self, child, deadline):
+        self.check_alive(child)
+
+
+class ProbeCheck(ReadinessCheck):
+
+    """
+    Calls :meth:`probe` until it returns true, sleeping
+    `initial_delay` seconds between tries at first and doubling that
+    up to `max_delay`.
+    """
+
+    def __init__(self, initial_delay=0.001, max_delay=0.1):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+
+    def wait(self, child, deadline):
+        delay = self.initial_delay
+        while 1:
+            self.check_alive(child)
+            self.check_deadline(child, deadline)
+            if self.probe(child, max(0.001, deadline - time.time())):
+                return
+            time.sleep(min(delay, max(0, deadline - time.time())))
+            delay = min(delay * 2, self.max_delay)
+
+    def probe(self, child, timeout):
+        raise NotImplementedError
+
+
+class ConnectCheck(ProbeCheck):
+
+    def probe(self, child, timeout):
+        if child.socket_path:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            address = child.socket_path
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            address = ('127.0.0.1', child.port)
+        try:
+            sock.settimeout(timeout)
+            try:
+                sock.connect(address)
+            except socket.error:
+                return False
+            return True
+        finally:
+            sock.close()
+
+
+class HTTPCheck(ProbeCheck):
+
+    def __init__(self, path='/', initial_delay=0.001, max_delay=0.1):
+        ProbeCheck.__init__(self, initial_delay, max_delay)
+        if not path.startswith('/'):
+            path = '/' + path
+        self.path = path
+
+    def probe(self, child, timeout):
+        if child.socket_path:
+            conn = UnixHTTPConnection(child.socket_path, timeout=timeout)
+        else:
+            conn = httplib.HTTPConnection('127.0.0.1', child.port,
+                                          timeout=timeout)
+        try:
+            try:
+                conn.request('GET', self.path)
+                res = conn.getresponse()
+                res.read()
+            except (socket.error, httplib.HTTPException):
+                return False
+        finally:
+            conn.close()
+        return res.status < 500
+
+
+class StdoutCheck(ReadinessCheck):
+
+    """
+    Reads the subprocess's stdout (from a thread, for as long as it
+    runs) until a line contains `ready_line`.
+    """
+
+    def __init__(self, ready_line='READY'):
+        self.ready_line = ready_line
+
+    def popen_args(self):
+        return {'stdout': subprocess.PIPE}
+
+    def started(self, child, logger):
+        child.ready_event = threading.Event()
+        child.ready_seen = False
+        t = threading.Thread(target=self.read_output,
+                             args=(child, child.proc.stdout, logger))
+        t.setDaemon(True)
+        t.start()
+
+    def read_output(self, child, stdout, logger):
+        try:
+            for line in iter(stdout.readline, ''):
+                if not child.ready_seen and self.ready_line in line:
+                    child.ready_seen = True
+                    child.ready_event.set()
+                logger.debug('Subprocess %s: %s'
+                             % (child.pid, line.rstrip()))
+        finally:
+            stdout.close()
+            # Wake up wait() if the output ended without the line
+            child.ready_event.set()
+
+    def wait(self, child, deadline):
+        child.ready_event.wait(max(0, deadline - time.time()))
+        if not child.ready_seen:
+            if child.ready_event.isSet():
+                # The output ended; the process is probably exiting
+                while child.alive() and time.time() < deadline:
+                    time.sleep(0.01)
+                self.check_alive(child)
+                raise StartupError(
+                    "Subprocess %s closed stdout without printing %r"
+                    % (child.pid, self.ready_line))
+            raise StartupTimeout(
+                "Subprocess %s wasn't ready in time" % child.pid)
+        self.check_alive(child)
+
+
+checks = {
+    'connect': ConnectCheck,
+    'socket': SocketCheck,
+    'http': HTTPCheck,
+    'stdout': StdoutCheck,
+    }
+
+def make_check(ready='connect', ready_path='/', ready_line='READY'):
+    """
+    Returns the check named by `ready` (or `ready` itself, if it is a
+    check already).
+    """
+    if not isinstance(ready, basestring):
+        return ready
+    if ready == 'http':
+        return HTTPCheck(ready_path)
+    if ready == 'stdout':
+        return StdoutCheck(ready_line)
+    if ready not in checks:
+        raise ValueError(
+            "Unknown ready check %r (use one of: %s)"
+            % (ready, ', '.join(sorted(checks))))
+    return checks[ready]()
@@ -1,13 +1,195 @@
+"""
+Loading the secrets used to sign requests.
+
+A :class:`SecretFile` keeps the secret in memory and only looks at the
+file again every `reload_interval` seconds (or when :meth:`reload
+<SecretFile.reload>` is called), so signing doesn't cost a ``stat``
+for each request.  A secret that is changed on disk is picked up
+within that interval.
+
+A :class:`Keyring` holds several versions of the secret, so it can be
+changed without every server having to switch at the same moment.
+Its path is either a file (the old format: the whole file is the
+secret, with key id ``0``) or a directory with one file per secret,
+named by its key id, like::
+
+    secrets/1
+    secrets/2
+
+Requests are signed with the highest version (compared as numbers
+when the names are numbers), or with the key named in a ``current``
+file in the directory, and signatures made with any of the keys are
+accepted.  To rotate the secret across many servers:
+
+1. add the new key to every server (with a ``current`` file naming
+   the old key, if the proxies use the same directory), so they all
+   accept it;
+
+2. make it the current key on the proxies, which start signing with
+   it;
+
+3. once the old signatures have expired, remove the old key.
+"""
+
+import logging
 import os
+import threading
+import time
 
-cached = {}
+__all__ = ['SecretFile', 'Keyring', 'get_secret']
+
+# How often (in seconds) a secret file is checked for changes:
+default_reload_interval = 5
+
+# The file in a keyring directory that names the key to sign with:
+current_name = 'current'
+
+logger = logging.getLogger('wsgiproxy.secretloader')
+
+class ReloadingFile(object):
+
+    """
+    Something loaded from `path`, and loaded again when
+    :meth:`stamp` (by default, the modification time) changes.  With
+    a `reload_interval` of None it is only loaded again when
+    :meth:`reload` is called.  If loading it again fails (say, while
+    the files are being changed) the old value is kept.
+    """
+
+    def __init__(self, path, reload_interval=default_reload_interval):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.lock = threading.Lock()
+        self.last_stamp = None
+        self.value = None
+        self.next_check = 0
+        self.reload()
+
+    def get(self, now=None):
+        if self.reload_interval is not None:
+            if now is None:
+                now = time.time()
+            if now >= self.next_check:
+                self.check(now)
+        return self.value
+
+    def check(self, now):
+        try:
+            self.lock.acquire()
+            try:
+                if now < self.next_check:
+                    # Another thread just did it
+                    return
+                self.next_check = now + self.reload_interval
+                if self.stamp() == self.last_stamp:
+                    return
+            finally:
+                self.lock.release()
+            self.reload()
+        except (OSError, IOError, ValueError), e:
+            logger.warning('Could not reload %s (keeping the old value): %s'
+                           % (self.path, e))
 
-def get_secret(secret_file):
-    mtime = os.stat(secret_file).st_mtime
-    if (cached.get(secret_file) is None
-        or cached[secret_file][0] > mtime):
-        f = open(secret_file, 'rb')
-        c = f.read()
+    def reload(self):
+        """
+        Loads it again.
+        """
+        stamp = self.stamp()
+        value = self.load()
+        self.lock.acquire()
+        try:
+            self.last_stamp = stamp
+            self.value = value
+            if self.reload_interval is not None:
+                self.next_check = time.time() + self.reload_interval
+        finally:
+            self.lock.release()
+
+    def stamp(self):
+        return os.stat(self.path).st_mtime
+
+    def load(self):
+        raise NotImplementedError
+
+
+class SecretFile(ReloadingFile):
+
+    """
+    The contents of the file `path`.
+    """
+
+    def load(self):
+        return read_file(self.path)
+
+
+class Keyring(ReloadingFile):
+
+    """
+    The versioned secrets at `path` (a file or directory, see above).
+    :meth:`get` returns ``(current_key_id, {key_id: secret})``.
+    """
+
+    def stamp(self):
+        if not os.path.isdir(self.path):
+            return os.stat(self.path).st_mtime
+        stamps = [os.stat(self.path).st_mtime]
+        for name in sorted(os.listdir(self.path)):
+            filename = os.path.join(self.path, name)
+            stamps.append((name, os.stat(filename).st_mtime))
+        return tuple(stamps)
+
+    def load(self):
+        if not os.path.isdir(self.path):
+            return ('0', {'0': read_file(self.path)})
+        keys = {}
+        current = None
+        for name in os.listdir(self.path):
+            filename = os.path.join(self.path, name)
+            if name.startswith('.') or not os.path.isfile(filename):
+                continue
+            if name == current_name:
+                current = read_file(filename).strip()
+            else:
+                keys[name] = read_file(filename)
+        if not keys:
+            raise ValueError(
+                "There are no secrets in %s" % self.path)
+        if current is None:
+            current = max(keys, key=version_key)
+        elif current not in keys:
+            raise ValueError(
+                "The current key %r is not in %s" % (current, self.path))
+        return (current, keys)
+
+def version_key(name):
+    # Numbers sort as numbers (and before names)
+    if name.isdigit():
+        return (0, int(name), name)
+    return (1, 0, name)
+
+def read_file(filename):
+    f = open(filename, 'rb')
+    try:
+        return f.read()
+    finally:
         f.close()
-        cached[secret_file] = (mtime, c)
-    return cached[secret_file][1]
+
+cached = {}
+cached_lock = threading.Lock()
+
+def get_secret(secret_file, reload_interval=default_reload_interval):
+    """
+    Returns the secret in `secret_file`, from a :class:`SecretFile`
+    shared by everything using that file.
+    """
+    loader = cached.get(secret_file)
+    if loader is None:
+        cached_lock.acquire()
+        try:
+            loader = cached.get(secret_file)
+            if loader is None:
+                loader = cached[secret_file] = SecretFile(
+                    secret_file, reload_interval)
+        finally:
+            cached_lock.release()
+    return loader.get()
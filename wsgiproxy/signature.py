@@ -1,62 +1,243 @@
+"""
+Signing the requests :class:`wsgiproxy.app.WSGIProxyApp` sends, so
+:class:`wsgiproxy.middleware.WSGIProxyMiddleware` can trust them.
+
+When both are given a ``secret_file`` the proxy adds a header::
+
+    X-WSGIProxy-Signature: <key id> <time> <nonce> <hmac>
+
+where the hmac is HMAC-SHA256 (in hex), keyed with the current secret
+of the keyring (see :class:`wsgiproxy.secretloader.Keyring`), of the
+key id, the time, the random nonce, the method, the path and query
+string, and the other ``X-WSGIProxy-*`` headers.  The middleware
+accepts a request only if:
+
+* the hmac is right for the secret with that key id (any of the
+  secrets it has, so secrets can be rotated), compared in constant
+  time;
+
+* the time is within `window` seconds of its own clock;
+
+* it hasn't seen the nonce in the last `window` seconds, so a request
+  that was captured can't be sent again.  (Nonces are remembered by
+  each process, so with several backend processes a captured request
+  could still be replayed once to each.)
+
+The HMAC keyed with each secret is computed once and copied for each
+request, and the secrets are only read again when their files change.
+"""
+
+import binascii
+import hashlib
+import heapq
 import hmac
-import urllib
+import os
+import threading
 import time
-import itertools
-import hmac
+from wsgiproxy.exactproxy import request_path
+from wsgiproxy.secretloader import Keyring, default_reload_interval
 
-counter = itertools.count()
+__all__ = ['Signer', 'ReplayCache', 'BadSignature', 'sign_request',
+           'check_request']
 
-def sign_request(environ, secret):
-    """
-    Add a X-WSGIProxy-Signature header to a request environment, based
-    on the environment and an arbitrary number.
-    """
-    path = environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
-    path = urllib.quote(urllib)
-    date = environ.get('HTTP_DATE')
-    if not date:
-        date = time.gmtime()
-        date = time.strftime('%a, %d %b %Y %H:%M:%S GMT', date)
-        environ['HTTP_DATE'] = date
-    host = environ.get('HTTP_HOST')
-    if not host:
-        host = environ.get('SERVER_NAME', '')+':'+environ.get('SERVER_PORT')
-        environ['HTTP_HOST'] = host
-    count = str(counter.next())
-    msg = path + ' ' + date + ' ' + secret
-    msg = hmac.new(count, msg)
-    sig = '%s %s' % (count, msg.hexdigest())
-    environ['HTTP_X_WSGIPROXY_SIGNATURE'] = sig
+signature_key = 'HTTP_X_WSGIPROXY_SIGNATURE'
 
 class BadSignature(ValueError):
     """
     Exception raised by check_request
     """
 
+# The name check_request used to raise:
+BadSignatureError = BadSignature
+
+compare_digest = getattr(hmac, 'compare_digest', None)
+if compare_digest is None:
+    def compare_digest(a, b):
+        # Takes the same time wherever the strings differ
+        if len(a) != len(b):
+            return False
+        result = 0
+        for x, y in zip(a, b):
+            result |= ord(x) ^ ord(y)
+        return result == 0
+
+
+class ReplayCache(object):
+
+    """
+    The nonces seen in the last `window` seconds.  At most `max_size`
+    are kept (those due to be forgotten soonest go first), which
+    should be more than the number of requests in `window` seconds.
+    """
+
+    def __init__(self, window=300, max_size=100000):
+        self.window = window
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # Maps nonces to when they can be forgotten:
+        self.seen = {}
+        # A heap of (expires, nonce):
+        self.expiries = []
+
+    def add(self, nonce, now=None, signed=None):
+        """
+        Adds `nonce`, returning false if it has been seen already.
+
+        The nonce is remembered for `window` seconds after the time it
+        was `signed` at, if that is later than `now`, since a
+        signature from the future is accepted for that long.
+        """
+        if now is None:
+            now = time.time()
+        self.lock.acquire()
+        try:
+            self.expire(now)
+            if nonce in self.seen:
+                return False
+            if len(self.seen) >= self.max_size:
+                expires, soonest = heapq.heappop(self.expiries)
+                del self.seen[soonest]
+            if signed is None or signed < now:
+                signed = now
+            expires = signed + self.window
+            self.seen[nonce] = expires
+            heapq.heappush(self.expiries, (expires, nonce))
+            return True
+        finally:
+            self.lock.release()
+
+    def expire(self, now):
+        expiries = self.expiries
+        # (a signature exactly `window` seconds old is still accepted)
+        while expiries and expiries[0][0] < now:
+            expires, nonce = heapq.heappop(expiries)
+            del self.seen[nonce]
+
+    def __len__(self):
+        return len(self.seen)
+
+
+class Signer(object):
+
+    """
+    Signs and checks requests with the keyring at `secret_file` (read
+    again when it changes, checking every `reload_interval` seconds)
+    or the string `secret` (with key id ``0``).  Signatures older (or
+    newer) than `window` seconds are refused, as are nonces seen
+    before; at most `max_nonces` are remembered.
+    """
+
+    def __init__(self, secret_file=None, secret=None, window=300,
+                 max_nonces=100000, reload_interval=default_reload_interval):
+        if (secret_file is None) == (secret is None):
+            raise TypeError(
+                "You must give one of secret_file or secret")
+        if secret_file is not None:
+            self.keyring = Keyring(secret_file, reload_interval)
+            self.keys = None
+        else:
+            self.keyring = None
+            self.keys = ('0', {'0': secret})
+        self.window = window
+        self.replay_cache = ReplayCache(window, max_nonces)
+        self._keyed = (None, None, {})
+
+    def keyed_hmacs(self):
+        """
+        Returns ``(current_key_id, {key_id: keyed_hmac})``; the HMACs
+        are only keyed again when the keyring changes.
+        """
+        if self.keyring is not None:
+            keys = self.keyring.get()
+        else:
+            keys = self.keys
+        keyed = self._keyed
+        if keyed[0] is not keys:
+            current, secrets = keys
+            hmacs = {}
+            for key_id, secret in secrets.items():
+                hmacs[key_id] = hmac.new(secret, digestmod=hashlib.sha256)
+            keyed = self._keyed = (keys, current, hmacs)
+        return keyed[1], keyed[2]
+
+    def digest(self, environ, keyed_hmac, key_id, timestamp, nonce):
+        mac = keyed_hmac.copy()
+        mac.update('%s\n%s\n%s\n%s\n%s\n' % (
+            key_id, timestamp, nonce, environ.get('REQUEST_METHOD', 'GET'),
+            request_path(environ)))
+        keys = [key for key in environ
+                if key[:17] == 'HTTP_X_WSGIPROXY_' and key != signature_key]
+        keys.sort()
+        for key in keys:
+            mac.update('%s:%s\n' % (key, environ[key]))
+        return mac.hexdigest()
+
+    def sign(self, environ, now=None):
+        """
+        Adds an ``X-WSGIProxy-Signature`` header to the request.  This
+        must be done once the request is otherwise ready to send.
+        """
+        if now is None:
+            now = time.time()
+        timestamp = str(int(now))
+        nonce = binascii.hexlify(os.urandom(12))
+        current, hmacs = self.keyed_hmacs()
+        environ[signature_key] = '%s %s %s %s' % (
+            current, timestamp, nonce,
+            self.digest(environ, hmacs[current], current, timestamp, nonce))
+
+    def check(self, environ, now=None):
+        """
+        Checks (and removes) the request's signature, raising
+        :exc:`BadSignature` if it isn't valid.
+        """
+        if signature_key not in environ:
+            raise BadSignature(
+                "No X-WSGIProxy-Signature header in request")
+        try:
+            key_id, timestamp, nonce, sig = environ.pop(signature_key).split()
+            signed = int(timestamp)
+        except ValueError:
+            raise BadSignature(
+                "Malformed X-WSGIProxy-Signature header")
+        if now is None:
+            now = time.time()
+        if abs(now - signed) > self.window:
+            raise BadSignature(
+                "Signature is too old (or from the future)")
+        current, hmacs = self.keyed_hmacs()
+        if key_id not in hmacs:
+            raise BadSignature(
+                "Signed with an unknown key (%r)" % key_id)
+        expected = self.digest(environ, hmacs[key_id], key_id, timestamp,
+                               nonce)
+        if not compare_digest(sig, expected):
+            raise BadSignature(
+                "Bad signature (hash is not correct)")
+        # Only remembered once it is known to be genuine:
+        if not self.replay_cache.add(nonce, now, signed):
+            raise BadSignature(
+                "Signature has been used already")
+
+signers = {}
+
+def get_signer(secret):
+    signer = signers.get(secret)
+    if signer is None:
+        signer = signers[secret] = Signer(secret=secret)
+    return signer
+
+def sign_request(environ, secret):
+    """
+    Add a X-WSGIProxy-Signature header to a request environment,
+    signed with `secret`.
+    """
+    get_signer(secret).sign(environ)
+
 def check_request(environ, secret):
     """
     Checks the environments' signature.  If the signature is not
-    correct, raises BadSignatureError.  Removes the signature from the
+    correct, raises BadSignature.  Removes the signature from the
     request.
     """
-    if 'HTTP_DATE' not in environ:
-        raise BadSignature(
-            "No Date header in request")
-    if 'HTTP_X_WSGIPROXY_SIGNATURE' not in environ:
-        raise BadSignature(
-            "No X-WSGIProxy-Signature header in request")
-    # @@: Need to check this isn't terribly old:
-    date = environ['HTTP_DATE']
-    path = environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', '')
-    path = urllib.quote(path)
-    host = environ['HTTP_HOST']
-    sig = environ.pop('HTTP_X_WSGIPROXY_SIGNATURE')
-    msg = path + ' ' + date + ' ' + secret
-    count, sig = sig.split(None, 1)
-    msg = hmac.new(count, msg)
-    expect_sig = msg.hexdigest()
-    if sig != expect_sig:
-        raise BadSignatureError(
-            "Bad signature (hash is not correct)")
-
-    
+    get_signer(secret).check(environ)
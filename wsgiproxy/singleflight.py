@@ -0,0 +1,353 @@
+"""
+Coalescing identical concurrent requests.
+
+When a popular resource expires, many requests for it can arrive at
+once and would each be sent to the backend.  :class:`SingleFlight`
+sends only the first of them (the leader); requests that arrive while
+its response is in flight wait for that response and get a copy of it
+as it streams in.  Nothing is kept once the response is finished (use
+:mod:`wsgiproxy.cache` for that).
+
+Requests are identical if they have the same method, host, path and
+query string, and the same values for the ``vary`` headers.  Only
+``GET`` and ``HEAD`` requests without a body are coalesced.
+"""
+
+import sys
+import threading
+
+__all__ = ['SingleFlight']
+
+# Requests that differ in these headers are not merged:
+default_vary = ('Accept', 'Accept-Encoding', 'Accept-Language',
+                'Authorization', 'Cookie')
+
+class SingleFlight(object):
+
+    """
+    Middleware that merges identical concurrent requests to `app`.
+
+    ``vary``:
+        Request headers that must also be the same for requests to be
+        merged.
+
+    ``max_size``:
+        Responses larger than this are not shared: if the leader's
+        response has a larger Content-Length the waiting requests are
+        sent on their own, and a response without a Content-Length
+        takes no new waiters once it has passed this size.
+
+    ``timeout``:
+        How long a waiting request waits for the leader's response
+        headers before going to the backend itself.
+
+    Counters are kept in ``stats`` (``flights``, ``merged`` and
+    ``not_merged``).
+    """
+
+    def __init__(self, app, vary=default_vary, max_size=1024 * 1024,
+                 timeout=30, methods=('GET', 'HEAD')):
+        self.app = app
+        self.vary = ['HTTP_%s' % name.upper().replace('-', '_')
+                     for name in vary]
+        self.max_size = max_size
+        self.timeout = timeout
+        self.methods = methods
+        self.lock = threading.Lock()
+        self.flights = {}
+        self.stats = {'flights': 0, 'merged': 0, 'not_merged': 0}
+
+    def request_key(self, environ):
+        """
+        Returns the key identifying identical requests, or None if the
+        request can't be merged.
+        """
+        method = environ['REQUEST_METHOD']
+        if method not in self.methods:
+            return None
+        if environ.get('CONTENT_LENGTH', '0') not in ('', '0'):
+            return None
+        if environ.get('HTTP_TRANSFER_ENCODING'):
+            return None
+        host = environ.get('HTTP_HOST') or '%s:%s' % (
+            environ.get('SERVER_NAME'), environ.get('SERVER_PORT'))
+        return (method, environ.get('wsgi.url_scheme', 'http'), host,
+                environ.get('SCRIPT_NAME', '') + environ.get('PATH_INFO', ''),
+                environ.get('QUERY_STRING', ''),
+                tuple([environ.get(name) for name in self.vary]))
+
+    def __call__(self, environ, start_response):
+        key = self.request_key(environ)
+        if key is None:
+            return self.app(environ, start_response)
+        self.lock.acquire()
+        try:
+            flight = self.flights.get(key)
+            if flight is None:
+                flight = self.flights[key] = Flight(self, key)
+                self.stats['flights'] += 1
+                leader = True
+            else:
+                leader = False
+            reader = flight.join()
+        finally:
+            self.lock.release()
+        if leader:
+            return self.lead(flight, reader, environ, start_response)
+        if not flight.wait_ready(self.timeout) or not flight.shared:
+            flight.leave(reader)
+            self.count('not_merged')
+            return self.app(environ, start_response)
+        self.count('merged')
+        start_response(flight.status, list(flight.headers))
+        return FlightAppIter(flight, reader)
+
+    def count(self, name):
+        self.lock.acquire()
+        try:
+            self.stats[name] += 1
+        finally:
+            self.lock.release()
+
+    def lead(self, flight, reader, environ, start_response):
+        captured = []
+        written = []
+        def capture_start_response(status, headers, exc_info=None):
+            captured[:] = [status, headers]
+            return written.append
+        try:
+            app_iter = self.app(environ, capture_start_response)
+            first_chunks = written
+            if not captured:
+                # The app is lazy about calling start_response
+                for chunk in app_iter:
+                    first_chunks.append(chunk)
+                    if captured:
+                        break
+            if not captured:
+                raise AssertionError(
+                    "The application did not call start_response")
+        except:
+            flight.fail()
+            flight.leave(reader)
+            raise
+        status, headers = captured
+        flight.start(status, headers, first_chunks, app_iter)
+        start_response(status, headers)
+        return FlightAppIter(flight, reader)
+
+    def land(self, flight):
+        """
+        Stops new requests from joining `flight` (with ``lock`` held).
+        """
+        flight.landed = True
+        if self.flights.get(flight.key) is flight:
+            del self.flights[flight.key]
+
+
+class Flight(object):
+
+    """
+    A response in flight, shared by the leader and the requests
+    waiting on it.  Whichever of them is reading furthest ahead pulls
+    the next chunk from the backend.
+
+    If the backend response fails partway, every reader gets the
+    chunks read before it and then the same exception, rather than a
+    body that just stops short.
+
+    Chunks are kept for the slower readers, and for requests that may
+    still join, only while the flight takes new requests (until the
+    response passes ``max_size``).  Once it has landed each chunk is
+    dropped as soon as every reader has passed it, and a response read
+    by just one request, or too large to share, isn't kept at all.
+
+    All of the flight's state is guarded by the
+    :class:`SingleFlight`'s lock (``cond`` uses it).
+    """
+
+    def __init__(self, single_flight, key):
+        self.single_flight = single_flight
+        self.key = key
+        self.cond = threading.Condition(single_flight.lock)
+        # Maps each reader to the index of the next chunk it reads:
+        self.positions = {}
+        self.ready = False
+        self.shared = False
+        self.landed = False
+        self.status = self.headers = None
+        self.app_iter = self.closeable = None
+        # The chunks from index `base` on:
+        self.chunks = []
+        self.base = 0
+        self.size = 0
+        self.pulling = False
+        self.done = False
+        # sys.exc_info() if the backend response failed:
+        self.error = None
+
+    @property
+    def users(self):
+        return len(self.positions)
+
+    def join(self):
+        """
+        Adds a reader (with the lock held), returning its token.
+        """
+        reader = object()
+        self.positions[reader] = 0
+        return reader
+
+    def start(self, status, headers, first_chunks, app_iter):
+        content_length = None
+        for name, value in headers:
+            if name.lower() == 'content-length':
+                try:
+                    content_length = int(value)
+                except ValueError:
+                    pass
+        self.cond.acquire()
+        try:
+            self.status = status
+            self.headers = headers
+            self.app_iter = iter(app_iter)
+            self.closeable = app_iter
+            self.chunks.extend(first_chunks)
+            self.size = sum([len(chunk) for chunk in first_chunks])
+            self.shared = (content_length is None
+                           or content_length <= self.single_flight.max_size)
+            if not self.shared or self.size > self.single_flight.max_size:
+                self.single_flight.land(self)
+            self.ready = True
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def fail(self):
+        self.cond.acquire()
+        try:
+            self.single_flight.land(self)
+            self.ready = True
+            self.done = True
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def wait_ready(self, timeout):
+        self.cond.acquire()
+        try:
+            if not self.ready:
+                self.cond.wait(timeout)
+            return self.ready and self.app_iter is not None
+        finally:
+            self.cond.release()
+
+    def get(self, reader):
+        """
+        Returns the next chunk of the response for `reader`, or None
+        at the end of it; raises the backend's exception once the
+        reader reaches the point where it failed.
+        """
+        while 1:
+            self.cond.acquire()
+            try:
+                while 1:
+                    index = self.positions[reader] - self.base
+                    if index < len(self.chunks):
+                        chunk = self.chunks[index]
+                        self.positions[reader] += 1
+                        self.trim()
+                        return chunk
+                    if self.done:
+                        if self.error is not None:
+                            raise self.error[0], self.error[1], self.error[2]
+                        return None
+                    if not self.pulling:
+                        self.pulling = True
+                        break
+                    self.cond.wait()
+            finally:
+                self.cond.release()
+            chunk = error = None
+            try:
+                try:
+                    chunk = self.app_iter.next()
+                except StopIteration:
+                    pass
+                except:
+                    error = sys.exc_info()
+            finally:
+                self.cond.acquire()
+                try:
+                    self.pulling = False
+                    if chunk is None:
+                        self.error = error
+                        self.done = True
+                        self.single_flight.land(self)
+                    else:
+                        self.chunks.append(chunk)
+                        self.size += len(chunk)
+                        if (len(self.positions) <= 1 or not self.shared
+                            or self.size > self.single_flight.max_size):
+                            self.single_flight.land(self)
+                    self.cond.notifyAll()
+                finally:
+                    self.cond.release()
+
+    def trim(self):
+        """
+        Drops the chunks every reader has passed, once no more
+        readers can join (with the lock held).
+        """
+        if not self.landed or not self.positions:
+            return
+        passed = min(self.positions.values()) - self.base
+        if passed > 0:
+            del self.chunks[:passed]
+            self.base += passed
+
+    def leave(self, reader):
+        """
+        Called when a request is done with the flight; the last one
+        closes the backend response.
+        """
+        self.cond.acquire()
+        try:
+            del self.positions[reader]
+            last = not self.positions
+            if last:
+                self.single_flight.land(self)
+                self.chunks = []
+            else:
+                self.trim()
+            # Readers waiting on a puller that left can pull themselves
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+        if last and self.app_iter is not None and hasattr(self.closeable,
+                                                          'close'):
+            self.closeable.close()
+
+
+class FlightAppIter(object):
+    """
+    One request's view of a shared response.
+    """
+
+    def __init__(self, flight, reader):
+        self.flight = flight
+        self.reader = reader
+
+    def __iter__(self):
+        flight = self.flight
+        while flight is not None:
+            chunk = flight.get(self.reader)
+            if chunk is None:
+                break
+            yield chunk
+
+    def close(self):
+        flight = self.flight
+        self.flight = None
+        if flight is not None:
+            flight.leave(self.reader)
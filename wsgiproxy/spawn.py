@@ -7,14 +7,29 @@ time of the first request) and closed when this process is closed.
 See SpawningApplication for more.
 """
 
+import fcntl
+import itertools
+import math
+import os
+import shlex
+import signal
+import socket
+import subprocess
+import tempfile
 import threading
 import time
 import weakref
 import atexit
+from paste import httpexceptions
+from wsgiproxy.balancer import ReleasingAppIter
 from wsgiproxy.exactproxy import proxy_exact_request
+from wsgiproxy.pool import default_pool
+from wsgiproxy.instrument import default_instruments, begin, finishing
+from wsgiproxy.prewarm import WarmPolicy
+from wsgiproxy.readiness import make_check, StartupError, StartupTimeout
 import logging
 
-__all__ = ['SpawningApplication']
+__all__ = ['SpawningApplication', 'install_reload_handler']
 
 spawn_inited = False
 spawn_init_lock = threading.Lock()
@@ -43,20 +58,95 @@ class SpawningApplication(object):
     If you give ``spawned_port`` that will be used; otherwise the
     server will look for a free port.
 
+    With ``bind_socket`` this process binds and listens on the port
+    itself, and the subprocess inherits the socket: ``__FD__`` in
+    ``start_script`` is replaced with its file descriptor.  The port
+    can't be taken by anything else in the meantime, and a socket
+    outlives its subprocess, so a subprocess started in its place
+    picks up the connections made while it was starting (they wait in
+    the listen backlog).
+
+    With ``unix_socket`` (a directory, or True for a temporary one)
+    each subprocess listens on a Unix domain socket in that directory
+    instead of a port, which skips TCP for the hop from this process:
+    ``__SOCKET__`` in ``start_script`` is replaced with the socket's
+    path.  This works with ``bind_socket`` too (the socket is then
+    bound here and inherited, as above).
+
     If you give ``idle_shutdown`` then the subprocess will be shut
     down after that many seconds of idle (when there are no requests).
     It will be started up again on the next request.
 
+    To use more than one core, give ``max_processes``: up to that many
+    subprocesses are started (each on its own port), and each request
+    goes to the one with the fewest requests in flight.  A new
+    subprocess is started in the background whenever all of them have
+    ``grow_in_flight`` or more requests in flight; subprocesses beyond
+    ``min_processes`` are shut down after ``shrink_after`` seconds
+    without requests.  ``idle_shutdown`` applies to each subprocess
+    separately.
+
+    A new subprocess gets requests once it is ready, as told by the
+    ``ready`` check: ``connect`` (the default) waits until its port
+    accepts connections (``socket``, the default with
+    ``bind_socket``, only checks that it hasn't exited, since the
+    socket already accepts connections), ``http`` until ``ready_path`` gives a
+    response, and ``stdout`` until it prints a line containing
+    ``ready_line`` (see :mod:`wsgiproxy.readiness`).  If it exits
+    first the request gets a ``502 Bad Gateway``, and if it isn't
+    ready within ``start_timeout`` seconds a ``503 Service
+    Unavailable`` with a Retry-After header.  Startup times are counted in ``stats``.
+
+    To avoid cold starts after quiet periods, ``min_warm`` subprocesses
+    are kept running (despite ``idle_shutdown``), as well as more at
+    the times of day given in ``warm_schedule``, and one while the
+    request rate over ``warm_rate_window`` seconds is at least
+    ``warm_rate`` per second (see :mod:`wsgiproxy.prewarm`).  These
+    are checked every ``warm_interval`` seconds.  Normally a request
+    that arrives when nothing is running waits for a subprocess to
+    start; with ``cold_wait`` the subprocess is started in the
+    background and the request waits at most that many seconds (0 for
+    not at all) before getting a ``503 Service Unavailable`` with a
+    Retry-After header.
+
+    :meth:`reload` (or the signal handler installed with
+    :func:`install_reload_handler`) replaces the subprocesses without
+    dropping requests: new ones are started and given all new
+    requests once ready, and the old ones are shut down after their
+    requests in flight finish.  With ``bind_socket`` each new
+    subprocess inherits the listening socket of the one it replaces
+    (so both accept connections until the old one is shut down, and
+    the ``ready`` check should be one the old subprocess can't answer,
+    like ``socket`` or ``stdout``).  Otherwise the new subprocesses
+    need ports of their own, so a fixed ``spawned_port`` can't be
+    reloaded.  A subprocess that doesn't exit within ``kill_timeout``
+    seconds of SIGTERM is killed.
+
     Note that the Host header will be preserved in the subrequest.
     REMOTE_ADDR is put in X-Forwarded-For, and the scheme is put into
     X-Forwarded-Scheme.  The entire original path is requested, but
     SCRIPT_NAME is put into X-Script-Name.
+
+    Connections to the subprocess are kept alive in
+    ``connection_pool`` (by default the process-wide
+    :data:`wsgiproxy.pool.default_pool`).
+
+    Requests are reported to the subscribers of ``instruments`` (by
+    default :data:`wsgiproxy.instrument.default_instruments`), with the
+    time spent waiting for a subprocess as the ``acquire`` phase.
     """
 
     spawn_port_start = 10000
 
     def __init__(self, start_script, cwd=None, script_env=None, spawned_port=None,
-                 idle_shutdown=None, logger=None):
+                 idle_shutdown=None, logger=None, connection_pool=None,
+                 min_processes=1, max_processes=None, grow_in_flight=2,
+                 shrink_after=30, ready=None, ready_path='/',
+                 ready_line='READY', start_timeout=30, bind_socket=False,
+                 listen_backlog=128, min_warm=0, warm_schedule=None,
+                 warm_rate=None, warm_rate_window=600, warm_interval=5,
+                 cold_wait=None, kill_timeout=10, unix_socket=None,
+                 instruments=None):
         if not spawn_inited:
             spawn_init_lock.acquire()
             try:
@@ -67,89 +157,534 @@ class SpawningApplication(object):
         self.start_script = start_script
         self.cwd = cwd
         self.script_env = script_env
+        if max_processes is None:
+            max_processes = min_processes
+        if max_processes < min_processes or max_processes < 1:
+            raise ValueError(
+                "max_processes (%r) must be at least 1 and min_processes (%r)"
+                % (max_processes, min_processes))
+        if spawned_port is not None and max_processes > 1:
+            raise ValueError(
+                "You cannot give a spawned_port with more than one process")
+        self.min_processes = min_processes
+        self.max_processes = max_processes
+        self.grow_in_flight = grow_in_flight
+        self.shrink_after = shrink_after
         self.spawned_port = spawned_port
         self.spawn_lock = threading.Lock()
-        self.proc = None
+        self.reload_lock = threading.Lock()
+        self.kill_timeout = kill_timeout
+        # Protects children, growing and in_flight counts:
+        self.lock = threading.Lock()
+        # Notified when children are added (or a spawn fails):
+        self.children_changed = threading.Condition(self.lock)
+        self.children = []
+        # Ports given to subprocesses that are running (or starting):
+        self.allocated_ports = set()
+        # Listening sockets not in use by a subprocess:
+        self.free_sockets = []
+        self.bind_socket = bind_socket
+        self.listen_backlog = listen_backlog
+        if unix_socket is True:
+            unix_socket = tempfile.mkdtemp(prefix='wsgiproxy-')
+            self.remove_socket_dir = True
+        else:
+            self.remove_socket_dir = False
+        self.unix_socket = unix_socket
+        self.growing = 0
+        self.counter = itertools.count()
         self.idle_shutdown = idle_shutdown
-        self.idle_shutdown_thread = None
-        self.idle_shutdown_event = None
-        self.last_request = None
+        if ready is None:
+            if bind_socket:
+                ready = 'socket'
+            else:
+                ready = 'connect'
+        self.readiness = make_check(ready, ready_path=ready_path,
+                                    ready_line=ready_line)
+        self.start_timeout = start_timeout
+        self.stats = {'spawned': 0, 'failed': 0, 'last_startup_time': None,
+                      'max_startup_time': 0, 'total_startup_time': 0}
+        if connection_pool is None:
+            connection_pool = default_pool
+        self.connection_pool = connection_pool
+        if instruments is None:
+            instruments = default_instruments
+        self.instruments = instruments
         if logger is None:
             logger = logging.getLogger('wsgifilter.spawn')
         if isinstance(logger, basestring):
             logger = logging.getLogger(logger)
         self.logger = logger
+        self.cold_wait = cold_wait
+        self.warm_policy = WarmPolicy(min_warm, warm_schedule, warm_rate,
+                                      warm_rate_window)
+        self.warm_interval = warm_interval
+        self.stopped = threading.Event()
         apps.append(weakref.ref(self))
+        if self.warm_policy.active():
+            t = threading.Thread(target=_run_keeper,
+                                 args=(weakref.ref(self),))
+            t.setDaemon(True)
+            t.start()
+
+    @property
+    def proc(self):
+        """
+        The ``subprocess.Popen`` object of the (first) subprocess, or
+        None if nothing is running.
+        """
+        children = self.children
+        if not children:
+            return None
+        return children[0].proc
 
     def __call__(self, environ, start_response):
-        if self.proc is None:
-            self.spawn_lock.acquire()
+        event, started_event = begin(environ, 'spawn', self.instruments)
+        exc = None
+        try:
+            child = self.acquire_child()
+        except StartupError, e:
+            # (only when the request waits for the subprocess to start)
+            self.logger.error('Could not start the subprocess: %s' % e)
+            child = None
+            if event is not None:
+                event.error = e
+            if isinstance(e, StartupTimeout):
+                exc = httpexceptions.HTTPServiceUnavailable(
+                    "The application took too long to start",
+                    headers=[('Retry-After',
+                              str(self.expected_startup_time()))])
+            else:
+                exc = httpexceptions.HTTPBadGateway(
+                    "The application failed to start (%s)" % e)
+        if event is not None:
+            event.mark('acquire')
+        if child is None:
+            if exc is None:
+                exc = httpexceptions.HTTPServiceUnavailable(
+                    "The application is starting",
+                    headers=[('Retry-After',
+                              str(self.expected_startup_time()))])
+            if started_event:
+                event.status = exc.code
+                event.finish()
+            return exc(environ, start_response)
+        release = lambda: self.release_child(child)
+        if started_event:
+            release = finishing(event, release)
+        try:
+            app_iter = self.send_to_subprocess(environ, start_response, child)
+        except:
+            release()
+            raise
+        return ReleasingAppIter(app_iter, release)
+
+    def acquire_child(self):
+        """
+        Returns the live subprocess with the fewest requests in flight
+        (spawning subprocesses if there are none), and counts the
+        request against it.
+
+        If ``cold_wait`` is set, subprocesses are spawned in the
+        background and this waits at most that long for one, returning
+        None if there still isn't one.
+        """
+        self.warm_policy.record_request()
+        deadline = None
+        while 1:
+            self.lock.acquire()
             try:
-                if self.proc is None:
-                    self.spawn_subprocess()
+                live, dead = [], []
+                for child in self.children:
+                    if child.alive():
+                        live.append(child)
+                    else:
+                        dead.append(child)
+                for child in dead:
+                    self.children.remove(child)
+                if live:
+                    # Start at a rotating offset so ties are spread around:
+                    start = self.counter.next() % len(live)
+                    best = None
+                    for child in live[start:] + live[:start]:
+                        if best is None or child.in_flight < best.in_flight:
+                            best = child
+                    best.in_flight += 1
+                    best.last_request = time.time()
+                    grow = (best.in_flight > self.grow_in_flight
+                            and len(self.children) + self.growing
+                            < self.max_processes)
+                    if grow:
+                        self.growing += 1
             finally:
-                self.spawn_lock.release()
-        self.send_to_subprocess(environ, start_response)
+                self.lock.release()
+            for child in dead:
+                self.logger.warning('Subprocess PID %s exited with %s'
+                                    % (child.pid, child.returncode))
+                child.close()
+            if live:
+                if grow:
+                    self.grow()
+                return best
+            if self.cold_wait is None:
+                self.spawn_lock.acquire()
+                try:
+                    if not self.children:
+                        self.spawn_subprocesses(self.initial_processes())
+                finally:
+                    self.spawn_lock.release()
+                continue
+            if deadline is None:
+                deadline = time.time() + self.cold_wait
+            self.lock.acquire()
+            try:
+                if self.children:
+                    continue
+                if not self.growing:
+                    spawn = self.initial_processes()
+                    self.growing += spawn
+                    self.grow(spawn)
+                remaining = deadline - time.time()
+                if remaining > 0:
+                    self.children_changed.wait(remaining)
+                if not self.children and (
+                    not self.growing or time.time() >= deadline):
+                    # Still starting (or failed to start)
+                    return None
+            finally:
+                self.lock.release()
+
+    def initial_processes(self):
+        """
+        The number of subprocesses to start when there are none.
+        """
+        return min(self.max_processes,
+                   max(1, self.min_processes, self.warm_policy.warm_count()))
 
-    def send_to_subprocess(self, environ, start_response):
-        ## FIXME: I should use the WSGIProxy proxying code, not
-        ## another copy of it:
+    def expected_startup_time(self):
+        """
+        The average time it has taken to start a subprocess, in whole
+        seconds (at least 1).
+        """
+        stats = self.stats
+        if not stats['spawned']:
+            return 1
+        return max(1, int(math.ceil(
+            stats['total_startup_time'] / stats['spawned'])))
+
+    def keep_warm(self):
+        """
+        Starts subprocesses in the background if there are fewer than
+        the warm policy asks for.
+        """
+        want = min(self.max_processes, self.warm_policy.warm_count())
+        self.lock.acquire()
+        try:
+            have = len([child for child in self.children if child.alive()])
+            missing = want - have - self.growing
+            if missing > 0:
+                self.growing += missing
+        finally:
+            self.lock.release()
+        if missing > 0:
+            self.logger.info('Warming up %s subprocesses' % missing)
+            self.grow(missing)
+
+    def release_child(self, child):
+        self.lock.acquire()
+        try:
+            child.in_flight -= 1
+            child.last_request = time.time()
+            if not child.in_flight:
+                # For drain()
+                self.children_changed.notifyAll()
+        finally:
+            self.lock.release()
+
+    def send_to_subprocess(self, environ, start_response, child=None):
         environ['HTTP_X_SCRIPT_NAME'] = environ.get('SCRIPT_NAME', '')
         environ['HTTP_X_FORWARDED_SCHEME'] = environ['wsgi.url_scheme']
         environ['HTTP_X_FORWARDED_FOR'] = environ['REMOTE_ADDR']
         environ['SERVER_NAME'] = '127.0.0.1'
-        environ['SERVER_PORT'] = str(self.spawned_port)
+        if child is None:
+            port = self.spawned_port
+        else:
+            port = child.port
+            if child.socket_path:
+                environ['wsgiproxy.unix_socket'] = child.socket_path
+                port = 80
+        environ['SERVER_PORT'] = str(port)
+        environ['wsgiproxy.connection_pool'] = self.connection_pool
+        environ['wsgiproxy.instruments'] = self.instruments
         return proxy_exact_request(environ, start_response)
 
+    def spawn_subprocesses(self, count):
+        """
+        Starts `count` subprocesses and waits for them to be ready.
+        """
+        children = self.start_children(count)
+        self.lock.acquire()
+        try:
+            self.children.extend(children)
+            self.children_changed.notifyAll()
+        finally:
+            self.lock.release()
+        self.start_monitors(children)
+
+    def start_children(self, count, sockets=None):
+        """
+        Starts `count` subprocesses, returning them once they are
+        ready (but without giving them any requests).  With
+        ``bind_socket``, `sockets` can give the listening sockets they
+        inherit (see :meth:`start_child`).
+        """
+        children = []
+        if sockets is None:
+            sockets = [None] * count
+        try:
+            for sock in sockets:
+                children.append(self.start_child(sock))
+            for child in children:
+                self.wait_child(child)
+        except:
+            for child in children:
+                child.close()
+            raise
+        return children
+
+    def start_monitors(self, children):
+        if self.idle_shutdown or self.max_processes > self.min_processes:
+            for child in children:
+                child.start_monitor()
+
+    def reload(self, start_script=None, drain_timeout=30):
+        """
+        Replaces the running subprocesses without dropping requests.
+
+        New subprocesses are started (with `start_script`, if given)
+        and, once they are ready, get all new requests.  The old ones
+        are shut down when their requests in flight are done, or after
+        `drain_timeout` seconds.  If the new subprocesses fail to start
+        the old ones are kept and the error is raised.
+
+        With ``bind_socket`` the new subprocesses inherit the old ones'
+        listening sockets.  Without it a ``spawned_port`` can't be
+        shared by the old and new subprocesses, and this raises
+        ValueError.
+        """
+        if (self.spawned_port is not None and not self.bind_socket
+            and not self.unix_socket):
+            raise ValueError(
+                "You cannot reload a subprocess on a fixed spawned_port "
+                "without bind_socket")
+        self.reload_lock.acquire()
+        try:
+            old_script = self.start_script
+            if start_script is not None:
+                self.start_script = start_script
+            replaced = list(self.children)
+            if not replaced:
+                # The next request starts them with the new script
+                return
+            self.logger.info('Reloading %s subprocesses' % len(replaced))
+            sockets = None
+            if self.bind_socket:
+                sockets = [child.socket for child in replaced]
+            try:
+                new_children = self.start_children(len(replaced), sockets)
+            except:
+                self.start_script = old_script
+                raise
+            self.lock.acquire()
+            try:
+                old_children = self.children
+                self.children = new_children
+                for child in replaced:
+                    child.owns_socket = False
+                for child in new_children:
+                    child.owns_socket = True
+                    if child.socket in self.free_sockets:
+                        # Its old subprocess exited in the meantime
+                        self.free_sockets.remove(child.socket)
+                self.children_changed.notifyAll()
+            finally:
+                self.lock.release()
+            self.start_monitors(new_children)
+            self.drain(old_children, drain_timeout)
+        finally:
+            self.reload_lock.release()
+
+    def drain(self, children, timeout=None):
+        """
+        Waits (up to `timeout` seconds) for the requests in flight on
+        `children` to finish, then shuts them down.  The children must
+        already have been taken out of ``children``.
+        """
+        if timeout:
+            deadline = time.time() + timeout
+            self.lock.acquire()
+            try:
+                while 1:
+                    busy = sum([child.in_flight for child in children])
+                    remaining = deadline - time.time()
+                    if not busy or remaining <= 0:
+                        break
+                    self.children_changed.wait(remaining)
+            finally:
+                self.lock.release()
+            if busy:
+                self.logger.warning(
+                    'Shutting down subprocesses with %s requests in flight'
+                    % busy)
+        for child in children:
+            child.close()
+
     def spawn_subprocess(self):
-        self.logger.info('Spawning subprocess with %s' % self.start_script)
-        script = self.start_script
-        if self.spawned_port is None:
-            self.allocate_port()
-        script = script.replace('__PORT__', str(self.spawned_port))
-        self.proc = subprocess.Popen(script, cwd=self.cwd,
-                                env=self.script_env)
-        self.logger.info('Started subprocess with PID %s' % self.proc.pid)
-        if self.idle_shutdown:
-            self.spawn_shutdown_monitor()
-        time_open = time.time()
-        self.wait_open()
-        self.logger.debug('Waited %s seconds for server to start' % (time.time() - time_open))
+        self.spawn_subprocesses(1)
 
-    def spawn_shutdown_monitor(self):
-        if self.idle_shutdown_thread is not None:
-            return
-        self.idle_shutdown_event = threading.Event()
-        # We already have spawn_lock acquired
-        t = threading.Thread(target=self.shutdown_monitor)
+    def grow(self, count=1):
+        """
+        Starts `count` more subprocesses in the background.  The
+        caller must already have added `count` to ``growing``.
+        """
+        t = threading.Thread(target=self._grow, args=(count,))
         t.setDaemon(True)
-        self.idle_shutdown_thread = t
         t.start()
 
-    def shutdown_monitor(self):
-        while 1:
-            now = time.time()
-            if self.proc is None:
-                return
-            if self.last_request is None:
-                wait_time = self.idle_shutdown
-            elif now - self.last_request > self.idle_shutdown:
-                # Should shut down the subprocess
-                self.logger.info('Server idle for %s seconds; shutting down'
-                                 % (now - self.last_request))
-                self.shutdown_subprocess()
-                return
+    def _grow(self, count):
+        try:
+            try:
+                self.spawn_subprocesses(count)
+            except Exception, e:
+                self.logger.exception('Could not start another subprocess')
+        finally:
+            self.lock.acquire()
+            try:
+                self.growing -= count
+                self.children_changed.notifyAll()
+            finally:
+                self.lock.release()
+
+    def start_child(self, inherited=None):
+        """
+        Starts a subprocess (without waiting for it to be ready).  With
+        ``bind_socket`` it listens on `inherited`, the socket of a
+        subprocess that is still running, if that is given.
+        """
+        sock = socket_path = port = None
+        if inherited is not None:
+            sock = inherited
+        elif self.bind_socket:
+            sock = self.listening_socket()
+        if sock is not None:
+            if self.unix_socket:
+                socket_path = sock.getsockname()
             else:
-                wait_time = self.idle_shutdown - (now - self.last_request)
-            self.idle_shutdown_event.wait(wait_time)
+                port = sock.getsockname()[1]
+        elif self.unix_socket:
+            socket_path = self.socket_path()
+        elif self.spawned_port is not None:
+            port = self.spawned_port
+        else:
+            port = self.allocate_port()
+        script = self.start_script.replace('__PORT__', str(port))
+        if socket_path is not None:
+            script = script.replace('__SOCKET__', socket_path)
+        if sock is not None:
+            script = script.replace('__FD__', str(sock.fileno()))
+        self.logger.info('Spawning subprocess with %s' % script)
+        child = SpawnedProcess(self, port)
+        child.socket = sock
+        # (the subprocess it replaces keeps an inherited socket until
+        # the reload is done)
+        child.owns_socket = inherited is None
+        child.socket_path = socket_path
+        popen_args = self.readiness.popen_args()
+        if sock is not None:
+            popen_args['preexec_fn'] = _inherit_fd(sock.fileno())
+        try:
+            child.proc = subprocess.Popen(
+                shlex.split(script), cwd=self.cwd, env=self.script_env,
+                **popen_args)
+        except:
+            if inherited is None:
+                self.release_port(port, sock)
+            raise
+        child.started = time.time()
+        child.pid = child.proc.pid
+        self.logger.info('Started subprocess with PID %s' % child.pid)
+        self.readiness.started(child, self.logger)
+        return child
 
-    def shutdown_subprocess(self):
-        self.spawn_lock.acquire()
+    def wait_child(self, child):
         try:
-            self.close()
-            self.idle_shutdown_thread = None
+            self.wait_open(child)
+        except:
+            self.count_startup(None)
+            child.close()
+            raise
+        startup_time = time.time() - child.started
+        self.count_startup(startup_time)
+        self.logger.debug('Waited %s seconds for server to start'
+                          % startup_time)
+
+    def count_startup(self, startup_time):
+        self.lock.acquire()
+        try:
+            stats = self.stats
+            if startup_time is None:
+                stats['failed'] += 1
+                return
+            stats['spawned'] += 1
+            stats['last_startup_time'] = startup_time
+            stats['total_startup_time'] += startup_time
+            stats['max_startup_time'] = max(stats['max_startup_time'],
+                                            startup_time)
+        finally:
+            self.lock.release()
+
+    def idle_limit(self, child):
+        """
+        The seconds without requests after which `child` is shut down,
+        or None if it isn't shut down for idleness.
+        """
+        limits = []
+        if self.idle_shutdown:
+            limits.append(self.idle_shutdown)
+        if self.shrink_after and len(self.children) > self.min_processes:
+            limits.append(self.shrink_after)
+        if not limits:
+            return None
+        return min(limits)
+
+    def retire_idle(self, child, idle):
+        """
+        Shuts down `child` if it has been idle too long (and, when
+        shrinking, there are more than ``min_processes``).  The warm
+        policy's count of subprocesses is always kept.  Returns true
+        if the child is gone.
+        """
+        warm_count = self.warm_policy.warm_count()
+        self.lock.acquire()
+        try:
+            if child not in self.children:
+                return True
+            if child.in_flight or len(self.children) <= warm_count:
+                return False
+            if self.idle_shutdown and idle >= self.idle_shutdown:
+                reason = 'idle for %i seconds' % idle
+            elif (self.shrink_after and idle >= self.shrink_after
+                  and len(self.children) > self.min_processes):
+                reason = 'not needed'
+            else:
+                return False
+            self.children.remove(child)
         finally:
-            self.spawn_lock.release()
+            self.lock.release()
+        self.logger.info('Subprocess PID %s %s; shutting down'
+                         % (child.pid, reason))
+        child.close()
+        return True
 
     def find_port(self):
         """
@@ -158,6 +693,9 @@ class SpawningApplication(object):
         host = '127.0.0.1'
         port = self.spawn_port_start
         while 1:
+            if port in self.allocated_ports:
+                port += 1
+                continue
             s = socket.socket(
                 socket.AF_INET, socket.SOCK_STREAM)
             try:
@@ -169,38 +707,259 @@ class SpawningApplication(object):
                 self.logger.info('Found free port at %s' % port)
                 return port
 
+    def socket_path(self):
+        """
+        Returns a new path in the ``unix_socket`` directory for a
+        subprocess to listen on.
+        """
+        while 1:
+            path = os.path.join(self.unix_socket, 'spawned-%s-%s.sock'
+                                % (os.getpid(), self.counter.next()))
+            if not os.path.exists(path):
+                return path
+
+    def listening_socket(self):
+        """
+        Returns a socket that is bound and listening, for a subprocess
+        to inherit: one left by a subprocess that has exited, or else
+        a new one (on ``spawned_port``, or a port the OS chooses, or
+        with ``unix_socket`` a new path).
+        """
+        self.lock.acquire()
+        try:
+            if self.free_sockets:
+                return self.free_sockets.pop()
+        finally:
+            self.lock.release()
+        if self.unix_socket:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            address = self.socket_path()
+        else:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            address = ('127.0.0.1', self.spawned_port or 0)
+        sock.bind(address)
+        sock.listen(self.listen_backlog)
+        # Only the subprocess it is meant for inherits it:
+        flags = fcntl.fcntl(sock.fileno(), fcntl.F_GETFD)
+        fcntl.fcntl(sock.fileno(), fcntl.F_SETFD, flags | fcntl.FD_CLOEXEC)
+        self.logger.info('Listening for the subprocess on %s'
+                         % (sock.getsockname(),))
+        return sock
+
+    def release_port(self, port, sock=None):
+        """
+        Called when a subprocess is done with its port (and socket).
+        """
+        self.lock.acquire()
+        try:
+            if sock is not None:
+                # Connections made until the next subprocess takes
+                # the socket wait in its backlog
+                self.free_sockets.append(sock)
+            else:
+                self.allocated_ports.discard(port)
+        finally:
+            self.lock.release()
+
     def allocate_port(self):
-        self.spawned_port = self.find_port()
+        """
+        Finds a free port for a new subprocess.
+        """
+        self.lock.acquire()
+        try:
+            port = self.find_port()
+            self.allocated_ports.add(port)
+            return port
+        finally:
+            self.lock.release()
 
-    def wait_open(self):
-        # servers don't start up *quite* right away, so we give it a
-        # moment to be ready to accept connections
-        while 1:
+    def wait_open(self, child):
+        """
+        Waits for `child` to be ready, raising
+        :exc:`wsgiproxy.readiness.StartupError` if it exits or takes
+        longer than ``start_timeout``.
+        """
+        self.readiness.wait(child, child.started + self.start_timeout)
+
+    def close(self, drain_timeout=None):
+        """
+        Shuts down the subprocesses; with `drain_timeout`, after
+        waiting that long for the requests in flight.
+        """
+        self.stopped.set()
+        self.lock.acquire()
+        try:
+            children = self.children
+            self.children = []
+        finally:
+            self.lock.release()
+        self.drain(children, drain_timeout)
+        self.lock.acquire()
+        try:
+            sockets = self.free_sockets
+            self.free_sockets = []
+        finally:
+            self.lock.release()
+        for sock in sockets:
+            if self.unix_socket:
+                _remove_socket(sock.getsockname())
+            sock.close()
+        if self.remove_socket_dir:
             try:
-                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                sock.connect(('127.0.0.1', self.fcgi_port))
-            except socket.error, e:
+                os.rmdir(self.unix_socket)
+            except OSError:
+                # Something else is still in it
                 pass
+
+    def __del__(self):
+        # (__init__ may have failed before setting everything up)
+        if hasattr(self, 'stopped'):
+            self.close()
+
+
+class SpawnedProcess(object):
+
+    """
+    One subprocess of a :class:`SpawningApplication`.
+    """
+
+    def __init__(self, app, port):
+        self.app = app
+        self.port = port
+        self.proc = None
+        self.socket = None
+        # False while the socket belongs to another subprocess:
+        self.owns_socket = True
+        self.socket_path = None
+        self.pid = None
+        self.returncode = None
+        self.started = None
+        self.in_flight = 0
+        self.last_request = None
+        self.stopped = threading.Event()
+        self.monitor_thread = None
+
+    def alive(self):
+        proc = self.proc
+        if proc is None:
+            return False
+        self.returncode = proc.poll()
+        return self.returncode is None
+
+    def start_monitor(self):
+        t = threading.Thread(target=self.shutdown_monitor)
+        t.setDaemon(True)
+        self.monitor_thread = t
+        t.start()
+
+    def shutdown_monitor(self):
+        while not self.stopped.isSet():
+            limit = self.app.idle_limit(self)
+            if limit is None:
+                # Check again later (the number of processes may change)
+                wait_time = self.app.shrink_after or self.app.idle_shutdown or 10
             else:
-                sock.close()
-                return
-            time.sleep(0.1)
+                idle = time.time() - (self.last_request or self.started)
+                if idle >= limit:
+                    if self.app.retire_idle(self, idle):
+                        return
+                    wait_time = limit
+                else:
+                    wait_time = limit - idle
+            self.stopped.wait(wait_time)
 
     def close(self):
-        if self.proc is not None:
-            self.logger.info('Shutting down PID %s' % self.proc.pid)
-            import signal
+        self.stopped.set()
+        proc = self.proc
+        if proc is None:
+            return
+        self.proc = None
+        if self.owns_socket:
+            self.app.release_port(self.port, self.socket)
+            if self.socket_path and self.socket is None:
+                # (an inherited socket is kept, and removed by the app)
+                _remove_socket(self.socket_path)
+        self.socket = None
+        self.app.logger.info('Shutting down PID %s' % proc.pid)
+        try:
+            os.kill(proc.pid, signal.SIGTERM)
+        except (OSError, IOError):
+            pass
+        else:
+            # Reap it, so it doesn't linger as a zombie
+            t = threading.Thread(target=_reap, args=(
+                proc, self.app.kill_timeout, self.app.logger))
+            t.setDaemon(True)
+            t.start()
+
+def _reap(proc, kill_timeout, logger):
+    # Waits for a process sent SIGTERM, killing it if it doesn't exit
+    # within kill_timeout seconds
+    deadline = time.time() + kill_timeout
+    while proc.poll() is None:
+        if time.time() >= deadline:
+            logger.warning('PID %s did not exit; killing it' % proc.pid)
             try:
-                os.kill(self.proc.pid, signal.SIGTERM)
+                os.kill(proc.pid, signal.SIGKILL)
             except (OSError, IOError):
                 pass
-            self.proc = None
-            if self.idle_shutdown_event:
-                # Trigger shutdown thread to stop:
-                self.idle_shutdown_event.set()
+            proc.wait()
+            return
+        time.sleep(0.05)
 
-    def __del__(self):
-        self.close()
+def _remove_socket(path):
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
+
+def install_reload_handler(signum=signal.SIGHUP, drain_timeout=30):
+    """
+    Makes signal `signum` (SIGHUP by default) gracefully reload the
+    subprocesses of every :class:`SpawningApplication` (see
+    :meth:`SpawningApplication.reload`).  The reload happens in a
+    background thread.
+    """
+    def handle_reload(signo, frame):
+        t = threading.Thread(target=_reload_all, args=(drain_timeout,))
+        t.setDaemon(True)
+        t.start()
+    signal.signal(signum, handle_reload)
+
+def _reload_all(drain_timeout):
+    for app in apps:
+        app = app()
+        if app is None:
+            continue
+        try:
+            app.reload(drain_timeout=drain_timeout)
+        except Exception:
+            app.logger.exception('Reloading subprocesses failed')
+
+def _run_keeper(app_ref):
+    # Keeps the warm policy's subprocesses running; like the health
+    # checker it only holds a weak reference between checks
+    while 1:
+        app = app_ref()
+        if app is None or app.stopped.isSet():
+            return
+        try:
+            app.keep_warm()
+        except Exception:
+            app.logger.exception('Error keeping subprocesses warm')
+        stopped, interval = app.stopped, app.warm_interval
+        del app
+        stopped.wait(interval)
+
+def _inherit_fd(fd):
+    """
+    Returns a ``preexec_fn`` that lets the subprocess inherit `fd`.
+    """
+    def preexec():
+        flags = fcntl.fcntl(fd, fcntl.F_GETFD)
+        fcntl.fcntl(fd, fcntl.F_SETFD, flags & ~fcntl.FD_CLOEXEC)
+    return preexec
 
 def _turn_sigterm_into_systemexit():
     """
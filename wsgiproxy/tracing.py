@@ -0,0 +1,126 @@
+"""
+W3C trace context and ``Server-Timing`` for proxied requests.
+
+With ``trace=True`` :class:`wsgiproxy.app.WSGIProxyApp` takes part in
+the trace of each request, as described by the `Trace Context
+<https://www.w3.org/TR/trace-context/>`_ recommendation: it continues
+the trace in the request's ``traceparent`` header (or starts a new
+one), and sends its own span id to the backend in ``traceparent``.
+Its :class:`TraceContext` is put in ``environ['wsgiproxy.trace']``.
+:class:`wsgiproxy.middleware.WSGIProxyMiddleware` puts the context it
+receives in ``environ['wsgiproxy.trace']`` too, so the backend's spans
+can be made children of the proxy's.
+
+With ``server_timing=True`` the app adds a ``Server-Timing`` response
+header (see :func:`server_timing`) with the time the request spent in
+the proxy, so the proxy's share and the backend's show up together in
+browser tools and APMs.
+"""
+
+import binascii
+import os
+import re
+import time
+
+__all__ = ['TraceContext', 'parse_traceparent', 'server_timing']
+
+# version-trace_id-parent_id-flags (and more fields in later versions):
+_traceparent_re = re.compile(
+    r'^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})(-.*)?$')
+
+invalid_trace_id = '0' * 32
+invalid_span_id = '0' * 16
+
+# The trace-flags bit saying the caller may have recorded the trace:
+FLAG_SAMPLED = 0x01
+
+class TraceContext(object):
+
+    """
+    A position in a trace: the ``trace_id`` (32 hex digits), the
+    ``span_id`` of the current span (16 hex digits), the trace
+    ``flags`` (an integer) and the ``tracestate`` header, if any.
+    """
+
+    def __init__(self, trace_id, span_id, flags=FLAG_SAMPLED,
+                 tracestate=None):
+        self.trace_id = trace_id
+        self.span_id = span_id
+        self.flags = flags
+        self.tracestate = tracestate
+
+    @classmethod
+    def new(cls, sampled=True):
+        """
+        Starts a new trace.
+        """
+        return cls(binascii.hexlify(os.urandom(16)), new_span_id(),
+                   sampled and FLAG_SAMPLED or 0)
+
+    def child(self):
+        """
+        A new span in the same trace.
+        """
+        return self.__class__(self.trace_id, new_span_id(), self.flags,
+                              self.tracestate)
+
+    @property
+    def sampled(self):
+        return bool(self.flags & FLAG_SAMPLED)
+
+    @property
+    def traceparent(self):
+        """
+        The ``traceparent`` header for requests made from this span.
+        """
+        return '00-%s-%s-%02x' % (self.trace_id, self.span_id, self.flags)
+
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, self.traceparent)
+
+def new_span_id():
+    return binascii.hexlify(os.urandom(8))
+
+def parse_traceparent(value, tracestate=None):
+    """
+    Returns the :class:`TraceContext` in a ``traceparent`` header, or
+    None if it is missing or not valid.
+    """
+    if not value:
+        return None
+    match = _traceparent_re.match(value.strip().lower())
+    if match is None:
+        return None
+    version, trace_id, span_id, flags, rest = match.groups()
+    if (version == 'ff' or (version == '00' and rest)
+        or trace_id == invalid_trace_id or span_id == invalid_span_id):
+        return None
+    return TraceContext(trace_id, span_id, int(flags, 16), tracestate)
+
+def server_timing(event, now=None):
+    """
+    Returns a ``Server-Timing`` header value for the request so far,
+    from `event` (a :class:`wsgiproxy.instrument.RequestEvent`), with
+    these metrics (in milliseconds):
+
+    ``queue``
+        Before the proxy started connecting: waiting for a subprocess,
+        choosing a backend and preparing the request.
+
+    ``connect``
+        Looking up and connecting (and TLS) to the backend, if a new
+        connection was made.
+
+    ``upstream``
+        The rest, until the response started (the backend's time,
+        including the network).
+    """
+    if now is None:
+        now = time.time()
+    phases = event.phases
+    queue = phases.get('acquire', 0) + phases.get('prepare', 0)
+    connect = (phases.get('dns', 0) + phases.get('connect', 0)
+               + phases.get('tls', 0))
+    upstream = max(0, now - event.start - queue - connect)
+    return 'queue;dur=%.3f, connect;dur=%.3f, upstream;dur=%.3f' % (
+        queue * 1000, connect * 1000, upstream * 1000)
@@ -3,20 +3,67 @@ from paste.deploy import converters
 def make_app(
     global_conf,
     href=None,
-    secret_file=None):
+    secret_file=None,
+    engine=None,
+    http2=False,
+    balance='round_robin',
+    weights=None,
+    hash_key=None,
+    failure_threshold=5,
+    recovery_time=10,
+    health_check=None,
+    health_interval=10,
+    connect_timeout=None,
+    first_byte_timeout=None,
+    read_timeout=None,
+    total_timeout=None,
+    envelope='auto',
+    trace=False,
+    server_timing=False):
     from wsgiproxy.app import WSGIProxyApp
     if href is None:
         raise ValueError(
             "You must give an href value")
     if secret_file is None and 'secret_file' in global_conf:
         secret_file = global_conf['secret_file']
-    return WSGIProxyApp(href=href, secret_file=secret_file)
+    # Several hrefs can be given, separated by whitespace:
+    hrefs = converters.aslist(href)
+    if len(hrefs) == 1:
+        href = hrefs[0]
+    else:
+        href = hrefs
+    if weights is not None:
+        weights = [int(weight) for weight in converters.aslist(weights)]
+    if envelope != 'auto':
+        envelope = converters.asbool(envelope)
+    return WSGIProxyApp(href=href, secret_file=secret_file, engine=engine,
+                        http2=converters.asbool(http2),
+                        balance=balance, weights=weights, hash_key=hash_key,
+                        failure_threshold=int(failure_threshold),
+                        recovery_time=float(recovery_time),
+                        health_check=health_check,
+                        health_interval=float(health_interval),
+                        connect_timeout=_asfloat(connect_timeout),
+                        first_byte_timeout=_asfloat(first_byte_timeout),
+                        read_timeout=_asfloat(read_timeout),
+                        total_timeout=_asfloat(total_timeout),
+                        envelope=envelope,
+                        trace=converters.asbool(trace),
+                        server_timing=converters.asbool(server_timing))
+
+def _asfloat(value):
+    if value is None:
+        return None
+    return float(value)
 
 def make_middleware(
     app, global_conf,
     secret_file=None,
     trust_ips=None,
-    prefix=None):
+    prefix=None,
+    lazy=False,
+    signature_window=300,
+    secret_reload_interval=5):
     from wsgiproxy.middleware import WSGIProxyMiddleware
     if secret_file is None and 'secret_file' in global_conf:
         secret_file = global_conf['secret_file']
@@ -24,7 +71,55 @@ def make_middleware(
         trust_ips = global_conf['trust_ips']
     trust_ips = converters.aslist(trust_ips)
     return WSGIProxyMiddleware(app, secret_file=secret_file,
-                               trust_ips=trust_ips)
+                               trust_ips=trust_ips,
+                               lazy=converters.asbool(lazy),
+                               signature_window=int(signature_window),
+                               secret_reload_interval=int(
+                                   secret_reload_interval))
+
+def make_cache(
+    app, global_conf,
+    max_bytes=64*1024*1024,
+    directory=None,
+    max_object_size=1024*1024,
+    stale_while_revalidate=0):
+    from wsgiproxy.cache import CachingMiddleware
+    return CachingMiddleware(app, max_bytes=int(max_bytes),
+                             directory=directory,
+                             max_object_size=int(max_object_size),
+                             stale_while_revalidate=float(stale_while_revalidate))
+
+def make_single_flight(
+    app, global_conf,
+    vary=None,
+    max_size=1024*1024,
+    timeout=30):
+    from wsgiproxy.singleflight import SingleFlight, default_vary
+    if vary is None:
+        vary = default_vary
+    else:
+        vary = converters.aslist(vary)
+    return SingleFlight(app, vary=vary, max_size=int(max_size),
+                        timeout=float(timeout))
+
+def make_compress(
+    app, global_conf,
+    min_size=1024,
+    level=6,
+    window_bits=15,
+    brotli=True,
+    types=None,
+    upstream_gzip=False):
+    from wsgiproxy.compress import CompressingMiddleware, compressible_types
+    if types is None:
+        types = compressible_types
+    else:
+        types = converters.aslist(types)
+    return CompressingMiddleware(app, min_size=int(min_size), level=int(level),
+                                 window_bits=int(window_bits),
+                                 brotli=converters.asbool(brotli),
+                                 types=types,
+                                 upstream_gzip=converters.asbool(upstream_gzip))
 
 def make_real_proxy(global_conf):
     from wsgiproxy import exactproxy